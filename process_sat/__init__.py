@@ -0,0 +1,7 @@
+'''
+WHIPS: customized regridding of level 2 satellite data to level 3.
+
+Runs may be made from Python with run or a Pipeline (see pipeline.py)
+as well as from the command line with whips.py.
+'''
+from pipeline import run, prepare, Pipeline, ConfigError
@@ -0,0 +1,244 @@
+'''
+Storage for the gridded arrays of the averaging output functions.
+
+The averaging output functions accumulate sums (or averages) for
+every gridcell and field in arrays of shape (nRows, nCols, ...).
+On a fine grid with layered fields these can exceed the memory of
+the machine.  The arrays are therefore allocated through an
+accumulator backend:
+
+    memory - ordinary numpy arrays (the default)
+    memmap - arrays memory mapped from scratch files, so that only
+             the parts in use need be in memory.  The scratch files
+             are deleted when the backend is closed.
+
+Updates are made in order of gridcell (see add_sorted) so that
+writes sweep through the arrays sequentially, and the final arrays
+are written out a block of rows at a time (see row_blocks) rather
+than all at once.  Backends may be used as context managers, closing
+on exit.
+
+The arrays have one row per gridcell kept, as given by a CellIndex.
+A dense index keeps every cell of the grid.  When the pixels only
+touch a small fraction of the grid (IE a regional composite on a
+global grid) a sparse index keeps just the cells touched, in order,
+so that both the arrays and the output follow the data observed.
+See cell_index.
+
+Because the arrays hold sums, the arrays of a coarser grid whose
+cells are blocks of whole cells are their block sums (see coarsen).
+'''
+import os
+import shutil
+import tempfile
+
+import numpy
+
+import pixel_table
+
+# size in bytes of the blocks of rows written at a time by backends
+# that do not hold their arrays in memory
+BLOCK_BYTES = 64*2**20
+
+class MemoryAccumulators(object):
+    '''Accumulator arrays held in memory.  scratchDir is ignored'''
+    inMemory = True
+    def __init__(self, scratchDir=None):
+        pass
+    def zeros(self, shape):
+        '''A new float64 array of shape, filled with zeros'''
+        return numpy.zeros(shape)
+    def close(self):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class MemmapAccumulators(MemoryAccumulators):
+    '''
+    Accumulator arrays memory mapped from scratch files, created in
+    a new directory within scratchDir (the system temporary directory
+    if None).  The directory is removed on close.
+    '''
+    inMemory = False
+    def __init__(self, scratchDir=None):
+        self.dir = tempfile.mkdtemp(prefix='whips_accum_', dir=scratchDir)
+        self._nArrays = 0
+    def zeros(self, shape):
+        '''
+        A new float64 array of shape, filled with zeros.  The scratch
+        file is sparse until written, so this costs neither time nor
+        disk space up front
+        '''
+        path = os.path.join(self.dir, 'accum{0}.dat'.format(self._nArrays))
+        self._nArrays += 1
+        return numpy.memmap(path, dtype=numpy.float64, mode='w+',
+                            shape=tuple(shape))
+    def close(self):
+        if os.path.isdir(self.dir):
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+BACKENDS = {'memory' : MemoryAccumulators,
+            'memmap' : MemmapAccumulators}
+
+def get_backend(name, scratchDir=None):
+    '''
+    Instantiate the accumulator backend called name.  Raises
+    ValueError if there is no such backend
+    '''
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError('Invalid accumulator {0}.  Must be one of {1}'.format(
+            name, ', '.join(sorted(BACKENDS.keys()))))
+    return backend(scratchDir)
+
+def add_sorted(target, groups, values):
+    '''
+    Add values (one row per element) into the rows of target given
+    by groups, in order of group.  The sort is stable, so the rows
+    of each group are added in their original order and the sums are
+    identical to those of pixel_table.group_sum.  target may be any
+    array (or memory map) with the groups along its first axis.
+    '''
+    groups = numpy.asarray(groups)
+    order = numpy.argsort(groups, kind='mergesort')
+    return pixel_table.group_sum(groups[order], numpy.asarray(values)[order],
+                                 target.shape[0], out=target)
+
+def row_blocks(backend, nRows, rowBytes):
+    '''
+    Slices covering rows 0 to nRows, to be processed one at a time.
+    rowBytes is the size of a row of the arrays processed together.
+    Backends holding their arrays in memory take every row at once.
+    '''
+    if backend.inMemory:
+        return [slice(0, nRows)]
+    step = max(1, int(BLOCK_BYTES // max(rowBytes, 1)))
+    return [slice(first, min(first + step, nRows))
+            for first in range(0, nRows, step)]
+
+class CellIndex(object):
+    '''
+    The gridcells kept by a set of accumulator arrays, which have one
+    row per cell kept.  Cells are identified by their flat index
+    (row*nCols + col, with row and col counted from the first row and
+    column of the grid).  A dense index (cells is None) keeps every
+    cell of the nRows x nCols grid.  A sparse index keeps only cells,
+    which must be sorted and unique.
+    '''
+    def __init__(self, nRows, nCols, cells=None):
+        self.nRows = nRows
+        self.nCols = nCols
+        self.sparse = cells is not None
+        if self.sparse:
+            self.cells = numpy.asarray(cells, dtype=numpy.int64)
+            self.nCells = self.cells.size
+        else:
+            self.cells = None
+            self.nCells = nRows*nCols
+    def density(self):
+        '''The fraction of the cells of the grid that are kept'''
+        return float(self.nCells)/max(self.nRows*self.nCols, 1)
+    def rows(self, flatInd):
+        '''The rows of the arrays for cells given by flat index'''
+        if not self.sparse:
+            return flatInd
+        return numpy.searchsorted(self.cells, flatInd)
+    def blocks(self, backend, rowBytes):
+        '''
+        (arrayRows, fileRows) slices for writing the arrays out a block
+        at a time (see row_blocks).  rowBytes is the size of a row of
+        the arrays.  arrayRows selects the rows of the arrays and
+        fileRows the matching slice of the first axis of the output
+        variables, which is the grid rows for a dense index and the
+        cells kept for a sparse one.  Use to_file to shape each block
+        of the arrays like the output.
+        '''
+        if self.sparse:
+            return [(rows, rows) for rows in 
+                    row_blocks(backend, self.nCells, rowBytes)]
+        return [(slice(rows.start*self.nCols, rows.stop*self.nCols), rows)
+                for rows in row_blocks(backend, self.nRows, 
+                                       rowBytes*self.nCols)]
+    def to_file(self, block):
+        '''Shape a block of the arrays like the output variables'''
+        if self.sparse:
+            return block
+        return block.reshape((-1, self.nCols) + block.shape[1:])
+
+def touched_cells(maps, (minRow, maxRow, minCol, maxCol)):
+    '''
+    The sorted flat indices (see CellIndex) of the cells of the grid
+    with index limits given that hold at least one pixel in any of
+    maps.  Only the cells stored in each map are visited.
+    '''
+    nCols = maxCol - minCol + 1
+    cells = set()
+    for map in maps:
+        for (cell, pixTups) in map.iteritems():
+            if cell != 'parser' and pixTups:
+                cells.add((cell[0] - minRow)*nCols + (cell[1] - minCol))
+    return numpy.array(sorted(cells), dtype=numpy.int64)
+
+def cell_index(maps, lims, maxDensity=None):
+    '''
+    The CellIndex for accumulating maps onto the grid with index
+    limits lims.  If maxDensity is given and the cells touched by the
+    maps make up at most that fraction of the grid, the index is
+    sparse and keeps only those cells.  Otherwise it is dense.
+    '''
+    (minRow, maxRow, minCol, maxCol) = lims
+    (nRows, nCols) = (maxRow - minRow + 1, maxCol - minCol + 1)
+    if maxDensity is None:
+        return CellIndex(nRows, nCols)
+    cells = touched_cells(maps, lims)
+    if cells.size > maxDensity*nRows*nCols:
+        return CellIndex(nRows, nCols)
+    return CellIndex(nRows, nCols, cells)
+
+def _map_arrays(func, arrays):
+    '''Apply func to every array in arrays, a (nested) dict or list of them'''
+    if isinstance(arrays, dict):
+        return dict([(key, _map_arrays(func, val)) 
+                     for (key, val) in arrays.iteritems()])
+    if isinstance(arrays, (list, tuple)):
+        return type(arrays)([_map_arrays(func, val) for val in arrays])
+    return func(arrays)
+
+def coarsen(index, backend, factor, arrays):
+    '''
+    Sum arrays, which have one row per cell of index, over blocks of
+    factor x factor cells of the grid.  Sums (IE of weights and of
+    weighted values) over the cells of each block are exactly the sums
+    over the pixels of the coarser cell, so averages of the coarser
+    grid follow exactly.  arrays may be a (nested) dict or list of 
+    arrays.  Returns (the dense CellIndex of the coarser grid, the 
+    sums, with the same structure as arrays and allocated by backend).
+    Raises ValueError if the grid is not a whole number of blocks.
+    '''
+    if index.nRows % factor or index.nCols % factor:
+        raise ValueError('A grid of {0} x {1} cells cannot be coarsened by a '
+                         'factor of {2}'.format(index.nRows, index.nCols, 
+                                                factor))
+    coarse = CellIndex(index.nRows // factor, index.nCols // factor)
+    pairs = []
+    def allocate(arr):
+        out = backend.zeros((coarse.nCells,) + arr.shape[1:])
+        pairs.append((arr, out))
+        return out
+    coarseArrays = _map_arrays(allocate, arrays)
+    rowBytes = sum([arr.nbytes // max(index.nCells, 1) for (arr, unused_out)
+                    in pairs])
+    for (rows, unused_fileRows) in index.blocks(backend, rowBytes):
+        if index.sparse:
+            cells = index.cells[rows]
+        else:
+            cells = numpy.arange(rows.start, rows.stop)
+        (row, col) = divmod(cells, index.nCols)
+        keys = (row // factor)*coarse.nCols + col // factor
+        for (arr, out) in pairs:
+            add_sorted(out, keys, numpy.asarray(arr[rows]))
+    return (coarse, coarseArrays)
@@ -0,0 +1,290 @@
+'''
+Persistent catalog of input granules.
+
+Opening every file in a directory only to find that its
+time range lies outside the requested window, or that its
+swath never crosses the grid, is wasteful.  The catalog
+records the time range and lat/lon bounding box of each
+granule in an SQLite database so that later runs can pick
+the granules they need before opening any file.
+
+The catalog is updated incrementally.  A granule is only
+read when it is new, or when its size or modification
+time has changed since it was catalogued.  Metadata is
+taken from the ECS core metadata of HDFEOS files where
+possible, and otherwise from the granule itself through
+its parser.
+
+Granules whose time range or extent could not be
+determined (including files that could not be opened) are
+always selected, so that they are handled exactly as they
+would be without a catalog.
+
+Longitude extents are stored as an interval [lonMin, lonMax]
+with lonMin in (-180, 180] and lonMax possibly greater than
+180, so that swaths crossing the dateline have a compact
+extent.
+'''
+import os
+import sqlite3
+
+import numpy
+
+import parse_geo
+import utils
+
+# default file name of the catalog within the data directory
+DEFAULT_NAME = 'whips_catalog.sqlite'
+
+# epoch and format used for times in the catalog (TAI93, as in
+# the time parameters of the output functions)
+TAI93_EPOCH = '1993-01-01 00:00:00'
+META_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# padding added to the extent of each granule, in degrees of
+# latitude, since the extent is computed from the pixel centers
+EXTENT_PAD = 2.0
+
+_SCHEMA = '''CREATE TABLE IF NOT EXISTS granules (
+                 path TEXT NOT NULL,
+                 filetype TEXT NOT NULL,
+                 size INTEGER,
+                 mtime REAL,
+                 orbit INTEGER,
+                 timeStart REAL,
+                 timeStop REAL,
+                 latMin REAL,
+                 latMax REAL,
+                 lonMin REAL,
+                 lonMax REAL,
+                 PRIMARY KEY (path, filetype))'''
+
+def parse_odl_values(text):
+    '''
+    Return a dictionary of the VALUE of every OBJECT in a block
+    of ODL (the format of ECS metadata), keyed by object name.
+    Values are left as strings, with any quotes removed.
+    '''
+    values = dict()
+    stack = []
+    for line in text.splitlines():
+        (key, sep, val) = line.partition('=')
+        if not sep:
+            continue
+        key = key.strip().upper()
+        val = val.strip()
+        if key in ('OBJECT', 'GROUP'):
+            stack.append(val.upper())
+        elif key in ('END_OBJECT', 'END_GROUP'):
+            if stack:
+                stack.pop()
+        elif key == 'VALUE' and stack:
+            values.setdefault(stack[-1], val.strip('"'))
+    return values
+
+def metadata_times(values):
+    '''
+    Time range of a granule from its parsed core metadata, in
+    TAI93 seconds.  Returns (None, None) if it is not present
+    '''
+    times = []
+    for which in ('BEGINNING', 'ENDING'):
+        try:
+            date = values['RANGE'+which+'DATE']
+            clock = values['RANGE'+which+'TIME']
+        except KeyError:
+            return (None, None)
+        (whole, unused_sep, frac) = clock.partition('.')
+        try:
+            secs = utils.timestr_to_nsecs(date+' '+whole, TAI93_EPOCH,
+                                          META_FORMAT)
+            times.append(secs + float('0.'+(frac.rstrip('Z') or '0')))
+        except ValueError:
+            return (None, None)
+    return tuple(times)
+
+def metadata_extent(values):
+    '''
+    Bounding box of a granule from its parsed core metadata as
+    (latMin, latMax, lonMin, lonMax).  Returns None if it is not
+    present
+    '''
+    try:
+        bounds = [float(values[name+'BOUNDINGCOORDINATE']) for name in
+                  ('SOUTH', 'NORTH', 'WEST', 'EAST')]
+    except (KeyError, ValueError):
+        return None
+    (south, north, west, east) = bounds
+    west = float(utils.wrap_lon_neg180_180(west))
+    east = west + numpy.mod(east - west, 360)
+    return (south, north, west, east)
+
+def lon_interval(lon):
+    '''
+    The smallest interval [lonMin, lonMax] (see module docstring)
+    containing every longitude in lon, which may wrap.  NaN's are
+    ignored.  Returns None if there are no valid longitudes
+    '''
+    lon = numpy.asarray(lon, dtype=numpy.float64).ravel()
+    lon = numpy.sort(utils.wrap_lon_0_360(lon[numpy.isfinite(lon)]))
+    if lon.size == 0:
+        return None
+    # the interval is the circle less its largest gap
+    gaps = numpy.diff(numpy.concatenate([lon, [lon[0]+360]]))
+    i = numpy.argmax(gaps)
+    lonMin = float(utils.wrap_lon_neg180_180(lon[(i+1) % lon.size]))
+    return (lonMin, lonMin + 360 - gaps[i])
+
+def pad_extent((latMin, latMax, lonMin, lonMax), pad):
+    '''Widen an extent by pad degrees of latitude in every direction'''
+    latMin = max(-90.0, latMin - pad)
+    latMax = min(90.0, latMax + pad)
+    # a degree of longitude is shorter away from the equator
+    cosLat = numpy.cos(numpy.radians(max(abs(latMin), abs(latMax))))
+    lonPad = pad/cosLat if cosLat > pad/180.0 else 180.0
+    if lonMax - lonMin + 2*lonPad >= 360:
+        return (latMin, latMax, -180.0, 180.0)
+    return (latMin, latMax, lonMin - lonPad, lonMax + lonPad)
+
+def extents_overlap((latMin1, latMax1, lonMin1, lonMax1),
+                    (latMin2, latMax2, lonMin2, lonMax2)):
+    '''Whether two extents (latMin, latMax, lonMin, lonMax) overlap'''
+    if latMin1 > latMax2 or latMin2 > latMax1:
+        return False
+    for shift in (-360, 0, 360):
+        if lonMin1 <= lonMax2 + shift and lonMin2 + shift <= lonMax1:
+            return True
+    return False
+
+def grid_extent(griddef):
+    '''
+    The extent (latMin, latMax, lonMin, lonMax) of the grid defined
+    by griddef, found from the lat/lon of the edges of the grid
+    '''
+    (minRow, maxRow, minCol, maxCol) = griddef.indLims()
+    rows = numpy.linspace(minRow, maxRow+1, 4*(maxRow-minRow+1)+1)
+    cols = numpy.linspace(minCol, maxCol+1, 4*(maxCol-minCol+1)+1)
+    edgeRows = numpy.concatenate([rows, rows,
+                                  numpy.repeat(rows[0], cols.size),
+                                  numpy.repeat(rows[-1], cols.size)])
+    edgeCols = numpy.concatenate([numpy.repeat(cols[0], rows.size),
+                                  numpy.repeat(cols[-1], rows.size),
+                                  cols, cols])
+    (lat, lon) = griddef.griddedToGeo(edgeRows, edgeCols)
+    (lonMin, lonMax) = lon_interval(lon)
+    return (float(numpy.nanmin(lat)), float(numpy.nanmax(lat)),
+            lonMin, lonMax)
+
+class GranuleCatalog:
+    '''
+    SQLite catalog of granules, stored in the file dbPath.
+
+    The catalog may be used as a context manager, closing the
+    database on exit.
+    '''
+    def __init__(self, dbPath):
+        self.path = dbPath
+        self._conn = sqlite3.connect(dbPath)
+        with self._conn:
+            self._conn.execute(_SCHEMA)
+    def close(self):
+        self._conn.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    def _stale(self, files, filetype):
+        '''The files that are not catalogued or have changed since'''
+        stale = []
+        for f in files:
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            row = self._conn.execute('SELECT size, mtime FROM granules WHERE '
+                                     'path = ? AND filetype = ?',
+                                     (os.path.abspath(f), filetype)).fetchone()
+            if row is None or row != (stat.st_size, stat.st_mtime):
+                stale.append((f, stat))
+        return stale
+    def update(self, files, filetype, openParser, timeField=None,
+               verbose=False):
+        '''
+        Catalog every file in files that is new or has changed.
+
+        openParser is called with the path of a file and should
+        return its parser (or raise an exception).  It is only used
+        when the core metadata of the file does not give its time
+        range and extent.  If timeField is given, the time range
+        is then read from that field.
+        '''
+        for (f, stat) in self._stale(files, filetype):
+            if verbose:
+                print('Cataloguing {0}'.format(f))
+            (orbit, times, extent) = self._describe(f, openParser, timeField)
+            with self._conn:
+                self._conn.execute('INSERT OR REPLACE INTO granules VALUES '
+                                   '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (os.path.abspath(f), filetype,
+                                    stat.st_size, stat.st_mtime, orbit) +
+                                   tuple(times) + tuple(extent))
+    def _describe(self, f, openParser, timeField):
+        '''Orbit number, time range and extent of a granule'''
+        orbit = None
+        times = (None, None)
+        extent = None
+        try:
+            values = parse_odl_values(parse_geo.getCoreMetadata(f))
+        except Exception:
+            values = dict()
+        try:
+            orbit = int(values['ORBITNUMBER'])
+        except (KeyError, ValueError):
+            pass
+        times = metadata_times(values)
+        extent = metadata_extent(values)
+        if extent is None or (times[0] is None and timeField is not None):
+            try:
+                parser = openParser(f)
+                if extent is None:
+                    centers = parser.get_geo_centers()
+                    lonLims = lon_interval(centers['lon'])
+                    if lonLims is not None:
+                        extent = (float(numpy.nanmin(centers['lat'])),
+                                  float(numpy.nanmax(centers['lat']))) + \
+                                 lonLims
+                        extent = pad_extent(extent, EXTENT_PAD)
+                if times[0] is None and timeField is not None:
+                    t = numpy.asarray(parser.get(timeField), dtype=numpy.float64)
+                    if numpy.isfinite(t).any():
+                        times = (float(numpy.nanmin(t)), float(numpy.nanmax(t)))
+            except Exception:
+                # leave whatever is unknown for the run to deal with
+                pass
+        return (orbit, times, extent or (None, None, None, None))
+    def select(self, files, filetype, window=None, extents=None):
+        '''
+        Return the files (in their original order) that might contain
+        data within the time window (timeStart, timeStop) and overlapping
+        any of extents, a list of (latMin, latMax, lonMin, lonMax).  Either
+        may be None to skip that test.  Files that are not catalogued,
+        or whose time range or extent is unknown, are always selected
+        '''
+        selected = []
+        for f in files:
+            row = self._conn.execute('SELECT timeStart, timeStop, latMin, '
+                                     'latMax, lonMin, lonMax FROM granules '
+                                     'WHERE path = ? AND filetype = ?',
+                                     (os.path.abspath(f), filetype)).fetchone()
+            if row is None:
+                selected.append(f)
+                continue
+            (tStart, tStop) = row[:2]
+            if (window is not None and tStart is not None and
+                (tStop < window[0] or tStart > window[1])):
+                continue
+            if (extents is not None and row[2] is not None and
+                not any([extents_overlap(row[2:], ext) for ext in extents])):
+                continue
+            selected.append(f)
+        return selected
@@ -0,0 +1,219 @@
+'''
+One-pass weighted statistics of the values in each gridcell.
+
+Besides their averages, the averaging output functions can report
+the spread and extremes of the values in every cell.  Statistics
+are accumulated for many keys (IE gridcells, or gridcells and
+layers) at once from batches of values, so they are computed in the
+same vectorized pass as the averages.  Available are
+
+    variance  - the weighted variance about the weighted mean
+    std       - its square root
+    min, max  - the smallest and largest value
+    histogram - the number of values in each of a fixed set of bins
+
+Variances are accumulated as (sum of weights, weighted mean, sum of
+weighted squared deviations) and updated with the pairwise formula
+of Chan et al., which stays accurate when the mean is large compared
+with the spread.  Every statistic is therefore mergeable: statistics
+accumulated from separate batches (or separate runs) combine exactly
+as if the values had been added together (see merge).  So that runs
+can be merged later, the moment state is written out alongside the
+variance and std, and statistics are rebuilt from what was written
+with CellStatistics.from_results.
+
+Values that are NaN, or whose weight is NaN or not positive, are
+ignored.  The arrays are allocated through an accumulator backend
+(see accumulators.py).
+'''
+import numpy
+
+# the statistics that may be requested, in the order they are written
+STATISTICS = ('variance', 'std', 'min', 'max', 'histogram')
+
+# the moment state behind the variance and std, written after them
+MOMENT_STATE = ('sumWght', 'mean', 'sqDev')
+
+def check_statistics(stats, binEdges=None):
+    '''
+    Raise ValueError unless stats are all valid statistics and, if a
+    histogram is requested, binEdges are at least 2 increasing values
+    '''
+    invalid = [stat for stat in stats if stat not in STATISTICS]
+    if invalid:
+        raise ValueError('Invalid statistics {0}.  Must be among {1}'.format(
+            ', '.join(invalid), ', '.join(STATISTICS)))
+    if 'histogram' in stats:
+        if binEdges is None or len(binEdges) < 2 or \
+           not numpy.all(numpy.diff(binEdges) > 0):
+            raise ValueError('A histogram needs at least 2 increasing bin '
+                             'edges')
+
+class CellStatistics(object):
+    '''
+    The statistics stats (see STATISTICS) for each of nKeys keys.
+    binEdges are the edges of the histogram bins.  Values equal to
+    the last edge fall in the last bin, as for numpy.histogram.
+    '''
+    def __init__(self, backend, nKeys, stats, binEdges=None):
+        check_statistics(stats, binEdges)
+        self.stats = [stat for stat in STATISTICS if stat in stats]
+        self.nKeys = nKeys
+        self.moments = 'variance' in stats or 'std' in stats
+        if self.moments:
+            self.sumWght = backend.zeros((nKeys,))
+            self.mean = backend.zeros((nKeys,))
+            self.sqDev = backend.zeros((nKeys,))
+        if 'min' in stats:
+            self.min = backend.zeros((nKeys,))
+            self.min.fill(numpy.inf)
+        if 'max' in stats:
+            self.max = backend.zeros((nKeys,))
+            self.max.fill(-numpy.inf)
+        if 'histogram' in stats:
+            self.binEdges = numpy.asarray(binEdges, dtype=numpy.float64)
+            self.hist = backend.zeros((nKeys, self.binEdges.size - 1))
+    @staticmethod
+    def from_results(backend, stats, results, binEdges=None, 
+                     fillVal=numpy.NaN):
+        '''
+        Rebuild the statistics stats from results (see results), IE as
+        read back from an output file, with fillVal for keys without
+        values, so that they can be merged with others.  Each element
+        of the results (each row, for histograms) is a key.  The
+        results must include the moment state (see MOMENT_STATE) if
+        stats include variance or std.
+        '''
+        arrays = dict([(name, numpy.asarray(vals, dtype=numpy.float64))
+                       for (name, vals) in results.iteritems()])
+        if 'histogram' in arrays:
+            arrays['histogram'] = arrays['histogram'].reshape(
+                -1, len(binEdges) - 1)
+            nKeys = arrays['histogram'].shape[0]
+        else:
+            nKeys = arrays.values()[0].size
+        cellStats = CellStatistics(backend, nKeys, stats, binEdges)
+        if cellStats.moments:
+            (wght, mean, sqDev) = [arrays[name].ravel() 
+                                   for name in MOMENT_STATE]
+            keys = numpy.flatnonzero(wght > 0)
+            cellStats._merge_moments(keys, wght[keys], mean[keys], 
+                                     sqDev[keys])
+        for (stat, empty) in (('min', numpy.inf), ('max', -numpy.inf)):
+            if stat in cellStats.stats:
+                vals = arrays[stat].ravel()
+                missing = numpy.isnan(vals) | (vals == fillVal)
+                getattr(cellStats, stat)[:] = numpy.where(missing, empty, 
+                                                          vals)
+        if 'histogram' in cellStats.stats:
+            cellStats.hist[:] = arrays['histogram']
+        return cellStats
+    def outputs(self):
+        '''
+        The names of the arrays returned by results: the statistics,
+        then the moment state if variance or std are kept
+        '''
+        return self.stats + (list(MOMENT_STATE) if self.moments else [])
+    def nbytes(self):
+        '''The total size of the arrays, in bytes'''
+        arrays = [getattr(self, name) for name in ('sumWght', 'mean', 'sqDev',
+                                                   'min', 'max', 'hist')
+                  if hasattr(self, name)]
+        return sum([arr.nbytes for arr in arrays])
+    def add(self, keys, values, weights=None):
+        '''
+        Add values to the statistics of keys (one key per value) with
+        weights (default 1).  keys, values and weights must have the
+        same shape.
+        '''
+        keys = numpy.asarray(keys, dtype=numpy.int64).ravel()
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        if weights is None:
+            weights = numpy.ones(values.shape)
+        weights = numpy.asarray(weights, dtype=numpy.float64).ravel()
+        with numpy.errstate(invalid='ignore'):
+            use = numpy.logical_not(numpy.isnan(values)) & (weights > 0)
+        # sort by key so that every key is a contiguous run
+        order = numpy.argsort(keys[use], kind='mergesort')
+        (keys, values, weights) = (keys[use][order], values[use][order],
+                                   weights[use][order])
+        if not keys.size:
+            return
+        (touched, start) = numpy.unique(keys, return_index=True)
+        if self.moments:
+            group = numpy.searchsorted(touched, keys)
+            batchWght = numpy.add.reduceat(weights, start)
+            batchMean = numpy.add.reduceat(weights*values, start)/batchWght
+            batchSqDev = numpy.add.reduceat(
+                weights*(values - batchMean[group])**2, start)
+            self._merge_moments(touched, batchWght, batchMean, batchSqDev)
+        if 'min' in self.stats:
+            self.min[touched] = numpy.minimum(
+                self.min[touched], numpy.minimum.reduceat(values, start))
+        if 'max' in self.stats:
+            self.max[touched] = numpy.maximum(
+                self.max[touched], numpy.maximum.reduceat(values, start))
+        if 'histogram' in self.stats:
+            nBins = self.binEdges.size - 1
+            bins = numpy.searchsorted(self.binEdges, values, 'right') - 1
+            bins[values == self.binEdges[-1]] = nBins - 1
+            inRange = (bins >= 0) & (bins < nBins)
+            flat = self.hist.reshape(-1)
+            numpy.add.at(flat, keys[inRange]*nBins + bins[inRange], 1)
+    def _merge_moments(self, keys, wght, mean, sqDev):
+        '''Combine (sum of weights, mean, squared deviations) into keys'''
+        oldWght = numpy.asarray(self.sumWght[keys])
+        oldMean = numpy.asarray(self.mean[keys])
+        total = oldWght + wght
+        delta = mean - oldMean
+        self.mean[keys] = oldMean + delta*wght/total
+        self.sqDev[keys] = numpy.asarray(self.sqDev[keys]) + sqDev + \
+            delta**2*oldWght*wght/total
+        self.sumWght[keys] = total
+    def merge(self, other):
+        '''
+        Combine the statistics of other, kept for the same keys and
+        statistics, into these
+        '''
+        if self.moments:
+            keys = numpy.flatnonzero(numpy.asarray(other.sumWght) > 0)
+            self._merge_moments(keys, numpy.asarray(other.sumWght[keys]),
+                                numpy.asarray(other.mean[keys]),
+                                numpy.asarray(other.sqDev[keys]))
+        if 'min' in self.stats:
+            self.min[:] = numpy.minimum(self.min, other.min)
+        if 'max' in self.stats:
+            self.max[:] = numpy.maximum(self.max, other.max)
+        if 'histogram' in self.stats:
+            self.hist[:] = self.hist + other.hist
+    def results(self, rows, fillVal=numpy.NaN):
+        '''
+        Dictionary of the statistics for rows (a slice of the keys),
+        with fillVal for keys without values, and of the moment state
+        (see outputs).  Histograms have the bins along their last axis
+        and, like the sums of weights, are never filled.
+        '''
+        out = dict()
+        if self.moments:
+            wght = numpy.asarray(self.sumWght[rows])
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                variance = numpy.where(wght > 0,
+                                       numpy.asarray(self.sqDev[rows])/wght,
+                                       fillVal)
+            out['sumWght'] = wght
+            for name in ('mean', 'sqDev'):
+                vals = numpy.asarray(getattr(self, name)[rows])
+                out[name] = numpy.where(wght > 0, vals, fillVal)
+            if 'variance' in self.stats:
+                out['variance'] = variance
+            if 'std' in self.stats:
+                out['std'] = numpy.where(wght > 0,
+                                         numpy.sqrt(numpy.abs(variance)),
+                                         fillVal)
+        for stat in ('min', 'max'):
+            if stat in self.stats:
+                vals = numpy.asarray(getattr(self, stat)[rows])
+                out[stat] = numpy.where(numpy.isinf(vals), fillVal, vals)
+        if 'histogram' in self.stats:
+            out['histogram'] = numpy.asarray(self.hist[rows])
+        return out
@@ -0,0 +1,149 @@
+'''
+Discovery of input files.
+
+Finding the files to process should not require opening
+each of them with an HDF library.  The functions here select
+candidate files by include and exclude glob patterns,
+optionally walking subdirectories, and then check the first
+bytes of each candidate for the signature of the file format
+its parser expects.  Stray logs, checksums and other sidecar
+files are thus rejected without any library open.
+
+Candidates are returned sorted by the timestamp embedded in
+their filenames (IE 2011m0430t1440 for OMI or 20050101 for
+MOPITT), so that granules are processed in time order.
+'''
+import os
+import re
+import sys
+import fnmatch
+import datetime
+
+import parse_geo
+
+# file signatures and the offsets at which they may be found.
+# HDF5 files may begin with a user block of 512, 1024, 2048...
+# bytes, but the archives we read don't use one larger than 2048
+SIGNATURES = {'HDF5' : ('\x89HDF\r\n\x1a\n', (0, 512, 1024, 2048)),
+              'HDF4' : ('\x0e\x03\x13\x01', (0,)),
+              'WHC' : (parse_geo.CACHE_MAGIC, (0,))}
+
+# patterns for timestamps embedded in filenames, tried in order
+TIMESTAMP_PATTERNS = [(re.compile(r'(\d{4}m\d{4}t\d{4})'), '%Ym%m%dt%H%M'),
+                      (re.compile(r'(\d{8}[tT_]\d{6})'), None),
+                      (re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:?\d{2}:?\d{2})'),
+                       None),
+                      (re.compile(r'(\d{4}-\d{2}-\d{2})'), '%Y-%m-%d'),
+                      (re.compile(r'(?<!\d)(\d{8})(?!\d)'), '%Y%m%d'),
+                      (re.compile(r'[AD\.](\d{7}\.\d{4})(?!\d)'), '%Y%j.%H%M')]
+
+def sniff_format(path):
+    '''
+    Return the format ('HDF5', 'HDF4' or 'WHC' for a granule cache)
+    of a file from its signature, or None if it is none of these or
+    cannot be read.
+    '''
+    try:
+        fid = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        for (fmt, (signature, offsets)) in SIGNATURES.iteritems():
+            for offset in offsets:
+                fid.seek(offset)
+                if fid.read(len(signature)) == signature:
+                    return fmt
+    finally:
+        fid.close()
+    return None
+
+def expected_format(filetype):
+    '''
+    The format of the files read by the parser for filetype,
+    or None if it cannot be told from the signature.  filetype
+    is the name of the parser, as passed to parse_geo.get_parser
+    '''
+    try:
+        parserClass = getattr(sys.modules[parse_geo.__name__],
+                              filetype + '_File')
+    except AttributeError:
+        return None
+    if issubclass(parserClass, parse_geo.HDF4File):
+        return 'HDF4'
+    if issubclass(parserClass, parse_geo.HDFFile):
+        return 'HDF5'
+    return None
+
+def filename_timestamp(name):
+    '''
+    Return the first timestamp found in the basename of name as
+    a datetime, or None if there is none.
+    '''
+    base = os.path.basename(name)
+    for (regex, fmt) in TIMESTAMP_PATTERNS:
+        for match in regex.finditer(base):
+            (stamp, stampFmt) = (match.group(1), fmt)
+            if stampFmt is None:
+                # separators vary too much for a single format
+                (stamp, stampFmt) = (re.sub(r'\D', '', stamp), '%Y%m%d%H%M%S')
+            try:
+                return datetime.datetime.strptime(stamp, stampFmt)
+            except ValueError:
+                continue
+    return None
+
+def _matches(relPath, patterns):
+    '''Whether relPath or its basename matches any of patterns'''
+    base = os.path.basename(relPath)
+    return any([fnmatch.fnmatch(relPath, pat) or fnmatch.fnmatch(base, pat)
+                for pat in patterns])
+
+def time_sorted(files):
+    '''
+    Sort files by the timestamp in their names.  Files without
+    one come last, sorted by name
+    '''
+    def key(f):
+        stamp = filename_timestamp(f)
+        return (stamp is None, stamp, f)
+    return sorted(files, key=key)
+
+def discover_files(directory, include=None, exclude=None, recursive=False,
+                   fileFormat=None):
+    '''
+    Return the paths of the candidate input files in directory.
+
+    Inputs:
+        directory - the directory to search
+        include - list of glob patterns.  If given, only files
+            matching at least one are kept.  Patterns are matched
+            against both the path relative to directory and the
+            basename.
+        exclude - list of glob patterns.  Files matching any of them
+            are dropped.
+        recursive - if True, subdirectories are searched as well
+        fileFormat - if given ('HDF5' or 'HDF4'), only files with
+            that signature (or granule caches) are kept.  See 
+            sniff_format.
+
+    Files are returned sorted by the timestamp in their names
+    (see time_sorted).
+    '''
+    candidates = []
+    for (root, dirs, names) in os.walk(directory):
+        if not recursive:
+            del dirs[:]
+        dirs.sort()
+        for name in names:
+            path = os.path.join(root, name)
+            relPath = os.path.relpath(path, directory)
+            if include and not _matches(relPath, include):
+                continue
+            if exclude and _matches(relPath, exclude):
+                continue
+            candidates.append(path)
+    if fileFormat is not None:
+        # granule caches can stand in for files of any format
+        candidates = [f for f in candidates 
+                      if sniff_format(f) in (fileFormat, 'WHC')]
+    return time_sorted(candidates)
@@ -0,0 +1,348 @@
+'''
+A small expression language for pixel weights and filters.
+
+Weights and filters for the averaging output functions are
+normally Python functions, which cannot be given on the command
+line or in an input file.  The expressions here can.  They are
+parsed by a fixed grammar (nothing is passed to eval) and compiled
+to numpy operations that are evaluated over every pixel of a
+granule at once.
+
+Names in an expression are the names of parser fields.  Field
+names that are not simple identifiers (IE containing spaces) are
+written in braces, IE {Solar Zenith Angle}.  Supported are:
+    numbers, and the constants nan, pi, True and False
+    arithmetic:   +  -  *  /  %  **
+    comparisons:  <  <=  >  >=  ==  !=
+    logic:        and  or  not  (also &  |  ~)
+    functions:    abs, sqrt, exp, log, log10, sin, cos, tan,
+                  radians, degrees, floor, ceil, isnan, isfinite,
+                  min(a, b), max(a, b), where(cond, a, b)
+    index(n):     the index of each pixel along axis n (IE the
+                  cross-track position of OMI pixels is index(1))
+
+For example, the OMI quality and cloud filter
+    CloudFraction <= 0.3 and SolarZenithAngle <= 85 and
+    vcdQualityFlags % 2 == 0
+'''
+import re
+
+import numpy
+
+# functions callable from expressions, with their number of arguments
+FUNCTIONS = {'abs' : (numpy.abs, 1),
+             'sqrt' : (numpy.sqrt, 1),
+             'exp' : (numpy.exp, 1),
+             'log' : (numpy.log, 1),
+             'log10' : (numpy.log10, 1),
+             'sin' : (numpy.sin, 1),
+             'cos' : (numpy.cos, 1),
+             'tan' : (numpy.tan, 1),
+             'radians' : (numpy.radians, 1),
+             'degrees' : (numpy.degrees, 1),
+             'floor' : (numpy.floor, 1),
+             'ceil' : (numpy.ceil, 1),
+             'isnan' : (numpy.isnan, 1),
+             'isfinite' : (numpy.isfinite, 1),
+             'min' : (numpy.minimum, 2),
+             'max' : (numpy.maximum, 2),
+             'where' : (numpy.where, 3)}
+
+CONSTANTS = {'nan' : numpy.NaN,
+             'pi' : numpy.pi,
+             'True' : True,
+             'False' : False}
+
+_BINARY = {'+' : numpy.add,
+           '-' : numpy.subtract,
+           '*' : numpy.multiply,
+           '/' : numpy.true_divide,
+           '%' : numpy.mod,
+           '**' : numpy.power,
+           '<' : numpy.less,
+           '<=' : numpy.less_equal,
+           '>' : numpy.greater,
+           '>=' : numpy.greater_equal,
+           '==' : numpy.equal,
+           '!=' : numpy.not_equal,
+           'and' : numpy.logical_and,
+           '&' : numpy.logical_and,
+           'or' : numpy.logical_or,
+           '|' : numpy.logical_or}
+
+_TOKEN = re.compile(r'''\s*(?:
+                        (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?) |
+                        (?P<name>[A-Za-z_][A-Za-z0-9_]*) |
+                        \{(?P<field>[^{}]+)\} |
+                        (?P<op>\*\*|<=|>=|==|!=|[-+*/%<>()&|~,]))''',
+                    re.VERBOSE)
+
+def tokenize(text):
+    '''
+    Split text into a list of (kind, value) tuples, where kind is
+    one of 'number', 'name', 'field' or 'op'.  Raises ValueError on
+    any character that cannot start a token.
+    '''
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise ValueError('Invalid expression {0!r}: unexpected {1!r} at '
+                             'position {2}'.format(text, text[pos:], pos))
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'field':
+            value = value.strip()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+class Expression(object):
+    '''
+    A compiled expression.  fields is the set of parser fields it
+    reads and text the expression it was compiled from.  Call
+    evaluate to compute it for a set of pixels.
+    '''
+    def __init__(self, text):
+        self.text = text
+        self.fields = set()
+        self._tokens = tokenize(text)
+        self._pos = 0
+        if not self._tokens:
+            raise ValueError('Empty expression')
+        self._func = self._or()
+        if self._pos != len(self._tokens):
+            self._error('unexpected {0!r}'.format(self._peek()[1]))
+        del self._tokens
+    def __repr__(self):
+        return 'Expression({0!r})'.format(self.text)
+    def evaluate(self, parser, ind):
+        '''
+        Evaluate the expression for the pixels of parser given by ind,
+        an array with one row of indices per pixel (the ind field of
+        the geolocation).  Each field is read once for all the pixels,
+        through get_cm, so the parser must be in a context manager.
+        Returns an array with one value per pixel.
+        '''
+        ind = numpy.asarray(ind)
+        ind = ind.reshape(ind.shape[0], -1)
+        pxInd = tuple(ind.T)
+        values = dict([(field, numpy.asarray(parser.get_cm(field, pxInd)))
+                       for field in self.fields])
+        with numpy.errstate(all='ignore'):
+            result = numpy.asarray(self._func(values, ind))
+        if result.ndim == 0:
+            return numpy.repeat(result, ind.shape[0])
+        if result.shape != (ind.shape[0],):
+            raise ValueError('Expression {0!r} does not give one value per '
+                             'pixel (shape {1})'.format(self.text,
+                                                        result.shape))
+        return result
+    # recursive descent parser.  Each method consumes its rule and
+    # returns a function of (values, ind)
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+    def _error(self, msg):
+        raise ValueError('Invalid expression {0!r}: {1}'.format(self.text, msg))
+    def _expect(self, op):
+        if self._next() != ('op', op):
+            self._error('expected {0!r}'.format(op))
+    def _binary_rule(self, ops, operand):
+        left = operand()
+        while self._peek()[1] in ops and self._peek()[0] in ('op', 'name'):
+            func = _BINARY[self._next()[1]]
+            right = operand()
+            left = (lambda f, l, r: lambda v, i: f(l(v, i), r(v, i)))(
+                func, left, right)
+        return left
+    def _or(self):
+        return self._binary_rule(('or', '|'), self._and)
+    def _and(self):
+        return self._binary_rule(('and', '&'), self._not)
+    def _not(self):
+        if self._peek() in (('name', 'not'), ('op', '~')):
+            self._next()
+            operand = self._not()
+            return lambda v, i: numpy.logical_not(operand(v, i))
+        return self._comparison()
+    def _comparison(self):
+        left = self._additive()
+        if self._peek()[0] == 'op' and self._peek()[1] in ('<', '<=', '>',
+                                                           '>=', '==', '!='):
+            func = _BINARY[self._next()[1]]
+            right = self._additive()
+            return lambda v, i: func(left(v, i), right(v, i))
+        return left
+    def _additive(self):
+        return self._binary_rule(('+', '-'), self._term)
+    def _term(self):
+        return self._binary_rule(('*', '/', '%'), self._unary)
+    def _unary(self):
+        if self._peek() == ('op', '-'):
+            self._next()
+            operand = self._unary()
+            return lambda v, i: numpy.negative(operand(v, i))
+        if self._peek() == ('op', '+'):
+            self._next()
+            return self._unary()
+        return self._power()
+    def _power(self):
+        base = self._atom()
+        if self._peek() == ('op', '**'):
+            self._next()
+            exponent = self._unary()
+            return lambda v, i: numpy.power(base(v, i), exponent(v, i))
+        return base
+    def _atom(self):
+        (kind, value) = self._next()
+        if kind == 'number':
+            number = float(value)
+            return lambda v, i: number
+        if kind == 'field':
+            self.fields.add(value)
+            return lambda v, i: v[value]
+        if kind == 'name':
+            if self._peek() == ('op', '('):
+                return self._call(value)
+            if value in ('and', 'or', 'not'):
+                self._error('unexpected {0!r}'.format(value))
+            if value in CONSTANTS:
+                constant = CONSTANTS[value]
+                return lambda v, i: constant
+            self.fields.add(value)
+            return lambda v, i: v[value]
+        if (kind, value) == ('op', '('):
+            inner = self._or()
+            self._expect(')')
+            return inner
+        if kind is None:
+            self._error('unexpected end of expression')
+        self._error('unexpected {0!r}'.format(value))
+    def _call(self, name):
+        self._expect('(')
+        args = [self._or()]
+        while self._peek() == ('op', ','):
+            self._next()
+            args.append(self._or())
+        self._expect(')')
+        if name == 'index':
+            if len(args) != 1:
+                self._error('index takes 1 argument')
+            axis = args[0]
+            return lambda v, i: i[:, int(axis(v, i))].astype(numpy.float64)
+        try:
+            (func, nArgs) = FUNCTIONS[name]
+        except KeyError:
+            self._error('unknown function {0!r}'.format(name))
+        if len(args) != nArgs:
+            self._error('{0} takes {1} argument(s)'.format(name, nArgs))
+        return lambda v, i: func(*[arg(v, i) for arg in args])
+
+def compile_expression(text):
+    '''Compile text into an Expression.  Raises ValueError if invalid'''
+    return Expression(text)
+
+class _Primed(object):
+    '''
+    Base for callables built on an Expression that can be evaluated
+    for a whole granule up front (see prime).  The values are kept as
+    an array with one row per pixel primed, handed out whole for the
+    same pixels (see values) or looked up one pixel at a time.
+    '''
+    def __init__(self, text):
+        self.expression = compile_expression(text)
+        self._parser = None
+        self._ind = numpy.zeros((0, 0), dtype=int)
+        self._values = numpy.zeros((0,))
+        # row of self._values for each index tuple, built on first lookup
+        self._rows = None
+    def prime(self, parser, ind):
+        '''
+        Evaluate the expression for every pixel in ind (an array with
+        one row of indices per pixel) at once
+        '''
+        ind = numpy.asarray(ind)
+        ind = ind.reshape(len(ind), int(numpy.prod(ind.shape[1:])))
+        self._parser = parser
+        self._ind = ind
+        self._rows = None
+        if len(ind):
+            self._values = numpy.asarray(self.expression.evaluate(parser, ind))
+        else:
+            self._values = numpy.zeros((0,))
+    def values(self, parser, ind):
+        '''
+        The values of the expression for the pixels of parser given by
+        ind, an array with one row of indices per pixel.  The array
+        computed by prime is returned as is for the pixels primed.
+        '''
+        ind = numpy.asarray(ind)
+        ind = ind.reshape(len(ind), int(numpy.prod(ind.shape[1:])))
+        if parser is self._parser and ind.shape == self._ind.shape and \
+           numpy.array_equal(ind, self._ind):
+            return self._values
+        return self._lookup(parser, ind)
+    def _lookup(self, parser, inds):
+        '''The values of the expression for a sequence of index tuples'''
+        if parser is not self._parser:
+            self.prime(parser, [])
+        if self._rows is None:
+            self._rows = dict(zip([tuple(row) for row in self._ind], 
+                                  range(len(self._ind))))
+        keys = [tuple(ind) for ind in inds]
+        missing = sorted(set([key for key in keys if key not in self._rows]))
+        if missing:
+            missingInd = numpy.array(missing)
+            values = numpy.asarray(self.expression.evaluate(parser, 
+                                                            missingInd))
+            self._rows.update(zip(missing, range(len(self._ind), 
+                                                 len(self._ind) + len(missing))))
+            self._ind = numpy.concatenate([self._ind.reshape(
+                        -1, missingInd.shape[1]), missingInd])
+            self._values = numpy.concatenate([self._values, values])
+        return self._values[[self._rows[key] for key in keys]]
+
+class ExpressionWeight(_Primed):
+    '''
+    Weight function (see out_geo.wght_avg_netCDF) computing the
+    weight of each pixel from an expression
+    '''
+    def __init__(self, text):
+        _Primed.__init__(self, text)
+        self.__doc__ = 'Pixels weighted by {0}'.format(text)
+    def __call__(self, parser, index, prevWght):
+        return float(self._lookup(parser, [index])[0])
+    def weights(self, parser, ind):
+        '''The weights of the pixels of parser given by ind, at once'''
+        return numpy.asarray(self.values(parser, ind), dtype=numpy.float64)
+
+class ExpressionFilter(_Primed):
+    '''
+    Filter function (see out_geo.wght_avg_netCDF) keeping the pixels
+    for which an expression is true and rejecting all others
+    '''
+    def __init__(self, text):
+        _Primed.__init__(self, text)
+        self.__doc__ = 'Pixels kept where {0}'.format(text)
+    def __call__(self, parser, indStack):
+        if len(indStack) == 0:
+            return numpy.array([], dtype=bool)
+        return self._reject(self._lookup(parser, indStack))
+    def rejected(self, parser, ind):
+        '''
+        Flags for the pixels of parser given by ind, at once, true for
+        those to be removed
+        '''
+        return self._reject(self.values(parser, ind))
+    @staticmethod
+    def _reject(keep):
+        # NaN's are neither true nor false, so those pixels are rejected
+        return numpy.logical_not(numpy.logical_and(keep != 0, keep == keep))
@@ -34,8 +34,8 @@ should follow the form
 
 where AttrCastType is one of the cast types for OutFuncAttrs
 
-   [None, 'int', 'posint', 'decimal', 'posdecimal',
-    'time', 'bool', 'list', 'listoflists']
+   [None, 'int', 'posint', 'decimal', 'posdecimal', 'intlist',
+    'decimallist', 'time', 'bool', 'list', 'listoflists']
 '''
 
 class OMI_NO2_KNMI_HDF_v2_0_preFeb2006_filetype():
@@ -5,6 +5,7 @@ import unittest
 import os
 import sys
 import tempfile
+import datetime
 from itertools import izip, product
 import pdb
 
@@ -15,8 +16,24 @@ import tables
 import parse_geo
 import grid_geo
 import map_geo
+import map_helpers
 import out_geo
 import utils
+import grid_cache
+import tiling
+import regridding
+import catalog
+import discovery
+import scanlines
+import prefilter
+import expressions
+import pixel_table
+import granule_cache
+import accumulators
+import sketches
+import cell_stats
+import pipeline
+import lazy
 
 class Helpers:
 
@@ -94,9 +111,11 @@ class fakeParser(parse_geo.GeoFile):
         """
         self._next_data[key] = data
     def get(self, key, indices=None):
+        if indices is None:
+            return self._next_data[key]
         return self._next_data[key][indices]
     def get_cm(self, key, indices=None):
-        return self._next_data[key][indices]
+        return self.get(key, indices)
     def __enter__(self):
         return self
     def __exit__(self, unused_one, unused_two, unused_three):
@@ -565,8 +584,19 @@ class TestKnmiOmiL2Parser(unittest.TestCase):
             self.assertEqual(numpy.rank(p.get_cm('SolarZenithAngle', (6,5))), 0) #non-Nan, no applies scale-offset
             self.assertEqual(numpy.rank(p.get_cm('CloudFraction', (0,0))), 0) #Nan, applies scale-offset
             self.assertEqual(numpy.rank(p.get_cm('SolarZenithAngle', (6,5))), 0) #Nan, no apply scale offset
-    
-@skipUnlessSamples()        
+
+    def test_nested_cm_keeps_file_open(self):
+        with self.parser as outer:
+            unused_val = outer.get_cm('CloudFraction', (6,5))
+            with self.parser as inner:
+                unused_val = inner.get_cm('SolarZenithAngle', (6,5))
+            # inner exit must not close the file or drop cached vars
+            self.assertIn('CloudFraction', outer._open_vars)
+            self.assertAlmostEqual(outer.get_cm('SolarZenithAngle', (6,5)),
+                                   self.parser.get('SolarZenithAngle', (6,5)))
+        self.assertFalse(hasattr(self.parser, '_fid'))
+
+@skipUnlessSamples()
 class TestKnmiOmiL2GetGeoCorners(TestKnmiOmiL2Parser):
 
 
@@ -582,6 +612,13 @@ class TestKnmiOmiL2GetGeoCorners(TestKnmiOmiL2Parser):
 
     def test_geocorners_size(self):
         self.assertEqual(self.geoarray.size, 1622*60)
+
+    def test_geocorners_read_once_in_cm(self):
+        with self.parser as p:
+            first = p.get_geo_corners()
+            self.assertIs(p.get_geo_corners(), first)
+        numpy.testing.assert_array_equal(first['lat'], self.geoarray['lat'])
+        self.assertIsNot(self.parser.get_geo_corners(), first)
         
     def test_geocorners_types(self):
         self.assertEqual(self.geoarray['lat'].dtype, numpy.float32)
@@ -1366,10 +1403,27 @@ class TestOverallGridGeo(unittest.TestCase):
                           'xCell'       : 1000,
                           'yCell'       : 2000,
                           'nRows'       : 150,
-                          'nCols'       : 250}
+                          'nCols'       : 250,
+                          'gridFile'    : None,
+                          'latVar'      : 'lat_corner',
+                          'lonVar'      : 'lon_corner'}
+        # regular half-degree corners with the reference point on a corner
+        (fd, self.fakeParms['gridFile']) = tempfile.mkstemp(suffix='.nc')
+        os.close(fd)
+        (lonCorner, latCorner) = numpy.meshgrid(numpy.arange(-100, -79.9, .5),
+                                                numpy.arange(40, 55.1, .5))
+        fid = netCDF4.Dataset(self.fakeParms['gridFile'], 'w')
+        fid.createDimension('row_stag', latCorner.shape[0])
+        fid.createDimension('col_stag', latCorner.shape[1])
+        for (name, arr) in (('lat_corner', latCorner), ('lon_corner', lonCorner)):
+            fid.createVariable(name, 'f8', ('row_stag', 'col_stag'))[:] = arr
+        fid.close()
         self.projNames = grid_geo.ValidProjections()
         self.origLat = self.fakeParms['refLat']
         self.origLon = self.fakeParms['refLon']
+
+    def tearDown(self):
+        os.remove(self.fakeParms['gridFile'])
         
     def test_existence_of_ValidProjections(self):
         for name in self.projNames:
@@ -1454,6 +1508,99 @@ class TestOverallGridGeo(unittest.TestCase):
             (y, x) = inst.geoToProjected(self.origLat, self.origLon)
             self.assertEqual((y,x), (0,0))
 
+class Testcurvilinear_GridDef(unittest.TestCase):
+
+
+    def setUp(self):
+        self.fakeParms = {'gridFile' : None,
+                          'latVar'   : 'lat_corner',
+                          'lonVar'   : 'lon_corner'}
+        # regular half-degree corners
+        (fd, self.fakeParms['gridFile']) = tempfile.mkstemp(suffix='.nc')
+        os.close(fd)
+        (lonCorner, latCorner) = numpy.meshgrid(numpy.arange(-100, -79.9, .5),
+                                                numpy.arange(40, 55.1, .5))
+        fid = netCDF4.Dataset(self.fakeParms['gridFile'], 'w')
+        fid.createDimension('row_stag', latCorner.shape[0])
+        fid.createDimension('col_stag', latCorner.shape[1])
+        for (name, arr) in (('lat_corner', latCorner), ('lon_corner', lonCorner)):
+            fid.createVariable(name, 'f8', ('row_stag', 'col_stag'))[:] = arr
+        fid.close()
+        self.instance = grid_geo.curvilinear_GridDef(self.fakeParms)
+        self.random = numpy.random.RandomState(0)
+        # the same grid defined analytically
+        self.latlon = grid_geo.latlon_GridDef({'xOrig' : -100, 'yOrig' : 40,
+                                               'xCell' : .5, 'yCell' : .5,
+                                               'nRows' : 30, 'nCols' : 40})
+
+    def tearDown(self):
+        os.remove(self.fakeParms['gridFile'])
+
+    def test_accurate_indLims(self):
+        self.assertEqual(self.instance.indLims(), (0, 29, 0, 39))
+
+    def test_geo2Grid_matches_regular_grid(self):
+        lat = self.random.rand(1000)*15+40
+        lon = self.random.rand(1000)*20-100
+        (row, col) = self.instance.geoToGridded(lat, lon)
+        (rowExp, colExp) = self.latlon.geoToGridded(lat, lon)
+        numpy.testing.assert_allclose(row, rowExp, atol=1e-9)
+        numpy.testing.assert_allclose(col, colExp, atol=1e-9)
+
+    def test_grid2Geo_matches_regular_grid(self):
+        row = self.random.rand(1000)*30
+        col = self.random.rand(1000)*40
+        (lat, lon) = self.instance.griddedToGeo(row, col)
+        (latExp, lonExp) = self.latlon.griddedToGeo(row, col)
+        numpy.testing.assert_allclose(lat, latExp, atol=1e-9)
+        numpy.testing.assert_allclose(lon, lonExp, atol=1e-9)
+
+    def test_geo2Grid_accepts_other_lon_convention(self):
+        (row, col) = self.instance.geoToGridded(47.25, 270.25)
+        self.assertAlmostEqual(row, 14.5)
+        self.assertAlmostEqual(col, 20.5)
+
+    def test_geo2Grid_outside_domain_is_outside_indLims(self):
+        (row, col) = self.instance.geoToGridded(numpy.array([30, 47.5, 0, -60]),
+                                                numpy.array([-90, -120, 90, 0]))
+        (minRow, maxRow, minCol, maxCol) = self.instance.indLims()
+        outside = (row < minRow) | (row >= maxRow+1) | (col < minCol) | (col >= maxCol+1)
+        self.assertTrue(outside.all())
+
+    def test_geo2Grid_nan_stays_nan(self):
+        (row, col) = self.instance.geoToGridded(numpy.array([numpy.nan, 47.5]),
+                                                numpy.array([-90, -90]))
+        self.assertTrue(numpy.isnan(row[0]) and numpy.isnan(col[0]))
+        self.assertEqual((row[1], col[1]), (15, 20))
+
+    def test_curved_grid_round_trip(self):
+        # corners from a projection, so the cells are not lat/lon aligned
+        lcc = grid_geo.lcc2par_GridDef({'stdPar1' : 45, 'stdPar2' : 50,
+                                        'refLat' : 47.5, 'refLon' : -90,
+                                        'earthRadius' : 6370000,
+                                        'xOrig' : -10000, 'yOrig' : -50000,
+                                        'xCell' : 1000, 'yCell' : 2000,
+                                        'nRows' : 40, 'nCols' : 60})
+        (cols, rows) = numpy.meshgrid(numpy.arange(61.), numpy.arange(41.))
+        (latCorner, lonCorner) = lcc.griddedToGeo(rows, cols)
+        fid = netCDF4.Dataset(self.fakeParms['gridFile'], 'w')
+        fid.createDimension('Time', 1)
+        fid.createDimension('row_stag', 41)
+        fid.createDimension('col_stag', 61)
+        for (name, arr) in (('lat_corner', latCorner), ('lon_corner', lonCorner)):
+            fid.createVariable(name, 'f8', ('Time', 'row_stag', 'col_stag'))[:] = arr
+        fid.close()
+        inst = grid_geo.curvilinear_GridDef(self.fakeParms)
+        row = self.random.rand(1000)*40
+        col = self.random.rand(1000)*60
+        (lat, lon) = inst.griddedToGeo(row, col)
+        (rowCalc, colCalc) = inst.geoToGridded(lat, lon)
+        numpy.testing.assert_allclose(rowCalc, row, atol=1e-6)
+        numpy.testing.assert_allclose(colCalc, col, atol=1e-6)
+        (lat, lon) = inst.griddedToGeo(rows, cols)
+        numpy.testing.assert_allclose(lat, latCorner, atol=1e-9)
+        numpy.testing.assert_allclose(lon, lonCorner, atol=1e-9)
+
 class Testlcc2par_GridDef(TestOverallGridGeo):
     
     
@@ -1489,6 +1636,40 @@ class Testlcc2par_GridDef(TestOverallGridGeo):
         self.assertEqual(maxRow-minRow+1, self.fakeParms['nRows'])
         self.assertEqual(maxCol-minCol+1, self.fakeParms['nCols'])
 
+    def test_lut_geo2Grid_within_error(self):
+        lutInst = grid_geo.lcc2par_GridDef(dict(self.fakeParms, lutMaxError=0.01))
+        rows = numpy.random.rand(1000)*self.fakeParms['nRows']
+        cols = numpy.random.rand(1000)*self.fakeParms['nCols']
+        (lat, lon) = self.instance.griddedToGeo(rows, cols)
+        (rowCalc, colCalc) = lutInst.geoToGridded(lat, lon)
+        self.assertLessEqual(numpy.abs(rowCalc-rows).max(), 0.01)
+        self.assertLessEqual(numpy.abs(colCalc-cols).max(), 0.01)
+
+    def test_lut_geo2Grid_exact_outside_table(self):
+        lutInst = grid_geo.lcc2par_GridDef(dict(self.fakeParms, lutMaxError=0.01))
+        # all but the third and last points are far outside the domain
+        for (lat, lon) in [self.knownGeoCoords[i] for i in (0, 1, 3, 4)]:
+            self.assertEqual(self.instance.geoToGridded(lat, lon), 
+                             lutInst.geoToGridded(lat, lon))
+
+    def test_lut_zero_margin(self):
+        lutInst = grid_geo.lcc2par_GridDef(dict(self.fakeParms, lutMaxError=0.01,
+                                                lutMargin=0))
+        rows = numpy.random.rand(1000)*self.fakeParms['nRows']
+        cols = numpy.random.rand(1000)*self.fakeParms['nCols']
+        (lat, lon) = self.instance.griddedToGeo(rows, cols)
+        (rowCalc, colCalc) = lutInst.geoToGridded(lat, lon)
+        self.assertLessEqual(numpy.abs(rowCalc-rows).max(), 0.01)
+        self.assertLessEqual(numpy.abs(colCalc-cols).max(), 0.01)
+
+    def test_lut_negative_margin_raises(self):
+        self.assertRaises(ValueError, grid_geo.lcc2par_GridDef, 
+                          dict(self.fakeParms, lutMaxError=0.01, lutMargin=-1))
+
+    def test_lut_unreachable_error_raises(self):
+        self.assertRaises(ValueError, grid_geo.lcc2par_GridDef, 
+                          dict(self.fakeParms, lutMaxError=1e-14))
+
     def test_geo2Proj_vs_matlab(self):
         for ((lat, lon), (x, y)) in izip(self.knownGeoCoords, self.knownProjCoords):
             (yCalc, xCalc) = self.instance.geoToProjected(lat, lon)
@@ -1648,6 +1829,51 @@ class TestMapGeo(unittest.TestCase):
         self.assertEqual(mapDict, self.testMapDict)
     
 
+class TestGridMap(unittest.TestCase):
+
+
+    def setUp(self):
+        self.map = map_helpers.init_output_map((0, 4, 0, 9))
+
+    def test_untouched_cells_read_empty(self):
+        self.assertEqual(self.map[(3,7)], [])
+
+    def test_untouched_cells_not_stored(self):
+        self.map[(1,2)].append(((0,),None))
+        self.assertEqual(self.map.keys(), [(1,2)])
+
+    def test_float_keys_stored_as_int(self):
+        self.map[(numpy.float64(1), numpy.float64(2))].append(((0,),None))
+        self.assertEqual(self.map[(1,2)], [((0,),None)])
+        self.assertIsInstance(self.map.keys()[0][0], int)
+
+    def test_cell_outside_lims_raises(self):
+        for key in [(5,0), (0,10), (-1,0), (1.5,2), 'parser']:
+            self.assertRaises(KeyError, self.map.__getitem__, key)
+
+    def test_equal_to_full_dict(self):
+        full = dict([(key, []) for key in product(range(5), range(10))])
+        full[(2,3)] = [((1,),None)]
+        self.map[(2,3)].append(((1,),None))
+        self.assertEqual(self.map, full)
+        full[(2,4)] = [((1,),None)]
+        self.assertNotEqual(self.map, full)
+
+    def test_cell_polys_built_on_demand(self):
+        polys = map_helpers.CellPolys((0, 4, 0, 9))
+        self.assertEqual(len(polys), 0)
+        self.assertEqual(polys[(1,2)].bounds, (1, 2, 2, 3))
+        self.assertEqual(polys.keys(), [(1,2)])
+        self.assertRaises(KeyError, polys.__getitem__, (5,0))
+
+    def test_grid_polys_kept_for_recent_tiles_only(self):
+        first = map_helpers.rect_grid_polys((0, 4, 0, 4))
+        self.assertIs(map_helpers.rect_grid_polys((0, 4, 0, 4)), first)
+        for tile in [(0, 4, 5, 9), (5, 9, 0, 4)]:
+            map_helpers.rect_grid_polys(tile)
+        self.assertIsNot(map_helpers.rect_grid_polys((0, 4, 0, 4)), first)
+        self.assertLessEqual(len(map_helpers._gridPolyCache), 2)
+
 class Test_regional_intersect(TestMapGeo):
     
 
@@ -2158,6 +2384,41 @@ class TestUtils(unittest.TestCase):
         finalData = numpy.array([utils.wrap_lon_neg180_180(lon) for lon in intermediateData])
         numpy.testing.assert_array_almost_equal(inputData, finalData, decimal=5)
         
+    def test_wrap_lon_accepts_arrays(self):
+        knownIn = numpy.array([0, 360, 180, 47.5, -47.5, -80, -180, -365, -725, 410])
+        numpy.testing.assert_array_equal(utils.wrap_lon_0_360(knownIn),
+                    [0, 0, 180, 47.5, 312.5, 280, 180, 355, 355, 50])
+        numpy.testing.assert_array_equal(utils.wrap_lon_neg180_180(knownIn),
+                    [0, 0, 180, 47.5, -47.5, -80, 180, -5, -5, 50])
+        
+    def test_UTCoffset_from_lon_array_matches_scalar(self):
+        lons = numpy.random.rand(5, 7)*720 - 360
+        compOut = utils.UTCoffset_from_lon(lons)
+        knownOut = numpy.array([[utils.UTCoffset_from_lon(float(lon)) for lon in row]
+                                for row in lons])
+        numpy.testing.assert_array_equal(knownOut, compOut)
+        
+    def test_time_window_covers_outputs(self):
+        outputs = [{'timeStart' : 100, 'timeStop' : 200},
+                   {'timeStart' : 150, 'timeStop' : 300, 
+                    'timeComparison' : 'local'}]
+        self.assertEqual(utils.time_window(outputs), 
+                         (150 - utils.TIME_PAD - utils.LOCAL_TIME_PAD, 
+                          300 + utils.TIME_PAD + utils.LOCAL_TIME_PAD))
+        self.assertIsNone(utils.time_window(outputs + [{'timeStart' : 0}]))
+        
+    def test_time_window_mask_broadcasts_scanline_times(self):
+        times = numpy.array([0., 10., 20., numpy.nan])
+        lons = numpy.zeros((4, 3))
+        lons[:, 2] = 90  # 6 hours ahead of UTC
+        mask = utils.time_window_mask(times, lons, 5, 15)
+        knownOut = numpy.array([[False]*3, [True]*3, [False]*3, [True]*3])
+        numpy.testing.assert_array_equal(knownOut, mask)
+        mask = utils.time_window_mask(times - 21600, lons, 5, 15, local=True)
+        knownOut[:, :2] = False
+        knownOut[3, :] = True
+        numpy.testing.assert_array_equal(knownOut, mask)
+        
     def test_timestr_to_nsecs_known_input_defaults(self):
         inputTstr = ['00:00:00 01-01-1970', '01:00:00 01-02-1970',
                      '08:30:15 01-01-1970', '00:00:00 12-31-1969',
@@ -2242,6 +2503,1101 @@ class TestUtils(unittest.TestCase):
         calcOut = [utils.UTCoffset_from_lon(lon) for lon in inLons]
         self.assertListEqual(knownOut, calcOut)
 
+class TestGridCache(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.parms = {'xOrig' : -180, 'yOrig' : -90, 'xCell' : 10, 
+                      'yCell' : 10, 'nRows' : 18, 'nCols' : 36}
+        self.griddef = grid_geo.latlon_GridDef(dict(self.parms))
+        self.cacheDir = tempfile.mkdtemp()
+        grid_cache._loaded.clear()
+        
+    def tearDown(self):
+        grid_cache._loaded.clear()
+        import shutil
+        shutil.rmtree(self.cacheDir)
+        
+    def test_global_areas_sum_to_earth(self):
+        geom = grid_cache.load_grid_geometry(self.griddef)
+        self.assertAlmostEqual(geom['area'].sum(), 
+                               4*numpy.pi*grid_cache.EARTH_RADIUS_KM**2,
+                               delta=1)
+        
+    def test_key_depends_on_parms(self):
+        other = grid_geo.latlon_GridDef(dict(self.parms, xCell=5))
+        same = grid_geo.latlon_GridDef(dict(self.parms))
+        self.assertNotEqual(grid_cache.grid_key(self.griddef), 
+                            grid_cache.grid_key(other))
+        self.assertEqual(grid_cache.grid_key(self.griddef), 
+                         grid_cache.grid_key(same))
+        
+    def test_cache_reloaded_from_disk(self):
+        computed = grid_cache.load_grid_geometry(self.griddef, self.cacheDir)
+        grid_cache._loaded.clear()
+        loaded = grid_cache.load_grid_geometry(self.griddef, self.cacheDir)
+        self.assertIsInstance(loaded['cent_lat'], numpy.memmap)
+        for (k, v) in computed.iteritems():
+            numpy.testing.assert_array_equal(v, loaded[k])
+        numpy.testing.assert_array_equal(loaded['ll_lat'][:,0], 
+                                         numpy.arange(-90, 90, 10))
+
+    def test_lru_cache_drops_least_recent(self):
+        cache = grid_cache.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+
+class TestRegridding(unittest.TestCase):
+
+    def setUp(self):
+        self.src = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                            'xCell' : 1, 'yCell' : 1, 
+                                            'nRows' : 4, 'nCols' : 4})
+        self.dst = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                            'xCell' : 2, 'yCell' : 2, 
+                                            'nRows' : 2, 'nCols' : 2})
+        self.cacheDir = tempfile.mkdtemp()
+        (outFid, self.inFname) = tempfile.mkstemp()
+        os.close(outFid)
+        self.outFname = self.inFname + '_regridded'
+        grid_cache._loaded.clear()
+        regridding._loaded.clear()
+
+    def tearDown(self):
+        grid_cache._loaded.clear()
+        regridding._loaded.clear()
+        import shutil
+        shutil.rmtree(self.cacheDir)
+        for fname in (self.inFname, self.outFname):
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    def test_coarsening_is_area_weighted(self):
+        matrix = regridding.load_weight_matrix(self.src, self.dst)
+        vals = numpy.arange(16.).reshape(4, 4)
+        area = grid_cache.load_grid_geometry(self.src)['area']
+        out = matrix.apply(vals)
+        self.assertEqual(out.shape, (2, 2))
+        self.assertAlmostEqual(out[1,0], numpy.average(vals[2:,:2], 
+                                                       weights=area[2:,:2]))
+        numpy.testing.assert_array_almost_equal(matrix.data.sum(), area.sum())
+
+    def test_latlon_overlaps_match_polygons(self):
+        shifted = grid_geo.latlon_GridDef({'xOrig' : .5, 'yOrig' : -.25,
+                                           'xCell' : 1.5, 'yCell' : 2, 
+                                           'nRows' : 2, 'nCols' : 3})
+        geom = grid_cache.load_grid_geometry(self.src)
+        direct = regridding._latlon_overlaps(self.src, shifted)
+        polys = regridding._polygon_overlaps(self.src, shifted, geom)
+        dense = []
+        for (srcCells, dstCells, fracs) in (direct, polys):
+            weights = numpy.zeros((6, 16))
+            numpy.add.at(weights, (dstCells, srcCells), fracs)
+            dense.append(weights)
+        numpy.testing.assert_array_almost_equal(dense[0], dense[1])
+
+    def test_fill_values_and_layers(self):
+        matrix = regridding.load_weight_matrix(self.src, self.dst)
+        vals = numpy.ones((4, 4, 2))
+        vals[:, :, 1] = 2.
+        vals[:2, :2, 0] = -1.
+        vals[2, 2, 0] = -1.
+        vals[0, 3, 1] = numpy.NaN
+        out = matrix.apply(vals, -1.)
+        numpy.testing.assert_array_almost_equal(out[:, :, 0], 
+                                                [[-1., 1.], [1., 1.]])
+        numpy.testing.assert_array_almost_equal(out[:, :, 1], 2.)
+        covered = matrix.apply(vals, -1., minCoverage=.8)
+        self.assertEqual(covered[1,1,0], -1.)
+        self.assertEqual(covered[1,1,1], 2.)
+
+    def test_matrix_reloaded_from_cache(self):
+        computed = regridding.load_weight_matrix(self.src, self.dst, 
+                                                 self.cacheDir)
+        regridding._loaded.clear()
+        loaded = regridding.load_weight_matrix(self.src, self.dst, 
+                                               self.cacheDir)
+        self.assertIsInstance(loaded.data, numpy.memmap)
+        self.assertEqual(loaded.dstShape, (2, 2))
+        numpy.testing.assert_array_equal(loaded.indices, computed.indices)
+
+    def test_regrid_file(self):
+        fid = netCDF4.Dataset(self.inFname, 'w', format='NETCDF3_CLASSIC')
+        fid.createDimension('row', 4)
+        fid.createDimension('col', 4)
+        fid.createDimension('layer', 3)
+        setattr(fid, 'Projection', 'latlon')
+        for k in self.src.parm_list():
+            setattr(fid, k, self.src.parms[k])
+        var = fid.createVariable('NO2', 'd', ('row', 'col', 'layer'), 
+                                 fill_value=-9999.)
+        var[:] = numpy.ones((4, 4, 3))
+        var.Units = 'molec/cm^2'
+        fid.createVariable('count', 'i', ('row', 'col'))[:] = 1
+        fid.createVariable('levels', 'd', ('layer',))[:] = [1, 2, 3]
+        fid.close()
+        result = regridding.regrid_file(self.inFname, self.outFname, self.dst,
+                                        ['NO2'])
+        numpy.testing.assert_array_almost_equal(result['NO2'], 
+                                                numpy.ones((2, 2, 3)))
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['NO2'].dimensions, 
+                             ('row', 'col', 'layer'))
+            self.assertEqual(fid.variables['NO2'].Units, 'molec/cm^2')
+            self.assertNotIn('count', fid.variables)
+            numpy.testing.assert_array_equal(fid.variables['levels'][:], 
+                                             [1, 2, 3])
+            self.assertEqual(fid.xCell, 2)
+        finally:
+            fid.close()
+        self.assertRaises(ValueError, regridding.regrid_file, self.inFname,
+                          self.outFname, self.dst, ['levels'])
+
+    def test_counts_are_summed(self):
+        fid = netCDF4.Dataset(self.inFname, 'w', format='NETCDF3_CLASSIC')
+        fid.createDimension('row', 4)
+        fid.createDimension('col', 4)
+        fid.createDimension('histogramBin', 2)
+        setattr(fid, 'Projection', 'latlon')
+        for k in self.src.parm_list():
+            setattr(fid, k, self.src.parms[k])
+        counts = numpy.arange(16).reshape(4, 4)
+        var = fid.createVariable('ValidPixelCount', 'i', ('row', 'col'), 
+                                 fill_value=-9999)
+        var[:] = counts
+        var[0, 0] = -9999
+        hist = fid.createVariable('NO2Histogram', 'i', 
+                                  ('row', 'col', 'histogramBin'))
+        hist.Units = 'count'
+        hist[:] = numpy.ones((4, 4, 2))
+        fid.createVariable('NO2', 'd', ('row', 'col'))[:] = counts
+        fid.close()
+        result = regridding.regrid_file(self.inFname, self.outFname, self.dst)
+        # the fill value counts for nothing
+        numpy.testing.assert_array_almost_equal(result['ValidPixelCount'], 
+                                                [[10, 18], [42, 50]])
+        numpy.testing.assert_array_almost_equal(result['NO2Histogram'], 4.)
+        self.assertTrue((result['NO2'] < 16).all())
+        # a source cell straddling two target cells is shared between them
+        half = grid_geo.latlon_GridDef({'xOrig' : .5, 'yOrig' : 0, 
+                                        'xCell' : 1, 'yCell' : 4, 
+                                        'nRows' : 1, 'nCols' : 3})
+        result = regridding.regrid_file(self.inFname, self.outFname, half, 
+                                        ['NO2Histogram'])
+        numpy.testing.assert_array_almost_equal(result['NO2Histogram'], 4.)
+
+    def test_statistics_are_merged(self):
+        random = numpy.random.RandomState(0)
+        (vals, wghts) = (random.rand(200) + 10, random.rand(200))
+        (rows, cols) = (random.randint(0, 4, 200), random.randint(0, 4, 200))
+        rows[rows == 0] = 1
+        stats = ['variance', 'std', 'min', 'max']
+        backend = accumulators.MemoryAccumulators()
+        srcStats = cell_stats.CellStatistics(backend, 16, stats)
+        srcStats.add(rows*4 + cols, vals, wghts)
+        fid = netCDF4.Dataset(self.inFname, 'w', format='NETCDF3_CLASSIC')
+        fid.createDimension('row', 4)
+        fid.createDimension('col', 4)
+        setattr(fid, 'Projection', 'latlon')
+        for k in self.src.parm_list():
+            setattr(fid, k, self.src.parms[k])
+        fid.createVariable('NO2', 'd', ('row', 'col'), 
+                           fill_value=-9999.)[:] = 1.
+        written = srcStats.results(slice(0, 16), -9999.)
+        for (stat, arr) in written.iteritems():
+            fid.createVariable('NO2_' + stat, 'd', ('row', 'col'), 
+                               fill_value=-9999.)[:] = arr.reshape(4, 4)
+        fid.close()
+        result = regridding.regrid_file(self.inFname, self.outFname, self.dst)
+        # the target cells hold whole source cells, so the statistics are
+        # those of all the values in each
+        dstStats = cell_stats.CellStatistics(backend, 4, stats)
+        dstStats.add((rows//2)*2 + cols//2, vals, wghts)
+        expected = dstStats.results(slice(0, 4), -9999.)
+        for (stat, arr) in expected.iteritems():
+            numpy.testing.assert_array_almost_equal(result['NO2_' + stat], 
+                                                    arr.reshape(2, 2))
+        # the regridded moment state can still be merged
+        merged = cell_stats.CellStatistics.from_results(
+            backend, ['variance'], dict([(stat, result['NO2_' + stat]) 
+                                  for stat in cell_stats.MOMENT_STATE]), 
+            fillVal=-9999.)
+        merged.merge(merged)
+        numpy.testing.assert_array_almost_equal(
+            merged.results(slice(0, 4), -9999.)['variance'], 
+            expected['variance'])
+        # the variance cannot be rebuilt without the moment state
+        fid = netCDF4.Dataset(self.inFname, 'a')
+        fid.renameVariable('NO2_sqDev', 'NO2_spread')
+        fid.close()
+        self.assertRaises(ValueError, regridding.regrid_file, self.inFname,
+                          self.outFname, self.dst, ['NO2_variance'])
+
+class TestTiling(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.griddef = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                                'xCell' : 1, 'yCell' : 1, 
+                                                'nRows' : 10, 'nCols' : 25})
+        
+    def test_tiles_cover_grid_once(self):
+        tiles = tiling.split_tiles(self.griddef.indLims(), 4, 10)
+        self.assertEqual(len(tiles), 9)
+        counts = numpy.zeros((10, 25))
+        for (r0, r1, c0, c1) in tiles:
+            self.assertLessEqual(r1-r0+1, 4)
+            self.assertLessEqual(c1-c0+1, 10)
+            counts[r0:r1+1, c0:c1+1] += 1
+        numpy.testing.assert_array_equal(counts, numpy.ones((10, 25)))
+        
+    def test_tile_keeps_full_lims(self):
+        tile = self.griddef.tile((4, 7, 10, 19))
+        self.assertEqual(tile.indLims(), (4, 7, 10, 19))
+        self.assertEqual(tile.fullIndLims(), self.griddef.indLims())
+        self.assertEqual(tile.geoToGridded(5.5, 12.5), (5.5, 12.5))
+        self.assertEqual(self.griddef.indLims(), (0, 9, 0, 24))
+        
+    def test_straddling_pixel_routed_to_both_tiles(self):
+        protoDtype = [('lat', 'f8', 4), ('lon', 'f8', 4), ('ind', 'i8', 2)]
+        struct = numpy.zeros(3, dtype=protoDtype)
+        # one pixel in each tile and one across the boundary at col 10
+        struct['lat'] = [[1, 2, 2, 1], [1, 2, 2, 1], [1, 2, 2, 1]]
+        struct['lon'] = [[1, 1, 2, 2], [12, 12, 13, 13], [9.5, 9.5, 10.5, 10.5]]
+        struct['ind'] = [[0, 0], [0, 1], [0, 2]]
+        tiles = [(0, 9, 0, 9), (0, 9, 10, 24)]
+        routed = tiling.route_pixels(struct, self.griddef, tiles)
+        self.assertListEqual(list(routed[0]), [0, 2])
+        self.assertListEqual(list(routed[1]), [1, 2])
+        
+    def test_tile_maps_match_full_map(self):
+        parser = fakeParser('foo.dat')
+        parser.prime_centers(numpy.random.rand(4, 5)*10, 
+                             numpy.random.rand(4, 5)*25,
+                             numpy.indices((4, 5)).transpose((1,2,0)))
+        struct = parser.get_geo_centers()
+        fullMap = map_geo.point_in_cell_map_geo(parser, self.griddef, False)
+        tiles = tiling.split_tiles(self.griddef.indLims(), 3, 7)
+        routed = tiling.route_pixels(struct, self.griddef, tiles)
+        for (lims, sel) in izip(tiles, routed):
+            tileParser = tiling.TileParser(parser, 'centers', struct, sel)
+            tileMap = map_geo.point_in_cell_map_geo(tileParser, 
+                                    self.griddef.tile(lims), False)
+            for (key, pixList) in tileMap.iteritems():
+                if key != 'parser':
+                    self.assertEqual(pixList, fullMap[key])
+
+    def test_stitch_scatters_gathered_tiles(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            tileFiles = [os.path.join(tmpDir, 'tile{0}.nc'.format(i))
+                         for i in range(2)]
+            for (i, fname) in enumerate(tileFiles):
+                fid = netCDF4.Dataset(fname, 'w', format='NETCDF3_CLASSIC')
+                fid.createDimension('row', 2)
+                fid.createDimension('col', 3)
+                if i == 0:
+                    fid.createDimension('cell', 2)
+                    cell = fid.createVariable('cell', 'i', ('cell',))
+                    cell.compress = 'row col'
+                    cell[:] = [1, 5]
+                    var = fid.createVariable('val', 'd', ('cell',),
+                                             fill_value=-1.0)
+                    var[:] = [10., 20.]
+                else:
+                    var = fid.createVariable('val', 'd', ('row', 'col'),
+                                             fill_value=-1.0)
+                    var[:] = numpy.arange(6.).reshape(2, 3)
+                fid.close()
+            outFname = os.path.join(tmpDir, 'out.nc')
+            tiling.stitch_netcdf(tileFiles, [(0, 1, 0, 2), (0, 1, 3, 5)],
+                                 (0, 1, 0, 5), outFname)
+            fid = netCDF4.Dataset(outFname, 'r')
+            try:
+                self.assertNotIn('cell', fid.variables)
+                self.assertEqual(fid.variables['val'].dimensions, 
+                                 ('row', 'col'))
+                numpy.testing.assert_array_equal(fid.variables['val'][:],
+                    [[-1, 10, -1, 0, 1, 2], [-1, -1, 20, 3, 4, 5]])
+            finally:
+                fid.close()
+        finally:
+            import shutil
+            shutil.rmtree(tmpDir)
+
+class fakeScanlineParser(fakeParser):
+    """fakeParser that also provides the times of its scanlines"""
+    def get_scanline_times(self):
+        return numpy.asarray(self.get('Time'), dtype=numpy.float64).ravel()
+
+class TestScanlines(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.griddef = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                                'xCell' : 1, 'yCell' : 1, 
+                                                'nRows' : 10, 'nCols' : 10})
+        self.parser = fakeScanlineParser('foo.dat')
+        self.parser.prime_centers(numpy.random.rand(6, 3)*10, 
+                                  numpy.random.rand(6, 3)*10,
+                                  numpy.indices((6, 3)).transpose((1,2,0)))
+        self.parser.prime_get('Time', numpy.array([0, 10, 20, numpy.NaN, 
+                                                   40, 50]))
+        
+    def test_scanline_range(self):
+        times = numpy.array([0, 10, 20, 30, 40, 50], dtype=numpy.float64)
+        self.assertEqual(scanlines.scanline_range(times, (10, 30)), (1, 4))
+        self.assertEqual(scanlines.scanline_range(times, (11, 19)), (0, 0))
+        self.assertEqual(scanlines.scanline_range(times, (-5, 100)), (0, 6))
+        self.assertEqual(scanlines.scanline_range(times, (60, 70)), (0, 0))
+        
+    def test_scanline_range_skips_nans(self):
+        times = numpy.array([numpy.NaN, 10, numpy.NaN, 30, numpy.NaN])
+        self.assertEqual(scanlines.scanline_range(times, (0, 20)), (1, 2))
+        self.assertEqual(scanlines.scanline_range(times, (0, 40)), (1, 4))
+        self.assertEqual(scanlines.scanline_range(times*numpy.NaN, (0, 40)),
+                         (0, 0))
+
+    def test_unsorted_times_keep_everything(self):
+        times = numpy.array([0, 30, 10, 20], dtype=numpy.float64)
+        self.assertEqual(scanlines.scanline_range(times, (25, 35)), (0, 4))
+        
+    def test_window_keeps_nan_scanlines(self):
+        sel = scanlines.window_scanlines(self.parser.get('Time'), (15, 45))
+        self.assertListEqual(list(sel), [2, 3, 4])
+        
+    def test_restrict_to_window(self):
+        # only the scanline with a missing time can be in the window
+        restricted = scanlines.restrict_to_window(self.parser, (60, 70))
+        self.assertEqual(restricted.get_geo_centers().shape, (1, 3))
+        self.assertTrue(numpy.isnan(restricted.get_scanline_times()).all())
+        self.parser.prime_get('Time', numpy.arange(6.0)*10)
+        self.assertIsNone(scanlines.restrict_to_window(self.parser, (60, 70)))
+        self.parser.prime_get('Time', numpy.array([0, 10, 20, numpy.NaN, 
+                                                   40, 50]))
+        self.assertIs(scanlines.restrict_to_window(self.parser, (-1, 51)),
+                      self.parser)
+        plain = fakeParser('bar.dat')
+        self.assertIs(scanlines.restrict_to_window(plain, (60, 70)), plain)
+        restricted = scanlines.restrict_to_window(self.parser, (15, 45))
+        centers = restricted.get_geo_centers()
+        self.assertEqual(centers.shape, (3, 3))
+        numpy.testing.assert_array_equal(centers['ind'][:, 0, 0], [2, 3, 4])
+        self.assertEqual(restricted.get('Time', (4,)), 40)
+        
+    def test_restricted_map_matches_time_filtered_map(self):
+        window = (15, 45)
+        fullMap = map_geo.point_in_cell_map_geo(self.parser, self.griddef, 
+                                                False)
+        restricted = scanlines.restrict_to_window(self.parser, window)
+        partMap = map_geo.point_in_cell_map_geo(restricted, self.griddef, 
+                                                False)
+        times = self.parser.get('Time')
+        for row in range(10):
+            for col in range(10):
+                expected = [(ind, wght) for (ind, wght) in fullMap[(row, col)]
+                            if not (times[ind[0]] < window[0] or 
+                                    times[ind[0]] > window[1])]
+                self.assertEqual(partMap[(row, col)], expected)
+        
+class trailingIndexParser(fakeParser):
+    """
+    fakeParser that indexes its fields along their last axes, except
+    for 'const', which is returned whole (as IE pressure grids are)
+    """
+    def get(self, key, indices=None):
+        if indices is None or key == 'const':
+            return self._next_data[key]
+        return self._next_data[key][(Ellipsis,) + tuple(indices)]
+
+class indexMapParser(fakeParser):
+    """
+    fakeParser that indexes its fields through an index map, as the
+    HDF parsers do
+    """
+    _indexMap = {'default' : lambda var, ind: var[:, ind[0], ind[1]],
+                 'time' : lambda var, ind: var[ind[0]],
+                 'const' : lambda var, ind: var[:]}
+    def get(self, key, indices=None):
+        self.reads = getattr(self, 'reads', 0) + 1
+        if indices is None:
+            return self._next_data[key]
+        return self._indexMap.get(key, self._indexMap['default'])(
+            self._next_data[key], indices)
+
+class TestPixelTable(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.griddef = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                                'xCell' : 1, 'yCell' : 1, 
+                                                'nRows' : 10, 'nCols' : 10})
+        self.parser = fakeParser('foo.dat')
+        self.parser.prime_centers(numpy.random.rand(5, 4)*10,
+                                  numpy.random.rand(5, 4)*10,
+                                  numpy.indices((5, 4)).transpose((1,2,0)))
+        self.parser.prime_get('foo', numpy.random.rand(5, 4))
+        self.parser.prime_get('bar', numpy.random.rand(5, 4, 3))
+        
+    def test_chunks_cover_granule(self):
+        tables = list(self.parser.get_pixel_tables(['foo', 'bar'], chunkRows=2))
+        self.assertEqual([len(t) for t in tables], [8, 8, 4])
+        join = lambda name: numpy.concatenate([t[name] for t in tables])
+        numpy.testing.assert_array_equal(join('ind'), 
+                                         numpy.indices((5, 4)).reshape(2, -1).T)
+        numpy.testing.assert_array_equal(join('foo'), 
+                                         self.parser.get('foo').ravel())
+        numpy.testing.assert_array_equal(join('bar'), 
+                                         self.parser.get('bar').reshape(20, 3))
+        numpy.testing.assert_array_equal(join('lat'), 
+                                    self.parser.get_geo_centers()['lat'].ravel())
+        
+    def test_chunked_map_matches_full_map(self):
+        fullMap = map_geo.point_in_cell_map_geo(self.parser, self.griddef, False)
+        for table in self.parser.get_pixel_tables(chunkRows=3):
+            # the table stands in for its parser
+            self.assertEqual(table.get('foo', (1, 2)), 
+                             self.parser.get('foo', (1, 2)))
+            tableMap = map_geo.point_in_cell_map_geo(table, self.griddef, False)
+            self.assertIs(tableMap['parser'], table)
+        chunkedMap = map_geo.map_pixel_tables(map_geo.point_in_cell_map_geo, 
+                                              self.parser, self.griddef, 
+                                              False, 3)
+        self.assertIs(chunkedMap['parser'], self.parser)
+        self.assertEqual(chunkedMap, fullMap)
+        
+    def test_unique_rows(self):
+        ind = numpy.array([[2, 1], [0, 3], [2, 1], [0, 0], [0, 3]])
+        (rows, first, inverse) = pixel_table.unique_rows(ind)
+        numpy.testing.assert_array_equal(rows, [[0, 0], [0, 3], [2, 1]])
+        numpy.testing.assert_array_equal(first, [3, 1, 0])
+        numpy.testing.assert_array_equal(rows[inverse], ind)
+        
+    def test_pixels_first_whatever_the_index_map(self):
+        parser = trailingIndexParser('foo.dat')
+        parser.prime_get('bar', numpy.random.rand(3, 5, 4))
+        parser.prime_get('const', numpy.arange(3.0))
+        ind = numpy.array([[0, 1], [4, 3], [2, 2]])
+        vals = pixel_table.read_field(parser, 'bar', ind)
+        self.assertEqual(vals.shape, (3, 3))
+        for (row, pxInd) in enumerate(ind):
+            numpy.testing.assert_array_equal(vals[row], 
+                                             parser.get('bar', tuple(pxInd)))
+        # fields without pixel dimensions are repeated for each pixel
+        numpy.testing.assert_array_equal(
+            pixel_table.read_field(parser, 'const', ind), 
+            numpy.tile(numpy.arange(3.0), (3, 1)))
+        
+    def test_pixel_axis_from_index_map(self):
+        parser = indexMapParser('foo.dat')
+        parser.prime_get('bar', numpy.random.rand(3, 5, 4))
+        parser.prime_get('time', numpy.random.rand(5))
+        parser.prime_get('const', numpy.arange(3.0))
+        ind = numpy.array([[0, 1], [4, 3], [2, 2]])
+        (vals, perPixel) = pixel_table.read_column(parser, 'bar', ind)
+        # the field is read once
+        self.assertEqual(parser.reads, 1)
+        self.assertTrue(perPixel)
+        for (row, pxInd) in enumerate(ind):
+            numpy.testing.assert_array_equal(vals[row], 
+                                             parser.get('bar', tuple(pxInd)))
+        numpy.testing.assert_array_equal(
+            pixel_table.read_field(parser, 'time', ind), 
+            parser.get('time')[ind[:, 0]])
+        (vals, perPixel) = pixel_table.read_column(parser, 'const', ind)
+        self.assertFalse(perPixel)
+        numpy.testing.assert_array_equal(vals, numpy.arange(3.0))
+
+    def test_read_no_pixels(self):
+        ind = numpy.zeros((0, 2), dtype=int)
+        for parser in (trailingIndexParser('foo.dat'), 
+                       indexMapParser('foo.dat')):
+            parser.prime_get('bar', numpy.random.rand(3, 5, 4))
+            self.assertEqual(pixel_table.read_field(parser, 'bar', ind).shape,
+                             (0, 3))
+        self.assertEqual(pixel_table.read_field(self.parser, 'bar', ind).shape,
+                         (0, 3))
+        
+    def test_group_sum_matches_loop_over_map(self):
+        map = map_geo.point_in_cell_map_geo(self.parser, self.griddef, False)
+        table = pixel_table.map_table(map, ['foo', 'bar'])
+        self.assertEqual(len(table), 20)
+        groups = table['cell'][:, 0]*10 + table['cell'][:, 1]
+        sums = pixel_table.group_sum(groups, table['bar'], 100)
+        expected = numpy.zeros((100, 3))
+        for (cell, pixList) in map.iteritems():
+            if cell == 'parser':
+                continue
+            for (ind, unused_weight) in pixList:
+                expected[cell[0]*10 + cell[1]] += self.parser.get('bar', ind)
+        numpy.testing.assert_array_equal(sums, expected)
+        # sums may be added into an existing array
+        out = numpy.ones(100)
+        pixel_table.group_sum(groups, table['foo'], 100, out=out)
+        self.assertAlmostEqual(out.sum(), 100 + self.parser.get('foo').sum())
+
+class TestCatalog(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp()
+        self.files = []
+        self.opened = []
+        # three granules at successive times over different regions
+        for i in range(3):
+            fname = os.path.join(self.dataDir, 'granule{0}.dat'.format(i))
+            open(fname, 'w').close()
+            self.files.append(fname)
+        self.cat = catalog.GranuleCatalog(os.path.join(self.dataDir, 
+                                                       catalog.DEFAULT_NAME))
+        
+    def tearDown(self):
+        self.cat.close()
+        import shutil
+        shutil.rmtree(self.dataDir)
+
+    def openParser(self, fname):
+        i = self.files.index(fname)
+        self.opened.append(fname)
+        (lat0, lon0) = [(40, -90), (-30, 150), (40, 175)][i]
+        parser = fakeParser(fname)
+        lat = lat0 + numpy.arange(10.)
+        lon = lon0 + numpy.arange(10.)
+        parser.prime_centers(lat, lon, numpy.arange(10))
+        parser.prime_get('Time', 1000.0*i + numpy.arange(10.))
+        return parser
+
+    def test_parse_odl_values(self):
+        text = '\n'.join(['GROUP = INVENTORYMETADATA',
+                          '  OBJECT = RANGEBEGINNINGDATE',
+                          '    NUM_VAL = 1',
+                          '    VALUE = "2005-01-01"',
+                          '  END_OBJECT = RANGEBEGINNINGDATE',
+                          '  OBJECT = RANGEBEGINNINGTIME',
+                          '    VALUE = "00:00:10.500000"',
+                          '  END_OBJECT = RANGEBEGINNINGTIME',
+                          '  OBJECT = RANGEENDINGDATE',
+                          '    VALUE = "2005-01-01"',
+                          '  END_OBJECT = RANGEENDINGDATE',
+                          '  OBJECT = RANGEENDINGTIME',
+                          '    VALUE = "01:00:00"',
+                          '  END_OBJECT = RANGEENDINGTIME',
+                          'END_GROUP = INVENTORYMETADATA'])
+        values = catalog.parse_odl_values(text)
+        self.assertEqual(values['RANGEBEGINNINGDATE'], '2005-01-01')
+        start = utils.timestr_to_nsecs('00:00:00 01-01-2005', 
+                                       '00:00:00 01-01-1993')
+        self.assertEqual(catalog.metadata_times(values), 
+                         (start+10.5, start+3600))
+
+    def test_lon_interval_crosses_dateline(self):
+        self.assertEqual(catalog.lon_interval([170, -170, 179, numpy.nan]),
+                         (170, 190))
+
+    def test_extents_overlap_across_dateline(self):
+        self.assertTrue(catalog.extents_overlap((0, 10, 170, 190), 
+                                                (0, 10, -175, -160)))
+        self.assertFalse(catalog.extents_overlap((0, 10, 170, 190), 
+                                                 (0, 10, -165, -160)))
+        self.assertFalse(catalog.extents_overlap((0, 10, 170, 190), 
+                                                 (20, 30, 175, 180)))
+
+    def test_select_by_time(self):
+        self.cat.update(self.files, 'fake', self.openParser, 'Time')
+        self.assertEqual(self.cat.select(self.files, 'fake', (995, 1100)),
+                         self.files[1:2])
+        self.assertEqual(self.cat.select(self.files, 'fake', (0, 5000)),
+                         self.files)
+
+    def test_select_by_grid(self):
+        self.cat.update(self.files, 'fake', self.openParser)
+        griddef = grid_geo.latlon_GridDef({'xOrig' : -100, 'yOrig' : 30,
+                                           'xCell' : 1, 'yCell' : 1,
+                                           'nRows' : 10, 'nCols' : 10})
+        self.assertEqual(self.cat.select(self.files, 'fake', 
+                                         extents=[catalog.grid_extent(griddef)]),
+                         self.files[:1])
+
+    def test_unchanged_files_not_reopened(self):
+        self.cat.update(self.files, 'fake', self.openParser)
+        self.cat.update(self.files, 'fake', self.openParser)
+        self.assertEqual(self.opened, self.files)
+        with open(self.files[2], 'w') as fid:
+            fid.write('changed')
+        self.cat.update(self.files, 'fake', self.openParser)
+        self.assertEqual(self.opened, self.files + self.files[2:])
+
+    def test_unknown_files_always_selected(self):
+        def badParser(fname):
+            raise IOError
+        self.cat.update(self.files, 'fake', badParser, 'Time')
+        self.assertEqual(self.cat.select(self.files, 'fake', (-10, -5), 
+                                         [(0, 1, 0, 1)]),
+                         self.files)
+
+class TestDiscovery(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dataDir, 'sub'))
+        self.write('OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003.he5', 
+                   '\x89HDF\r\n\x1a\n')
+        self.write('OMI-Aura_L2-OMNO2_2011m0430t1259-o36119_v003.he5', 
+                   '\x89HDF\r\n\x1a\n')
+        self.write('OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003.he5.md5', 
+                   'abc123')
+        self.write('MOP02T-20050101-L2V10.1.1.prov.hdf', '\x0e\x03\x13\x01')
+        self.write(os.path.join('sub', 'OMI-Aura_L2-OMNO2_2011m0429t1000.he5'),
+                   '\0'*512 + '\x89HDF\r\n\x1a\n')
+        
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dataDir)
+
+    def write(self, name, contents):
+        with open(os.path.join(self.dataDir, name), 'wb') as fid:
+            fid.write(contents)
+
+    def names(self, files):
+        return [os.path.relpath(f, self.dataDir) for f in files]
+
+    def test_sniff_format(self):
+        path = os.path.join(self.dataDir, 'MOP02T-20050101-L2V10.1.1.prov.hdf')
+        self.assertEqual(discovery.sniff_format(path), 'HDF4')
+        path = os.path.join(self.dataDir, 'sub', 
+                            'OMI-Aura_L2-OMNO2_2011m0429t1000.he5')
+        self.assertEqual(discovery.sniff_format(path), 'HDF5')
+        self.assertIsNone(discovery.sniff_format(path + 'missing'))
+
+    def test_expected_format(self):
+        self.assertEqual(discovery.expected_format('HDFnasaomil2'), 'HDF5')
+        self.assertEqual(discovery.expected_format('HDFmopittl2'), 'HDF4')
+        self.assertIsNone(discovery.expected_format('nonexistent'))
+
+    def test_filename_timestamp(self):
+        self.assertEqual(discovery.filename_timestamp(
+                'OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003-2011m0501t043317.he5'),
+                         datetime.datetime(2011, 4, 30, 14, 40))
+        self.assertEqual(discovery.filename_timestamp(
+                '/data/MOP02T-20050101-L2V10.1.1.prov.hdf'),
+                         datetime.datetime(2005, 1, 1))
+        self.assertIsNone(discovery.filename_timestamp('README'))
+
+    def test_format_filters_and_sorts_by_time(self):
+        files = discovery.discover_files(self.dataDir, fileFormat='HDF5')
+        self.assertEqual(self.names(files), 
+                         ['OMI-Aura_L2-OMNO2_2011m0430t1259-o36119_v003.he5',
+                          'OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003.he5'])
+
+    def test_recursive(self):
+        files = discovery.discover_files(self.dataDir, recursive=True, 
+                                         fileFormat='HDF5')
+        self.assertEqual(self.names(files)[0], 
+                         os.path.join('sub', 'OMI-Aura_L2-OMNO2_2011m0429t1000.he5'))
+        self.assertEqual(len(files), 3)
+
+    def test_include_exclude(self):
+        files = discovery.discover_files(self.dataDir, include=['*2011m0430*'],
+                                         exclude=['*t1259*'])
+        self.assertEqual(self.names(files), 
+                         ['OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003.he5',
+                          'OMI-Aura_L2-OMNO2_2011m0430t1440-o36120_v003.he5.md5'])
+
+class TestGranuleCache(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.dataDir, 'granule.whc')
+        self.parser = fakeParser('granule.he5')
+        self.parser.prime_centers(numpy.random.rand(4, 3)*10,
+                                  numpy.random.rand(4, 3)*10,
+                                  numpy.indices((4, 3)).transpose((1,2,0)))
+        self.parser.prime_corners(numpy.random.rand(4, 3, 4)*10,
+                                  numpy.random.rand(4, 3, 4)*10,
+                                  numpy.indices((4, 3)).transpose((1,2,0)))
+        times = numpy.array([10., 20., 30., 40.])
+        self.parser.prime_get('Time', numpy.repeat(times[:, None], 3, axis=1))
+        self.parser.get_scanline_times = lambda: times
+        self.parser.prime_get('flag', numpy.arange(12).reshape(4, 3))
+        self.parser.prime_get('profile', numpy.random.rand(4, 3, 5))
+        self.fields = ['flag', 'profile', 'Time']
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dataDir)
+
+    def ingest(self, filterText=None):
+        (arrays, fieldInfo) = granule_cache.cache_arrays(self.parser, 
+                                                         self.fields, 
+                                                         filterText)
+        granule_cache.write_cache(self.cachePath, arrays, fieldInfo, 
+                                  self.parser.name, 'HDFknmiomil2', filterText)
+        return parse_geo.get_parser(self.cachePath, 'HDFknmiomil2', {})
+
+    def test_cache_reads_like_granule(self):
+        cache = self.ingest()
+        self.assertIsInstance(cache, parse_geo.WHCcache_File)
+        self.assertTrue(parse_geo.is_cache_file(self.cachePath))
+        for pxInd in [(0, 0), (3, 2), (1, 1)]:
+            numpy.testing.assert_array_equal(cache.get('profile', pxInd),
+                                             self.parser.get('profile', pxInd))
+            self.assertEqual(cache.get_cm('flag', pxInd), 
+                             self.parser.get('flag', pxInd))
+        pxInd = (numpy.array([0, 3, 2]), numpy.array([1, 0, 2]))
+        numpy.testing.assert_array_equal(cache.get('profile', pxInd),
+                                         self.parser.get('profile', pxInd))
+        numpy.testing.assert_array_equal(cache.get('flag'), 
+                                         self.parser.get('flag'))
+        with cache:
+            centers = cache.get_geo_centers()
+            corners = cache.get_geo_corners()
+        numpy.testing.assert_array_equal(
+                centers['lat'], self.parser.get_geo_centers()['lat'].ravel())
+        numpy.testing.assert_array_equal(
+                corners['lon'], 
+                self.parser.get_geo_corners()['lon'].reshape(12, 4))
+        numpy.testing.assert_array_equal(cache.get_scanline_times(),
+                                         numpy.repeat([10., 20., 30., 40.], 3))
+        self.assertRaises(KeyError, cache.get, 'missing', (0, 0))
+
+    def test_cache_maps_like_granule(self):
+        griddef = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                           'xCell' : 1, 'yCell' : 1, 
+                                           'nRows' : 10, 'nCols' : 10})
+        cache = self.ingest()
+        fullMap = map_geo.point_in_cell_map_geo(self.parser, griddef, False)
+        cacheMap = map_geo.point_in_cell_map_geo(cache, griddef, False)
+        for (key, pixList) in fullMap.iteritems():
+            if key != 'parser':
+                self.assertEqual([tuple(ind) for (ind, wgt) in cacheMap[key]], 
+                                 [tuple(ind) for (ind, wgt) in pixList])
+
+    def test_filter_drops_pixels(self):
+        cache = self.ingest('flag % 2 == 0')
+        ind = cache.get_geo_centers()['ind']
+        self.assertEqual(len(ind), 6)
+        self.assertTrue(numpy.all(self.parser.get('flag', tuple(ind.T)) % 2 == 0))
+        self.assertEqual(cache.get('profile', (1, 0)).shape, (5,))
+        # pixels filtered out are missing
+        self.assertTrue(numpy.isnan(cache.get('profile', (0, 1))).all())
+        self.assertEqual(cache.get('flag', (0, 1)), 0)
+        numpy.testing.assert_array_equal(cache.get_scanline_times(), 
+                                         [10., 10., 20., 30., 30., 40.])
+
+    def test_cache_checks_parser(self):
+        self.ingest()
+        self.assertRaises(IOError, parse_geo.get_parser, self.cachePath, 
+                          'HDFmopittl2', {})
+        self.assertEqual(discovery.sniff_format(self.cachePath), 'WHC')
+        self.assertListEqual(discovery.discover_files(self.dataDir,
+                                                      fileFormat='HDF5'),
+                             [self.cachePath])
+
+    def test_cache_rebuilt_for_other_fields_or_filter(self):
+        self.ingest()
+        outDir = tempfile.mkdtemp()
+        try:
+            ingest = lambda fields, filterText=None: \
+                parse_geo.read_cache_header(granule_cache.ingest_file(
+                    self.cachePath, 'HDFknmiomil2', {}, outDir, fields, 
+                    filterText))
+            self.assertEqual(ingest(['flag'])['fields'].keys(), ['flag'])
+            self.assertEqual(sorted(ingest(['flag', 'Time'])['fields']), 
+                             ['Time', 'flag'])
+            self.assertEqual(ingest(['flag', 'Time'], 'flag > 2')['filter'],
+                             'flag > 2')
+            self.assertIsNone(ingest(['Time', 'flag'])['filter'])
+        finally:
+            import shutil
+            shutil.rmtree(outDir)
+
+class TestPipeline(unittest.TestCase):
+    
+    def setUp(self):
+        self.dataDir = tempfile.mkdtemp()
+        self.outDir = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.dataDir, 'granule.whc')
+        self.write_granule([1., 2., 3., 4.])
+        self.config = {'filetype' : 'HDFknmiomil2',
+                       'directory' : self.dataDir,
+                       'outDirectory' : self.outDir,
+                       'outFileName' : 'out.nc',
+                       'gridProj' : 'latlon',
+                       'projAttrs' : {'xOrig' : '0', 'yOrig' : '0', 
+                                      'xCell' : '1', 'yCell' : '1', 
+                                      'nRows' : '1', 'nCols' : '2'},
+                       'mapFunc' : 'point_in_cell',
+                       'outFunc' : 'expression_avg_netCDF',
+                       'outFuncAttrs' : {'time' : 'time',
+                                         'longitude' : 'lon',
+                                         'inFieldNames' : 'val',
+                                         'outFieldNames' : 'outVal',
+                                         'outUnits' : 'foo',
+                                         'logNormal' : 'False',
+                                         'dimLabels' : '',
+                                         'dimSizes' : '',
+                                         'timeStart' : '00:00:00_01-04-2012',
+                                         'timeStop' : '23:59:59_01-04-2012',
+                                         'timeComparison' : 'UTC',
+                                         'fillVal' : '-9999',
+                                         'weight' : '1',
+                                         'filter' : 'cf <= 0.3'},
+                       'verbose' : 'False'}
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dataDir)
+        shutil.rmtree(self.outDir)
+
+    def write_granule(self, vals):
+        parser = fakeParser('granule.he5')
+        lat = numpy.array([[.5, .5, .5, .5]])
+        lon = numpy.array([[.5, .5, 1.5, 1.5]])
+        ind = numpy.indices((1, 4)).transpose((1,2,0))
+        parser.prime_centers(lat, lon, ind)
+        parser.prime_corners(numpy.repeat(lat[..., None], 4, 2), 
+                             numpy.repeat(lon[..., None], 4, 2), ind)
+        time = utils.timestr_to_nsecs('12:00:00_01-04-2012', 
+                                      '00:00:00_01-01-1993', 
+                                      '%H:%M:%S_%m-%d-%Y')
+        parser.prime_get('time', numpy.array([[time]*4]))
+        parser.prime_get('lon', lon)
+        parser.prime_get('cf', numpy.array([[.1, .2, .5, .3]]))
+        parser.prime_get('val', numpy.array([vals]))
+        (arrays, fieldInfo) = granule_cache.cache_arrays(
+            parser, ['time', 'lon', 'cf', 'val'], None)
+        granule_cache.write_cache(self.cachePath, arrays, fieldInfo, 
+                                  parser.name, 'HDFknmiomil2', None)
+
+    def read_output(self):
+        fid = netCDF4.Dataset(os.path.join(self.outDir, 'out.nc'), 'r')
+        try:
+            return fid.variables['outVal'][:]
+        finally:
+            fid.close()
+
+    def test_run_writes_output(self):
+        written = pipeline.run(self.config)
+        self.assertEqual(written, [os.path.join(self.outDir, 'out.nc')])
+        numpy.testing.assert_array_almost_equal(self.read_output(), 
+                                                [[1.5, 4.]])
+        # the configuration is left as it was
+        self.assertIn('nRows', self.config['projAttrs'])
+        self.assertNotIn('nRows', self.config)
+
+    def test_invalid_config_raises(self):
+        del self.config['projAttrs']['nRows']
+        self.config['outFuncAttrs']['fillVal'] = 'none'
+        try:
+            pipeline.prepare(self.config)
+        except pipeline.ConfigError as err:
+            text = ' '.join(err.messages)
+            self.assertIn('nRows', text)
+            self.assertIn('fillVal', text)
+        else:
+            self.fail('ConfigError not raised')
+        self.config['mapFunc'] = 'nearest'
+        self.assertRaises(pipeline.ConfigError, pipeline.run, self.config)
+
+    def test_pyramid_rejected_when_tiled(self):
+        self.config['outFunc'] = 'OMNO2e_netCDF_avg'
+        self.config['outFuncAttrs'] = {'inFieldNames' : 'val', 
+                                       'pyramidFactors' : '2'}
+        self.config['tileShape'] = '1,1'
+        try:
+            pipeline.prepare(self.config)
+        except pipeline.ConfigError as err:
+            self.assertIn('pyramidFactors', ' '.join(err.messages))
+        else:
+            self.fail('ConfigError not raised')
+
+    def test_pipeline_keeps_grids_and_parsers(self):
+        with pipeline.Pipeline(keepOpen=True) as pl:
+            pl.run(self.config)
+            parser = pl.parser(self.cachePath, 'HDFknmiomil2', {})
+            griddef = pl.griddef(grid_geo.latlon_GridDef, 
+                                 pipeline.prepare(self.config).grids[0][1])
+            pl.run(self.config)
+            self.assertIs(pl.parser(self.cachePath, 'HDFknmiomil2', {}), 
+                          parser)
+            self.assertEqual(len(pl._griddefs), 1)
+            self.assertIs(pl._griddefs.values()[0], griddef)
+            # a granule that changes is read again
+            self.write_granule([5., 6., 7., 8.])
+            mtime = os.path.getmtime(self.cachePath) + 10
+            os.utime(self.cachePath, (mtime, mtime))
+            pl.run(self.config)
+            self.assertIsNot(pl.parser(self.cachePath, 'HDFknmiomil2', {}), 
+                             parser)
+            numpy.testing.assert_array_almost_equal(self.read_output(), 
+                                                    [[5.5, 8.]])
+        self.assertEqual(len(pl._parsers), 0)
+
+    def test_run_opens_granule_once_for_all_outputs(self):
+        self.config['gridBlocks'] = [{'gridProj' : 'latlon', 
+                                      'attrs' : {'nCols' : '1'}}]
+        self.config['outBlocks'] = [{'outFunc' : 'expression_avg_netCDF', 
+                                     'outFileName' : 'other.nc', 
+                                     'attrs' : {}}]
+        opens = []
+        enter = parse_geo.WHCcache_File.__enter__
+        def counting_enter(parser):
+            if not getattr(parser, '_cmDepth', 0):
+                opens.append(parser)
+            return enter(parser)
+        parse_geo.WHCcache_File.__enter__ = counting_enter
+        try:
+            written = pipeline.run(self.config)
+        finally:
+            parse_geo.WHCcache_File.__enter__ = enter
+        self.assertEqual(len(written), 4)
+        # opened once to map onto both grids and once to build all
+        # four outputs, and closed again afterwards
+        self.assertEqual(len(opens), 2)
+        self.assertEqual(opens[0]._cmDepth, 0)
+        numpy.testing.assert_array_almost_equal(self.read_output(), 
+                                                [[1.5, 4.]])
+
+    def test_parser_pool_is_bounded(self):
+        pl = pipeline.Pipeline(maxParsers=1)
+        other = os.path.join(self.dataDir, 'other.whc')
+        import shutil
+        shutil.copy(self.cachePath, other)
+        first = pl.parser(self.cachePath, 'HDFknmiomil2', {})
+        pl.parser(other, 'HDFknmiomil2', {})
+        self.assertEqual(len(pl._parsers), 1)
+        self.assertIsNot(pl.parser(self.cachePath, 'HDFknmiomil2', {}), first)
+
+    def test_prepare_lists_output_files(self):
+        self.config['gridBlocks'] = [{'gridProj' : 'latlon', 
+                                      'attrs' : {'nCols' : '1'}}]
+        job = pipeline.prepare(self.config)
+        self.assertEqual(job.output_files(), 
+                         [os.path.join(self.outDir, 'out.nc'),
+                          os.path.join(self.outDir, 'out_grid1.nc')])
+        self.assertEqual(os.listdir(self.outDir), [])
+
+class TestLazyImports(unittest.TestCase):
+
+    HEAVY = ['tables', 'pyhdf', 'netCDF4', 'shapely', 'pyproj']
+
+    def test_registries_skip_heavy_imports(self):
+        import subprocess
+        script = '\n'.join([
+            'import sys',
+            'import parse_geo, grid_geo, map_geo, out_geo, pipeline',
+            'names = (parse_geo.SupportedFileTypes() + ',
+            '         grid_geo.ValidProjections() + map_geo.ValidMaps() + ',
+            '         out_geo.ValidOutfuncs())',
+            'assert "latlon" in names and "point_in_cell" in names',
+            'try:',
+            '    pipeline.prepare({"filetype" : "HDFknmiomil2_generic", ',
+            '                      "gridProj" : "latlon", ',
+            '                      "mapFunc" : "point_in_cell", ',
+            '                      "outDirectory" : {0!r}, '.format(
+                    tempfile.gettempdir()),
+            '                      "verbose" : False})',
+            'except pipeline.ConfigError:',
+            '    pass',
+            'print " ".join([m for m in {0!r} if m in sys.modules])'.format(
+                    self.HEAVY)])
+        out = subprocess.check_output(
+            [sys.executable, '-c', script], 
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(out.strip(), '')
+
+    def test_lazy_module_loads_on_use(self):
+        mod = lazy.LazyModule('netCDF4')
+        self.assertFalse(mod.loaded())
+        self.assertIs(mod.Dataset, netCDF4.Dataset)
+        self.assertTrue(mod.loaded())
+        self.assertRaises(AttributeError, getattr, mod, 'noSuchAttribute')
+
+class TestAccumulators(unittest.TestCase):
+
+    def test_add_sorted_matches_group_sum(self):
+        groups = numpy.random.randint(0, 5, 50)
+        values = numpy.random.rand(50, 3)
+        backend = accumulators.get_backend('memmap')
+        try:
+            target = backend.zeros((5, 3))
+            accumulators.add_sorted(target, groups, values)
+            numpy.testing.assert_array_equal(target, 
+                pixel_table.group_sum(groups, values, 5))
+        finally:
+            backend.close()
+
+    def test_memmap_scratch_removed_on_close(self):
+        scratchDir = tempfile.mkdtemp()
+        try:
+            with accumulators.get_backend('memmap', scratchDir) as backend:
+                backend.zeros((10, 10))
+                self.assertEqual(len(os.listdir(scratchDir)), 1)
+            self.assertEqual(os.listdir(scratchDir), [])
+        finally:
+            os.rmdir(scratchDir)
+
+    def test_row_blocks_cover_every_row(self):
+        backend = accumulators.get_backend('memmap')
+        try:
+            blocks = accumulators.row_blocks(backend, 10, 
+                                             accumulators.BLOCK_BYTES // 3)
+            self.assertEqual([(b.start, b.stop) for b in blocks], 
+                             [(0, 3), (3, 6), (6, 9), (9, 10)])
+        finally:
+            backend.close()
+        self.assertEqual(accumulators.row_blocks(
+                accumulators.get_backend('memory'), 10, 2**40), 
+                         [slice(0, 10)])
+
+    def test_invalid_backend_raises(self):
+        self.assertRaises(ValueError, accumulators.get_backend, 'disk')
+
+    def test_coarsen_sums_blocks(self):
+        fine = numpy.arange(24.).reshape(4, 6)
+        index = accumulators.CellIndex(4, 6, [1, 7, 20, 23])
+        (coarse, sums) = accumulators.coarsen(index, 
+            accumulators.MemoryAccumulators(), 2, 
+            {'a' : fine.ravel()[index.cells], 'b' : [numpy.ones((4, 2))]})
+        self.assertEqual((coarse.nRows, coarse.nCols, coarse.sparse), 
+                         (2, 3, False))
+        numpy.testing.assert_array_equal(sums['a'], [8, 0, 0, 0, 20, 23])
+        numpy.testing.assert_array_equal(sums['b'][0][:, 0], 
+                                         [2, 0, 0, 0, 1, 1])
+        self.assertRaises(ValueError, accumulators.coarsen, index, 
+                          accumulators.MemoryAccumulators(), 4, [])
+
+    def test_cell_index_sparse_below_density(self):
+        maps = [map_helpers.init_output_map((2, 5, 10, 14)),
+                map_helpers.init_output_map((2, 5, 10, 14))]
+        maps[0][(2, 11)].append(((0, 0), None))
+        maps[0][(5, 14)]
+        maps[1][(3, 10)].append(((0, 1), None))
+        maps[1][(2, 11)].append(((0, 2), None))
+        index = accumulators.cell_index(maps, (2, 5, 10, 14), .15)
+        self.assertTrue(index.sparse)
+        numpy.testing.assert_array_equal(index.cells, [1, 5])
+        numpy.testing.assert_array_equal(index.rows(numpy.array([5, 1, 5])),
+                                         [1, 0, 1])
+        self.assertAlmostEqual(index.density(), .1)
+        self.assertFalse(accumulators.cell_index(maps, (2, 5, 10, 14), 
+                                                 .05).sparse)
+        dense = accumulators.cell_index(maps, (2, 5, 10, 14))
+        self.assertFalse(dense.sparse)
+        self.assertEqual(dense.nCells, 20)
+        self.assertEqual([(rows.start, rows.stop, fileRows) for (rows, fileRows)
+                          in dense.blocks(accumulators.MemoryAccumulators(), 8)],
+                         [(0, 20, slice(0, 4))])
+
 class TestOutGeo(unittest.TestCase):
     
     
@@ -3663,6 +5019,513 @@ class Test_OMNO2e_netCDF_avg_out_func(TestOutGeo):
         out = self.fid.variables['outTest2D'][:]
         numpy.testing.assert_array_almost_equal(expected, out)
 
+    def test_cutoff_sweep_writes_var_per_combination(self):
+        self.defParms['cloudFractUpperCutoff'] = '0.25,0.5'
+        self.defParms['solarZenAngUpperCutoff'] = [80, 85]
+        outFunc = out_geo.OMNO2e_netCDF_avg_out_func(self.defParms)
+        self.mapDict[(0,0)] = []
+        resDict = outFunc(self.mapDict, self.one_el_grid, self.outFname,
+                          verbose=False, version=self.version)
+        expected = set()
+        for suffix in ['_cf0.25_sza80', '_cf0.25_sza85',
+                       '_cf0.5_sza80', '_cf0.5_sza85']:
+            expected.update(['outTest2D'+suffix, 'outTest3D'+suffix])
+        self.assertEqual(set(resDict.keys()), expected)
+
+    def test_cutoff_sweep_matches_individual_runs(self):
+        self.cfrac[0,28:32] = [.1, .4, .1, .4]
+        self.solZenAng[0,28:32] = [30, 30, 82, 82]
+        self.time[0,28:32] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[0,28:32] = numpy.random.rand(4)
+        self.mapDict[(0,0)] = [((0,i), None) for i in range(28,32)]
+        self.defParms['cloudFractUpperCutoff'] = [.25, .5]
+        self.defParms['solarZenAngUpperCutoff'] = [80, 85]
+        sweepDict = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+            self.mapDict, self.one_el_grid, self.outFname, verbose=False,
+            version=self.version)
+        for (cfCut, szaCut) in product([.25, .5], [80, 85]):
+            self.defParms['cloudFractUpperCutoff'] = cfCut
+            self.defParms['solarZenAngUpperCutoff'] = szaCut
+            resDict = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, self.one_el_grid, self.outFname, verbose=False,
+                version=self.version)
+            suffix = '_cf{0:g}_sza{1:g}'.format(cfCut, szaCut)
+            numpy.testing.assert_array_equal(resDict['outTest2D'],
+                                             sweepDict['outTest2D'+suffix])
+
+    def test_repeated_cutoffs_written_once(self):
+        self.mapDict[(0,0)] = []
+        self.defParms['cloudFractUpperCutoff'] = '.25,.5,.25'
+        self.defParms['solarZenAngUpperCutoff'] = [80, 80]
+        resDict = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+            self.mapDict, self.one_el_grid, self.outFname, verbose=False,
+            version=self.version)
+        self.assertIn('outTest2D_cf0.25_sza80', resDict)
+        self.assertIn('outTest2D_cf0.5_sza80', resDict)
+        self.assertEqual(len([k for k in resDict if 
+                              k.startswith('outTest2D')]), 2)
+        # cutoffs too close to name apart are rejected up front
+        self.defParms['cloudFractUpperCutoff'] = [.25, .2500001]
+        outFunc = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))
+        self.assertRaises(ValueError, outFunc, self.mapDict, 
+                          self.one_el_grid, self.outFname, False, 
+                          self.version)
+
+    def test_pixel_filter_matches_cutoffs(self):
+        self.cfrac[0,:4] = [.2, .3, numpy.NaN, .2]
+        self.solZenAng[0,:4] = [30, 30, 30, numpy.NaN]
+        self.qualFlag[0,:4] = [0, 0, 0, 0]
+        self.qualFlag[0,4:6] = [1, 2]
+        self.time[0,:] = self.toTAI93('08:00:00 08-30-2011')
+        self.time[0,6] = self.toTAI93('08:00:00 08-31-2011')
+        self.solZenAng[0,7] = 85
+        ind = numpy.array([[0, i] for i in range(8)])
+        # fields are read through the context manager only
+        get = self.parser.get
+        self.parser.get_cm = lambda key, indices=None: get(key, indices)
+        self.parser.get = None
+        mask = self.defOutFunc.pixel_filter(self.parser, ind)
+        numpy.testing.assert_array_equal(mask, [True, False, False, True, 
+                                                False, True, False, False])
+
+    def test_prefiltered_map_gives_identical_output(self):
+        griddef = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                           'xCell' : 1, 'yCell' : 1, 
+                                           'nRows' : 4, 'nCols' : 4})
+        self.parser.prime_centers(numpy.random.rand(20, 60)*4, 
+                                  numpy.random.rand(20, 60)*4,
+                                  numpy.indices((20, 60)).transpose((1,2,0)))
+        self.cfrac[:] = numpy.random.rand(20, 60)*.5
+        self.qualFlag[:] = numpy.random.randint(0, 4, (20, 60))
+        self.solZenAng[:] = numpy.random.rand(20, 60)*100
+        self.time[:] = self.toTAI93('08:00:00 08-30-2011')
+        self.time[::3] = self.toTAI93('08:00:00 08-31-2011')
+        self.test2D[:] = numpy.random.rand(20, 60)
+        self.test3D[:] = numpy.random.rand(20, 60, 4)
+        self.defParms['includePixelCount'] = True
+        fullMap = map_geo.point_in_cell_map_geo(self.parser, griddef, False)
+        full = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                fullMap, griddef, self.outFname, False, self.version)
+        filtered = prefilter.prefilter_parser(self.parser, 
+                       [out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))])
+        self.assertIsNot(filtered, self.parser)
+        self.assertLess(filtered.get_geo_centers().size, 20*60)
+        partMap = map_geo.point_in_cell_map_geo(filtered, griddef, False)
+        part = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                partMap, griddef, self.outFname, False, self.version)
+        self.assertEqual(sorted(full.keys()), sorted(part.keys()))
+        for key in full:
+            numpy.testing.assert_array_equal(full[key], part[key])
+
+    def test_memmap_accumulator_gives_identical_file(self):
+        self.cfrac[:2] = numpy.random.rand(2, 60)*.5
+        self.time[:2] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[:2] = numpy.random.rand(2, 60)
+        self.test3D[:2] = numpy.random.rand(2, 60, 4)
+        for i in range(6):
+            self.mapDict[divmod(i, 3)] = [((i//3, j), None) for j 
+                                          in range(i*10, i*10+10)]
+        self.defParms['includePixelCount'] = True
+        self.defParms['cloudFractUpperCutoff'] = [.25, .5]
+        inMemory = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, self.six_el_grid, self.outFname, False, 
+                self.version)
+        (outFid, mmapFname) = tempfile.mkstemp()
+        os.close(outFid)
+        self.defParms['accumulator'] = 'memmap'
+        try:
+            result = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, self.six_el_grid, mmapFname, False, self.version)
+            self.assertEqual(result, {})
+            fid = netCDF4.Dataset(mmapFname, 'r')
+            try:
+                self.assertEqual(sorted(fid.variables.keys()), 
+                                 sorted(inMemory.keys()))
+                for key in inMemory:
+                    numpy.testing.assert_array_equal(fid.variables[key][:],
+                                                     inMemory[key])
+            finally:
+                fid.close()
+        finally:
+            os.remove(mmapFname)
+
+    def test_sparse_output_gathers_dense_values(self):
+        self.cfrac[:2] = numpy.random.rand(2, 60)*.5
+        self.time[:2] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[:2] = numpy.random.rand(2, 60)
+        self.test3D[:2] = numpy.random.rand(2, 60, 4)
+        self.mapDict[(0,1)] = [((0, j), None) for j in range(10)]
+        self.mapDict[(1,2)] = [((1, j), None) for j in range(10, 20)]
+        self.mapDict[(1,0)] = []
+        self.defParms['includePixelCount'] = True
+        dense = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, self.six_el_grid, self.outFname, False, 
+                self.version)
+        self.defParms['sparseDensity'] = '0.5'
+        sparse = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, self.six_el_grid, self.outFname, False, 
+                self.version)
+        numpy.testing.assert_array_equal(sparse['cell'], [1, 5])
+        for key in dense:
+            numpy.testing.assert_array_equal(sparse[key], 
+                dense[key].reshape((6,) + dense[key].shape[2:])[[1, 5]])
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outTest3D'].dimensions, 
+                             ('cell', 'layer'))
+            self.assertEqual(fid.variables['cell'].compress, 'row col')
+            numpy.testing.assert_array_equal(fid.variables['outTest2D'][:],
+                                             sparse['outTest2D'])
+        finally:
+            fid.close()
+
+    def test_invalid_accumulator_raises(self):
+        self.defParms['accumulator'] = 'disk'
+        outFunc = out_geo.OMNO2e_netCDF_avg_out_func(self.defParms)
+        self.assertRaises(ValueError, outFunc.pixel_filter, self.parser, 
+                          [[0, 0]])
+        self.assertIn('accumulator', outFunc.optional_parms())
+
+    def test_statistics_written_with_average(self):
+        self.time[:4] = self.toTAI93('17:20:00 08-30-2011')
+        self.cfrac[:4] = .1
+        self.test2D[:4,5] = [1., 2., 4., numpy.NaN]
+        self.test3D[:4,5] = numpy.arange(16.).reshape(4, 4)
+        # same cross-track position and cloud fraction, so equal weights
+        self.mapDict[(0,1)] = [((i, 5), None) for i in range(4)]
+        self.defParms['statistics'] = 'std,min,max,histogram'
+        self.defParms['histogramBins'] = '0,2,16'
+        result = out_geo.OMNO2e_netCDF_avg_out_func(self.defParms)(
+                self.mapDict, self.six_el_grid, self.outFname, False, 
+                self.version)
+        self.assertAlmostEqual(result['outTest2D_std'][0,1], 
+                               numpy.std([1., 2., 4.]))
+        self.assertEqual(result['outTest2D_min'][0,1], 1.)
+        self.assertEqual(result['outTest2D_max'][0,0], -99999.0)
+        # the pixel with a NaN is rejected outright, as for the average
+        numpy.testing.assert_array_equal(result['outTest3D_max'][0,1], 
+                                         [8., 9., 10., 11.])
+        numpy.testing.assert_array_equal(result['outTest2D_histogram'][0,1],
+                                         [1, 2])
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outTest3D_histogram'].dimensions,
+                             ('row', 'col', 'layer', 'histogramBin'))
+            numpy.testing.assert_array_equal(
+                fid.variables['HistogramBinEdges'][:], [0, 2, 16])
+            numpy.testing.assert_array_equal(fid.variables['outTest2D_std'][:],
+                                             result['outTest2D_std'])
+        finally:
+            fid.close()
+
+    def test_invalid_statistic_raises(self):
+        self.defParms['statistics'] = ['median']
+        outFunc = out_geo.OMNO2e_netCDF_avg_out_func(self.defParms)
+        self.assertRaises(ValueError, outFunc.pixel_filter, self.parser, 
+                          [[0, 0]])
+
+    def pyramid_maps(self):
+        '''
+        A 2x4 grid and map, and the 1x2 grid and map it coarsens to by a
+        factor of 2
+        '''
+        self.cfrac[:2] = numpy.random.rand(2, 60)*.5
+        self.time[:2] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[:2] = numpy.random.rand(2, 60)
+        self.test3D[:2] = numpy.random.rand(2, 60, 4)
+        fine = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 'xCell' : 1,
+                                        'yCell' : 1, 'nRows' : 2, 'nCols' : 4})
+        coarse = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                          'xCell' : 2, 'yCell' : 2, 
+                                          'nRows' : 1, 'nCols' : 2})
+        coarseMap = {'parser' : self.parser, (0,0) : [], (0,1) : []}
+        for cell in product(range(2), range(4)):
+            pixels = [((cell[0], j), None) for j in 
+                      range(cell[1]*15, cell[1]*15 + 5*(cell[0] + 1))]
+            self.mapDict[cell] = pixels
+            coarseMap[(0, cell[1]//2)] += pixels
+        return (fine, coarse, coarseMap)
+
+    def test_pyramid_matches_coarse_run(self):
+        (fine, coarse, coarseMap) = self.pyramid_maps()
+        self.defParms['includePixelCount'] = True
+        self.defParms['cloudFractUpperCutoff'] = [.25, .5]
+        direct = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                coarseMap, coarse, self.outFname, False, self.version)
+        self.defParms['pyramidFactors'] = '2'
+        result = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, fine, self.outFname, False, self.version)
+        for key in direct:
+            numpy.testing.assert_array_almost_equal(result[key + '_x2'], 
+                                                    direct[key], 12)
+        self.assertEqual(result['outTest3D_cf0.5_sza80'].shape, (2, 4, 4))
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outTest3D_cf0.5_sza80_x2'].dimensions,
+                             ('row_x2', 'col_x2', 'layer'))
+            self.assertEqual(list(numpy.atleast_1d(fid.Pyramid_factors)), 
+                             [2])
+        finally:
+            fid.close()
+
+    def test_pyramid_files(self):
+        (fine, coarse, coarseMap) = self.pyramid_maps()
+        self.defParms['pyramidFactors'] = [2]
+        self.defParms['pyramidFiles'] = 'True'
+        self.defParms['accumulator'] = 'memmap'
+        self.defParms['sparseDensity'] = 1
+        levelFname = self.outFname + '_x2'
+        try:
+            out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                self.mapDict, fine, self.outFname, False, self.version)
+            fid = netCDF4.Dataset(levelFname, 'r')
+            try:
+                self.assertEqual(fid.variables['outTest2D'].dimensions, 
+                                 ('row', 'col'))
+                self.assertEqual((fid.nRows, fid.nCols, fid.xCell), (1, 2, 2))
+                levelAvg = fid.variables['outTest2D'][:]
+            finally:
+                fid.close()
+        finally:
+            if os.path.isfile(levelFname):
+                os.remove(levelFname)
+        del self.defParms['pyramidFactors']
+        del self.defParms['sparseDensity']
+        direct = out_geo.OMNO2e_netCDF_avg_out_func(dict(self.defParms))(
+                coarseMap, coarse, self.outFname, False, self.version)
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            numpy.testing.assert_array_almost_equal(
+                levelAvg, fid.variables['outTest2D'][:], 12)
+        finally:
+            fid.close()
+
+    def test_pyramid_needs_whole_blocks(self):
+        self.defParms['pyramidFactors'] = [2]
+        self.mapDict[(0,0)] = []
+        self.assertRaises(ValueError, out_geo.OMNO2e_netCDF_avg_out_func(
+                dict(self.defParms)), self.mapDict, self.six_el_grid, 
+                          self.outFname, False, self.version)
+        self.defParms['pyramidFactors'] = [1]
+        self.assertRaises(ValueError, out_geo.OMNO2e_netCDF_avg_out_func(
+                dict(self.defParms)), self.mapDict, self.one_el_grid, 
+                          self.outFname, False, self.version)
+
+    def test_no_prefilter_without_pixel_filter(self):
+        self.parser.prime_centers(numpy.zeros((2, 3)), numpy.zeros((2, 3)),
+                                  numpy.indices((2, 3)).transpose((1,2,0)))
+        self.assertIs(prefilter.prefilter_parser(self.parser, 
+                          [self.defOutFunc, out_geo.out_func({})]), 
+                      self.parser)
+
+class Test_OMNO2e_netCDF_quantile_out_func(TestOutGeo):
+
+    def setUp(self):
+        Test_OMNO2e_netCDF_avg_out_func.setUp.im_func(self)
+        self.defParms['percentiles'] = '0,50,100'
+
+    def tearDown(self):
+        os.remove(self.outFname)
+
+    def test_percentiles_of_filtered_pixels(self):
+        self.time[0] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[0,:6] = [5., 1., 4., 2., 100., numpy.NaN]
+        self.test3D[0,:6] = numpy.arange(24.).reshape(6, 4)
+        # cloudy pixel rejected, as is the pixel with a field all NaN
+        self.cfrac[0,4] = .5
+        self.mapDict[(0,0)] = [((0, j), None) for j in range(6)]
+        self.mapDict[(0,1)] = []
+        self.defParms['includePixelCount'] = True
+        outFunc = out_geo.OMNO2e_netCDF_quantile_out_func(self.defParms)
+        result = outFunc(self.mapDict, self.six_el_grid, self.outFname,
+                         verbose=False, version=self.version)
+        numpy.testing.assert_array_equal(result['outTest2D_p50'][0,:2], 
+                                         [3., -99999.0])
+        self.assertEqual(result['outTest2D_p0'][0,0], 1.)
+        self.assertEqual(result['outTest2D_p100'][0,0], 5.)
+        numpy.testing.assert_array_equal(result['outTest3D_p50'][0,0], 
+                                         [6., 7., 8., 9.])
+        self.assertEqual(result['ValidPixelCount'][0,0], 4)
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outTest3D_p100'].dimensions, 
+                             ('row', 'col', 'layer'))
+            self.assertEqual(fid.variables['outTest2D_p50'].Percentile, 50)
+        finally:
+            fid.close()
+
+    def test_sketch_merges_granules(self):
+        self.time[:] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[:] = numpy.random.rand(20, 60)
+        self.defParms['sketchSize'] = 20
+        self.defParms['percentiles'] = [10, 50, 90]
+        maps = []
+        for half in range(2):
+            map = map_helpers.init_output_map(self.one_el_grid.indLims())
+            map['parser'] = self.parser
+            map[(0,0)] = [((i, j), None) for i in range(half*10, half*10+10)
+                          for j in range(60)]
+            maps.append(map)
+        result = out_geo.OMNO2e_netCDF_quantile_out_func(self.defParms)(
+            maps, self.one_el_grid, self.outFname, False, self.version)
+        expected = numpy.percentile(self.test2D, [10, 50, 90])
+        for (pct, exp) in zip([10, 50, 90], expected):
+            self.assertAlmostEqual(result['outTest2D_p{0}'.format(pct)][0,0],
+                                   exp, delta=.05)
+
+    def test_written_sketches_merge_across_runs(self):
+        self.time[:] = self.toTAI93('17:20:00 08-30-2011')
+        self.test2D[:] = numpy.random.rand(20, 60)
+        self.defParms['sketchSize'] = 20
+        self.defParms['percentiles'] = [50]
+        self.defParms['writeSketches'] = 'True'
+        backend = accumulators.MemoryAccumulators()
+        merged = None
+        for half in range(2):
+            map = map_helpers.init_output_map(self.one_el_grid.indLims())
+            map['parser'] = self.parser
+            map[(0,0)] = [((i, j), None) for i in range(half*10, half*10+10)
+                          for j in range(60)]
+            out_geo.OMNO2e_netCDF_quantile_out_func(self.defParms)(
+                [map], self.one_el_grid, self.outFname, False, self.version)
+            fid = netCDF4.Dataset(self.outFname, 'r')
+            try:
+                self.assertEqual(
+                    fid.variables['outTest2D_sketchCount'].dimensions,
+                    ('row', 'col', 'sketchSlot'))
+                sk = sketches.QuantileSketches.load(backend, 
+                    fid.variables['outTest2D_sketchMean'][:],
+                    fid.variables['outTest2D_sketchCount'][:])
+            finally:
+                fid.close()
+            if merged is None:
+                merged = sk
+            else:
+                merged.merge(sk)
+        self.assertEqual(merged.total(slice(0, 1))[0], 1200)
+        self.assertAlmostEqual(merged.quantiles(slice(0, 1), [.5])[0,0],
+                               numpy.median(self.test2D), delta=.05)
+
+    def test_cutoff_sweep_names(self):
+        self.defParms['cloudFractUpperCutoff'] = [.25, .5]
+        self.mapDict[(0,0)] = []
+        result = out_geo.OMNO2e_netCDF_quantile_out_func(self.defParms)(
+            self.mapDict, self.one_el_grid, self.outFname, False, self.version)
+        self.assertIn('outTest2D_cf0.5_sza80_p50', result)
+        self.assertEqual(len(result), 12)
+
+    def test_invalid_percentile_raises(self):
+        self.defParms['percentiles'] = [50, 101]
+        outFunc = out_geo.OMNO2e_netCDF_quantile_out_func(self.defParms)
+        self.mapDict[(0,0)] = []
+        self.assertRaises(ValueError, outFunc, self.mapDict, self.one_el_grid,
+                          self.outFname, False, self.version)
+
+    def test_in_valid_outfuncs(self):
+        self.assertIn('OMNO2e_netCDF_quantile', out_geo.ValidOutfuncs())
+        self.assertIn('sketchSize', 
+                      out_geo.OMNO2e_netCDF_quantile_out_func.optional_parms())
+
+class TestCellStats(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = accumulators.MemoryAccumulators()
+
+    def test_weighted_variance(self):
+        (vals, wghts) = (numpy.random.rand(50) + 1e6, numpy.random.rand(50))
+        keys = numpy.arange(50) % 2
+        stats = cell_stats.CellStatistics(self.backend, 3, ['variance', 'min'])
+        stats.add(keys, vals, wghts)
+        result = stats.results(slice(0, 3), -1.)
+        for key in range(2):
+            mean = numpy.average(vals[keys == key], weights=wghts[keys == key])
+            self.assertAlmostEqual(result['variance'][key], numpy.average(
+                    (vals[keys == key] - mean)**2, weights=wghts[keys == key]),
+                                   places=6)
+        numpy.testing.assert_array_equal(result['min'][2:], [-1.])
+        self.assertEqual(result['variance'][2], -1.)
+
+    def test_merge_matches_single_pass(self):
+        (vals, keys) = (numpy.random.rand(100), numpy.arange(100) % 4)
+        whole = cell_stats.CellStatistics(self.backend, 4, 
+                                          cell_stats.STATISTICS, [0, .5, 1])
+        whole.add(keys, vals)
+        parts = [cell_stats.CellStatistics(self.backend, 4, 
+                                           cell_stats.STATISTICS, [0, .5, 1])
+                 for i in range(2)]
+        parts[0].add(keys[:30], vals[:30])
+        parts[1].add(keys[30:], vals[30:])
+        parts[0].merge(parts[1])
+        (expected, merged) = (whole.results(slice(0, 4)), 
+                              parts[0].results(slice(0, 4)))
+        for stat in cell_stats.STATISTICS:
+            numpy.testing.assert_array_almost_equal(merged[stat], 
+                                                    expected[stat])
+
+    def test_merge_with_results_read_back(self):
+        (vals, keys) = (numpy.random.rand(100), numpy.arange(100) % 4)
+        whole = cell_stats.CellStatistics(self.backend, 5, 
+                                          cell_stats.STATISTICS, [0, .5, 1])
+        whole.add(keys, vals)
+        parts = [cell_stats.CellStatistics(self.backend, 5, 
+                                           cell_stats.STATISTICS, [0, .5, 1])
+                 for i in range(2)]
+        parts[0].add(keys[:30], vals[:30])
+        parts[1].add(keys[30:], vals[30:])
+        # as written to, and read back from, two output files
+        written = [part.results(slice(0, 5), -9999.) for part in parts]
+        self.assertEqual(sorted(written[0].keys()), 
+                         sorted(parts[0].outputs()))
+        reread = [cell_stats.CellStatistics.from_results(
+                self.backend, cell_stats.STATISTICS, results, [0, .5, 1], 
+                -9999.) for results in written]
+        reread[0].merge(reread[1])
+        (expected, merged) = (whole.results(slice(0, 5), -9999.), 
+                              reread[0].results(slice(0, 5), -9999.))
+        for stat in whole.outputs():
+            numpy.testing.assert_array_almost_equal(merged[stat], 
+                                                    expected[stat])
+
+    def test_histogram(self):
+        vals = numpy.random.rand(200)*10
+        stats = cell_stats.CellStatistics(self.backend, 1, ['histogram'], 
+                                          [0, 2.5, 5, 10])
+        stats.add(numpy.zeros(200), vals)
+        numpy.testing.assert_array_equal(stats.results(slice(0, 1))['histogram'][0],
+            numpy.histogram(vals, [0, 2.5, 5, 10])[0])
+
+    def test_invalid_statistics_raise(self):
+        self.assertRaises(ValueError, cell_stats.check_statistics, ['mode'])
+        self.assertRaises(ValueError, cell_stats.check_statistics, 
+                          ['histogram'], [1, 0])
+
+class TestSketches(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = accumulators.MemoryAccumulators()
+
+    def test_exact_below_sketch_size(self):
+        sk = sketches.QuantileSketches(self.backend, 3, 10)
+        sk.add([0, 0, 0, 1, 1, 1, 1], [3., 1., 2., 4., 1., numpy.NaN, 2.])
+        numpy.testing.assert_array_equal(
+            sk.quantiles(slice(0, 3), [0, .5, 1], -1.),
+            [[1., 2., 3.], [1., 2., 4.], [-1., -1., -1.]])
+        numpy.testing.assert_array_equal(sk.total(slice(0, 3)), [3, 3, 0])
+
+    def test_merge_matches_single_pass(self):
+        vals = numpy.random.rand(500)
+        whole = sketches.QuantileSketches(self.backend, 1, 10)
+        whole.add(numpy.zeros(500), vals)
+        parts = [sketches.QuantileSketches(self.backend, 1, 10) 
+                 for i in range(2)]
+        parts[0].add(numpy.zeros(250), vals[:250])
+        parts[1].add(numpy.zeros(250), vals[250:])
+        parts[0].merge(parts[1])
+        self.assertEqual(parts[0].total(slice(0, 1)), 500)
+        self.assertLessEqual(numpy.count_nonzero(parts[0].counts), 10)
+        for sk in (whole, parts[0]):
+            self.assertAlmostEqual(sk.quantiles(slice(0, 1), [.5])[0,0],
+                                   numpy.median(vals), delta=.1)
 
 class Test_unweighted_filtered_MOPITT_avg_netCDF_out_func(TestOutGeo):
     
@@ -3926,6 +5789,51 @@ class Test_unweighted_filtered_MOPITT_avg_netCDF_out_func(TestOutGeo):
                               version = self.version)
         numpy.testing.assert_array_almost_equal(resDict['threeDnorm'][1,2,:], expected)
 
+    def test_both_writes_day_and_night_vars(self):
+        self.pDict['dayTime'] = 'Both'
+        newOutClass = out_geo.unweighted_filtered_MOPITT_avg_netCDF_out_func(self.pDict)
+        resDict = newOutClass(self.mapDict, self.sixElGr,
+                              self.outFname, verbose=False,
+                              version = self.version)
+        expected = set()
+        for name in self.pDict['outFieldNames']:
+            expected.update([name+'_day', name+'_night'])
+        self.assertEqual(set(resDict.keys()), expected)
+
+    def test_both_splits_on_SZA_2D(self):
+        self.pDict['dayTime'] = 'Both'
+        newOutClass = out_geo.unweighted_filtered_MOPITT_avg_netCDF_out_func(self.pDict)
+        self.mapDict[(1,2)] = [((2,3), None), ((2,4), None)]
+        self.SZA[2,4] = 100
+        resDict = newOutClass(self.mapDict, self.sixElGr,
+                              self.outFname, verbose=False,
+                              version = self.version)
+        self.assertAlmostEqual(resDict['twoDnorm_day'][1,2], self.twoDnorm[2,3])
+        self.assertAlmostEqual(resDict['twoDnorm_night'][1,2], self.twoDnorm[2,4])
+
+    def test_both_filters_sTypes_within_split(self):
+        self.pDict['dayTime'] = 'Both'
+        newOutClass = out_geo.unweighted_filtered_MOPITT_avg_netCDF_out_func(self.pDict)
+        # three day pixels on surface type 0, one night pixel on type 1.
+        # The night pixel must not be screened out by the day majority
+        self.mapDict[(1,2)] = [((0,0), None), ((0,1), None), ((0,2), None),
+                               ((1,0), None)]
+        self.SZA[1,0] = 100
+        self.sType[1,0] = 1
+        resDict = newOutClass(self.mapDict, self.sixElGr,
+                              self.outFname, verbose=False,
+                              version = self.version)
+        self.assertAlmostEqual(resDict['twoDnorm_day'][1,2],
+                               self.twoDnorm[0,:3].mean())
+        self.assertAlmostEqual(resDict['twoDnorm_night'][1,2],
+                               self.twoDnorm[1,0])
+
+    def test_invalid_dayTime_rejected(self):
+        self.pDict['dayTime'] = 'Dusk'
+        self.assertRaises(ValueError,
+                          out_geo.unweighted_filtered_MOPITT_avg_netCDF_out_func,
+                          self.pDict)
+
     def test_screen_out_bad_sTypes_2D(self):
         self.mapDict[(1,2)] = [((0,0), None), ((0,1), None), ((0,2), None), 
                                ((1,0), None), ((1,1), None), ((1,2), None),
@@ -4622,6 +6530,232 @@ class Test_unweighted_filtered_MOPITT_avg_netCDF_out_func(TestOutGeo):
         numpy.testing.assert_array_almost_equal(self.fid.variables['threeDnorm'][1,2,:].filled(), expected)
 
 
+class TestExpressions(unittest.TestCase):
+    
+    
+    def setUp(self):
+        self.parser = fakeParser('foo.dat')
+        self.parser.prime_get('cf', numpy.array([[.1, .5, numpy.NaN], 
+                                                 [.2, .3, .4]]))
+        self.parser.prime_get('Solar Zenith Angle', 
+                              numpy.array([[10., 20., 30.], [40., 90., 60.]]))
+        self.parser.prime_get('flag', numpy.array([[0, 1, 2], [3, 4, 5]]))
+        self.ind = numpy.indices((2, 3)).reshape(2, -1).T
+
+    def evaluate(self, text):
+        return expressions.compile_expression(text).evaluate(self.parser, 
+                                                             self.ind)
+
+    def test_fields_read_through_context_manager(self):
+        get = self.parser.get
+        self.parser.get_cm = lambda key, indices=None: get(key, indices)
+        self.parser.get = None
+        numpy.testing.assert_array_equal(self.evaluate('flag * 2'), 
+                                         [0, 2, 4, 6, 8, 10])
+
+    def test_arithmetic_precedence(self):
+        numpy.testing.assert_array_almost_equal(self.evaluate('1 + 2*3**2 - -1'),
+                                                [20]*6)
+        numpy.testing.assert_array_almost_equal(self.evaluate('(1+2)*flag % 4'),
+                                                [0, 3, 2, 1, 0, 3])
+
+    def test_fields_and_braces(self):
+        expr = expressions.compile_expression('cf <= 0.3 and '
+                                              '{Solar Zenith Angle} < 85')
+        self.assertEqual(expr.fields, set(['cf', 'Solar Zenith Angle']))
+        numpy.testing.assert_array_equal(expr.evaluate(self.parser, self.ind),
+                                         [True, False, False, True, 
+                                          False, False])
+
+    def test_logic_and_functions(self):
+        numpy.testing.assert_array_equal(
+            self.evaluate('not isnan(cf) & (flag % 2 == 0 or cf > 0.35)'),
+            [True, True, False, False, True, True])
+        numpy.testing.assert_array_almost_equal(
+            self.evaluate('where(flag > 2, max(cf, 0.35), index(1))'),
+            [0, 1, 2, .35, .35, .4])
+
+    def test_constant_gives_value_per_pixel(self):
+        numpy.testing.assert_array_equal(self.evaluate('True'), [True]*6)
+
+    def test_invalid_expressions_raise(self):
+        for text in ['', 'cf <', '(cf', 'cf cf', 'foo(cf)', 'min(cf)', 
+                     '__import__("os")', 'cf; flag', 'cf.real']:
+            self.assertRaises(ValueError, expressions.compile_expression, text)
+
+    def test_weight_and_filter_functions(self):
+        wght = expressions.ExpressionWeight('1/(1+3*cf)')
+        filt = expressions.ExpressionFilter('{Solar Zenith Angle} <= 85 and '
+                                            'cf < 0.45')
+        wght.prime(self.parser, self.ind)
+        self.assertAlmostEqual(wght(self.parser, (1, 0), None), 1/1.6)
+        numpy.testing.assert_array_equal(
+            filt(self.parser, [(0, 0), (0, 2), (1, 1), (1, 2)]),
+            [False, True, True, False])
+        self.assertEqual(len(filt(self.parser, [])), 0)
+
+    def test_primed_values_handed_out_whole(self):
+        wght = expressions.ExpressionWeight('1/(1+3*cf)')
+        filt = expressions.ExpressionFilter('{Solar Zenith Angle} <= 85 and '
+                                            'cf < 0.45')
+        for func in (wght, filt):
+            func.prime(self.parser, self.ind)
+        self.assertIs(wght.values(self.parser, self.ind), wght._values)
+        numpy.testing.assert_array_almost_equal(
+            wght.weights(self.parser, self.ind), 
+            [wght(self.parser, tuple(i), None) for i in self.ind])
+        numpy.testing.assert_array_equal(filt.rejected(self.parser, self.ind),
+                                         filt(self.parser, self.ind))
+        # pixels not primed are evaluated when asked for
+        numpy.testing.assert_array_almost_equal(
+            wght.weights(self.parser, self.ind[[4, 1]]), [1/1.9, 1/2.5])
+
+class Test_expression_avg_netCDF_out_func(TestOutGeo):
+    
+    def setUp(self):
+        TestOutGeo.setUp(self)
+        self.grid = grid_geo.latlon_GridDef({'xOrig' : 0, 'yOrig' : 0, 
+                                             'xCell' : 1, 'yCell' : 1, 
+                                             'nRows' : 1, 'nCols' : 2})
+        self.pDict = {'time' : 'time',
+                      'longitude' : 'lon',
+                      'inFieldNames' : ['val'],
+                      'outFieldNames' : ['outVal'],
+                      'outUnits' : ['foo'],
+                      'logNormal' : ['False'],
+                      'dimLabels' : [[]],
+                      'dimSizes' : [[]],
+                      'timeStart' : '00:00:00_01-04-2012',
+                      'timeStop' : '23:59:59_01-04-2012',
+                      'timeComparison' : 'UTC',
+                      'fillVal' : -9999.0,
+                      'weight' : '1/(1+3*cf)',
+                      'filter' : 'cf <= 0.3'}
+        (outFid, self.outFname) = (tempfile.mkstemp())
+        os.close(outFid)
+        self.parser.prime_get('time', numpy.array(
+                [self.toTAI93('12:00:00 01-04-2012')]*4).reshape(1, 4))
+        self.parser.prime_get('lon', numpy.zeros((1, 4)))
+        self.parser.prime_get('cf', numpy.array([[.1, .2, .5, .3]]))
+        self.parser.prime_get('val', numpy.array([[1., 2., 3., 4.]]))
+        self.mapDict = map_helpers.init_output_map(self.grid.indLims())
+        self.mapDict['parser'] = self.parser
+        self.mapDict[(0,0)] = [((0, 0), None), ((0, 1), None), ((0, 2), None)]
+        self.mapDict[(0,1)] = [((0, 2), None)]
+
+    def tearDown(self):
+        os.remove(self.outFname)
+
+    def test_weighted_filtered_average(self):
+        outFunc = out_geo.expression_avg_netCDF_out_func(self.pDict)
+        result = outFunc(self.mapDict, self.grid, self.outFname, 
+                         verbose=False, version='TEST VERSION')
+        (w0, w1) = (1/1.3, 1/1.6)
+        self.assertAlmostEqual(result['outVal'][0,0], (w0*1 + w1*2)/(w0 + w1))
+        self.assertEqual(result['outVal'][0,1], -9999.0)
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertIn('cf <= 0.3', fid.Filter_function_description)
+        finally:
+            fid.close()
+
+    def test_expressions_evaluated_once_per_granule(self):
+        outFunc = out_geo.expression_avg_netCDF_out_func(self.pDict)
+        calls = []
+        for name in ('weightFunction', 'filterFunction'):
+            expression = outFunc.parmDict[name].expression
+            def evaluate(parser, ind, evaluate=expression.evaluate):
+                calls.append(len(ind))
+                return evaluate(parser, ind)
+            expression.evaluate = evaluate
+        result = outFunc(self.mapDict, self.grid, self.outFname, 
+                         verbose=False, version='TEST VERSION')
+        # each expression is evaluated once, for the 3 pixels mapped
+        self.assertEqual(calls, [3, 3])
+        (w0, w1) = (1/1.3, 1/1.6)
+        self.assertAlmostEqual(result['outVal'][0,0], (w0*1 + w1*2)/(w0 + w1))
+
+    def test_in_valid_outfuncs(self):
+        self.assertIn('expression_avg_netCDF', out_geo.ValidOutfuncs())
+        self.assertIn('filter', 
+                      out_geo.expression_avg_netCDF_out_func.required_parms())
+
+    def test_pixel_filter(self):
+        outFunc = out_geo.expression_avg_netCDF_out_func(self.pDict)
+        mask = outFunc.pixel_filter(self.parser, [[0, 0], [0, 1], [0, 2], 
+                                                  [0, 3]])
+        numpy.testing.assert_array_equal(mask, [True, True, False, True])
+
+    def test_invalid_expression_raises(self):
+        self.pDict['weight'] = 'cf +'
+        self.assertRaises(ValueError, out_geo.expression_avg_netCDF_out_func,
+                          self.pDict)
+
+    def test_memmap_accumulator_gives_identical_file(self):
+        inMemory = out_geo.expression_avg_netCDF_out_func(self.pDict)(
+            self.mapDict, self.grid, self.outFname, False, 'TEST VERSION')
+        self.pDict['accumulator'] = 'memmap'
+        (outFid, mmapFname) = tempfile.mkstemp()
+        os.close(outFid)
+        try:
+            result = out_geo.expression_avg_netCDF_out_func(self.pDict)(
+                self.mapDict, self.grid, mmapFname, False, 'TEST VERSION')
+            self.assertEqual(result, {})
+            fid = netCDF4.Dataset(mmapFname, 'r')
+            try:
+                numpy.testing.assert_array_equal(fid.variables['outVal'][:],
+                                                 inMemory['outVal'])
+            finally:
+                fid.close()
+        finally:
+            os.remove(mmapFname)
+
+    def test_sparse_output_above_density_is_dense(self):
+        self.pDict['sparseDensity'] = 0.5
+        result = out_geo.expression_avg_netCDF_out_func(self.pDict)(
+            self.mapDict, self.grid, self.outFname, False, 'TEST VERSION')
+        self.assertNotIn('cell', result)
+        self.assertEqual(result['outVal'].shape, (1, 2))
+
+    def test_sparse_output(self):
+        self.pDict['sparseDensity'] = 0.5
+        del self.mapDict[(0,1)]
+        result = out_geo.expression_avg_netCDF_out_func(self.pDict)(
+            self.mapDict, self.grid, self.outFname, False, 'TEST VERSION')
+        numpy.testing.assert_array_equal(result['cell'], [0])
+        (w0, w1) = (1/1.3, 1/1.6)
+        self.assertAlmostEqual(result['outVal'][0], (w0*1 + w1*2)/(w0 + w1))
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outVal'].dimensions, ('cell',))
+        finally:
+            fid.close()
+
+    def test_invalid_accumulator_raises(self):
+        self.pDict['accumulator'] = 'disk'
+        self.assertRaises(ValueError, out_geo.expression_avg_netCDF_out_func,
+                          self.pDict)
+
+    def test_statistics(self):
+        self.pDict['statistics'] = ['variance', 'max']
+        result = out_geo.expression_avg_netCDF_out_func(self.pDict)(
+            self.mapDict, self.grid, self.outFname, False, 'TEST VERSION')
+        (w0, w1) = (1/1.3, 1/1.6)
+        mean = (w0*1 + w1*2)/(w0 + w1)
+        self.assertAlmostEqual(result['outVal_variance'][0,0], 
+                               (w0*(1 - mean)**2 + w1*(2 - mean)**2)/(w0 + w1))
+        self.assertEqual(result['outVal_max'][0,0], 2.)
+        self.assertEqual(result['outVal_max'][0,1], -9999.0)
+        fid = netCDF4.Dataset(self.outFname, 'r')
+        try:
+            self.assertEqual(fid.variables['outVal_variance'].Units, '(foo)^2')
+            # with the state needed to merge the variance with other runs
+            self.assertAlmostEqual(fid.variables['outVal_sumWght'][0,0], 
+                                   w0 + w1)
+            self.assertAlmostEqual(fid.variables['outVal_mean'][0,0], mean)
+        finally:
+            fid.close()
+
 '''
 if __name__ == '__main__':
     foo = '__main__.TestNASAOmiL2GetGeoCorners.test_raises_IO_if_no_corner_file_invalid_dir'
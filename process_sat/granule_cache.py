@@ -0,0 +1,177 @@
+'''
+Compact caches of granules for fast reprocessing.
+
+Each run of whips opens and decodes every granule it processes,
+although it usually needs only a handful of the fields in each.
+Archives that are processed many times can instead be ingested
+once (see ingest.py) into granule caches.  A cache holds the
+geolocation of a granule and the selected fields, with missing
+values, scale and offset already applied.  Optionally, only the
+pixels passing a filter expression (see expressions.py) are kept.
+Caches are read with parse_geo.WHCcache_File.
+
+A cache is a single file.  It starts with the 8 byte signature
+parse_geo.CACHE_MAGIC, followed by the length of a JSON header as
+a little-endian 8 byte integer and the header itself.  The arrays
+follow, each starting on a multiple of parse_geo.CACHE_ALIGN bytes
+from the start of the data (itself the first such multiple after
+the header), so that they can be memory mapped.  The header gives
+the dtype, shape and offset of every array, the fields and the
+arrays holding them, and the granule and parser the cache was
+made from.
+
+The arrays of a cache are
+    ind - the indices of the pixels kept, one row per pixel
+    rows - for every pixel index of the granule, the row of the
+        pixel in the other arrays, or -1 if it was not kept
+    lat, lon - the pixel centers
+    latCorners, lonCorners - the pixel corners (if the parser
+        provides them)
+    scanlineTimes - the time of the scanline of each pixel (if
+        the parser provides it)
+    field<n> - the fields, one row per pixel for fields that vary
+        by pixel and otherwise whole
+'''
+import os
+import json
+import datetime
+
+import numpy
+
+import parse_geo
+import expressions
+import pixel_table
+
+# version of the cache format
+CACHE_VERSION = 1
+
+# extension given to caches
+CACHE_EXT = '.whc'
+
+def cache_arrays(parser, fields, filterText=None):
+    '''
+    Read the arrays of a cache (see module docstring) from parser.
+    Returns (arrays, fieldInfo), where arrays is a dictionary of
+    arrays by name and fieldInfo describes every field for the header.
+    If filterText is given, only the pixels for which that expression
+    is true are kept.
+    '''
+    with parser:
+        centers = parser.get_geo_centers()
+        flat = centers.reshape(-1)
+        ind = flat['ind'].reshape(flat.size, -1)
+        keep = numpy.ones(flat.size, dtype=bool)
+        if filterText is not None and flat.size:
+            vals = expressions.compile_expression(filterText).evaluate(parser,
+                                                                       ind)
+            # NaN's are neither true nor false, so those pixels are dropped
+            keep = numpy.logical_and(vals != 0, vals == vals)
+        kept = numpy.flatnonzero(keep)
+
+        # lookup from pixel index to row
+        if flat.size:
+            indShape = tuple(ind.max(axis=0) + 1)
+        else:
+            indShape = (0,) * ind.shape[1]
+        rows = numpy.empty(indShape, dtype=numpy.int64)
+        rows.fill(-1)
+        rows[tuple(ind[kept].T)] = numpy.arange(kept.size)
+        arrays = {'ind' : ind[kept], 'rows' : rows,
+                  'lat' : flat['lat'][kept], 'lon' : flat['lon'][kept]}
+
+        try:
+            corners = parser.get_geo_corners().reshape(-1)
+            arrays['latCorners'] = corners['lat'][kept]
+            arrays['lonCorners'] = corners['lon'][kept]
+        except (IOError, NotImplementedError):
+            pass
+
+        try:
+            times = parser.get_scanline_times()
+        except NotImplementedError:
+            times = None
+        if times is not None and centers.ndim and len(times) == len(centers):
+            # the scanline of each pixel is its index along the first axis
+            perLine = flat.size // max(len(centers), 1)
+            arrays['scanlineTimes'] = times[kept // max(perLine, 1)]
+
+        fieldInfo = dict()
+        for (i, field) in enumerate(fields):
+            name = 'field{0}'.format(i)
+            (arrays[name], perPixel) = pixel_table.read_column(parser, field,
+                                                               ind[kept])
+            fieldInfo[field] = {'array' : name, 'perPixel' : perPixel}
+    return (arrays, fieldInfo)
+
+def write_cache(cachePath, arrays, fieldInfo, source, parserName,
+                filterText=None):
+    '''
+    Write arrays and fieldInfo (as returned by cache_arrays) to a
+    cache at cachePath.  source is the granule they were read from and
+    parserName the parser it was read with.  The cache is written to
+    a temporary file first, so a failed write never leaves a partial
+    cache behind.
+    '''
+    header = {'version' : CACHE_VERSION, 'source' : os.path.abspath(source),
+              'parser' : parserName, 'filter' : filterText,
+              'fields' : fieldInfo, 'arrays' : dict()}
+    offset = 0
+    order = sorted(arrays.keys())
+    for name in order:
+        arr = numpy.ascontiguousarray(arrays[name])
+        arrays[name] = arr
+        header['arrays'][name] = {'dtype' : arr.dtype.str,
+                                  'shape' : list(arr.shape),
+                                  'offset' : offset}
+        offset = parse_geo.cache_aligned(offset + arr.nbytes)
+    headerStr = json.dumps(header)
+    dataStart = parse_geo.cache_aligned(len(parse_geo.CACHE_MAGIC) + 8 +
+                                        len(headerStr))
+    tmpPath = cachePath + '.tmp'
+    with open(tmpPath, 'wb') as fid:
+        fid.write(parse_geo.CACHE_MAGIC)
+        fid.write(numpy.array(len(headerStr), dtype='<u8').tostring())
+        fid.write(headerStr)
+        for name in order:
+            fid.seek(dataStart + header['arrays'][name]['offset'])
+            fid.write(arrays[name].tostring())
+        # make sure the file covers the last (possibly empty) array
+        fid.truncate(dataStart + offset)
+    os.rename(tmpPath, cachePath)
+
+def cache_matches(cachePath, parserName, fields, filterText=None):
+    '''
+    Whether the cache at cachePath was made by this version with the
+    parser parserName, holding exactly fields and kept the pixels
+    passing filterText
+    '''
+    try:
+        header = parse_geo.read_cache_header(cachePath)
+    except (IOError, ValueError):
+        return False
+    return (header.get('version') == CACHE_VERSION and
+            header.get('parser') == parserName and
+            header.get('filter') == filterText and
+            set(header.get('fields', {}).keys()) == set(fields))
+
+def ingest_file(f, parserName, parserParms, outDirectory, fields,
+                filterText=None, verbose=False):
+    '''
+    Convert the granule f, read with the parser parserName, into a
+    cache in outDirectory.  The cache is only written if it doesn't
+    exist, is older than the granule or was made with a different
+    parser, fields or filter.  Returns the path of the cache.
+    '''
+    cachePath = os.path.join(outDirectory, os.path.basename(f) + CACHE_EXT)
+    if (os.path.exists(cachePath) and
+        os.path.getmtime(cachePath) >= os.path.getmtime(f) and
+        cache_matches(cachePath, parserName, fields, filterText)):
+        if verbose:
+            print('Cache {0} is up to date'.format(cachePath))
+        return cachePath
+    if verbose:
+        print('Ingesting {0} at {1}'.format(f, str(datetime.datetime.now())))
+    parser = parse_geo.get_parser(f, parserName, parserParms)
+    (arrays, fieldInfo) = cache_arrays(parser, fields, filterText)
+    write_cache(cachePath, arrays, fieldInfo, f, parserName, filterText)
+    return cachePath
@@ -0,0 +1,170 @@
+'''
+Cache for the geometry of a grid.
+
+Computing the lat/lon of every gridcell corner and center
+requires an inverse projection of every point in the grid,
+which is slow for large domains.  The functions here compute
+these products once per grid definition and, if a cache
+directory is given, store them on disk so that later runs
+on the same grid can skip the projections entirely.
+
+Grids are identified by the name of their GridDef class,
+their parameters and their index limits.  Each grid gets its
+own subdirectory of the cache directory, containing one .npy
+file per product.  The arrays are loaded memory-mapped and
+read-only.
+
+Products stored for each grid:
+    indLims - the index limits of the grid (see GridDef.indLims)
+    ll_lat, ll_lon, ul_lat, ul_lon, ur_lat, ur_lon,
+    lr_lat, lr_lon, cent_lat, cent_lon - the latitude and
+        longitude of each corner and the center of every
+        gridcell, in degrees.  Arrays are (nRows, nCols).
+    area - the area of every gridcell in square kilometers,
+        computed on a sphere from the corners.
+'''
+import os
+import shutil
+import hashlib
+import tempfile
+from collections import OrderedDict
+
+import numpy
+
+# corner labels and their (row, col) offsets within a gridcell
+CELL_POINTS = [('ll', (0,0)), ('ul', (1,0)), ('ur', (1,1)),
+               ('lr', (0,1)), ('cent', (.5,.5))]
+
+EARTH_RADIUS_KM = 6371.0
+
+class LRUCache(object):
+    '''
+    A cache holding at most maxSize items.  Once full, adding an
+    item drops the item least recently added or looked up, so that
+    long runs (IE many tiles, or a long-lived Pipeline) only keep
+    what they are using
+    '''
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._items = OrderedDict()
+    def get(self, key, default=None):
+        '''The item for key, or default if it is not held'''
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            return default
+        self._items[key] = value
+        return value
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxSize:
+            self._items.popitem(last=False)
+    def __contains__(self, key):
+        return key in self._items
+    def __len__(self):
+        return len(self._items)
+    def clear(self):
+        self._items.clear()
+
+# grids most recently loaded in this process, keyed by grid_key
+_loaded = LRUCache(4)
+
+def grid_key(griddef):
+    '''
+    Return a string uniquely identifying the grid defined by griddef.
+    Grids with the same class, parameters and index limits share a key
+    '''
+    ident = repr((griddef.__class__.__name__, sorted(griddef.parms.items()),
+                  tuple(griddef.indLims())))
+    return hashlib.sha1(ident).hexdigest()
+
+def cell_areas(cornerLats, cornerLons):
+    '''
+    Area (in square kilometers) of spherical polygons given the
+    lat/lon of their vertices in order.  cornerLats and cornerLons
+    are lists of arrays, one per vertex.
+    '''
+    area = numpy.zeros(numpy.shape(cornerLats[0]))
+    nVerts = len(cornerLats)
+    for i in range(nVerts):
+        (lat1, lon1) = (cornerLats[i], cornerLons[i])
+        (lat2, lon2) = (cornerLats[(i+1)%nVerts], cornerLons[(i+1)%nVerts])
+        dLon = numpy.mod(lon2 - lon1 + 180, 360) - 180
+        area += numpy.radians(dLon) * (2 + numpy.sin(numpy.radians(lat1)) +
+                                       numpy.sin(numpy.radians(lat2)))
+    return numpy.abs(area) * EARTH_RADIUS_KM**2 / 2
+
+def compute_grid_geometry(griddef):
+    '''Compute all the products stored for griddef.  Returns a dict'''
+    (minRow, maxRow, minCol, maxCol) = griddef.indLims()
+    (cols, rows) = numpy.meshgrid(numpy.arange(minCol, maxCol+1, dtype=float),
+                                  numpy.arange(minRow, maxRow+1, dtype=float))
+    geom = {'indLims' : numpy.array(griddef.indLims())}
+    for (lbl, (rowOff, colOff)) in CELL_POINTS:
+        (lat, lon) = griddef.griddedToGeo(rows+rowOff, cols+colOff)
+        geom[lbl+'_lat'] = numpy.asarray(lat, dtype=numpy.float64)
+        geom[lbl+'_lon'] = numpy.asarray(lon, dtype=numpy.float64)
+    corners = [lbl for (lbl, unused_off) in CELL_POINTS if lbl != 'cent']
+    geom['area'] = cell_areas([geom[lbl+'_lat'] for lbl in corners],
+                              [geom[lbl+'_lon'] for lbl in corners])
+    return geom
+
+def _read_cache(path):
+    '''Load all the products in path.  Returns None if any are missing'''
+    names = ['indLims', 'area'] + [lbl+suffix for (lbl, unused_off)
+                                   in CELL_POINTS for suffix in ('_lat', '_lon')]
+    try:
+        return dict([(name, numpy.load(os.path.join(path, name+'.npy'),
+                                       mmap_mode='r')) for name in names])
+    except (IOError, ValueError):
+        return None
+
+def write_arrays(path, arrays):
+    '''
+    Write arrays (a dict keyed to name) to the directory path, one
+    .npy file per array.  The files are written to a temporary
+    directory first and moved into place, so other processes never
+    see a partially written cache.
+    '''
+    parent = os.path.dirname(path)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    tmpPath = tempfile.mkdtemp(dir=parent)
+    try:
+        for (name, arr) in arrays.iteritems():
+            numpy.save(os.path.join(tmpPath, name+'.npy'), arr)
+        os.rename(tmpPath, path)
+    finally:
+        # only left behind if something went wrong
+        shutil.rmtree(tmpPath, ignore_errors=True)
+
+def load_grid_geometry(griddef, cacheDir=None):
+    '''
+    Return the geometry products for griddef as a dict of arrays.
+
+    The products of the last few grids are kept in memory.  If
+    cacheDir is given, they are read from (or, the first time, 
+    written to) that directory as well.
+    '''
+    key = grid_key(griddef)
+    if key in _loaded:
+        return _loaded.get(key)
+    geom = None
+    if cacheDir is not None:
+        path = os.path.join(cacheDir, '{0}_{1}'.format(
+                griddef.__class__.__name__, key))
+        geom = _read_cache(path)
+        if geom is None:
+            geom = compute_grid_geometry(griddef)
+            try:
+                write_arrays(path, geom)
+            except (IOError, OSError):
+                # fine if another process wrote the same grid first
+                if not os.path.isdir(path):
+                    print('Warning: unable to write grid cache to '
+                          '{0}'.format(path))
+    if geom is None:
+        geom = compute_grid_geometry(griddef)
+    _loaded[key] = geom
+    return geom
@@ -49,10 +49,29 @@ Functions implemented for each class:
     griddedToGeo - from decimal indices (row/col) 
         to geo-coordinates.  Accepts numpy arrays.
         Returns (lat,lon) in degrees.
+
+Subclasses may also implement optionalParms, which
+has the same form as requiredParms but lists 
+parameters that may be omitted.
+
+Functions implemented once for all classes:
+    tile - return a copy of the GridDef whose
+        indLims are restricted to part of the grid.
+        All the transformations are unchanged.
+    fullIndLims - the indLims of the whole grid,
+        even if the instance is a tile.
 '''
 import sys
+import math
+import copy
+from itertools import product
+
+import numpy
+
+import lazy
 
-from pyproj import Proj
+netCDF4 = lazy.LazyModule('netCDF4')
+pyproj = lazy.LazyModule('pyproj')
 
 def ValidProjections():
     '''Return a list of valid projection names'''
@@ -67,6 +86,9 @@ class GridDef:
     def requiredParms():
         raise NotImplementedError
     requiredParms = staticmethod(requiredParms)
+    def optionalParms():
+        return {}
+    optionalParms = staticmethod(optionalParms)
     def indLims(self):
         raise NotImplementedError
     def geoToProjected(self, lat, lon):
@@ -77,6 +99,116 @@ class GridDef:
         raise NotImplementedError
     def griddedToGeo(self, row, col):
         raise NotImplementedError
+    def tile(self, lims):
+        '''
+        Return a copy of this GridDef covering only the cells
+        within lims, given as (minRow, maxRow, minCol, maxCol)
+        '''
+        lims = tuple(lims)
+        tile = copy.copy(self)
+        tile.indLims = lambda: lims
+        return tile
+    def fullIndLims(self):
+        '''indLims for the whole grid, even for a tile'''
+        return self.__class__.indLims(self)
+
+
+class GeoLookupTable:
+    '''
+    Approximate a smooth transform from geo-coordinates to gridded
+    coordinates by bilinear interpolation in a regular lat/lon table.
+
+    The table spans the box [minLat, maxLat] x [minLon, maxLon].  
+    Longitudes are measured relative to centerLon and wrapped to 
+    (-180, 180] so the box may straddle the dateline.  The table is 
+    refined at construction until the interpolated row and column
+    agree with exactFunc to within maxError (in cells) at the
+    midpoints of every table cell and cell edge.  If that cannot be
+    done within maxNodes nodes per side, a ValueError is raised.
+
+    Points outside the table (or NaN) are passed to exactFunc.
+    '''
+    def __init__(self, exactFunc, minLat, maxLat, minLon, maxLon, 
+                 centerLon, maxError, maxNodes=4096):
+        self._exactFunc = exactFunc
+        self._centerLon = centerLon
+        self._minLat = float(minLat)
+        self._minLon = self._relLon(minLon)
+        maxLon = self._relLon(maxLon)
+        if maxLon <= self._minLon:
+            raise ValueError('Lookup table longitude range is empty')
+        (nLat, nLon) = (16, 16)
+        while True:
+            lats = numpy.linspace(self._minLat, maxLat, nLat)
+            lons = numpy.linspace(self._minLon, maxLon, nLon)
+            (lat, lon) = numpy.meshgrid(lats, lons, indexing='ij')
+            (self._rowTab, self._colTab) = self._exact(lat, lon)
+            self._dLat = lats[1]-lats[0]
+            self._dLon = lons[1]-lons[0]
+            self._shape = (nLat, nLon)
+            # check halfway between nodes, where interpolation is worst
+            midLats = numpy.linspace(self._minLat, maxLat, 2*nLat-1)
+            midLons = numpy.linspace(self._minLon, maxLon, 2*nLon-1)
+            (lat, lon) = numpy.meshgrid(midLats, midLons, indexing='ij')
+            (row, col) = self._exact(lat, lon)
+            (rowInt, colInt) = self._interp(lat, lon)
+            err = max(numpy.nanmax(numpy.abs(rowInt-row)), 
+                      numpy.nanmax(numpy.abs(colInt-col)))
+            self.achievedError = err
+            if err <= maxError:
+                break
+            # interpolation error goes as spacing squared
+            factor = 1.1*math.sqrt(err/maxError)
+            (nLat, nLon) = (int(math.ceil((nLat-1)*factor))+1, 
+                            int(math.ceil((nLon-1)*factor))+1)
+            if max(nLat, nLon) > maxNodes:
+                raise ValueError('Could not build a lookup table accurate '
+                                 'to {0} cells with at most {1} nodes per '
+                                 'side (best error {2} cells)'.format(
+                                     maxError, maxNodes, err))
+    def _relLon(self, lon):
+        return numpy.mod(numpy.asarray(lon, dtype=numpy.float64) 
+                         - self._centerLon + 180, 360) - 180
+    def _exact(self, lat, relLon):
+        return self._exactFunc(lat, relLon + self._centerLon)
+    def _interp(self, lat, relLon):
+        '''Bilinear interpolation for points known to be in the table'''
+        fi = (lat-self._minLat)/self._dLat
+        fj = (relLon-self._minLon)/self._dLon
+        i = numpy.clip(numpy.floor(fi).astype(int), 0, self._shape[0]-2)
+        j = numpy.clip(numpy.floor(fj).astype(int), 0, self._shape[1]-2)
+        ti = fi-i
+        tj = fj-j
+        # flat indices of the four surrounding nodes
+        k00 = i*self._shape[1]+j
+        k10 = k00+self._shape[1]
+        out = []
+        for tab in (self._rowTab.ravel(), self._colTab.ravel()):
+            lower = tab.take(k00) + tj*(tab.take(k00+1)-tab.take(k00))
+            upper = tab.take(k10) + tj*(tab.take(k10+1)-tab.take(k10))
+            out.append(lower + ti*(upper-lower))
+        return tuple(out)
+    def __call__(self, lat, lon):
+        (lat, lon) = numpy.broadcast_arrays(numpy.asarray(lat, dtype=numpy.float64),
+                                            numpy.asarray(lon, dtype=numpy.float64))
+        relLon = self._relLon(lon)
+        fi = (lat-self._minLat)/self._dLat
+        fj = (relLon-self._minLon)/self._dLon
+        with numpy.errstate(invalid='ignore'):
+            inside = ((fi >= 0) & (fi <= self._shape[0]-1) & 
+                      (fj >= 0) & (fj <= self._shape[1]-1))
+        if inside.all():
+            (row, col) = self._interp(lat, relLon)
+        else:
+            row = numpy.empty(lat.shape)
+            col = numpy.empty(lat.shape)
+            (row[inside], col[inside]) = self._interp(lat[inside], 
+                                                      relLon[inside])
+            outside = numpy.logical_not(inside)
+            (row[outside], col[outside]) = self._exactFunc(lat[outside], 
+                                                           lon[outside])
+        # return scalars when given scalars
+        return (row[()], col[()])
 
 
 class latlon_GridDef(GridDef):
@@ -190,6 +322,24 @@ class lcc2par_GridDef(GridDef):
                 "earthRadius":('The assumed radius of the Earth '\
                                   '(assumed spherical).  Must match units used'\
                                   ' for xCell and yCell','posdecimal')}
+    @staticmethod
+    def optionalParms():
+        '''
+        parameters that may be in the dictionary passed to 
+        instantiate this class
+        '''
+        return {"lutMaxError":('If supplied, lat/lon are converted to grid '\
+                                   'indices by interpolating in a lookup '\
+                                   'table instead of projecting every point.  '\
+                                   'The table is refined until its error is '\
+                                   'below this value (in gridcells).  Points '\
+                                   'outside the table are projected exactly', 
+                               'posdecimal'),
+                "lutMargin":('The number of gridcells beyond each edge of '\
+                                 'the domain covered by the lookup table.  '\
+                                 'Only used with lutMaxError (default: 10).  '\
+                                 'Must not be negative', 
+                             'int')}
     def __init__(self, parms):
         GridDef.__init__(self, parms)
 
@@ -213,7 +363,33 @@ class lcc2par_GridDef(GridDef):
                        'lon_0'  : parms['refLon'],
                        'x_0'    : 0,
                        'y_0'    : 0}
-        self.__proj = Proj(pyprojParms)
+        self.__proj = pyproj.Proj(pyprojParms)
+
+        # optionally build the lookup table for geoToGridded
+        self.__lut = None
+        if parms.get('lutMaxError', None) is not None:
+            margin = int(parms.get('lutMargin', 10))
+            if margin < 0:
+                raise ValueError('lutMargin must not be negative')
+            self.__lut = self.__build_lut(float(parms['lutMaxError']), margin)
+    def __build_lut(self, maxError, margin):
+        '''Build a lookup table covering the domain plus margin cells'''
+        # the extremes of lat/lon lie on the edge of the (padded) domain
+        rows = numpy.arange(-margin, self.parms['nRows']+margin+1)
+        cols = numpy.arange(-margin, self.parms['nCols']+margin+1)
+        edgeRows = numpy.concatenate([rows, rows, 
+                                      numpy.repeat(rows[0], cols.size),
+                                      numpy.repeat(rows[-1], cols.size)])
+        edgeCols = numpy.concatenate([numpy.repeat(cols[0], rows.size),
+                                      numpy.repeat(cols[-1], rows.size),
+                                      cols, cols])
+        (lat, lon) = self.griddedToGeo(edgeRows, edgeCols)
+        relLon = numpy.mod(lon - self.parms['refLon'] + 180, 360) - 180
+        return GeoLookupTable(self.__exactGeoToGridded, 
+                              numpy.min(lat), numpy.max(lat),
+                              numpy.min(relLon) + self.parms['refLon'],
+                              numpy.max(relLon) + self.parms['refLon'],
+                              self.parms['refLon'], maxError)
     def indLims(self):
         return (0, self.parms['nRows']-1,
                  0, self.parms['nCols']-1)
@@ -221,6 +397,10 @@ class lcc2par_GridDef(GridDef):
         (x,y) = self.__proj(lon, lat)
         return (y,x)
     def geoToGridded(self, lat, lon):
+        if self.__lut is not None:
+            return self.__lut(lat, lon)
+        return self.__exactGeoToGridded(lat, lon)
+    def __exactGeoToGridded(self, lat, lon):
         (y,x) = self.geoToProjected(lat, lon)
         # transform x and y to new origin
         y = y-self.parms['yOrig']
@@ -236,3 +416,268 @@ class lcc2par_GridDef(GridDef):
         y = row*self.parms['yCell']+self.parms['yOrig']
         x = col*self.parms['xCell']+self.parms['xOrig']
         return self.projectedToGeo(y,x)        
+
+
+class curvilinear_GridDef(GridDef):
+    '''
+    Performs transformations on a grid defined by the lat/lon of 
+    its cell corners rather than by a projection.
+
+    The corners are read from 2D variables in a netCDF file
+    (for example XLAT_C and XLONG_C in a WRF geo_em file).  The 
+    arrays have one more row and column than the grid, and 
+    element (i, j) is the lower-left corner of cell (i, j).  A 
+    leading time dimension of length 1 is ignored.
+
+    Within each cell, the lat/lon are a bilinear function of the 
+    fractional row and column.  geoToGridded finds the cell center
+    nearest each point through a spatial hash of the centers built
+    when the grid is loaded, then inverts the bilinear function of 
+    that cell, moving to a neighboring cell when the point falls 
+    outside it.  Points outside the domain are extrapolated from the
+    nearest edge cell, so they still fall outside indLims.
+
+    Convention for this class is that the "projected" coordinates
+    are the gridded coordinates, since there is no native projection.
+
+    Cautions:
+    - The grid may not contain a pole
+    - Cells must be convex
+    '''
+    # the number of times a point may move to a neighboring cell
+    # while inverting the bilinear function
+    MAX_CELL_STEPS = 4
+    # the number of Newton iterations per cell
+    NEWTON_ITERS = 6
+
+    @staticmethod
+    def parm_list():
+        return ['gridFile', 'latVar', 'lonVar']
+
+    @staticmethod
+    def requiredParms():
+        '''Parameters that must be in the dictonary passed to instantiate'''
+        return {"gridFile":('The netCDF file containing the latitude and '\
+                                'longitude of the gridcell corners', None),
+                "latVar":('The name of the variable in gridFile holding the '\
+                              'latitude of the gridcell corners, in '\
+                              'degrees.  It must have one more row and '\
+                              'column than the grid', None),
+                "lonVar":('The name of the variable in gridFile holding the '\
+                              'longitude of the gridcell corners, in '\
+                              'degrees.  It must have one more row and '\
+                              'column than the grid', None)}
+    def __init__(self, parms):
+        GridDef.__init__(self, parms)
+        self.parms = parms
+        fid = netCDF4.Dataset(parms['gridFile'], 'r')
+        try:
+            lat = numpy.array(fid.variables[parms['latVar']][:], 
+                              dtype=numpy.float64)
+            lon = numpy.array(fid.variables[parms['lonVar']][:], 
+                              dtype=numpy.float64)
+        finally:
+            fid.close()
+        # drop any leading singleton (time) dimensions
+        while lat.ndim > 2 and lat.shape[0] == 1:
+            lat = lat[0]
+            lon = lon[0]
+        if lat.ndim != 2 or lat.shape != lon.shape or min(lat.shape) < 2:
+            raise ValueError('Corner variables {0} and {1} in {2} must be '\
+                             '2D arrays of the same shape with at least 2 '\
+                             'rows and columns'.format(parms['latVar'], 
+                                                       parms['lonVar'],
+                                                       parms['gridFile']))
+        self.__lat = lat
+        self.__lon = lon
+        self.__nRows = lat.shape[0]-1
+        self.__nCols = lat.shape[1]-1
+        self.__build_index()
+    def __build_index(self):
+        '''Build the spatial hash of the cell centers'''
+        corners = [self.__unit(self.__lat[r:r+self.__nRows, c:c+self.__nCols],
+                               self.__lon[r:r+self.__nRows, c:c+self.__nCols])
+                   for (r, c) in ((0,0), (1,0), (1,1), (0,1))]
+        cent = sum(corners)
+        cent /= numpy.sqrt((cent**2).sum(axis=-1))[..., numpy.newaxis]
+        self.__centers = cent.reshape(-1, 3)
+        # a point in a cell is no farther from its nearest center than 
+        # the largest center-to-corner distance.  With buckets twice 
+        # that size the nearest center is always in one of the 8 buckets
+        # around the bucket corner closest to the point
+        self.__bucket = 2*max([numpy.sqrt(((corner-cent)**2).sum(axis=-1)).max()
+                             for corner in corners])
+        self.__bucket = max(self.__bucket, 1e-9)
+        self.__nBuckets = int(math.ceil(2.0/self.__bucket)) + 3
+        buckets = self.__buckets(self.__centers)[0]
+        self.__minBucket = buckets.min(axis=0)
+        self.__maxBucket = buckets.max(axis=0)
+        keys = self.__keys(buckets)
+        self.__order = numpy.argsort(keys, kind='mergesort')
+        (self.__uniqueKeys, self.__starts, self.__counts) = numpy.unique(
+            keys[self.__order], return_index=True, return_counts=True)
+        # a subsample of the cells on the edge of the domain, used to 
+        # find a starting cell for points far outside it
+        edge = numpy.zeros((self.__nRows, self.__nCols), dtype=bool)
+        edge[[0,-1],:] = True
+        edge[:,[0,-1]] = True
+        edge = numpy.flatnonzero(edge)
+        step = max(1, edge.size // 256)
+        self.__edgeCells = edge[::step]
+    @staticmethod
+    def __unit(lat, lon):
+        '''Unit vectors for lat/lon, stacked on the last axis'''
+        (lat, lon) = (numpy.radians(lat), numpy.radians(lon))
+        return numpy.concatenate([(numpy.cos(lat)*numpy.cos(lon))[..., numpy.newaxis],
+                                  (numpy.cos(lat)*numpy.sin(lon))[..., numpy.newaxis],
+                                  numpy.sin(lat)[..., numpy.newaxis]], axis=-1)
+    def __buckets(self, vecs):
+        '''
+        Integer bucket coordinates of vecs, one column per dimension,
+        and the direction (-1 or 1) to the nearest bucket boundary
+        '''
+        scaled = vecs/self.__bucket
+        buckets = numpy.floor(scaled)
+        side = numpy.where(scaled - buckets < .5, -1, 1)
+        return (buckets.astype(numpy.int64) + self.__nBuckets//2, side)
+    def __keys(self, buckets):
+        '''Hash keys of buckets'''
+        return ((buckets[:,0]*self.__nBuckets + buckets[:,1])*self.__nBuckets + 
+                buckets[:,2])
+    def __nearest_cells(self, vecs):
+        '''
+        Flat index of the cell whose center is nearest each of vecs.
+        Points with no center in a neighboring bucket get the nearest
+        of the sampled edge cells
+        '''
+        best = numpy.zeros(vecs.shape[0], dtype=numpy.int64)
+        bestDist = numpy.empty(vecs.shape[0])
+        bestDist.fill(numpy.inf)
+        (buckets, side) = self.__buckets(vecs)
+        # only points next to an occupied bucket need searching
+        near = numpy.flatnonzero(((buckets >= self.__minBucket-1) & 
+                                  (buckets <= self.__maxBucket+1)).all(axis=1))
+        (buckets, side) = (buckets[near], side[near])
+        for offset in product((0,1), repeat=3):
+            keys = self.__keys(buckets + side*offset)
+            pos = numpy.minimum(numpy.searchsorted(self.__uniqueKeys, keys),
+                                self.__uniqueKeys.size-1)
+            hit = numpy.flatnonzero(self.__uniqueKeys[pos] == keys)
+            (inds, start) = (near[hit], self.__starts[pos[hit]])
+            count = self.__counts[pos[hit]]
+            for k in range(count.max() if count.size else 0):
+                (inds, start, count) = (inds[count > k], start[count > k], 
+                                        count[count > k])
+                cells = self.__order[start+k]
+                dist = ((vecs[inds]-self.__centers[cells])**2).sum(axis=-1)
+                closer = dist < bestDist[inds]
+                best[inds[closer]] = cells[closer]
+                bestDist[inds[closer]] = dist[closer]
+        far = numpy.flatnonzero(numpy.isinf(bestDist))
+        edgeCenters = self.__centers[self.__edgeCells]
+        for i0 in range(0, far.size, 4096):
+            inds = far[i0:i0+4096]
+            # for unit vectors the nearest has the largest dot product
+            nearest = numpy.dot(vecs[inds], edgeCenters.T).argmax(axis=1)
+            best[inds] = self.__edgeCells[nearest]
+        return best
+    def __corners(self, row, col, lon):
+        '''
+        The corners of cells (row, col) as (lat, lon) pairs in the order
+        ll, ul, ur, lr.  Longitudes are relative to lon.
+        '''
+        corners = []
+        for (r, c) in ((0,0), (1,0), (1,1), (0,1)):
+            cLon = numpy.mod(self.__lon[row+r, col+c] - lon + 180, 360) - 180
+            corners.append((self.__lat[row+r, col+c], cLon))
+        return corners
+    @staticmethod
+    def __bilinear(corners, s, t):
+        '''Bilinear interpolation of the corners at fractional s (row), t (col)'''
+        ((lat00, lon00), (lat10, lon10), (lat11, lon11), (lat01, lon01)) = corners
+        lat = ((1-s)*(1-t)*lat00 + s*(1-t)*lat10 + s*t*lat11 + (1-s)*t*lat01)
+        lon = ((1-s)*(1-t)*lon00 + s*(1-t)*lon10 + s*t*lon11 + (1-s)*t*lon01)
+        return (lat, lon)
+    def indLims(self):
+        return (0, self.__nRows-1, 0, self.__nCols-1)
+    def geoToProjected(self, lat, lon):
+        return self.geoToGridded(lat, lon)
+    def projectedToGeo(self, y, x):
+        return self.griddedToGeo(y, x)
+    def geoToGridded(self, lat, lon):
+        (latArr, lonArr) = numpy.broadcast_arrays(numpy.asarray(lat, dtype=numpy.float64),
+                                                  numpy.asarray(lon, dtype=numpy.float64))
+        shape = latArr.shape
+        latArr = latArr.ravel()
+        lonArr = lonArr.ravel()
+        row = numpy.empty(latArr.shape)
+        row.fill(numpy.nan)
+        col = row.copy()
+        valid = numpy.flatnonzero(numpy.isfinite(latArr) & numpy.isfinite(lonArr))
+        if valid.size:
+            (qLat, qLon) = (latArr[valid], lonArr[valid])
+            (cellRow, cellCol) = numpy.unravel_index(
+                self.__nearest_cells(self.__unit(qLat, qLon)), 
+                (self.__nRows, self.__nCols))
+            for unused_step in range(self.MAX_CELL_STEPS):
+                (s, t) = self.__invert_cell(cellRow, cellCol, qLat, qLon)
+                newRow = numpy.clip(cellRow + numpy.floor(s).astype(int), 
+                                    0, self.__nRows-1)
+                newCol = numpy.clip(cellCol + numpy.floor(t).astype(int), 
+                                    0, self.__nCols-1)
+                if (newRow == cellRow).all() and (newCol == cellCol).all():
+                    break
+                (cellRow, cellCol) = (newRow, newCol)
+            else:
+                (s, t) = self.__invert_cell(cellRow, cellCol, qLat, qLon)
+            row[valid] = cellRow + s
+            col[valid] = cellCol + t
+        return (row.reshape(shape)[()], col.reshape(shape)[()])
+    def __invert_cell(self, cellRow, cellCol, lat, lon):
+        '''
+        Fractional position (s, t) of lat/lon within cells 
+        (cellRow, cellCol) by Newton iteration on the bilinear function
+        '''
+        corners = self.__corners(cellRow, cellCol, lon)
+        ((lat00, lon00), (lat10, lon10), (lat11, lon11), (lat01, lon01)) = corners
+        s = numpy.empty(lat.shape)
+        s.fill(0.5)
+        t = s.copy()
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            for unused_iter in range(self.NEWTON_ITERS):
+                (fLat, fLon) = self.__bilinear(corners, s, t)
+                fLat -= lat
+                # relative longitudes put the point at 0
+                dLat_ds = (1-t)*(lat10-lat00) + t*(lat11-lat01)
+                dLon_ds = (1-t)*(lon10-lon00) + t*(lon11-lon01)
+                dLat_dt = (1-s)*(lat01-lat00) + s*(lat11-lat10)
+                dLon_dt = (1-s)*(lon01-lon00) + s*(lon11-lon10)
+                det = dLat_ds*dLon_dt - dLat_dt*dLon_ds
+                dS = (fLat*dLon_dt - fLon*dLat_dt)/det
+                dT = (fLon*dLat_ds - fLat*dLon_ds)/det
+                ok = numpy.isfinite(dS) & numpy.isfinite(dT)
+                s[ok] -= dS[ok]
+                t[ok] -= dT[ok]
+        return (s, t)
+    def griddedToGeo(self, row, col):
+        (rowArr, colArr) = numpy.broadcast_arrays(numpy.asarray(row, dtype=numpy.float64),
+                                                  numpy.asarray(col, dtype=numpy.float64))
+        shape = rowArr.shape
+        rowArr = rowArr.ravel()
+        colArr = colArr.ravel()
+        lat = numpy.empty(rowArr.shape)
+        lat.fill(numpy.nan)
+        lon = lat.copy()
+        valid = numpy.flatnonzero(numpy.isfinite(rowArr) & numpy.isfinite(colArr))
+        if valid.size:
+            # points outside the grid are extrapolated from the edge cells
+            cellRow = numpy.clip(numpy.floor(rowArr[valid]).astype(int), 
+                                 0, self.__nRows-1)
+            cellCol = numpy.clip(numpy.floor(colArr[valid]).astype(int), 
+                                 0, self.__nCols-1)
+            baseLon = self.__lon[cellRow, cellCol]
+            corners = self.__corners(cellRow, cellCol, baseLon)
+            (lat[valid], relLon) = self.__bilinear(corners, rowArr[valid]-cellRow, 
+                                                   colArr[valid]-cellCol)
+            lon[valid] = baseLon + relLon
+        return (lat.reshape(shape)[()], lon.reshape(shape)[()])
@@ -0,0 +1,120 @@
+#! /Library/Frameworks/Python.framework/Versions/Current/bin/python
+'''
+Command-line ingest of granules into compact caches
+
+Converts each granule into a cache (see granule_cache.py) holding
+only the selected fields, and optionally only the pixels passing
+a filter expression, IE
+
+    ingest.py --filetype OMI_NO2_KNMI_HDF_v2_0_postFeb2006
+              --directory /data/omi --outDirectory /data/omi_cache
+              --fields CloudFraction SolarZenithAngle Time Longitude
+                       TroposphericColumnFlag TroposphericVerticalColumn
+              --filter "TroposphericColumnFlag % 2 == 0"
+
+Caches are processed by whips exactly like the granules they came
+from, with the same filetype.  Only the fields stored in the cache
+can be used, so the fields should include every field the outputs
+read (IE the time, longitude and filter fields as well as the 
+fields to average).  Keep caches in a directory of their own, so 
+that granules are not processed twice.
+
+A cache is only rewritten when its granule is newer than it.
+'''
+import os
+import sys
+import argparse
+
+from process_sat import parse_geo
+from process_sat import filetypes
+from process_sat import discovery
+from process_sat import expressions
+from process_sat import granule_cache
+
+def parser_for_filetype(filetype):
+    '''
+    The name of the parser for filetype, which may be either a
+    filetype (see filetypes.py) or the name of a parser
+    '''
+    try:
+        return getattr(filetypes, filetype + '_filetype').parser
+    except AttributeError:
+        if hasattr(parse_geo, filetype + '_File'):
+            return filetype
+        raise ValueError('Unknown filetype {0}'.format(filetype))
+
+def parse_parser_attrs(pairs):
+    '''
+    Parse a list of "name:value" strings into a dictionary of parser
+    parameters.  Comma-delimited values become lists
+    '''
+    parms = dict()
+    for pair in pairs or []:
+        (name, unused_sep, value) = pair.partition(':')
+        parms[name] = value.split(',') if ',' in value else value
+    return parms
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser("Convert granules into compact "
+                                        "caches for fast reprocessing")
+    argParser.add_argument('--filetype', required=True, help='The filetype '
+                           '(or parser) of the granules to ingest')
+    argParser.add_argument('--directory', default=os.getcwd(),
+                           metavar='DirectoryPath', help='The directory '
+                           'containing the granules (default: current '
+                           'working directory)')
+    argParser.add_argument('--fileList', nargs='*', metavar='FileName',
+                           help='The list of files in the directory to '
+                           'ingest (default: every file the parser can read)')
+    argParser.add_argument('--include', nargs='+', metavar='Pattern',
+                           help='Only ingest files matching at least one of '
+                           'these glob patterns')
+    argParser.add_argument('--exclude', nargs='+', metavar='Pattern',
+                           help='Skip files matching any of these glob '
+                           'patterns')
+    argParser.add_argument('--recursive', default='False',
+                           choices={'True', 'False'}, help='Supply True to '
+                           'search subdirectories as well')
+    argParser.add_argument('--outDirectory', required=True,
+                           metavar='DirectoryPath', help='The directory to '
+                           'write caches to.  Should not contain granules')
+    argParser.add_argument('--fields', nargs='+', required=True,
+                           metavar='FieldName', help='The fields to store')
+    argParser.add_argument('--filter', metavar='Expression', help='Only keep '
+                           'the pixels for which this expression is true')
+    argParser.add_argument('--parserAttrs', nargs='*', metavar='name:value',
+                           help='Parameters required by the parser, IE '
+                           'cornerDir:/data/ompixcor')
+    argParser.add_argument('--verbose', default='True',
+                           choices={'True', 'False'}, help='Supply False to '
+                           'disable status messages')
+    args = argParser.parse_args(argv)
+    verbose = args.verbose != 'False'
+
+    parserName = parser_for_filetype(args.filetype)
+    parserParms = parse_parser_attrs(args.parserAttrs)
+    if args.filter is not None:
+        # fail before reading any file
+        expressions.compile_expression(args.filter)
+    if args.fileList:
+        files = [os.path.join(args.directory, f) for f in args.fileList]
+    else:
+        files = discovery.discover_files(args.directory, args.include,
+                                         args.exclude,
+                                         args.recursive == 'True',
+                                         discovery.expected_format(parserName))
+        # never ingest caches
+        files = [f for f in files if not parse_geo.is_cache_file(f)]
+    if not os.path.isdir(args.outDirectory):
+        os.makedirs(args.outDirectory)
+    for f in files:
+        try:
+            granule_cache.ingest_file(f, parserName, parserParms,
+                                      args.outDirectory, args.fields,
+                                      args.filter, verbose)
+        except (IOError, KeyError) as err:
+            print('Unable to ingest {0}: {1}'.format(f, err))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,40 @@
+'''
+Deferred imports of the heavy I/O and geometry libraries.
+
+tables, pyhdf, netCDF4, shapely and pyproj take far longer to import
+than the rest of WHIPS, and are not needed to list the filetypes,
+projections, maps and output functions, to print help or to check a
+configuration.  The modules using them therefore hold a LazyModule
+in their place, IE
+
+    netCDF4 = lazy.LazyModule('netCDF4')
+
+which imports the library the first time any of its attributes is
+used, that is when a parser, grid, map or output actually needs it.
+'''
+import importlib
+
+class LazyModule(object):
+    '''
+    Stands in for the module name until one of its attributes is
+    first used, when name is imported along with submodules (IE
+    'pyhdf.SD'), a list of submodules that must also be loaded
+    '''
+    def __init__(self, name, submodules=()):
+        self.__dict__['_name'] = name
+        self.__dict__['_submodules'] = tuple(submodules)
+        self.__dict__['_module'] = None
+    def _load(self):
+        '''Import the module (once) and return it'''
+        if self._module is None:
+            for sub in self._submodules:
+                importlib.import_module(sub)
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+    def loaded(self):
+        '''Whether the module has been imported yet'''
+        return self._module is not None
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+    def __repr__(self):
+        return '<lazy module {0}>'.format(self._name)
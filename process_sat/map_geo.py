@@ -23,6 +23,15 @@ The returned dictionary must be formatted as follows:
         the parser as is)
         - the data-independent weight (pass None if
         no weight is computed from this function)
+
+Maps are built with map_helpers.init_output_map, which
+only stores the gridboxes that pixels were assigned to.
+Every other gridbox reads as an empty list, so output 
+functions should not expect to see them when iterating.
+
+The parser may be a pixel_table.PixelTable standing in for
+its parser, so that a granule can be mapped a chunk of
+scanlines at a time (see map_pixel_tables).
 '''
 import sys
 from itertools import izip
@@ -30,17 +39,36 @@ import datetime
 import pdb
 
 import map_helpers
+import pixel_table
+import lazy
 
-from shapely.prepared import prep
-import shapely.geometry as geom
 import numpy
 
+prepared = lazy.LazyModule('shapely.prepared')
+geom = lazy.LazyModule('shapely.geometry')
+
 def ValidMaps():
     '''Return a list of valid map names'''
     currentModule = sys.modules[__name__]
     names = dir(currentModule)
     return [el[:-8] for el in names if el.endswith("_map_geo")]
 
+def map_pixel_tables(mapFunc, parser, griddef, verbose=True, chunkRows=None):
+    '''
+    Map parser onto griddef with the mapping function mapFunc, one 
+    chunk of chunkRows scanlines at a time (see 
+    pixel_table.iter_pixel_tables), or all at once if chunkRows is
+    None.  The maps of the chunks are joined, in order, into a single
+    map of parser.  The parser must be in a context manager.
+    '''
+    map = map_helpers.init_output_map(griddef.indLims())
+    for table in pixel_table.iter_pixel_tables(parser, (), chunkRows):
+        for (cell, pixTups) in mapFunc(table, griddef, verbose).iteritems():
+            if cell != 'parser':
+                map[cell].extend(pixTups)
+    map['parser'] = parser
+    return map
+
 def global_intersect_map_geo(parser, griddef, verbose=True):
     '''
     For each pixel, find all gridcells that it intersects
@@ -75,15 +103,8 @@ def global_intersect_map_geo(parser, griddef, verbose=True):
     # create the dictionary we'll use as a map
     map = map_helpers.init_output_map(outer_indices)
     map['parser'] = parser
-        # we're going to hold onto both the prepared and unprepared versions
-    # of the polys, so we can access the fully method set in the unprep
-    # polys, but still do fast comparisons
+    # the polygons of the cells are only built as pixels reach them
     gridPolys = map_helpers.rect_grid_polys(outer_indices)
-    prepPolys = map_helpers.rect_grid_polys(outer_indices)
-    if verbose: print('prepping polys in grid')
-    for poly in prepPolys.itervalues():
-        poly = prep(poly)  # prepare these, they're going to get compared a lot
-    if verbose: print('done prepping polys in grid')
     cornersStruct = parser.get_geo_corners()
     (row, col) = griddef.geoToGridded(cornersStruct['lat'], \
                                       cornersStruct['lon']) 
@@ -91,12 +112,14 @@ def global_intersect_map_geo(parser, griddef, verbose=True):
     # reshape the matrixes to make looping workable
     row = row.reshape(-1,4)
     col = col.reshape(-1,4)
-    ind = ind.reshape(row.shape[0],-1)
+    # (an empty ind can't infer its second dimension)
+    ind = ind.reshape(row.shape[0], -1) if ind.size else ind.reshape(0, 0)
     if verbose: print('Intersecting pixels')
     # create the appropriate pixel(s) depending on whether
-    # the pixels span the cyclic point
-    minCol = griddef.indLims()[2]
-    maxCol = griddef.indLims()[3] + 1
+    # the pixels span the cyclic point.  The cyclic point is
+    # at the edge of the whole grid, even when mapping a tile
+    minCol = griddef.fullIndLims()[2]
+    maxCol = griddef.fullIndLims()[3] + 1
     midCol = (minCol+maxCol)/2.0
     for (pxrow, pxcol, pxind) in izip(row, col, ind):
         if (numpy.any(numpy.isnan(pxrow)) or 
@@ -123,7 +146,7 @@ def global_intersect_map_geo(parser, griddef, verbose=True):
         # try intersecting the poly(s) with all the grid polygons
         for poly in pixPolys:
             for key in map_helpers.get_possible_cells(outer_indices, poly):
-                if prepPolys[key].intersects(poly) and not gridPolys[key].touches(poly):
+                if gridPolys[key].intersects(poly) and not gridPolys[key].touches(poly):
                     map[key].append((tuple(pxind), None))
     if verbose: print('Done intersecting.')
     return map
@@ -160,16 +183,11 @@ def regional_intersect_map_geo(parser, griddef, verbose=True):
     outer_indices = griddef.indLims()
     map = map_helpers.init_output_map(outer_indices)
     map['parser'] = parser
-    bounds = prep(map_helpers.rect_bound_poly(outer_indices))
-    # we're going to hold onto both the prepared and unprepared versions
-    # of the polys, so we can access the fully method set in the unprep
-    # polys, but still do fast comparisons
+    # pixels are kept if they have a corner anywhere in the grid, even
+    # when only mapping a tile of it
+    bounds = prepared.prep(map_helpers.rect_bound_poly(griddef.fullIndLims()))
+    # the polygons of the cells are only built as pixels reach them
     gridPolys = map_helpers.rect_grid_polys(outer_indices)
-    prepPolys = map_helpers.rect_grid_polys(outer_indices)
-    if verbose: print('prepping polys in grid')
-    for poly in prepPolys.itervalues():
-        poly = prep(poly)  # prepare these, they're going to get compared a lot
-    if verbose: print('done prepping polys in grid')
     cornersStruct = parser.get_geo_corners()
     (row, col) = griddef.geoToGridded(cornersStruct['lat'], \
                                       cornersStruct['lon']) 
@@ -177,7 +195,8 @@ def regional_intersect_map_geo(parser, griddef, verbose=True):
     # reshape the matrixes to make looping workable
     row = row.reshape(-1,4)
     col = col.reshape(-1,4)
-    ind = ind.reshape(row.shape[0],-1)
+    # (an empty ind can't infer its second dimension)
+    ind = ind.reshape(row.shape[0], -1) if ind.size else ind.reshape(0, 0)
     if verbose:
         griddedPix = 0 
         print('Intersecting pixels')
@@ -196,7 +215,7 @@ def regional_intersect_map_geo(parser, griddef, verbose=True):
             pixPoly = geom.MultiPoint(zip(pxrow, pxcol)).convex_hull
             
             for key in map_helpers.get_possible_cells(outer_indices, pixPoly):
-                if prepPolys[key].intersects(pixPoly) and not \
+                if gridPolys[key].intersects(pixPoly) and not \
                                   gridPolys[key].touches(pixPoly) :
                     map[key].append((tuple(pxind), None))
         print('Done intersecting.')
@@ -209,7 +228,7 @@ def regional_intersect_map_geo(parser, griddef, verbose=True):
                 continue  # if none of the corners are in bounds, skip
             pixPoly = geom.MultiPoint(zip(pxrow, pxcol)).convex_hull
             for key in map_helpers.get_possible_cells(outer_indices, pixPoly):
-                if prepPolys[key].intersects(pixPoly) and not \
+                if gridPolys[key].intersects(pixPoly) and not \
                                   gridPolys[key].touches(pixPoly):
                     map[key].append((tuple(pxind), None))
     return map
@@ -254,7 +273,8 @@ def point_in_cell_map_geo(parser, griddef, verbose=True):
                                       centersStruct['lon'])
     row = numpy.floor(row.flatten()) # we floor values to get the cell indices
     col = numpy.floor(col.flatten())
-    ind = ind.reshape(row.size, -1)
+    # (an empty ind can't infer its second dimension)
+    ind = ind.reshape(row.size, -1) if ind.size else ind.reshape(0, 0)
     # loop over pixels and grid as appropriate
     (minRow, maxRow, minCol, maxCol) = mapLims  # unpack this so we can use it
     if verbose:
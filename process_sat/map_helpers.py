@@ -4,23 +4,76 @@ the map_geo module
 '''
 import math, itertools, pdb
 
-from shapely.geometry import Polygon
+import lazy
+import grid_cache
+
+geom = lazy.LazyModule('shapely.geometry')
+
+# polygons built by rect_grid_polys for the grids (or tiles) most 
+# recently mapped, keyed by index limits.  Tiles are mapped one after
+# another, so only the polygons of the tile in use are kept
+_gridPolyCache = grid_cache.LRUCache(2)
+
+def _cell_key(key, (minRow, maxRow, minCol, maxCol)):
+    '''
+    Return key as an integer (row,col) tuple if it names a 
+    cell within the index limits.  Otherwise return None
+    '''
+    try:
+        (row, col) = key
+        if row != int(row) or col != int(col):
+            return None
+        (row, col) = (int(row), int(col))
+    except (TypeError, ValueError):
+        return None
+    if minRow <= row <= maxRow and minCol <= col <= maxCol:
+        return (row, col)
+    return None
+
+class CellPolys(dict):
+    '''
+    Dictionary of polygons representing the grid cells
+    for a rectilinear grid, keyed as (row,col) tuples.
+
+    Polygons are only built the first time a cell is
+    looked up, so only the cells actually used cost 
+    anything.  Iterating gives only the cells built so far.
+    '''
+    def __init__(self, lims):
+        dict.__init__(self)
+        self.lims = tuple(lims)
+    def __missing__(self, key):
+        cell = _cell_key(key, self.lims)
+        if cell is None:
+            raise KeyError(key)
+        (row, col) = cell
+        ll = (row,col)
+        ul = (row+1,col)
+        ur = (row+1,col+1)
+        lr = (row, col+1)
+        poly = geom.Polygon([ll, ul, ur, lr])
+        self[cell] = poly
+        return poly
 
 def rect_grid_polys((minRow, maxRow, minCol, maxCol)):
     '''
     Create an dictionary of polygons representing
     all the grid cells for a rectilinear grid.
     
-    Dictionary is keyed as (row,col) tuples
+    Dictionary is keyed as (row,col) tuples.  See
+    CellPolys.
+
+    The polygons only depend on the index limits, so
+    they are shared by every later call with the same
+    limits, as long as no more than one other set of
+    limits was used in between (see _gridPolyCache).
+    Do not modify the result.
     '''
-    polys = dict()
-    for row in range(minRow, maxRow+1):
-        for col in range(minCol, maxCol+1):
-            ll = (row,col)
-            ul = (row+1,col)
-            ur = (row+1,col+1)
-            lr = (row, col+1)
-            polys[(row,col)] = Polygon([ll, ul, ur, lr])
+    lims = (minRow, maxRow, minCol, maxCol)
+    polys = _gridPolyCache.get(lims)
+    if polys is None:
+        polys = CellPolys(lims)
+        _gridPolyCache[lims] = polys
     return polys
 
 def rect_bound_poly((minRow, maxRow, minCol, maxCol)):
@@ -32,7 +85,7 @@ def rect_bound_poly((minRow, maxRow, minCol, maxCol)):
     ul = (maxRow+1, minCol)
     ur = (maxRow+1, maxCol+1)
     lr = (minRow, maxCol+1)
-    return Polygon([ll, ul, ur, lr])
+    return geom.Polygon([ll, ul, ur, lr])
 
 def get_possible_cells((minRow, maxRow, minCol, maxCol), testPoly):
     '''
@@ -67,14 +120,61 @@ def iter_all_but_final(arrayNd):
     for row in flatterArray:
         yield row
             
+class GridMap(dict):
+    '''
+    Dictionary used as the output of a mapping function.
+
+    Keys are (row,col) tuples for the cells of the grid, each
+    corresponding to a list of (pixel index, weight) tuples,
+    plus the 'parser' key.  Cells that no pixel touched are
+    not stored.  Looking one up gives an empty list (which is
+    stored, so it may be appended to), and iterating gives
+    only the cells looked up so far.  Looking up a cell outside
+    the index limits raises a KeyError, as for a plain dict.
+
+    Two maps are equal if they agree on every cell, with
+    cells that are not stored counting as empty.
+    '''
+    def __init__(self, lims):
+        dict.__init__(self)
+        self.lims = tuple(lims)
+    def __missing__(self, key):
+        cell = _cell_key(key, self.lims)
+        if cell is None:
+            raise KeyError(key)
+        self[cell] = []
+        return self[cell]
+    def _peek(self, key, default):
+        '''Value for key, without storing missing cells'''
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        if _cell_key(key, self.lims) is not None:
+            return []
+        return default
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        absent = object()
+        for key in set(self.iterkeys()) | set(other.iterkeys()):
+            if isinstance(other, GridMap):
+                otherVal = other._peek(key, absent)
+            else:
+                otherVal = other.get(key, absent)
+            if self._peek(key, absent) != otherVal:
+                return False
+        return True
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+    __hash__ = None
+            
 def init_output_map((minRow, maxRow, minCol, maxCol)):
     '''
     Initialize and return a dict intended for
-    use as an output from a mapping function with
-    empty lists for each of the (row,col) keys
+    use as an output from a mapping function.
+    Every (row,col) key reads as an empty list
+    until something is added to it.  See GridMap.
     '''
-    map = dict()
-    for row in range(minRow, maxRow+1):
-        for col in range(minCol, maxCol+1):
-            map[(row,col)] = []
-    return map
+    return GridMap((minRow, maxRow, minCol, maxCol))
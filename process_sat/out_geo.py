@@ -31,6 +31,7 @@ filename passed (IE if output0 is passed, a function
 may choose to call outputs output0-0, output0-1, etc...
 though something more descriptive is preferable)
 '''
+import os
 import sys
 from itertools import izip
 import datetime
@@ -39,9 +40,17 @@ import pdb
 
 
 import numpy
-import netCDF4
 
+import lazy
 import utils
+import grid_geo
+import expressions
+import pixel_table
+import accumulators
+import sketches
+import cell_stats
+
+netCDF4 = lazy.LazyModule('netCDF4')
 
 def vsnmsg(version): 
     return "This file was generated using WHIPS v{0}".format(version)
@@ -58,12 +67,232 @@ class out_func:
         self.parmDict = parmDict
     def __call__(self, map_geo, griddef, outfilenames, verbose, version):
         raise NotImplementedError
+    def steps(self, maps, griddef, outfilename, verbose, version):
+        '''
+        Build the output of __call__ one map at a time, so that several
+        outputs can be built from each granule while it is open (see
+        pipeline.py).  A generator yielding None once each of maps (in
+        order) has been added, and then the result of __call__.  The
+        default does all the work in the last step.
+        '''
+        if not isinstance(maps, list):
+            maps = [maps]
+        for unused_map in maps:
+            yield None
+        yield self(maps, griddef, outfilename, verbose, version)
+    def pixel_filter(self, parser, ind):
+        '''
+        Decide, before mapping, which pixels of parser this output
+        could use.  ind is an array with one row of indices per pixel
+        (the ind field of the geolocation).  Returns a boolean vector,
+        False for pixels the output is certain to reject, or None if
+        that cannot be known without the map.  Fields are read with
+        get_cm, the parser being held open by the caller (see 
+        prefilter.pixel_mask) or by the filter itself.
+        '''
+        return None
     @staticmethod
     def parm_list():
         raise NotImplementedError
     @staticmethod
     def required_parms():
         raise NotImplementedError
+    @staticmethod
+    def optional_parms():
+        '''
+        Parameters that may be omitted, in the same form as 
+        required_parms.  They are only in the parameter dictionary
+        if the user supplied them.
+        '''
+        return {}
+
+def _accumulator_parms():
+    '''
+    The optional parameters of the output functions that allocate
+    their arrays through an accumulator backend (see accumulators.py)
+    '''
+    return {'accumulator' : ('How the gridded arrays are stored while ' \
+                             'they are accumulated.  "memory" (the ' \
+                             'default) holds them in memory.  "memmap" ' \
+                             'memory maps them from scratch files, for ' \
+                             'grids too large for memory.', None),
+            'scratchDir' : ('The directory in which to create scratch files ' \
+                            'when accumulator is "memmap" (default: the ' \
+                            'system temporary directory)', None),
+            'sparseDensity' : ('If given, output in which pixels touch at ' \
+                               'most this fraction of the gridcells is ' \
+                               'accumulated for those cells only and ' \
+                               'written in a gathered layout: variables ' \
+                               'have a single "cell" dimension and the ' \
+                               'variable "cell" holds the flat index ' \
+                               '(row*nCols+col) of each cell.  Denser ' \
+                               'output is written as usual.', 'decimal')}
+
+def _statistics_parms():
+    '''
+    The optional parameters of the output functions that can compute
+    statistics besides the average (see cell_stats.py)
+    '''
+    return {'statistics' : ('Statistics to compute for every output field ' \
+                            'besides the average.  Any of variance, std, ' \
+                            'min, max and histogram, as a comma-delimited ' \
+                            'list.  Each is written as a variable named ' \
+                            'after the output field, IE "NO2_std".  ' \
+                            'Variance and std are weighted like the ' \
+                            'average.', 'list'),
+            'histogramBins' : ('The edges of the histogram bins, as a ' \
+                               'comma-delimited list of increasing values.  ' \
+                               'Required for the histogram statistic', 
+                               'decimallist')}
+
+def _cast_statistics(parmDict):
+    '''
+    Cast the optional statistics and histogramBins parameters, if
+    present, and raise ValueError if they are invalid.  statistics 
+    defaults to an empty list
+    '''
+    parmDict['statistics'] = [stat.strip() for stat in listCaster(str)(
+            parmDict.get('statistics') or [])]
+    if parmDict.get('histogramBins') is not None:
+        parmDict['histogramBins'] = listCaster(float)(parmDict['histogramBins'])
+    cell_stats.check_statistics(parmDict['statistics'], 
+                                parmDict.get('histogramBins'))
+
+def _create_histogram_bins(outFid, binEdges):
+    '''
+    Create the histogramBin dimension of outFid, and the variable
+    HistogramBinEdges giving the edges of the bins
+    '''
+    outFid.createDimension('histogramBin', len(binEdges) - 1)
+    outFid.createDimension('histogramEdge', len(binEdges))
+    edgeVar = outFid.createVariable('HistogramBinEdges', 'd', 
+                                    ('histogramEdge',))
+    edgeVar[:] = binEdges
+
+def _create_stat_vars(outFid, cellStats, varName, dims, units, fillVal):
+    '''
+    Create the variables of outFid for the statistics of cellStats (a
+    cell_stats.CellStatistics) of the variable varName, which has 
+    dimensions dims, and for their moment state.  Returns the 
+    variables, keyed to statistic
+    '''
+    handles = dict()
+    for stat in cellStats.outputs():
+        (statDims, statUnits) = (tuple(dims), units)
+        if stat in ('variance', 'sqDev'):
+            statUnits = '({0})^2'.format(units)
+        elif stat == 'sumWght':
+            statUnits = 'weight'
+        elif stat == 'histogram':
+            (statDims, statUnits) = (statDims + ('histogramBin',), 'count')
+        handles[stat] = outFid.createVariable(varName + '_' + stat, 'd', 
+                                              statDims, fill_value=fillVal)
+        setattr(handles[stat], 'Units', statUnits)
+    return handles
+
+def _write_stat_block(handles, cellStats, keyRows, layerShape, index, 
+                      fileRows, fillVal):
+    '''
+    Write the statistics of cellStats for keyRows, the keys of a block
+    of cells of index, into the variables handles (see 
+    _create_stat_vars) at fileRows.  The layers of each cell (of shape
+    layerShape) must have consecutive keys.  Returns the arrays written,
+    keyed to statistic
+    '''
+    written = dict()
+    for (stat, vals) in cellStats.results(keyRows, fillVal).iteritems():
+        vals = index.to_file(vals.reshape((-1,) + layerShape + vals.shape[1:]))
+        handles[stat][fileRows] = vals
+        written[stat] = vals
+    return written
+
+def _pyramid_parms():
+    '''
+    The optional parameters of the output functions that can write
+    coarsened copies of their output (see accumulators.coarsen)
+    '''
+    return {'pyramidFactors' : ('Factors by which to coarsen the grid.  ' \
+                                'For each factor the averages are also ' \
+                                'written for a latlon grid whose cells are ' \
+                                'blocks of factor x factor gridcells, ' \
+                                'computed exactly from the same sums.  ' \
+                                'The grid must be a whole number of ' \
+                                'blocks.  Input as a comma-delimited list',
+                                'intlist'),
+            'pyramidFiles' : ('If True, each coarsened grid is written to ' \
+                              'its own file, named after the output file ' \
+                              'with "_x<factor>" added.  Otherwise (the ' \
+                              'default) all are written to the output ' \
+                              'file, with "_x<factor>" added to the names ' \
+                              'of their dimensions and variables', 'bool')}
+
+def _cast_pyramid(parmDict):
+    '''
+    Cast the optional pyramidFactors and pyramidFiles parameters,
+    raising ValueError if a factor is not greater than 1.  Factors
+    default to an empty list
+    '''
+    factors = listCaster(int)(parmDict.get('pyramidFactors') or [])
+    if any([factor < 2 for factor in factors]):
+        raise ValueError('Pyramid factors must be greater than 1')
+    parmDict['pyramidFactors'] = sorted(set(factors))
+    pyramidFiles = parmDict.get('pyramidFiles', False)
+    if isinstance(pyramidFiles, basestring):
+        pyramidFiles = boolCaster(pyramidFiles)
+    parmDict['pyramidFiles'] = bool(pyramidFiles)
+
+def _coarsen_griddef(griddef, factor):
+    '''
+    The latlon GridDef whose cells are blocks of factor x factor cells
+    of griddef.  Raises ValueError if griddef is not a whole latlon grid
+    made up of whole blocks
+    '''
+    if not isinstance(griddef, grid_geo.latlon_GridDef):
+        raise ValueError('Pyramid output requires a latlon grid')
+    if griddef.indLims() != griddef.fullIndLims():
+        raise ValueError('Pyramid output cannot be written for a tile')
+    parms = griddef.parms
+    if parms['nRows'] % factor or parms['nCols'] % factor:
+        raise ValueError('A grid of {0} x {1} cells cannot be coarsened by a '
+                         'factor of {2}'.format(parms['nRows'], 
+                                                parms['nCols'], factor))
+    return grid_geo.latlon_GridDef(dict(parms, xCell=parms['xCell']*factor,
+                                        yCell=parms['yCell']*factor,
+                                        nRows=parms['nRows']//factor,
+                                        nCols=parms['nCols']//factor))
+
+def _pyramid_filename(outfilename, factor):
+    '''The name of the file for the grid coarsened by factor'''
+    (root, ext) = os.path.splitext(outfilename)
+    return '{0}_x{1}{2}'.format(root, factor, ext)
+
+def _check_accumulator(parmDict):
+    '''Raise ValueError if parmDict names an invalid accumulator'''
+    name = parmDict.get('accumulator', 'memory')
+    if name not in accumulators.BACKENDS:
+        raise ValueError('Invalid accumulator {0}.  Must be one of {1}'.format(
+            name, ', '.join(sorted(accumulators.BACKENDS.keys()))))
+
+def _cast_sparse_density(parmDict):
+    '''Cast the optional sparseDensity parameter, if present'''
+    if parmDict.get('sparseDensity') is not None:
+        parmDict['sparseDensity'] = float(parmDict['sparseDensity'])
+
+def _gridded_dims(outFid, index):
+    '''
+    The leading dimensions of the gridded variables of outFid, which
+    already has the row and col dimensions.  For a sparse index (see
+    accumulators.CellIndex) the variables are gathered along a cell
+    dimension, and the cell variable holds the flat index of each
+    cell kept, as in the CF convention for compression by gathering.
+    '''
+    if not index.sparse:
+        return ('row', 'col')
+    outFid.createDimension('cell', index.nCells)
+    cellVar = outFid.createVariable('cell', 'i', ('cell',))
+    setattr(cellVar, 'compress', 'row col')
+    cellVar[:] = index.cells
+    return ('cell',)
 
 def _OMNO2e_formula(cloudFrac, fieldOfView):
     eps = 1.5*pow(10,15)*(1+3*cloudFrac)
@@ -85,6 +314,27 @@ def boolCaster(boolStr):
         msg = 'Attempt to cast invalid string %s to boolean' % boolStr
         raise TypeError(msg)
 
+def listCaster(castFunc):
+    '''
+    Return a function that casts a single value, a comma-delimited string,
+    or an iterable of values to a list of values cast by castFunc
+    '''
+    def caster(vals):
+        if isinstance(vals, basestring):
+            vals = vals.split(',')
+        try:
+            return [castFunc(v) for v in vals]
+        except TypeError:
+            # not iterable, so it's a single value
+            return [castFunc(vals)]
+    return caster
+
+def dayTimeCaster(dayStr):
+    '''Cast the MOPITT dayTime parameter to True, False, or "Both"'''
+    if dayStr is True or dayStr is False or dayStr == 'Both':
+        return dayStr
+    return boolCaster(dayStr)
+
 # currently borked.  No immediate plans to fix
 #class OMNO2e_wght_avg_out_func(out_func):
 class OMNO2e_wght_avg_BORKED(out_func): 
@@ -318,10 +568,12 @@ class OMNO2e_netCDF_avg_out_func(out_func):
             *format hh:mm:ss_MM-DD-YYYY will also be converted automatically.
         cloudFractUpperCutoff:
             Pixels with a higher cloud fraction than this 
-            value will be ignored.
+            value will be ignored.  May be a list of values,
+            see below.
         solarZenAngUpperCutoff:
             Pixels with a higher solar zenith angle than
-            this value will be ignored.
+            this value will be ignored.  May be a list of 
+            values, see below.
         pixIndXtrackAxis:
             The axis (IE which dimension in memory order)
             that specifies the pixels cross-track position.
@@ -337,12 +589,66 @@ class OMNO2e_netCDF_avg_out_func(out_func):
             'ValidPixelCount' in the output file that will include
             the number of valid pixels for each grid cell.
 
+    parameters dict may also contain keys:
+        accumulator:
+            'memory' (the default) or 'memmap'.  With 'memmap'
+            the gridded sums are memory mapped from scratch 
+            files (see accumulators.py) and nothing is returned.
+        scratchDir:
+            Directory for the scratch files of the 'memmap'
+            accumulator.
+        sparseDensity:
+            If the pixels touch at most this fraction of the
+            gridcells, only the cells touched are accumulated
+            and the output is gathered (see below).
+        statistics:
+            List of statistics (see cell_stats.py) to compute
+            besides the average, with the same weights.  Each 
+            is written as the output name + '_' + statistic.
+        histogramBins:
+            The edges of the bins of the histogram statistic.
+        pyramidFactors:
+            List of factors by which to coarsen the grid (see
+            below).  Only for latlon grids.
+        pyramidFiles:
+            If True, each coarser grid is written to a file of
+            its own (see below).
+
     Outputs a netcdf file with name determined by outFileName
     parameter.  This netcdf file contains as many variables
     as there are inFieldNames passed.  Each variable
     is output as an average over the range of values
     where it was valid acccording to the averaging
     scheme dedfined in the NASA document linked above.
+
+    If more than one value is given for cloudFractUpperCutoff or 
+    solarZenAngUpperCutoff, one average is computed for every combination
+    of the two cutoffs during a single pass over the input.  Each 
+    combination is written as a separate set of variables, with the
+    suffix "_cf<cloud cutoff>_sza<SZA cutoff>" appended to the output
+    names (IE "ColumnAmountNO2_cf0.3_sza85"), and the cutoffs are attached
+    to each variable as attributes.  With a single combination the output
+    is identical to that of a plain run.
+
+    Gathered output has a dimension "cell" in place of "row" and "col"
+    and a variable "cell" with the flat index (row*nCols + col) of each
+    gridcell present.  Cells absent are empty.  The arrays returned are
+    gathered in the same way, with the flat indices under "cell".
+
+    With pyramidFactors, the same averages are also written for 
+    coarser latlon grids, whose cells are blocks of factor x factor
+    cells of the grid.  The weighted sums of each coarser cell are the
+    block sums of the sums of the grid, so each coarser grid is
+    averaged exactly from the single accumulation (though with the
+    intersect map functions a pixel overlapping several cells of a
+    block counts once for each).  The grid must be a whole number of
+    blocks.  A coarser grid is written to the same file, with
+    dimensions "row_x<factor>" and "col_x<factor>" and the suffix
+    "_x<factor>" appended to the variable names, or, if pyramidFiles
+    is True, to a file of its own named with that suffix (IE
+    "out_x5.nc"), laid out as a run on the coarser grid.  The arrays
+    returned carry the same suffix.  Statistics are only computed for
+    the grid itself.
     '''
     @staticmethod
     def parm_list():
@@ -420,12 +726,17 @@ class OMNO2e_netCDF_avg_out_func(out_func):
                 'cloudFractUpperCutoff' : ('The maximum cloud fraction to ' \
                                            'allow before excluding pixel from '\
                                            'average.  Suggested value from ' \
-                                           'NASA is 0.3','decimal'),
+                                           'NASA is 0.3.  A comma-delimited ' \
+                                           'list of values computes one ' \
+                                           'average for each value.',
+                                           'decimallist'),
                 'solarZenAngUpperCutoff' : ('The maximum solar zenith angle to'\
                                             ' allow before excluding pixel ' \
                                             'from average, in degrees.  ' \
-                                            'Suggested value from NASA is 85.',\
-                                            'int'),
+                                            'Suggested value from NASA is 85.'\
+                                            '  A comma-delimited list of ' \
+                                            'values computes one average for '\
+                                            'each value.', 'intlist'),
                 'pixIndXtrackAxis' : ('The dimension order (0 based) of the ' \
                                       '"cross-track" dimension (whichever ' \
                                       'dimension has size 60).  For all ' \
@@ -441,23 +752,15 @@ class OMNO2e_netCDF_avg_out_func(out_func):
                                        'the number of vlaid pixels in each grid '\
                                        'cell.  Only pixels with nonzero weight  '\
                                        'are considered valid.', 'bool')}
+    @staticmethod
+    def optional_parms():
+        return dict(_accumulator_parms().items() + 
+                    _statistics_parms().items() + _pyramid_parms().items())
     # variable signifying which list is to act as the master list index
     __userKeys__ = "inFieldNames"
 
-    def __call__(self, maps, griddef, outfilename, verbose, version):
-        '''Write out a weighted-average file in netcdf format.'''
-        #Make sure non-string parameters are in the correct format
-        dimsizes = self.parmDict['extraDimSize']
-        for i in range(len(dimsizes)):
-            try:
-                dimsizes[i] = int(dimsizes[i])
-            except ValueError:
-                print ("Warning: {0} is not a valid extraDimSize value.  " \
-                      "Using 0 instead").format(dimsizes[i])
-                dimsizes[i] = 0
-                continue
-        self.parmDict['extraDimSize'] = dimsizes
-
+    def _cast_parms(self):
+        '''Cast the parameters that are not already in the correct format'''
         # even though IO interface handles casting already,
         # a catchblock has been added here for safety
         # in case someone wants to use this class directly
@@ -467,14 +770,75 @@ class OMNO2e_netCDF_avg_out_func(out_func):
                     'outFieldNames':list, 'outUnits':list,
                     'extraDimLabel':list, 'extraDimSize':list,
                     'timeComparison':str, 'timeStart':tai93conv,
-                    'timeStop':tai93conv, 'cloudFractUpperCutoff':float,
-                    'solarZenAngUpperCutoff':int, 'pixIndXtrackAxis':int,
+                    'timeStop':tai93conv, 
+                    'cloudFractUpperCutoff':listCaster(float),
+                    'solarZenAngUpperCutoff':listCaster(int), 
+                    'pixIndXtrackAxis':int,
                     'fillVal':float, 'includePixelCount':boolCaster}
         for (k,func) in castDict.items():
             try:
                 self.parmDict[k] = func(self.parmDict[k])
             except TypeError:
                 pass
+        # repeated cutoffs would give repeated combinations
+        for k in ['cloudFractUpperCutoff', 'solarZenAngUpperCutoff']:
+            cutoffs = []
+            for cutoff in self.parmDict[k]:
+                if cutoff not in cutoffs:
+                    cutoffs.append(cutoff)
+            self.parmDict[k] = cutoffs
+        _check_accumulator(self.parmDict)
+        _cast_sparse_density(self.parmDict)
+        _cast_statistics(self.parmDict)
+        _cast_pyramid(self.parmDict)
+
+    def pixel_filter(self, parser, ind):
+        '''
+        Reject the pixels that fail the quality flag, the loosest cloud
+        fraction and solar zenith angle cutoffs, or the time window, 
+        exactly as they are rejected in __call__.
+        '''
+        self._cast_parms()
+        pxInd = tuple(numpy.asarray(ind).T)
+        with parser, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # NaN flags are odd, NaN cloud fractions are rejected and
+            # NaN solar zenith angles are kept, as in __call__
+            sumFlag = numpy.asarray(
+                parser.get_cm(self.parmDict['overallQualFlag'], pxInd))
+            keep = numpy.logical_not(sumFlag % 2)
+            cFrac = numpy.asarray(
+                parser.get_cm(self.parmDict['cloudFrac'], pxInd))
+            keep &= cFrac <= max(self.parmDict['cloudFractUpperCutoff'])
+            solZenAng = numpy.asarray(
+                parser.get_cm(self.parmDict['solarZenithAngle'], pxInd))
+            keep &= numpy.logical_not(
+                solZenAng > max(self.parmDict['solarZenAngUpperCutoff']))
+            timeMask = utils.time_window_mask(
+                    parser.get_cm(self.parmDict['time']),
+                    parser.get_cm(self.parmDict['longitude']),
+                    self.parmDict['timeStart'], self.parmDict['timeStop'],
+                    local=(self.parmDict['timeComparison'] == 'local'))
+        return keep & timeMask[pxInd]
+
+    def _prepare(self):
+        '''
+        Cast and check the parameters before averaging.  Returns the
+        list of (cloud fraction cutoff, solar zenith angle cutoff) 
+        combinations and the list of suffixes of their variables
+        '''
+        #Make sure non-string parameters are in the correct format
+        dimsizes = self.parmDict['extraDimSize']
+        for i in range(len(dimsizes)):
+            try:
+                dimsizes[i] = int(dimsizes[i])
+            except ValueError:
+                print ("Warning: {0} is not a valid extraDimSize value.  " \
+                      "Using 0 instead").format(dimsizes[i])
+                dimsizes[i] = 0
+                continue
+        self.parmDict['extraDimSize'] = dimsizes
+        self._cast_parms()
 
         #Perform some basic sanity checks with parameters
         if self.parmDict['timeStart'] > self.parmDict['timeStop']:
@@ -490,23 +854,184 @@ class OMNO2e_netCDF_avg_out_func(out_func):
                 'should have the same number of elements.'
             raise IOError(msg)
 
-        # create numpy arrays to hold our data
+        # build the list of cutoff combinations.  Each combination gets its
+        # own set of accumulators, filled from the same pass over the pixels
+        cloudCutoffs = self.parmDict['cloudFractUpperCutoff']
+        szaCutoffs = self.parmDict['solarZenAngUpperCutoff']
+        combos = [(cfCut, szaCut) for cfCut in cloudCutoffs for szaCut in szaCutoffs]
+        if len(combos) == 1:
+            # keep the original variable names for a single combination
+            suffixes = ['']
+        else:
+            suffixes = ['_cf{0:g}_sza{1:g}'.format(cfCut, szaCut) 
+                        for (cfCut, szaCut) in combos]
+            if len(set(suffixes)) != len(suffixes):
+                raise ValueError('Cutoffs {0} and {1} must differ in their '
+                                 'first 6 significant digits'.format(
+                        cloudCutoffs, szaCutoffs))
+        return (combos, suffixes)
+
+    def __call__(self, maps, griddef, outfilename, verbose, version):
+        '''Write out a weighted-average file in netcdf format.'''
+        for result in self.steps(maps, griddef, outfilename, verbose, 
+                                 version):
+            pass
+        return result
+
+    def steps(self, maps, griddef, outfilename, verbose, version):
+        '''See out_func.steps'''
+        (combos, suffixes) = self._prepare()
+
+        # create arrays to hold our data
         (minRow, maxRow, minCol, maxCol) = griddef.indLims()
         nRows = maxRow - minRow + 1
         nCols = maxCol - minCol + 1
-        nValidPixels = numpy.zeros((nRows, nCols))
-        sumWght = numpy.zeros((nRows, nCols, 1))  # needs extra dim to generalize for 3D vars
-        sumVars = dict()
-        for field, size in zip(self.parmDict['inFieldNames'], self.parmDict['extraDimSize']):
-            if size:
-                sumVars[field] = numpy.zeros((nRows, nCols, size))
-            else:
-                # pad with a singlet dim if it was 2D
-                sumVars[field] = numpy.zeros((nRows, nCols, 1))
-        
-        # loop over maps
         if not isinstance(maps, list):
             maps = [maps] # create list if we only got a single map
+        for factor in self.parmDict['pyramidFactors']:
+            _coarsen_griddef(griddef, factor)  # fail before accumulating
+        index = accumulators.cell_index(maps, griddef.indLims(),
+                                        self.parmDict.get('sparseDensity'))
+        backend = accumulators.get_backend(
+                self.parmDict.get('accumulator', 'memory'),
+                self.parmDict.get('scratchDir'))
+        try:
+            for step in self._accumulate_steps(maps, griddef, outfilename, 
+                                               verbose, version, backend,
+                                               index, combos, suffixes, 
+                                               (nRows, nCols, minRow, minCol)):
+                yield step
+        finally:
+            backend.close()
+
+    def _map_pixels(self, map, parser, index, (nCols, minRow, minCol)):
+        '''
+        Gather every (cell, pixel) pair of map into a PixelTable, reading
+        each field once for all the pixels of the open parser.  Returns
+        (table, rawData, valid, weight, gridInd), where rawData holds 
+        each field with its values for a pixel flattened into a row, 
+        valid is True for the pixels passing the quality flag, the 
+        loosest cutoffs and the time window, weight is the OMNO2e weight
+        and gridInd the row of index for each pixel.  Returns None if 
+        the map is empty.
+        '''
+        # work out which pixels lie in the time window once
+        # for the whole granule
+        timeMask = utils.time_window_mask(
+                parser.get_cm(self.parmDict['time']),
+                parser.get_cm(self.parmDict['longitude']),
+                self.parmDict['timeStart'], self.parmDict['timeStop'],
+                local=(self.parmDict['timeComparison'] == 'local'))
+        fields = [self.parmDict['overallQualFlag'],
+                  self.parmDict['cloudFrac'],
+                  self.parmDict['solarZenithAngle']] + \
+                 list(self.parmDict['inFieldNames'])
+        table = pixel_table.map_table(map, fields, parser)
+        if len(table) == 0:
+            return None
+        pxInd = tuple(table['ind'].T)
+        cFrac = table[self.parmDict['cloudFrac']]
+        solZenAng = table[self.parmDict['solarZenithAngle']]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            # reject by summary flag, the loosest cutoffs and time.  Pixels
+            # failing the loosest cutoffs are rejected by every combination
+            valid = numpy.logical_not(
+                table[self.parmDict['overallQualFlag']] % 2)
+            valid &= cFrac <= max(self.parmDict['cloudFractUpperCutoff'])
+            valid &= numpy.logical_not(
+                solZenAng > max(self.parmDict['solarZenAngUpperCutoff']))
+            valid &= timeMask[pxInd]
+            # abandon pixels where any field is all NaN
+            rawData = dict()
+            for field in self.parmDict['inFieldNames']:
+                rawData[field] = table[field].reshape(len(table), -1)
+                valid &= numpy.logical_not(
+                    numpy.isnan(rawData[field]).all(axis=1))
+            # compute the weights
+            fov = table['ind'][:, self.parmDict['pixIndXtrackAxis']]
+            weight = _OMNO2e_formula(cFrac, fov)
+        # gridcells as rows of the accumulators
+        gridInd = index.rows((table['cell'][:, 0] - minRow)*nCols + \
+                             (table['cell'][:, 1] - minCol))
+        return (table, rawData, valid, weight, gridInd)
+
+    def _combo_mask(self, table, valid, (cfCut, szaCut)):
+        '''
+        True for the valid pixels of table (see _map_pixels) that meet
+        the cutoffs of a combination
+        '''
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            return valid & \
+                (table[self.parmDict['cloudFrac']] <= cfCut) & \
+                numpy.logical_not(
+                    table[self.parmDict['solarZenithAngle']] > szaCut)
+
+    def _create_file(self, outfilename, maps, griddef, version, index, 
+                     combos):
+        '''
+        Create the output file with its global attributes and the row
+        and col dimensions.  Returns the open file and the leading 
+        dimensions of gridded variables (see _gridded_dims)
+        '''
+        (minRow, maxRow, minCol, maxCol) = griddef.indLims()
+        outFid = netCDF4.Dataset(outfilename, 'w', format='NETCDF3_CLASSIC')
+        # create the 2 dimensions all files use
+        outFid.createDimension('row', maxRow - minRow + 1)
+        outFid.createDimension('col', maxCol - minCol + 1)
+        # write global attributes
+        setattr(outFid, 'Version', vsnmsg(version))
+        setattr(outFid, 'File_start_time', utils.nsecs_to_timestr(self.parmDict['timeStart'], '00:00:00 01-01-1993'))
+        setattr(outFid, 'File_end_time', utils.nsecs_to_timestr(self.parmDict['timeStop'], '00:00:00 01-01-1993'))
+        if len(combos) == 1:
+            setattr(outFid, 'Max_valid_cloud_fraction', combos[0][0])
+            setattr(outFid, 'Max_valid_solar_zenith_angle', combos[0][1])
+        else:
+            setattr(outFid, 'Max_valid_cloud_fraction', 
+                    self.parmDict['cloudFractUpperCutoff'])
+            setattr(outFid, 'Max_valid_solar_zenith_angle', 
+                    self.parmDict['solarZenAngUpperCutoff'])
+        setattr(outFid, 'Time_comparison_scheme', self.parmDict['timeComparison'])
+        fileListStr = ' '.join([map['parser'].name for map in maps])
+        setattr(outFid, 'Input_files', fileListStr)
+        setattr(outFid, 'Projection', griddef.__class__.__name__[:-8])
+        for (k,v) in griddef.parms.iteritems():
+            setattr(outFid, k, v)
+        return (outFid, _gridded_dims(outFid, index))
+
+    def _accumulate_steps(self, maps, griddef, outfilename, verbose, 
+                          version, backend, index, combos, suffixes, 
+                          (nRows, nCols, minRow, minCol)):
+        '''
+        Accumulate the maps into arrays allocated by backend, with a row
+        for every cell of index, and write the averages out.  Yields
+        after each map, and then the averages (see out_func.steps)
+        '''
+        nCells = index.nCells
+        nValidPixels = dict()
+        sumWght = dict()
+        sumVars = dict()
+        for suffix in suffixes:
+            nValidPixels[suffix] = backend.zeros((nCells,))
+            sumWght[suffix] = backend.zeros((nCells, 1))  # needs extra dim to generalize for 3D vars
+            sumVars[suffix] = dict()
+            for field, size in zip(self.parmDict['inFieldNames'], self.parmDict['extraDimSize']):
+                if size:
+                    sumVars[suffix][field] = backend.zeros((nCells, size))
+                else:
+                    # pad with a singlet dim if it was 2D
+                    sumVars[suffix][field] = backend.zeros((nCells, 1))
+        # statistics besides the average, for every cell and layer
+        cellStats = dict()
+        if self.parmDict['statistics']:
+            for suffix in suffixes:
+                cellStats[suffix] = dict()
+                for field in self.parmDict['inFieldNames']:
+                    cellStats[suffix][field] = cell_stats.CellStatistics(
+                        backend, nCells*sumVars[suffix][field].shape[1], 
+                        self.parmDict['statistics'], 
+                        self.parmDict.get('histogramBins'))
         
         for map in maps:
             # open up context manager
@@ -514,135 +1039,410 @@ class OMNO2e_netCDF_avg_out_func(out_func):
                 if verbose:
                     print('Processing {0} for output at {1}.'.format(\
                             parser.name, str(datetime.datetime.now())))
-                # loop over gridboxes in map and calculate weights
-                for (gridCell, pixTup) in map.iteritems():
-                    # translate gridCell to account for possible non-zero ll corner
-                    gridRow = gridCell[0]
-                    gridCol = gridCell[1]
-                    gridInd = (gridRow - minRow, gridCol - minCol)
-                    # get the values needed to calculate weight
-                    for (pxInd, unused_weight) in pixTup:
-                        # check summary flag
-                        sumFlag = parser.get_cm(self.parmDict['overallQualFlag'], pxInd)
-                        if sumFlag % 2:
-                            continue
-                        # check cloud fraction flag
-                        cFrac = parser.get_cm(self.parmDict['cloudFrac'], pxInd)
-                        if not (cFrac <= self.parmDict['cloudFractUpperCutoff']):
-                            continue
-                        # check solar zenith angle flag
-                        solZenAng = parser.get_cm(self.parmDict['solarZenithAngle'], pxInd)
-                        if solZenAng > self.parmDict['solarZenAngUpperCutoff']:
-                            continue
-                        # check time flag
-                        time = parser.get_cm(self.parmDict['time'], pxInd)
-                        # calculate and factor in offset if the user wanted us to
-                        if self.parmDict['timeComparison'] == 'local':
-                            pixLon = parser.get_cm(self.parmDict['longitude'], pxInd)
-                            offset = utils.UTCoffset_from_lon(pixLon)
-                            time += offset
-                        if time < self.parmDict['timeStart'] or time > self.parmDict['timeStop']:
-                            continue
-                        # read in all the data, abandon ship if data is all NaN
-                        rawDataDict = {}
-                        try:
-                            for field in self.parmDict['inFieldNames']:
-                                rawData = parser.get_cm(field, pxInd)
-                                if numpy.isnan(rawData).all():
-                                    raise invalidPixCeption
-                                rawDataDict[field] = rawData
-                        except invalidPixCeption:
-                            continue
-                        # compute the weight
-                        fov = pxInd[self.parmDict['pixIndXtrackAxis']]
-                        weight = _OMNO2e_formula(cFrac, fov)
-                        assert weight != numpy.NaN
-                        if weight > 0:
-                            nValidPixels[gridInd] += 1
-                        # add the weight tot the total for this cell                            
-                        sumWght[gridInd] += weight
+                pixels = self._map_pixels(map, parser, index, 
+                                          (nCols, minRow, minCol))
+                if pixels is not None:
+                    (table, rawData, valid, weight, gridInd) = pixels
+                    # add the pixels to every combination whose cutoffs they
+                    # meet.  NaN values count as zero, though their weight is
+                    # still added
+                    for (combo, suffix) in izip(combos, suffixes):
+                        use = self._combo_mask(table, valid, combo)
+                        cells = gridInd[use]
+                        counted = use & (weight > 0)
+                        accumulators.add_sorted(
+                            nValidPixels[suffix], gridInd[counted],
+                            numpy.ones(numpy.count_nonzero(counted)))
+                        accumulators.add_sorted(sumWght[suffix][:, 0],
+                                                cells, weight[use])
                         for field in self.parmDict['inFieldNames']:
-                            weightVals = rawDataDict[field] * weight
-                            if weightVals.size > 1:
-                                sumVars[field][gridInd] = numpy.nansum([sumVars[field][gridInd], weightVals], axis=0)        
-                            else:
-                                sumVars[field][gridInd] = numpy.nansum([sumVars[field][gridInd][0], weightVals])
+                            weightVals = rawData[field][use] * \
+                                         weight[use][:, numpy.newaxis]
+                            weightVals[numpy.isnan(weightVals)] = 0
+                            accumulators.add_sorted(sumVars[suffix][field],
+                                                    cells, weightVals)
+                            if cellStats:
+                                nLayers = sumVars[suffix][field].shape[1]
+                                keys = cells[:, numpy.newaxis]*nLayers + \
+                                       numpy.arange(nLayers)
+                                cellStats[suffix][field].add(keys, 
+                                    rawData[field][use], 
+                                    weight[use][:, numpy.newaxis].repeat(
+                                        nLayers, axis=1))
                 map['parser'] = parser  # return parser to map
+            yield None
                 
-        # divide out variables by weights to get avgs. 
+        # write out results to a netcdf file
+        (outFid, gridDims) = self._create_file(outfilename, maps, griddef, 
+                                               version, index, combos)
+        if 'histogram' in self.parmDict['statistics']:
+            _create_histogram_bins(outFid, self.parmDict['histogramBins'])
+        outAvg = self._write_averages(outFid, gridDims, backend, index, 
+                                      combos, suffixes, 
+                                      (nValidPixels, sumWght, sumVars), 
+                                      cellStats)
+        # coarser levels of the pyramid, block summed from the sums above
+        factors = self.parmDict['pyramidFactors']
+        if factors:
+            setattr(outFid, 'Pyramid_factors', factors)
+        for factor in factors:
+            (coarseIndex, coarseSums) = accumulators.coarsen(
+                index, backend, factor, 
+                [nValidPixels, sumWght, sumVars])
+            levelSuffix = '_x{0}'.format(factor)
+            if self.parmDict['pyramidFiles']:
+                (levelFid, levelDims) = self._create_file(
+                    _pyramid_filename(outfilename, factor), maps,
+                    _coarsen_griddef(griddef, factor), version, 
+                    coarseIndex, combos)
+                level = self._write_averages(levelFid, levelDims, backend,
+                                             coarseIndex, combos, suffixes,
+                                             coarseSums, dict())
+                levelFid.close()
+            else:
+                levelDims = ('row' + levelSuffix, 'col' + levelSuffix)
+                outFid.createDimension(levelDims[0], coarseIndex.nRows)
+                outFid.createDimension(levelDims[1], coarseIndex.nCols)
+                level = self._write_averages(outFid, levelDims, backend,
+                                             coarseIndex, combos, suffixes,
+                                             coarseSums, dict(), levelSuffix)
+            outAvg.update([(name + levelSuffix, vals) for (name, vals) 
+                           in level.iteritems()])
+        outFid.close()
+        yield outAvg
+
+    def _write_averages(self, outFid, gridDims, backend, index, combos, 
+                        suffixes, (nValidPixels, sumWght, sumVars), cellStats,
+                        nameSuffix=''):
+        '''
+        Create the variables of outFid for every combination and field,
+        with leading dimensions gridDims, and write the averages of the
+        sums, which have a row for every cell of index.  nameSuffix is
+        appended to the name of every variable.  Returns the arrays 
+        written if backend holds its arrays in memory
+        '''
+        nCells = index.nCells
+        outFnames = dict(izip(self.parmDict['inFieldNames'], self.parmDict['outFieldNames']))
+        units = dict(izip(self.parmDict['inFieldNames'], self.parmDict['outUnits']))
+        extraDim = dict(izip(self.parmDict['inFieldNames'], self.parmDict['extraDimLabel']))
+        # create the variables for every combination and field
+        varHandles = dict()
+        statHandles = dict()
+        for ((cfCut, szaCut), suffix) in izip(combos, suffixes):
+            for field in self.parmDict['inFieldNames']:
+                # create tuple of dimensions, defining new dim
+                # if necessary
+                if sumVars[suffix][field].shape[1] == 1:
+                    # only row/cols
+                    varDims = gridDims
+                else:
+                    # has extra dim
+                    dimName = extraDim[field]
+                    dimSize = sumVars[suffix][field].shape[1]
+                    if dimName not in outFid.dimensions.keys():
+                        outFid.createDimension(dimName, dimSize)
+                    varDims = gridDims + (dimName,)
+                varHandle = outFid.createVariable(outFnames[field] + suffix + nameSuffix, 'd', varDims, fill_value=self.parmDict['fillVal'])
+                # assign variable attributes
+                setattr(varHandle, 'Units', units[field])
+                if suffix:
+                    setattr(varHandle, 'Max_valid_cloud_fraction', cfCut)
+                    setattr(varHandle, 'Max_valid_solar_zenith_angle', szaCut)
+                varHandles[(suffix, field)] = varHandle
+                if cellStats:
+                    statHandles[(suffix, field)] = _create_stat_vars(
+                        outFid, cellStats[suffix][field], 
+                        outFnames[field] + suffix, varDims, units[field], 
+                        self.parmDict['fillVal'])
+            # Write out the pixel counts if the user requested them
+            if self.parmDict['includePixelCount']:
+                varDims = gridDims
+                varHandle = outFid.createVariable('ValidPixelCount' + suffix + nameSuffix, 'i', varDims, 
+                                                  fill_value=self.parmDict['fillVal'])
+                varHandles[(suffix, 'ValidPixelCount')] = varHandle
+
+        # divide out variables by weights to get avgs, a block of rows at
+        # a time, writing each block straight into the file.  Arrays in
+        # memory are done in a single block and also returned
+        outAvg = dict()
+        if index.sparse and backend.inMemory:
+            outAvg['cell'] = index.cells
+        rowBytes = sum([arr.nbytes // max(nCells, 1) for arr in 
+                        nValidPixels.values() + sumWght.values() + 
+                        [var for fieldVars in sumVars.values() 
+                         for var in fieldVars.values()]])
+        rowBytes += sum([stats.nbytes() // max(nCells, 1) for fieldStats in 
+                         cellStats.values() for stats in fieldStats.values()])
         oldSettings = numpy.seterr(divide='ignore')
-        avgs = dict()
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            for (field,var) in sumVars.iteritems():
-                unfiltAvgs = var/sumWght
-                filtAvgs = numpy.where(sumWght != 0, unfiltAvgs, \
-                           self.parmDict['fillVal'])
-                # strip trailing singlet for 2D arrays
-                if filtAvgs.shape[-1] == 1:
-                    avgs[field] = filtAvgs.reshape(filtAvgs.shape[0:2])
-                else:
-                    avgs[field] = filtAvgs
+            for (rows, fileRows) in index.blocks(backend, rowBytes):
+                for suffix in suffixes:
+                    wght = numpy.asarray(sumWght[suffix][rows])
+                    for field in self.parmDict['inFieldNames']:
+                        var = numpy.asarray(sumVars[suffix][field][rows])
+                        unfiltAvgs = var/wght
+                        filtAvgs = numpy.where(wght != 0, unfiltAvgs, \
+                                   self.parmDict['fillVal'])
+                        # strip trailing singlet for 2D arrays
+                        if filtAvgs.shape[-1] == 1:
+                            filtAvgs = filtAvgs[:, 0]
+                        filtAvgs = index.to_file(filtAvgs)
+                        varHandles[(suffix, field)][fileRows] = filtAvgs
+                        # keep the same data as avgs, but with the output names
+                        if backend.inMemory:
+                            outAvg[outFnames[field] + suffix] = filtAvgs
+                        if cellStats:
+                            nLayers = sumVars[suffix][field].shape[1]
+                            layerShape = (nLayers,) if nLayers > 1 else ()
+                            keyRows = slice(rows.start*nLayers, 
+                                            rows.stop*nLayers)
+                            written = _write_stat_block(
+                                statHandles[(suffix, field)], 
+                                cellStats[suffix][field], keyRows, 
+                                layerShape, index, fileRows, 
+                                self.parmDict['fillVal'])
+                            if backend.inMemory:
+                                for (stat, vals) in written.iteritems():
+                                    outAvg[outFnames[field] + suffix + '_' + 
+                                           stat] = vals
+                    if self.parmDict['includePixelCount']:
+                        counts = index.to_file(
+                                numpy.asarray(nValidPixels[suffix][rows]))
+                        varHandles[(suffix, 'ValidPixelCount')][fileRows] = counts
+                        if backend.inMemory:
+                            outAvg['ValidPixelCount' + suffix] = counts
         numpy.seterr(divide=oldSettings['divide'])
+        return outAvg
+
+class OMNO2e_netCDF_quantile_out_func(OMNO2e_netCDF_avg_out_func):
+    '''
+    Percentiles (IE the median) of the values in each gridcell.
+
+    Pixels are filtered exactly as by OMNO2e_netCDF_avg_out_func: by 
+    the overall quality flag, the cloud fraction and solar zenith angle
+    cutoffs and the time window.  Every pixel kept counts equally.  NaN
+    values are ignored (for layered fields, layer by layer).
+
+    The values of every cell are kept in a fixed-size quantile sketch
+    (see sketches.py) updated granule by granule, so memory does not 
+    grow with the number of pixels.  Percentiles are exact for cells 
+    holding no more values than the sketch size, and otherwise 
+    accurate to about 1/sketchSize in rank.
+
+    parameters dict must contain the keys of OMNO2e_netCDF_avg_out_func
+    and:
+        percentiles:
+            List of the percentiles to write (0 to 100).
+
+    parameters dict may also contain the optional keys of 
+    OMNO2e_netCDF_avg_out_func and:
+        sketchSize:
+            The number of centroids kept in each sketch (default 100).
+        writeSketches:
+            If True, the sketches themselves are also written, so
+            that they can be merged with those of other runs 
+            (default False).
+
+    Outputs a netcdf file with one variable for every field and 
+    percentile, named outFieldName + "_p" + percentile (IE 
+    "ColumnAmountNO2_p50"), with the percentile as an attribute.  
+    Lists of cutoffs give one set of variables per combination, with the
+    suffix of OMNO2e_netCDF_avg_out_func before the percentile (IE 
+    "ColumnAmountNO2_cf0.3_sza85_p50").  Cells without values are 
+    given fillVal.  With writeSketches, the means and counts of the 
+    centroids of the sketches are written to the variables 
+    outFieldName + suffix + "_sketchMean" and "_sketchCount", with the
+    extra dimension "sketchSlot" (see sketches.QuantileSketches.load).
+    '''
+    @staticmethod
+    def parm_list():
+        return OMNO2e_netCDF_avg_out_func.parm_list() + ['percentiles']
+    @staticmethod
+    def required_parms():
+        parms = dict(OMNO2e_netCDF_avg_out_func.required_parms())
+        parms['percentiles'] = ('The percentiles to write, from 0 to 100.  ' \
+                                'Input as a comma-delimited list, IE ' \
+                                '"10,50,90"', 'decimallist')
+        return parms
+    @staticmethod
+    def optional_parms():
+        parms = dict(OMNO2e_netCDF_avg_out_func.optional_parms())
+        # percentiles replace the other statistics, and are not summed
+        for parm in _statistics_parms().keys() + _pyramid_parms().keys():
+            del parms[parm]
+        parms['sketchSize'] = ('The number of centroids kept in the quantile '\
+                               'sketch of each gridcell (default 100).  ' \
+                               'Larger sketches are more accurate but use ' \
+                               'more memory', 'posint')
+        parms['writeSketches'] = ('If True, the means and counts of the ' \
+                                  'centroids of every sketch are also ' \
+                                  'written, so that they can be merged ' \
+                                  'with those of other runs (default ' \
+                                  'False)', 'bool')
+        return parms
+    # variable signifying which list is to act as the master list index
+    __userKeys__ = "inFieldNames"
+
+    def _cast_parms(self):
+        '''Cast the parameters that are not already in the correct format'''
+        OMNO2e_netCDF_avg_out_func._cast_parms(self)
+        self.parmDict['percentiles'] = listCaster(float)(
+            self.parmDict['percentiles'])
+        if not all([0 <= p <= 100 for p in self.parmDict['percentiles']]):
+            raise ValueError('Percentiles must be between 0 and 100')
+        self.parmDict['sketchSize'] = int(self.parmDict.get(
+            'sketchSize', sketches.DEFAULT_SIZE))
+        writeSketches = self.parmDict.get('writeSketches', False)
+        if isinstance(writeSketches, basestring):
+            writeSketches = boolCaster(writeSketches)
+        self.parmDict['writeSketches'] = bool(writeSketches)
+
+    def _accumulate_steps(self, maps, griddef, outfilename, verbose, 
+                          version, backend, index, combos, suffixes, 
+                          (nRows, nCols, minRow, minCol)):
+        '''
+        Sketch the values of the maps, with a sketch for every cell of
+        index (and layer), and write out the percentiles.  Yields after
+        each map, and then the percentiles (see out_func.steps)
+        '''
+        nCells = index.nCells
+        layers = dict([(field, max(size, 1)) for (field, size) in 
+                       izip(self.parmDict['inFieldNames'], 
+                            self.parmDict['extraDimSize'])])
+        nValidPixels = dict()
+        fieldSketches = dict()
+        for suffix in suffixes:
+            nValidPixels[suffix] = backend.zeros((nCells,))
+            fieldSketches[suffix] = dict()
+            for field in self.parmDict['inFieldNames']:
+                fieldSketches[suffix][field] = sketches.QuantileSketches(
+                    backend, nCells*layers[field], 
+                    self.parmDict['sketchSize'])
+
+        for map in maps:
+            with map.pop('parser') as parser: # remove parser for looping
+                if verbose:
+                    print('Processing {0} for output at {1}.'.format(\
+                            parser.name, str(datetime.datetime.now())))
+                pixels = self._map_pixels(map, parser, index, 
+                                          (nCols, minRow, minCol))
+                if pixels is not None:
+                    (table, rawData, valid, unused_weight, gridInd) = pixels
+                    for (combo, suffix) in izip(combos, suffixes):
+                        use = self._combo_mask(table, valid, combo)
+                        cells = gridInd[use]
+                        accumulators.add_sorted(nValidPixels[suffix], cells,
+                                                numpy.ones(cells.size))
+                        # one sketch per cell and layer
+                        for field in self.parmDict['inFieldNames']:
+                            nLayers = layers[field]
+                            keys = cells[:, numpy.newaxis]*nLayers + \
+                                   numpy.arange(nLayers)
+                            fieldSketches[suffix][field].add(
+                                keys, rawData[field][use])
+                map['parser'] = parser  # return parser to map
+            yield None
 
-        
         # associate coindexed parameters into dicts 
         # so we can loop by field
         outFnames = dict(izip(self.parmDict['inFieldNames'], self.parmDict['outFieldNames']))
         units = dict(izip(self.parmDict['inFieldNames'], self.parmDict['outUnits']))
         extraDim = dict(izip(self.parmDict['inFieldNames'], self.parmDict['extraDimLabel']))
-                
+        percentiles = self.parmDict['percentiles']
+        pctSuffixes = ['_p{0:g}'.format(pct) for pct in percentiles]
+
         # write out results to a netcdf file
-        outFid = netCDF4.Dataset(outfilename, 'w', format='NETCDF3_CLASSIC')
-        # create the 2 dimensions all files use
-        outFid.createDimension('row', nRows)
-        outFid.createDimension('col', nCols)
-        # write global attributes
-        setattr(outFid, 'Version', vsnmsg(version))
-        setattr(outFid, 'File_start_time', utils.nsecs_to_timestr(self.parmDict['timeStart'], '00:00:00 01-01-1993'))
-        setattr(outFid, 'File_end_time', utils.nsecs_to_timestr(self.parmDict['timeStop'], '00:00:00 01-01-1993'))
-        setattr(outFid, 'Max_valid_cloud_fraction', self.parmDict['cloudFractUpperCutoff'])
-        setattr(outFid, 'Max_valid_solar_zenith_angle', self.parmDict['solarZenAngUpperCutoff'])
-        setattr(outFid, 'Time_comparison_scheme', self.parmDict['timeComparison'])
-        fileListStr = ' '.join([map['parser'].name for map in maps])
-        setattr(outFid, 'Input_files', fileListStr)
-        setattr(outFid, 'Projection', griddef.__class__.__name__[:-8])
-        for (k,v) in griddef.parms.iteritems():
-            setattr(outFid, k, v)
-        # loop over fields and write variables
-        for field in self.parmDict['inFieldNames']:
-            # create tuple of dimensions, defining new dim
-            # if necessary
-            if len(avgs[field].shape) == 2:
-                # only row/cols
-                varDims = ('row', 'col')
-            elif len(avgs[field].shape) == 3:
-                # has extra dim
-                dimName = extraDim[field]
-                dimSize = avgs[field].shape[2]
-                if dimName not in outFid.dimensions.keys():
-                    outFid.createDimension(dimName, dimSize)
-                varDims = ('row', 'col', dimName)
-            # create and assign value to variable
-            varHandle = outFid.createVariable(outFnames[field], 'd', varDims, fill_value=self.parmDict['fillVal'])
-            varHandle[:] = avgs[field]
-            # assign variable attributes
-            setattr(varHandle, 'Units', units[field])
-        # Write out the pixel counts if the user requested them
-        if self.parmDict['includePixelCount']:
-            varDims = ('row', 'col')
-            varHandle = outFid.createVariable('ValidPixelCount', 'i', varDims, 
-                                              fill_value=self.parmDict['fillVal'])
-            varHandle[:] = nValidPixels
+        (outFid, gridDims) = self._create_file(outfilename, maps, griddef, 
+                                               version, index, combos)
+        setattr(outFid, 'Percentiles', percentiles)
+        setattr(outFid, 'Sketch_size', self.parmDict['sketchSize'])
+        writeSketches = self.parmDict['writeSketches']
+        if writeSketches:
+            outFid.createDimension('sketchSlot', self.parmDict['sketchSize'])
+        varHandles = dict()
+        for ((cfCut, szaCut), suffix) in izip(combos, suffixes):
+            for field in self.parmDict['inFieldNames']:
+                varDims = gridDims
+                if layers[field] > 1:
+                    dimName = extraDim[field]
+                    if dimName not in outFid.dimensions.keys():
+                        outFid.createDimension(dimName, layers[field])
+                    varDims = gridDims + (dimName,)
+                for (pct, pctSuffix) in izip(percentiles, pctSuffixes):
+                    varName = outFnames[field] + suffix + pctSuffix
+                    varHandle = outFid.createVariable(varName, 'd', varDims,
+                                    fill_value=self.parmDict['fillVal'])
+                    setattr(varHandle, 'Units', units[field])
+                    setattr(varHandle, 'Percentile', pct)
+                    if suffix:
+                        setattr(varHandle, 'Max_valid_cloud_fraction', cfCut)
+                        setattr(varHandle, 'Max_valid_solar_zenith_angle', 
+                                szaCut)
+                    varHandles[(suffix, field, pctSuffix)] = varHandle
+                if writeSketches:
+                    for part in ('Mean', 'Count'):
+                        varHandle = outFid.createVariable(
+                            outFnames[field] + suffix + '_sketch' + part, 
+                            'd', varDims + ('sketchSlot',))
+                        if part == 'Mean':
+                            setattr(varHandle, 'Units', units[field])
+                        varHandles[(suffix, field, '_sketch' + part)] = \
+                            varHandle
+            if self.parmDict['includePixelCount']:
+                varHandle = outFid.createVariable('ValidPixelCount' + suffix, 
+                                'i', gridDims, 
+                                fill_value=self.parmDict['fillVal'])
+                varHandles[(suffix, 'ValidPixelCount', '')] = varHandle
+
+        # compute the percentiles a block of rows at a time, writing each
+        # block straight into the file.  Arrays in memory are done in a 
+        # single block and also returned
+        outPct = dict()
+        if index.sparse and backend.inMemory:
+            outPct['cell'] = index.cells
+        rowBytes = 8*len(suffixes)*(1 + sum([2*self.parmDict['sketchSize']*n
+                                             for n in layers.values()]))
+        qs = [pct/100. for pct in percentiles]
+        for (rows, fileRows) in index.blocks(backend, rowBytes):
+            for suffix in suffixes:
+                for field in self.parmDict['inFieldNames']:
+                    nLayers = layers[field]
+                    keyRows = slice(rows.start*nLayers, rows.stop*nLayers)
+                    vals = fieldSketches[suffix][field].quantiles(
+                        keyRows, qs, self.parmDict['fillVal'])
+                    vals = vals.reshape(-1, nLayers, len(qs))
+                    for (j, pctSuffix) in enumerate(pctSuffixes):
+                        pctVals = vals[:, :, j]
+                        # strip trailing singlet for 2D fields
+                        if nLayers == 1:
+                            pctVals = pctVals[:, 0]
+                        pctVals = index.to_file(pctVals)
+                        varHandles[(suffix, field, pctSuffix)][fileRows] = \
+                            pctVals
+                        if backend.inMemory:
+                            outPct[outFnames[field] + suffix + pctSuffix] = \
+                                pctVals
+                    if writeSketches:
+                        sketch = fieldSketches[suffix][field]
+                        for (part, arr) in (('_sketchMean', sketch.means), 
+                                            ('_sketchCount', sketch.counts)):
+                            vals = numpy.asarray(arr[keyRows]).reshape(
+                                (-1, nLayers, sketch.sketchSize))
+                            if nLayers == 1:
+                                vals = vals[:, 0]
+                            varHandles[(suffix, field, part)][fileRows] = \
+                                index.to_file(vals)
+                if self.parmDict['includePixelCount']:
+                    counts = index.to_file(
+                            numpy.asarray(nValidPixels[suffix][rows]))
+                    varHandles[(suffix, 'ValidPixelCount', '')][fileRows] = \
+                        counts
+                    if backend.inMemory:
+                        outPct['ValidPixelCount' + suffix] = counts
         outFid.close()
-        # create a dict with teh same data as avgs, but diff names
-        outAvg = dict()
-        for (k,v) in avgs.iteritems():
-            outAvg[outFnames[k]] = v
-        if self.parmDict['includePixelCount']:
-            outAvg['ValidPixelCount'] = nValidPixels
-        return outAvg
-    
+        yield outPct
+
 class wght_avg_netCDF(out_func):
     '''
     Generalized weighted average algorithm
@@ -659,7 +1459,9 @@ class wght_avg_netCDF(out_func):
     Owing to the complexity of the inputs required for this function and the 
     security problems posed by allowing users to input functions to be 
     evaluated, this output function does not support the I/O interface at this
-    time.  It is designed to subclassed.
+    time.  It is designed to subclassed.  The subclass 
+    expression_avg_netCDF_out_func takes its weights and filter as 
+    expressions (see the expressions module) and supports the I/O interface.
 
     This function (and therefore subclasses of this function) at present can
     only handle a single input map.  It may be extended to properly handle 
@@ -775,7 +1577,13 @@ class wght_avg_netCDF(out_func):
             the average.  Either will be handled appropriately.  The docstring 
             for this function will be included as a global attribute in the 
             output file, so the docstring should be sufficient to describe the
-            function in it's entirety.
+            function in it's entirety.  If the function also has a method
+            prime(parser, ind), it is called once per file with an array 
+            of the indices of every mapped pixel, so that the weights can
+            be computed for the whole file at once.  If it has a method
+            weights(parser, ind), that is used in place of the function,
+            with the same array, and must return an array with the 
+            weight of every pixel.
         filterFunction:
             Function that looks at the entire stack of pixels for a cell and 
             selects any pixels that need to be filtered out.  Note that for 
@@ -797,12 +1605,56 @@ class wght_avg_netCDF(out_func):
             attribute in the final output file, so the docstring should be
             sufficient to describe the function in it's entirety.  Note that it
             is safe to use both get and get_cm functions within this function -
-            it is guaranteed to be called within a context manager.
+            it is guaranteed to be called within a context manager.  As with
+            weightFunction, a prime(parser, ind) method is called first if 
+            present.  A filter that judges every pixel on its own may have 
+            a method rejected(parser, ind), used in place of the function
+            with an array of the indices of every mapped pixel, returning
+            the flags for all of them at once.
+
+    parmDict may optionally contain the following keys:
+        composites:
+            List of (suffix, weightFunction, filterFunction) tuples.  When
+            present, weightFunction and filterFunction are ignored and one
+            average is accumulated for every tuple during a single pass over
+            the map, so that the values are only read once.  Each average is
+            written as outFieldName+suffix (IE "CO_day") and the function
+            descriptions are written as global attributes carrying the same
+            suffix.  Suffixes must be unique.
+        accumulator:
+            'memory' (the default) or 'memmap'.  With 'memmap' the output
+            arrays are memory mapped from scratch files (see 
+            accumulators.py), written out a block of rows at a time, and 
+            not returned.
+        scratchDir:
+            Directory for the scratch files of the 'memmap' accumulator.
+        sparseDensity:
+            If the pixels touch at most this fraction of the gridcells, 
+            only the cells touched are kept and the output is gathered: 
+            variables have a dimension "cell" in place of "row" and "col"
+            and the variable "cell" holds the flat index (row*nCols + col)
+            of each cell present.  The arrays returned are gathered in the
+            same way, with the flat indices under "cell".
+        statistics:
+            List of statistics (see cell_stats.py) to compute besides
+            the average, of the values themselves (not their logarithm,
+            even for logNormal fields) with the same weights.  Each is
+            written as outFieldName+suffix+'_'+statistic (IE "CO_std").
+        histogramBins:
+            The edges of the bins of the histogram statistic.
     '''
 
+    @staticmethod
+    def optional_parms():
+        return dict(_accumulator_parms().items() + 
+                    _statistics_parms().items())
+
     def __init__(self, parmDict=None):
         # call ancestor method
         out_func.__init__(self, parmDict)
+        _check_accumulator(self.parmDict)
+        _cast_sparse_density(self.parmDict)
+        _cast_statistics(self.parmDict)
 
         # check that all the lists are the same length
         lists = ['outFieldNames', 'outUnits', 'dimLabels', 'dimSizes', 'logNormal']
@@ -850,33 +1702,208 @@ class wght_avg_netCDF(out_func):
         for key in lists:
             self.parmDict[key] = dict(zip(inFnames, self.parmDict[key]))
         
+    def _composites(self):
+        '''
+        Return the list of (suffix, weightFunction, filterFunction) tuples
+        to be accumulated in a single pass.  If the parameter dictionary does
+        not specify 'composites', a single composite with an empty suffix is
+        built from weightFunction and filterFunction.
+        '''
+        try:
+            return self.parmDict['composites']
+        except KeyError:
+            return [('', self.parmDict['weightFunction'], 
+                     self.parmDict['filterFunction'])]
+
+    def _group_avg(self, field, vals, wghts, groups, nGroups):
+        '''
+        Compute the weighted averages of vals (one row per pixel) over
+        the nGroups cells given by groups, with grouped sums.  vals 
+        should already be logged if the field is lognormal.  wghts 
+        should contain NaN for all rejected pixels.  Returns the
+        averages, one row per cell, with NaN's replaced by fillVal.
+        '''
+        # broadcast the weights against the values
+        wghtVals = vals*wghts.reshape((-1,) + (1,)*(vals.ndim - 1))
+        
+        # sum the weighted values and the weights of each cell, leaving 
+        # out NaN's
+        wghtValSum = pixel_table.group_sum(
+            groups, numpy.where(numpy.isnan(wghtVals), 0, wghtVals), nGroups)
+        wghtSum = pixel_table.group_sum(
+            groups, numpy.where(numpy.isnan(wghts), 0, wghts), nGroups)
+        wghtSum = wghtSum.reshape((-1,) + (1,)*(vals.ndim - 1))
+        # avoid hassle with div/0 warnings
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            wghtValAvg = numpy.where(wghtSum != 0, wghtValSum/wghtSum, 
+                                     numpy.NaN)
+        
+        # re-exponentiate if we took log average
+        if self.parmDict['logNormal'][field]:
+            wghtValAvg = numpy.exp(wghtValAvg)
+        
+        # mask nan's with fillVal
+        return numpy.where(numpy.isnan(wghtValAvg),
+                           self.parmDict['fillVal'], 
+                           wghtValAvg)
+
+    @staticmethod
+    def _store_avg(outArray, rows, avgs):
+        '''
+        Put avgs (one row per cell) into rows of outArray, whose rows
+        have the shape of the extra dimensions of the field
+        '''
+        rowShape = outArray.shape[1:]
+        if not numpy.prod(rowShape):
+            # nothing is kept for fields with a 0 placeholder dimension
+            return
+        outArray[rows] = avgs.reshape((len(rows),) + rowShape)
+
+    def _average_table(self, p, table, timeMask, composites, index, lims,
+                       outputArrays, cellStats, nLayers):
+        '''
+        Average the pixels of table (see pixel_table.map_table), mapped
+        from the parser p, into the rows of outputArrays for the cells
+        of index, and add them to cellStats, with grouped reductions 
+        over the rows of the table.  timeMask flags the pixels of p in
+        the time window and lims are the index limits of the grid.
+        '''
+        (minRow, maxRow, minCol, maxCol) = lims
+        nCols = maxCol - minCol + 1
+        cellRows = index.rows((table['cell'][:, 0] - minRow)*nCols +
+                              (table['cell'][:, 1] - minCol))
+        (cells, groups) = numpy.unique(cellRows, return_inverse=True)
+        starts = numpy.flatnonzero(numpy.diff(cellRows)) + 1
+        outOfWindow = numpy.logical_not(timeMask[tuple(table['ind'].T)])
+        # the pixels mapped, each once
+        (pixInd, first, pixRows) = pixel_table.unique_rows(table['ind'])
+
+        # weight and filter functions that can be evaluated for the
+        # whole granule at once (IE those built from expressions) 
+        # are handed every mapped pixel up front
+        for (suffix, wghtFunc, filtFunc) in composites:
+            for func in (wghtFunc, filtFunc):
+                if hasattr(func, 'prime'):
+                    func.prime(p, pixInd)
+
+        # the values for every field are shared by all the composites
+        fieldVals = dict()
+        for field in self.parmDict['inFieldNames']:
+            vals = numpy.asarray(table[field], dtype=numpy.float64)
+            if self.parmDict['logNormal'][field]:
+                vals = numpy.log(vals) # work with logarithm of data
+            fieldVals[field] = vals
+
+        for (suffix, wghtFunc, filtFunc) in composites:
+            # compute the weight of each pixel once, all at once if the
+            # function can, or else with the weight the map gave the
+            # pixel where it first appears
+            if hasattr(wghtFunc, 'weights'):
+                wghts = numpy.asarray(wghtFunc.weights(p, pixInd),
+                                      dtype=numpy.float64)[pixRows]
+            else:
+                wghts = numpy.array([wghtFunc(p, tuple(ind), 
+                                              table['weight'][row])
+                                     for (ind, row) in izip(pixInd, first)],
+                                    dtype=numpy.float64)[pixRows]
+
+            # use the filter function to apply user-defined filter 
+            # conditions, on every pixel at once if it can, or else on
+            # the stack of each cell
+            if hasattr(filtFunc, 'rejected'):
+                uFlag = numpy.asarray(filtFunc.rejected(p, pixInd), 
+                                      dtype=bool)[pixRows]
+            else:
+                uFlag = numpy.zeros(len(table), dtype=bool)
+                for rows in numpy.split(numpy.arange(len(table)), starts):
+                    uFlag[rows] = filtFunc(p, [tuple(ind) for ind 
+                                               in table['ind'][rows]])
+
+            # filter the weights so that values that will be rejected (by
+            # the user filter or the time window) don't have their weights
+            # included in the denominator of the final average.
+            wghts = numpy.where(uFlag | outOfWindow, numpy.NaN, wghts)
+
+            # average every field over the cells with grouped sums
+            for field in self.parmDict['inFieldNames']:
+                self._store_avg(outputArrays[suffix][field], cells,
+                                self._group_avg(field, fieldVals[field], 
+                                                wghts, groups, cells.size))
+
+            # add every pixel to the statistics in one pass per field
+            if suffix in cellStats:
+                for field in self.parmDict['inFieldNames']:
+                    n = nLayers[field]
+                    vals = numpy.asarray(table[field], dtype=numpy.float64)
+                    keys = cellRows[:, numpy.newaxis]*n + numpy.arange(n)
+                    cellStats[suffix][field].add(keys, 
+                        vals.reshape(keys.shape), 
+                        wghts[:, numpy.newaxis].repeat(n, axis=1))
+
     def __call__(self, maps, griddef, outfilename, verbose, version):
         '''Write out a weighted-average file in netcdf format.'''
-        
-        # create a dictionary of numpy arrays that will hold the data for all 
-        # our variables, keyed to inFieldNames
+        for result in self.steps(maps, griddef, outfilename, verbose, 
+                                 version):
+            pass
+        return result
+
+    def steps(self, maps, griddef, outfilename, verbose, version):
+        '''See out_func.steps'''
+        if not isinstance(maps, list):
+            maps = [maps] # create list if we didn't get one
+        index = accumulators.cell_index(maps, griddef.indLims(),
+                                        self.parmDict.get('sparseDensity'))
+        backend = accumulators.get_backend(
+                self.parmDict.get('accumulator', 'memory'),
+                self.parmDict.get('scratchDir'))
+        try:
+            for step in self._average_steps(maps, griddef, outfilename, 
+                                            verbose, version, backend, index):
+                yield step
+        finally:
+            backend.close()
+
+    def _average_steps(self, maps, griddef, outfilename, verbose, version,
+                       backend, index):
+        '''
+        Average the maps into arrays allocated by backend, with a row for
+        every cell of index, and write them out.  Yields after each map,
+        and then the averages (see out_func.steps)
+        '''
+        composites = self._composites()
+
+        # create a dictionary of arrays that will hold the data for all 
+        # our variables, keyed to composite suffix and then inFieldNames
         (minRow, maxRow, minCol, maxCol) = griddef.indLims()
         nRows = maxRow - minRow + 1
         nCols = maxCol - minCol + 1
         outputArrays = dict()
-        for field in self.parmDict['inFieldNames']:
-            dims = [nRows, nCols] + self.parmDict['dimSizes'][field]
-            outputArrays[field] = numpy.zeros(dims)
+        for (suffix, unused_wf, unused_ff) in composites:
+            outputArrays[suffix] = dict()
+            for field in self.parmDict['inFieldNames']:
+                dims = [index.nCells] + self.parmDict['dimSizes'][field]
+                # cells absent from the map are never visited below
+                outputArrays[suffix][field] = backend.zeros(dims)
+                outputArrays[suffix][field].fill(self.parmDict['fillVal'])
+        # statistics besides the average, for every cell and layer
+        nLayers = dict([(field, int(numpy.prod(
+                        self.parmDict['dimSizes'][field])))
+                        for field in self.parmDict['inFieldNames']])
+        cellStats = dict()
+        if self.parmDict['statistics']:
+            for (suffix, unused_wf, unused_ff) in composites:
+                cellStats[suffix] = dict()
+                for field in self.parmDict['inFieldNames']:
+                    cellStats[suffix][field] = cell_stats.CellStatistics(
+                        backend, index.nCells*nLayers[field], 
+                        self.parmDict['statistics'], 
+                        self.parmDict.get('histogramBins'))
             
-        # prep for computing weights
-        wghtDict = dict()  # we only want to compute each weight once
-        wghtFunc = self.parmDict['weightFunction']
-        filtFunc = self.parmDict['filterFunction']
-        
         # convert the times to the proper format
         tConvFunc = self.parmDict['timeConv']
         timeStart = tConvFunc(self.parmDict['timeStart'])
         timeStop = tConvFunc(self.parmDict['timeStop'])
     
-        # loop over maps
-        if not isinstance(maps, list):
-            maps = [maps] # create list if we didn't get one
-
         # check to see that we were given exactly one map.  If we aren't
         # explain that this function only works for one map and exit
         if len(maps) != 1:
@@ -894,85 +1921,22 @@ class wght_avg_netCDF(out_func):
                     print('Processing %s for output at %s' %
                           (p.name, str(datetime.datetime.now())))
                     
-                # loop over the cells in the map, processing each
-                for (cellInd, pixTups) in map.iteritems():
-                    
-                    # compute the weight only if we haven't already.  In either
-                    # case, put the weights in array.
-                    wghts = [wghtDict.setdefault(ind, wghtFunc(p, ind, wgt))
-                            for (ind, wgt) in pixTups]
-                    
-                    # create the time array we'll be using to filter
-                    tArray = numpy.array([p.get_cm(self.parmDict['time'], ind)
-                                          for (ind, wgt) in pixTups]).squeeze()
-                    if self.parmDict['timeComparison'] == 'local':
-                        offsets = numpy.array([utils.UTCoffset_from_lon(
-                                               p.get_cm(self.parmDict['longitude'], ind)) 
-                                               for (ind, wgt) in pixTups]).squeeze()
-                        tArray += offsets
-                    tFlag = numpy.logical_or(tArray < timeStart, tArray > timeStop)
-                    
-                    # use the filter function on the stack to apply user-defined
-                    # filter conditions
-                    pixIndStack = [pInd for (pInd, unused_weight) in pixTups]
-                    uFlag = numpy.array(filtFunc(p, pixIndStack))
-
-                    # combine time filter and user filter into a single, global flag 
-                    gFlag = numpy.logical_or(uFlag, tFlag)
-
-                    # filter the weights so that values that will be rejected don't
-                    # have their weights included in the denominator of the final
-                    # average.
-                    wghts = numpy.where(gFlag, numpy.NaN, wghts)
-                    
-                    # loop over fields.  For each, compute avg and save
-                    for field in self.parmDict['inFieldNames']:
-                        
-                        # create the array of weighted values    
-                        vals = numpy.array([p.get_cm(field, ind)
-                                            for (ind, wgt) in pixTups]).squeeze()
-                        if self.parmDict['logNormal'][field]:
-                            vals = numpy.log(vals) # work with logarithm of data
-
-                        # create a slice object that will allow us to broadcast
-                        # weights against the values
-                        extraDims = self.parmDict['dimSizes'][field]
-                        # handle the special case where we put in 0 for extradims
-                        if len(extraDims) == 1 and extraDims == [0]:
-                            nExtraDims = 0
-                        else:
-                            nExtraDims = len(extraDims)
-                        wghtSlice = [Ellipsis]+[numpy.newaxis]*nExtraDims
-
-                        # handle special case where there were no pixels in
-                        # cell
-                        if vals.size == 0:
-                            vals = vals.reshape([0]+extraDims)
-
-                        # compute weighted values
-                        wghtVals = vals*wghts[wghtSlice]
-                        
-                        # average the weighted Values
-                        wghtValSum = numpy.nansum(wghtVals, axis=0)
-                        wghtSum = numpy.nansum(wghts, axis=0)
-                        # avoid hassle with div/0 warnings
-                        if wghtSum != 0:
-                            wghtValAvg = wghtValSum/wghtSum
-                        else:
-                            wghtValAvg = numpy.NaN
-                        
-                        # re-exponentiate if we took log average
-                        if self.parmDict['logNormal'][field]:
-                            wghtValAvg = numpy.exp(wghtValAvg)
-                        
-                        # mask nan's with fillVal, then slot into output array
-                        wghtValAvg = numpy.where(numpy.isnan(wghtValAvg),
-                                                 self.parmDict['fillVal'], 
-                                                 wghtValAvg)
-                        outputArrays[field][cellInd] = wghtValAvg
-        
-                    # done looping over fields
-                # done looping over cells
+                # work out which pixels lie in the time window once 
+                # for the whole file
+                timeMask = utils.time_window_mask(
+                        p.get_cm(self.parmDict['time']),
+                        p.get_cm(self.parmDict['longitude']),
+                        timeStart, timeStop,
+                        local=(self.parmDict['timeComparison'] == 'local'))
+
+                # read in the values of every field for all the mapped
+                # pixels at once.  The rows of the table follow the order
+                # of the map, so each cell is a contiguous block of rows
+                table = pixel_table.map_table(map, self.parmDict['inFieldNames'], p)
+                if len(table):
+                    self._average_table(p, table, timeMask, composites, index,
+                                        griddef.indLims(), outputArrays,
+                                        cellStats, nLayers)
             # done with context manager on parser
                         
             # return the parser to the map so it can be used elsewhere
@@ -980,6 +1944,7 @@ class wght_avg_netCDF(out_func):
             if verbose:
                 print('Done processing %s at %s' %
                       (p.name, str(datetime.datetime.now())))
+            yield None
             
         # done looping over maps
                 
@@ -1001,15 +1966,26 @@ class wght_avg_netCDF(out_func):
         setattr(outFid, 'Time_comparison_scheme', self.parmDict['timeComparison'])
         flistStr = ' '.join([map['parser'].name for map in maps])
         setattr(outFid, 'Input_files', flistStr)
-        setattr(outFid, 'Weighting_function_description', wghtFunc.__doc__)
-        setattr(outFid, 'Filter_function_description', filtFunc.__doc__)
+        for (suffix, wghtFunc, filtFunc) in composites:
+            setattr(outFid, 'Weighting_function_description' + suffix, 
+                    wghtFunc.__doc__)
+            setattr(outFid, 'Filter_function_description' + suffix, 
+                    filtFunc.__doc__)
         # add in attributes for the projection
         setattr(outFid, 'Projection', griddef.__class__.__name__[:-8])
         setattr(outFid, 'Notes', self.parmDict['notes'])
         for k in griddef.parm_list():
             setattr(outFid, k, griddef.parms[k])
 
-        # loop over fields and write all information for each field
+        # loop over fields and write all information for each field.  Arrays
+        # that are not in memory are written a block of rows at a time and
+        # not returned
+        gridDims = list(_gridded_dims(outFid, index))
+        finalOutArrays = dict()
+        if index.sparse and backend.inMemory:
+            finalOutArrays['cell'] = index.cells
+        if 'histogram' in self.parmDict['statistics']:
+            _create_histogram_bins(outFid, self.parmDict['histogramBins'])
         for field in self.parmDict['inFieldNames']:
 
             # create the dimensions in the file
@@ -1019,24 +1995,43 @@ class wght_avg_netCDF(out_func):
                 if label not in outFid.dimensions.keys():
                     outFid.createDimension(label, size)
                 
-            # write the variable to file
-            vDims = ['row', 'col'] + extraDimLabels
-            outFieldName = self.parmDict['outFieldNames'][field]
-            varHand = outFid.createVariable(outFieldName, 'd', vDims, fill_value=self.parmDict['fillVal'])
-            varHand[:] = outputArrays[field]
+            # write the variable to file, once per composite
+            vDims = gridDims + extraDimLabels
+            for (suffix, unused_wf, unused_ff) in composites:
+                outFieldName = self.parmDict['outFieldNames'][field] + suffix
+                varHand = outFid.createVariable(outFieldName, 'd', vDims, 
+                                                fill_value=self.parmDict['fillVal'])
+                outArray = outputArrays[suffix][field]
+                rowBytes = outArray.nbytes // max(index.nCells, 1)
+                if cellStats:
+                    stats = cellStats[suffix][field]
+                    statHandles = _create_stat_vars(outFid, stats, 
+                        outFieldName, vDims, self.parmDict['outUnits'][field],
+                        self.parmDict['fillVal'])
+                    rowBytes += stats.nbytes() // max(index.nCells, 1)
+                n = nLayers[field]
+                for (rows, fileRows) in index.blocks(backend, rowBytes):
+                    varHand[fileRows] = index.to_file(outArray[rows])
+                    if cellStats:
+                        written = _write_stat_block(statHandles, stats, 
+                            slice(rows.start*n, rows.stop*n), 
+                            tuple(extraDimSizes), index, fileRows, 
+                            self.parmDict['fillVal'])
             
-            # write variable attributes
-            setattr(varHand, 'Units', self.parmDict['outUnits'][field])
+                # write variable attributes
+                setattr(varHand, 'Units', self.parmDict['outUnits'][field])
+
+                # keep the array keyed to the output name
+                if backend.inMemory:
+                    finalOutArrays[outFieldName] = index.to_file(outArray)
+                    if cellStats:
+                        for (stat, vals) in written.iteritems():
+                            finalOutArrays[outFieldName + '_' + stat] = vals
 
         # close the output file
         outFid.close()
 
-        # create an output dictionary keyed to output field names
-
-        finalOutArrays = dict()
-        for (k,v) in outputArrays.iteritems():
-            finalOutArrays[self.parmDict['outFieldNames'][k]] = v
-        return finalOutArrays 
+        yield finalOutArrays 
             
 class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
     '''
@@ -1047,9 +2042,11 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
     nighttime values according to solar zenith angle.  Unfortunately, since 
     none of the NASA documentation actually specifies what cutoff value was
     used for solar zenith angle, the value is left up to the user with a 
-    default of 85.  Also, in contrast to the NASA product, only one time (day
-    or night) is actually included.  Which one is left to the user and noted
-    in the attributes of the output file.
+    default of 85.  The user may request either daytime or nighttime values
+    alone, or both at once.  When both are requested, the pixels are split on
+    solar zenith angle during a single pass over the input and every output
+    variable is written twice, with "_day" and "_night" appended to its name.
+    The choice is noted in the attributes of the output file.
 
     Also following NASA precedent, data are filtered based on surface type.
     For cells where one surface type makes up more than 75% of the pixels,
@@ -1107,11 +2104,15 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
             are typeically used in practice.  In degrees.  If SZA is exactly
             equal to the cutoff, it is included regardless of whether day
             or night was selected.
-        dayTime: Boolean variable setting whether the desired output file 
+        dayTime: Variable setting whether the desired output file
             will be for the daytime or nighttime.  If set to "True", the output
             file will feature daylight retrievals only.  If set to "False", the
-            output will feature night retrievals only.  Note that by most 
-            estimates, daylight retrievals are higher quality.
+            output will feature night retrievals only.  If set to "Both", the
+            output file will feature both, in separate variables suffixed
+            with "_day" and "_night".  In this case the surface type and
+            level count filters are applied separately to the day and night
+            pixels of each cell.  Note that by most estimates, daylight
+            retrievals are higher quality.
         surfTypeField: The string for the field associated with the surface
             type.  This field is assumed to have integers corresponding to 
             different surface types.  No effort is made to distinguish 
@@ -1215,13 +2216,15 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
                 'solZenAng' : ('The name of the field containing the solar' \
                                ' zenith angle in degrees.  { MOPITT - Solar ' \
                                'Zenith Angle }', None),
-                'dayTime' : ('Boolean variable that indicates ' \
+                'dayTime' : ('Variable that indicates ' \
 			     'whether the output file should contain ' \
 			     'values from day or night.  If set to ' \
 			     '"True" the output file will have ' \
 			     'daylight values.  If set to "False" ' \
 			     'the output file will have night ' \
-			     'values.', 'bool'),
+			     'values.  If set to "Both" the output ' \
+			     'file will have both, in variables ' \
+			     'suffixed with "_day" and "_night".', None),
                 'surfTypeField' : ('The name of the field containing the ' \
                                    'surface type index.\n{ MOPITT - Surface ' \
                                    'Index }', None),
@@ -1254,7 +2257,7 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
                     'timeStart':tai93conv, 'timeStop':tai93conv,
                     'timeComparison':str, 'fillVal':float,
                     'solZenAngCutoff':float, 'solZenAng':str,
-                    'dayTime':bool, 'surfTypeField':str,
+                    'dayTime':dayTimeCaster, 'surfTypeField':str,
                     'colMeasField':str}
         for (k,func) in castDict.items():
             try:
@@ -1274,28 +2277,47 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
         surfField = parmDict.pop('surfTypeField')
         colMeasField = parmDict.pop('colMeasField')
 
-        dayBool = dayTime
+        if dayTime not in [True, False, 'Both']:
+            msg = 'Invalid value %s for dayTime.  Must be "True", "False", ' \
+                'or "Both"' % str(dayTime)
+            raise ValueError(msg)
+
         # note which was chosen
+        if dayTime == 'Both':
+            choice = 'daytime (suffix _day) and nighttime (suffix _night)'
+        else:
+            choice = 'daytime' if dayTime else 'nighttime'
         parmDict['notes'] = 'All values %s with cutoff at %6.2f' % \
-            ('daytime' if dayBool else 'nighttime', SZAcut)
+            (choice, SZAcut)
         
-        # create weighting function
-        def wghtFunc(parser, index, prevWght):
+        # create weighting functions
+        def dayWghtFunc(parser, index, prevWght):
             '''
             Values not explicitly weighted.  Values not in desired part of 
             diurnal cycle (as determined by solar zenith angle) are given weight
-            of 0 and therefore not included in final average
+            of 0 and therefore not included in final average.  Daytime values
+            are desired.
             '''
             SZA = parser.get_cm(SZAfield, index)
-            if dayBool and SZA <= SZAcut:
+            if SZA <= SZAcut:
                 # we want day and it's day
                 return 1
-            elif not dayBool and SZA >= SZAcut:
+            else:
+                return 0
+
+        def nightWghtFunc(parser, index, prevWght):
+            '''
+            Values not explicitly weighted.  Values not in desired part of 
+            diurnal cycle (as determined by solar zenith angle) are given weight
+            of 0 and therefore not included in final average.  Nighttime values
+            are desired.
+            '''
+            SZA = parser.get_cm(SZAfield, index)
+            if SZA >= SZAcut:
                 # we want night and it's night
                 return 1
             else:
                 return 0
-        parmDict['weightFunction'] = wghtFunc
 
         # create filtering function
         def filterFunc(parser, indStack):
@@ -1342,7 +2364,152 @@ class unweighted_filtered_MOPITT_avg_netCDF_out_func(wght_avg_netCDF):
 
             # combine the filters and return
             return numpy.logical_or(cFlag, sFlag)
+
+        if dayTime == 'Both':
+            # each half of the diurnal cycle is filtered on its own, so that
+            # (for example) night pixels cannot decide the surface type of
+            # the daytime average
+            def splitFilter(wghtFunc):
+                def splitFilterFunc(parser, indStack):
+                    inSplit = numpy.array([wghtFunc(parser, ind, None) != 0 
+                                           for ind in indStack], dtype=bool)
+                    flags = numpy.ones(len(indStack), dtype=bool)
+                    subStack = [ind for (ind, keep) in izip(indStack, inSplit)
+                                if keep]
+                    if subStack:
+                        flags[inSplit] = filterFunc(parser, subStack)
+                    return flags
+                splitFilterFunc.__doc__ = filterFunc.__doc__.rstrip() + \
+                    '  Only pixels from the same part of the diurnal cycle ' \
+                    'are considered.\n'
+                return splitFilterFunc
+            parmDict['composites'] = [('_day', dayWghtFunc, 
+                                       splitFilter(dayWghtFunc)),
+                                      ('_night', nightWghtFunc, 
+                                       splitFilter(nightWghtFunc))]
+            # placeholders so the parent sees a complete parmDict
+            parmDict['weightFunction'] = dayWghtFunc
+        else:
+            parmDict['weightFunction'] = dayWghtFunc if dayTime else nightWghtFunc
         parmDict['filterFunction'] = filterFunc
 
         # invoke parent's constructor
         wght_avg_netCDF.__init__(self, parmDict)
+
+class expression_avg_netCDF_out_func(wght_avg_netCDF):
+    '''
+    Weighted average with the weights and filter given as expressions.
+
+    Unlike the other subclasses of wght_avg_netCDF, the weighting and
+    filtering are not fixed in the code, so this function can be 
+    driven entirely from the command line or an input file.  The
+    weight and filter are written in the expression language of the
+    expressions module (IE "weight:1/(1+3*CloudFraction)" and 
+    "filter:CloudFraction<=0.3 and vcdQualityFlags%2==0").  Both are
+    evaluated for every mapped pixel of a granule at once.
+
+    The filter is applied to each pixel on its own.  Pixels for which
+    it is false (or NaN) are rejected.  Pixels given a weight of 0 or 
+    NaN do not contribute to the average.
+
+    As with its parent, only a single input file may be processed.
+
+    The parameters dictionary must contain the following keys:
+        time:           SEE DOCUMENTATION FOR wght_avg_netCDF
+                            NOTE: must be in TAI93 format
+        longitude:      SEE DOCUMENTATION FOR wght_avg_netCDF
+        inFieldNames:   SEE DOCUMENTATION FOR wght_avg_netCDF
+        outFieldNames:  SEE DOCUMENTATION FOR wght_avg_netCDF
+        outUnits:       SEE DOCUMENTATION FOR wght_avg_netCDF
+        logNormal:      SEE DOCUMENTATION FOR wght_avg_netCDF
+        dimLabels:      SEE DOCUMENTATION FOR wght_avg_netCDF
+        dimSizes:       SEE DOCUMENTATION FOR wght_avg_netCDF
+        timeStart:      SEE DOCUMENTATION FOR wght_avg_netCDF
+        timeStop:       SEE DOCUMENTATION FOR wght_avg_netCDF
+        timeComparison: SEE DOCUMENTATION FOR wght_avg_netCDF
+        fillVal:        SEE DOCUMENTATION FOR wght_avg_netCDF
+        weight: Expression giving the weight of each pixel.  Use 1 for
+            an unweighted average.
+        filter: Expression that is true for the pixels to be kept.  Use
+            True to keep every pixel.
+    '''
+    @staticmethod
+    def parm_list():
+        return ['time', 'longitude', 'inFieldNames', 'outFieldNames',
+                'outUnits', 'logNormal', 'dimLabels', 'dimSizes', 'timeStart', 
+                'timeStop', 'timeComparison', 'fillVal', 'weight', 'filter']
+    @staticmethod
+    def required_parms():
+        parms = dict(unweighted_filtered_MOPITT_avg_netCDF_out_func.required_parms())
+        for key in ['solZenAngCutoff', 'solZenAng', 'dayTime', 
+                    'surfTypeField', 'colMeasField']:
+            del parms[key]
+        parms['time'] = ('The name of the field containing timestamps.  ' \
+                         'Timestamps are assumed to be in the TAI-93 format.' \
+                         '\n{ OMI - Time\n  MOPITT - Time }', None)
+        parms['longitude'] = ('The name of the field containing longitudes ' \
+                              'at cell centers.  Longitudes should be in ' \
+                              'degrees east.\n{ OMI - Longitude\n  MOPITT - ' \
+                              'Longitude }', None)
+        parms['weight'] = ('Expression for the weight of each pixel, in ' \
+                           'terms of the fields of the input files.  Field ' \
+                           'names containing spaces are written in braces, ' \
+                           'IE {Solar Zenith Angle}.  Use 1 for an ' \
+                           'unweighted average.', None)
+        parms['filter'] = ('Expression that is true for the pixels to keep, ' \
+                           'IE "CloudFraction<=0.3 and SolarZenithAngle<=85".'\
+                           '  Use True to keep every pixel.', None)
+        return parms
+    # variable signifying which list is to act as the master list index 
+    __userKeys__ = "inFieldNames"
+    def __init__(self, pDict):
+        '''Convert input to format of parent input'''
+
+        # make a shallow copy to the parameter dict, as we'll be making changes
+        # and we don't want to mutate the argument
+        parmDict = dict(pDict)
+
+        # even though IO interface handles casting already,
+        # a catchblock has been added here for safety
+        # in case someone wants to use this class directly
+        castDict = {'time':str, 'longitude':str,
+                    'inFieldNames':list, 'outFieldNames':list,
+                    'outUnits':list, 'logNormal':list,
+                    'dimLabels':list, 'dimSizes':list,
+                    'timeStart':tai93conv, 'timeStop':tai93conv,
+                    'timeComparison':str, 'fillVal':float,
+                    'weight':str, 'filter':str}
+        for (k,func) in castDict.items():
+            try:
+                parmDict[k] = func(parmDict[k])
+            except TypeError:
+                pass
+
+        # by this point times are already converted to TAI93 standard
+        # no need to convert here
+        parmDict['timeConv'] = lambda(x):x
+
+        # compile the expressions.  Invalid expressions raise ValueError
+        parmDict['weightFunction'] = expressions.ExpressionWeight(
+            parmDict.pop('weight'))
+        parmDict['filterFunction'] = expressions.ExpressionFilter(
+            parmDict.pop('filter'))
+        parmDict['notes'] = '{0}.  {1}.'.format(
+            parmDict['weightFunction'].__doc__, 
+            parmDict['filterFunction'].__doc__)
+
+        # invoke parent's constructor
+        wght_avg_netCDF.__init__(self, parmDict)
+
+    def pixel_filter(self, parser, ind):
+        '''Reject the pixels failing the filter or outside the time window'''
+        with parser:
+            keep = self.parmDict['filterFunction'].expression.evaluate(parser, 
+                                                                       ind)
+            keep = numpy.logical_and(keep != 0, keep == keep)
+            timeMask = utils.time_window_mask(
+                    parser.get_cm(self.parmDict['time']),
+                    parser.get_cm(self.parmDict['longitude']),
+                    self.parmDict['timeStart'], self.parmDict['timeStop'],
+                    local=(self.parmDict['timeComparison'] == 'local'))
+        return keep & timeMask[tuple(numpy.asarray(ind).T)]
@@ -48,6 +48,21 @@ if the desired mapping function requires them.
                         to contain the indices.  If cast to a 
                         tuple and fed into the get() function,
                         it should retrieve the same pixel
+    get_scanline_times() - returns a 1D array of the timestamps of the
+                        'Time' field (TAI93 seconds), one per index
+                        along the first axis of the arrays returned
+                        by get_geo_corners and get_geo_centers.
+                        Within a granule the times should not 
+                        decrease, apart from NaN's for missing values.
+                        Used to find the scanlines inside a time
+                        window without reading the whole swath.
+    get_pixel_tables(fields=(), chunkRows=None) -
+                        generates pixel_table.PixelTable's covering
+                        the whole granule, chunkRows indices along
+                        the first axis of the geolocation at a time,
+                        with a column for each of fields.  Provided
+                        by GeoFile for every parser that implements
+                        get_geo_centers or get_geo_corners and get_cm.
                         
 The following functions may be implemented or not in any class.
 They duplicate the functionality of the get function but in
@@ -64,23 +79,35 @@ NotImplementedError when called.
                  method throw some kind of error when called outside a
                  context manager.  Must operate exactly the same as
                  the get function in terms of inputs and output.
+                 Context managers may be nested.  Only the outermost
+                 one opens and closes the file, so that variables
+                 read by get_cm remain cached for the inner ones.
+                 The results of get_geo_corners and get_geo_centers
+                 are also cached while the context is open.
+
+Granules may be converted by ingest.py into compact caches holding
+only selected fields.  get_parser reads a cache with WHCcache_File
+whichever filetype is requested, so a cache can be processed in
+place of its granule.
                  
 This framework can be extended by adding classes for particular (sub)class
 '''
 
 import os
 import sys
+import json
 import string
 import pdb
 
-import tables
 import numpy
-import pyhdf.HDF
-import pyhdf.V
-import pyhdf.VS
-import pyhdf.SD
 
+import lazy
 import filetypes
+import pixel_table
+
+tables = lazy.LazyModule('tables')
+pyhdf = lazy.LazyModule('pyhdf', ['pyhdf.HDF', 'pyhdf.V', 'pyhdf.VS', 
+                                  'pyhdf.SD'])
 
 def SupportedFileTypes():
     '''Return a list of supported file types'''
@@ -121,6 +148,57 @@ def getLongName(fPath):
     fid.close()
     return chunks[-2]
 
+def getCoreMetadata(fPath):
+    '''
+    Retrieve the ECS core metadata (in ODL format) of an HDFEOS file.
+    Works for both HDF5 and HDF4 files.  Throws IOError if the file
+    has no core metadata
+    '''
+    try:
+        fid = tables.openFile(fPath)
+    except Exception:
+        fid = None
+    if fid is not None:
+        try:
+            for name in ['CoreMetadata', 'CoreMetadata.0']:
+                try:
+                    node = fid.getNode('/', 'HDFEOS INFORMATION/'+name)
+                except tables.exceptions.NoSuchNodeError:
+                    continue
+                return str(list(node)[0])
+        finally:
+            fid.close()
+    try:
+        sd = pyhdf.SD.SD(fPath)
+    except pyhdf.SD.HDF4Error:
+        raise IOError('Unable to open {0} as HDF5 or HDF4'.format(fPath))
+    try:
+        attrs = sd.attributes()
+        for name in sorted(attrs.keys()):
+            if name.lower().startswith('coremetadata'):
+                return str(attrs[name])
+    finally:
+        sd.end()
+    raise IOError('No core metadata found in {0}'.format(fPath))
+
+def geo_cached(func):
+    '''
+    Decorator for get_geo_corners and get_geo_centers.  Inside a context
+    manager the geolocation is only read once and the same record array
+    is returned until the context closes.  Outside a context manager
+    the function is called every time.
+    '''
+    def wrapper(self):
+        cache = getattr(self, '_geo_cache', None)
+        if cache is None:
+            return func(self)
+        if func.__name__ not in cache:
+            cache[func.__name__] = func(self)
+        return cache[func.__name__]
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
 def get_parser(file, filetype, parserParms):
     """Retrieve appropriate instantiated parser for a file"""
     # filename = os.path.split(file)[1]
@@ -128,6 +206,9 @@ def get_parser(file, filetype, parserParms):
     module = sys.modules[GeoFile.__module__]
     parserClass = getattr(module, subclass) 
                   # or GeoFile
+    # granule caches are read in place of the granules they came from
+    if parserClass is not WHCcache_File and is_cache_file(file):
+        return WHCcache_File(file, requestedParser=filetype)
     extension = ''
     subtype = ''
     for i in filetype:
@@ -149,12 +230,16 @@ class GeoFile():
         raise NotImplementedError
     def get_geo_centers(self):
         raise NotImplementedError
+    def get_scanline_times(self):
+        raise NotImplementedError
     def __enter__(self):
         raise NotImplementedError
     def __exit__(self):
         raise NotImplementedError
     def get_cm(self, key, indices=None):
         raise NotImplementedError
+    def get_pixel_tables(self, fields=(), chunkRows=None):
+        return pixel_table.iter_pixel_tables(self, fields, chunkRows)
 
 class HDF4File(GeoFile):
     """Provide generic interface for HDF 4 files"""
@@ -296,9 +381,14 @@ class HDF4File(GeoFile):
             return vData
 
     def __enter__(self):
-        '''Open up file and leave open.'''
+        '''Open up file and leave open.  Nested entries reuse the open file.'''
+        if getattr(self, '_cmDepth', 0):
+            self._cmDepth += 1
+            return self
+        self._cmDepth = 1
         self._fid = pyhdf.HDF.HDF(self.name)
         self._open_vars = dict()
+        self._geo_cache = dict()
         self._vsInt = self._fid.vstart()
         self._vInt = self._fid.vgstart()
         self._sdInt = pyhdf.SD.SD(self.name)
@@ -306,11 +396,16 @@ class HDF4File(GeoFile):
 
     def __exit__(self, exc_type, exc_value, traceback):
         '''Close file and delete references to file object and nodes.'''
+        self._cmDepth -= 1
+        if self._cmDepth:
+            # still inside an enclosing context manager
+            return False
         self._sdInt.end()
         self._vsInt.end()
         self._vInt.end()
         self._fid.close()
         del self._open_vars
+        del self._geo_cache
         del self._fid
         del self._vsInt
         del self._vInt
@@ -454,6 +549,10 @@ class HDFFile(GeoFile):
                 if var[:].dtype in ['float32', 'float64']:
                     # only do nan sub if we don't have to cast
                     var = numpy.where(var == missing, numpy.NaN, var)
+                else:
+                    # read into memory so that every pixel of a 
+                    # PixelTable can be indexed at once
+                    var = var[:]
                 self._open_vars[key] = var
                 self._scales[key] = scale
                 self._offsets[key] = offset
@@ -478,17 +577,27 @@ class HDFFile(GeoFile):
             return indFunc(self._open_vars[key], indices)        
             
     def __enter__(self):
-        '''Open up file and leave open.'''
+        '''Open up file and leave open.  Nested entries reuse the open file.'''
+        if getattr(self, '_cmDepth', 0):
+            self._cmDepth += 1
+            return self
+        self._cmDepth = 1
         self._fid = tables.openFile(self.name, mode='r')
         self._open_vars = dict()
+        self._geo_cache = dict()
         self._scales = dict()
         self._offsets = dict()
         return self
         
     def __exit__(self, exc_type, exc_value, traceback):
         '''Close file and delete references to file object and nodes'''
+        self._cmDepth -= 1
+        if self._cmDepth:
+            # still inside an enclosing context manager
+            return False
         self._fid.close()
         del self._open_vars
+        del self._geo_cache
         del self._scales
         del self._offsets
         del self._fid
@@ -546,6 +655,7 @@ class HDFknmiomil2_File(HDFFile):
                  "Time"                         : lambda var, ind: var[ind[0]]
                  }
     
+    @geo_cached
     def get_geo_corners(self):
         lat = self.get('LatitudeCornerpoints')
         lon = self.get('LongitudeCornerpoints')
@@ -557,6 +667,7 @@ class HDFknmiomil2_File(HDFFile):
         (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
         return struct
     
+    @geo_cached
     def get_geo_centers(self):
         lat = self.get('Latitude')
         lon = self.get('Longitude')
@@ -566,6 +677,10 @@ class HDFknmiomil2_File(HDFFile):
         (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
         return struct
 
+    def get_scanline_times(self):
+        '''Retrieves the time of each scanline, in TAI93 seconds'''
+        return numpy.asarray(self.get('Time'), dtype=numpy.float64).ravel()
+
         
 class HDFnasaomil2_File(HDFFile):
     """
@@ -742,6 +857,7 @@ class HDFnasaomil2_File(HDFFile):
                   'SpacecraftLongitude' : lambda var, ind: var[ind[0]],
                   'SpacecraftAltitude' : lambda var, ind: var[ind[0]]}
     
+    @geo_cached
     def get_geo_corners(self):
         '''
         Retrieves array of the corners of the pixels.  
@@ -768,6 +884,7 @@ class HDFnasaomil2_File(HDFFile):
         (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
         return struct
     
+    @geo_cached
     def get_geo_centers(self):
         lat = self.get('Latitude')
         lon = self.get('Longitude')
@@ -776,6 +893,10 @@ class HDFnasaomil2_File(HDFFile):
         struct = numpy.zeros(lat.shape, dtype=protoDtype)
         (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
         return struct
+
+    def get_scanline_times(self):
+        '''Retrieves the time of each scanline, in TAI93 seconds'''
+        return numpy.asarray(self.get('Time'), dtype=numpy.float64).ravel()
         
 class HDFmopittl2_File(HDF4File):
     """
@@ -827,6 +948,7 @@ class HDFmopittl2_File(HDF4File):
         '''Overloaded version of get_cm that applied the correct missing value.'''
         return HDF4File.get_cm(self, key, indices, missingValue=-9999.0)
 
+    @geo_cached
     def get_geo_centers(self):
         '''Retrieves array of the corners of the pixels'''
         lat = self.get('Latitude').squeeze()
@@ -836,3 +958,169 @@ class HDFmopittl2_File(HDF4File):
         struct = numpy.zeros(lat.size, dtype = protoDtype)
         (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
         return struct
+
+    def get_scanline_times(self):
+        '''
+        Retrieves the time of each pixel, in TAI93 seconds.  MOPITT 
+        pixels are indexed along a single axis, so each pixel is its 
+        own "scanline"
+        '''
+        return numpy.asarray(self.get('Time'), dtype=numpy.float64).ravel()
+
+# signature at the start of every granule cache (see WHCcache_File)
+CACHE_MAGIC = '\x89WHC\r\n\x1a\n'
+
+# arrays in a cache start on multiples of this many bytes
+CACHE_ALIGN = 64
+
+def cache_aligned(nBytes):
+    '''The first multiple of CACHE_ALIGN at or after nBytes'''
+    return -(-nBytes // CACHE_ALIGN) * CACHE_ALIGN
+
+def is_cache_file(fPath):
+    '''Whether fPath is a granule cache written by ingest.py'''
+    try:
+        with open(fPath, 'rb') as fid:
+            return fid.read(len(CACHE_MAGIC)) == CACHE_MAGIC
+    except IOError:
+        return False
+
+def read_cache_header(fPath):
+    '''
+    Read the header of a granule cache (see granule_cache.py).  Returns
+    a dictionary describing the arrays and fields of the cache, with
+    the offset of the data in the file as dataStart.  Throws IOError
+    if fPath is not a cache
+    '''
+    with open(fPath, 'rb') as fid:
+        if fid.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            raise IOError('Attempt to read non-cache file {0} as a granule '
+                          'cache'.format(fPath))
+        (size,) = numpy.frombuffer(fid.read(8), dtype='<u8')
+        header = json.loads(fid.read(int(size)))
+    header['dataStart'] = cache_aligned(len(CACHE_MAGIC) + 8 + int(size))
+    return header
+
+class WHCcache_File(GeoFile):
+    """
+    Provide interface to a granule cache written by ingest.py
+
+    A cache (see granule_cache.py) holds the geolocation of a granule 
+    and the fields selected when it was ingested, with missing values,
+    scale and offset already applied, and optionally only the pixels
+    that passed a filter.  Each array is memory mapped straight from
+    the file, so opening a cache costs next to nothing.
+
+    Caches are read in place of the granules they were made from.
+    get_parser returns this parser for any cache, whatever filetype is
+    requested, so existing filetypes work unchanged.  requestedParser
+    is the name of the parser the granule would otherwise have been
+    read with.  If given, it must match the parser the cache was made
+    with.
+
+    Pixels are indexed exactly as in the original granule.  Fields 
+    retrieved without indices are returned with one element per pixel
+    index (IE the Time of OMI pixels is repeated across each scanline).
+    Pixels removed by the filter are NaN (or 0 for integer fields).
+    The geolocation is returned as a flat array of the pixels kept, 
+    and get_scanline_times returns the time of the scanline of each
+    of those pixels.
+    """
+    def __init__(self, filename, subtype='', extension=None, 
+                 requestedParser=None):
+        GeoFile.__init__(self, filename, subtype=subtype, 
+                         extension=extension or 'whc')
+        self._header = read_cache_header(filename)
+        if (requestedParser is not None and 
+            requestedParser != self._header['parser']):
+            raise IOError('{0} is a cache of a {1} granule, not {2}'.format(
+                    filename, self._header['parser'], requestedParser))
+        self.source = self._header['source']
+        self._arrays = dict()
+        self._whole = dict()
+    def _array(self, name):
+        '''memory map the named array'''
+        if name not in self._arrays:
+            info = self._header['arrays'][name]
+            (dtype, shape) = (str(info['dtype']), tuple(info['shape']))
+            if 0 in shape:
+                # empty arrays cannot be memory mapped
+                self._arrays[name] = numpy.zeros(shape, dtype=dtype)
+            else:
+                offset = self._header['dataStart'] + info['offset']
+                self._arrays[name] = numpy.memmap(self.name, dtype=dtype,
+                                                  mode='r', offset=offset,
+                                                  shape=shape)
+        return self._arrays[name]
+    def fields(self):
+        '''The names of the fields stored in the cache'''
+        return self._header['fields'].keys()
+    def get(self, key, indices=None):
+        try:
+            info = self._header['fields'][key]
+        except KeyError:
+            raise KeyError("Attempt to use fieldname {0}, which is not stored "
+                           "in cache {1}".format(key, self.name))
+        data = self._array(info['array'])
+        if not info['perPixel']:
+            return numpy.asarray(data)
+        if indices is None:
+            return self._whole_field(key, data)
+        rows = self._array('rows')[indices]
+        if numpy.any(rows < 0):
+            # some pixels were filtered out
+            return self._whole_field(key, data)[indices]
+        return numpy.asarray(data[rows])
+    def get_cm(self, key, indices=None):
+        return self.get(key, indices)
+    def _whole_field(self, key, data):
+        '''the field spread out over every pixel index'''
+        if key not in self._whole:
+            rows = self._array('rows')
+            if data.dtype.kind in 'fc':
+                whole = numpy.empty(rows.shape + data.shape[1:], 
+                                    dtype=data.dtype)
+                whole.fill(numpy.NaN)
+            else:
+                whole = numpy.zeros(rows.shape + data.shape[1:], 
+                                    dtype=data.dtype)
+            kept = rows >= 0
+            whole[kept] = data[rows[kept]]
+            self._whole[key] = whole
+        return self._whole[key]
+    def _geo_table(self, names):
+        '''PixelTable of the pixels kept, with the named columns'''
+        for name in names:
+            if name not in self._header['arrays']:
+                raise IOError('Cache {0} does not hold {1}'.format(self.name,
+                                                                    name))
+        return pixel_table.PixelTable(dict([(name, 
+                                             numpy.asarray(self._array(name)))
+                                            for name in ('ind',) + names]))
+    @geo_cached
+    def get_geo_corners(self):
+        '''Retrieves array of the corners of the pixels kept'''
+        return self._geo_table(('latCorners', 'lonCorners')).get_geo_corners()
+    @geo_cached
+    def get_geo_centers(self):
+        '''Retrieves array of the centers of the pixels kept'''
+        return self._geo_table(('lat', 'lon')).get_geo_centers()
+    def get_scanline_times(self):
+        '''Retrieves the time of the scanline of each pixel kept'''
+        if 'scanlineTimes' not in self._header['arrays']:
+            raise NotImplementedError
+        return numpy.asarray(self._array('scanlineTimes'), 
+                             dtype=numpy.float64)
+    def __enter__(self):
+        '''Arrays are memory mapped, so only the geolocation is cached'''
+        if getattr(self, '_cmDepth', 0):
+            self._cmDepth += 1
+            return self
+        self._cmDepth = 1
+        self._geo_cache = dict()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cmDepth -= 1
+        if self._cmDepth == 0:
+            self._geo_cache = None
+        return False
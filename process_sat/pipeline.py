@@ -0,0 +1,838 @@
+'''
+Importable processing pipeline behind whips.py
+
+A run of whips is described by a configuration holding the same
+settings as the command line: either the namespace built by whips'
+argument parser, or a dictionary with the option names as keys and
+the projection, output function and filetype attributes as keys of
+their own, IE
+
+    config = {'filetype' : 'OMI_NO2_KNMI_HDF_v2_0_postFeb2006',
+              'directory' : '/data/omi',
+              'gridProj' : 'latlon', 'xCell' : '0.25', 'yCell' : '0.25',
+              ...,
+              'mapFunc' : 'point_in_cell',
+              'outDirectory' : '/data/out', 'outFileName' : 'no2.nc'}
+    pipeline.run(config)
+
+Values are given as strings, just as on the command line.  The
+attributes may also be collected into dictionaries under the keys
+projAttrs and outFuncAttrs.
+
+run processes a single configuration.  A Pipeline processes any
+number of them in turn and keeps what it can between them: the grid
+definitions, the geometry of their gridcells (see grid_cache) and
+a pool of parsers for the files read, so that a long-lived worker
+does not pay to rebuild them for every job.  Configuration errors
+raise ConfigError rather than exiting.
+'''
+import os
+import datetime
+import textwrap
+import argparse
+from collections import OrderedDict
+from itertools import izip
+
+import parse_geo
+import grid_geo
+import map_geo
+import out_geo
+import utils
+import tiling
+import catalog
+import discovery
+import scanlines
+import prefilter
+
+'''
+VERSION NUMBER
+'''
+__version__ = "1.1.6"
+
+# settings of a run that need not be given, and their defaults.
+# These match the defaults of the command line
+DEFAULTS = {'directory' : None,
+            'fileList' : None,
+            'include' : None,
+            'exclude' : None,
+            'recursive' : 'False',
+            'outFunc' : None,
+            'outFileName' : None,
+            'includeGrid' : None,
+            'gridCache' : None,
+            'tileShape' : None,
+            'nWorkers' : 1,
+            'catalog' : None,
+            'verbose' : True,
+            'interactive' : False,
+            'outBlocks' : None,
+            'gridBlocks' : None}
+
+# the default size of the parser pool of a Pipeline
+DEFAULT_MAX_PARSERS = 256
+
+# the number of scanlines of a granule mapped at a time (see
+# map_geo.map_pixel_tables)
+MAP_CHUNK_ROWS = 500
+
+class ConfigError(Exception):
+    '''
+    Raised when a configuration cannot be run.  messages is the list
+    of lines describing every problem found
+    '''
+    def __init__(self, messages):
+        if isinstance(messages, basestring):
+            messages = [messages]
+        Exception.__init__(self, '\n'.join(messages))
+        self.messages = messages
+
+def bad_file_default(filename):
+    '''
+    Dummy function for non-interactive file handling
+    '''
+    return 1
+
+def bad_file(filename):
+    '''
+    Determine what the user wants to do when one of the
+    files turns out to be invalid.
+    '''
+    prompt = '\n'.join(\
+             textwrap.wrap("File {0} couldn't be read properly.  What do you " \
+                           "wish to do?  Enter (1) to skip this file, but " \
+                           "continue processing other files.  Enter (2) to " \
+                           "stop reading files but continue with data " \
+                           "processing.  Enter (3) to quit this program.  " \
+                           "Enter your selection here: ".format(filename)))
+    while True:
+        print prompt
+        answer = raw_input(" ==> ")
+        try:
+            answer = int(answer)
+        except(ValueError, TypeError):
+            answer = 0
+        if answer in [1,2,3]:
+            return answer
+        print ("\nInvalid answer.  Please try again.")
+
+class BlockNamespace(object):
+    '''
+    Look up attributes for an additional output or grid block.  Attributes
+    given within the block take precedence over those given for the whole
+    run
+    '''
+    def __init__(self, block, namespace):
+        self._block = block
+        self._namespace = namespace
+    def __getattr__(self, name):
+        if name in ['outFunc', 'gridProj'] and name in self._block:
+            return self._block[name]
+        try:
+            return self._block['attrs'][name]
+        except KeyError:
+            return getattr(self._namespace, name)
+
+def grid_file_name(fname, gridNum):
+    '''
+    Name the file written for grid number gridNum.  The first grid keeps
+    fname, the others have "_grid<gridNum>" inserted before the extension
+    '''
+    if gridNum == 0:
+        return fname
+    (root, ext) = os.path.splitext(fname)
+    return '{0}_grid{1}{2}'.format(root, gridNum, ext)
+
+def make_namespace(config):
+    '''
+    Copy config (a namespace or dictionary) into a new namespace with
+    the defaults filled in, so that the run cannot alter config.
+    Attributes collected under projAttrs or outFuncAttrs are moved
+    to the namespace itself, and flags given as booleans become the
+    strings True and False, as on the command line
+    '''
+    if isinstance(config, dict):
+        settings = dict(config)
+    else:
+        settings = dict(vars(config))
+    for name in ['projAttrs', 'outFuncAttrs']:
+        if isinstance(settings.get(name), dict):
+            settings.update(settings.pop(name))
+    for (name, val) in DEFAULTS.items():
+        if settings.get(name) is None:
+            settings[name] = val
+    for name in ['recursive', 'verbose', 'interactive']:
+        if isinstance(settings[name], bool):
+            settings[name] = str(settings[name])
+    return argparse.Namespace(**settings)
+
+def _expand_dir(path, verbose):
+    '''Expand the '.' character as shorthand for the working directory'''
+    parts = path.split('.')
+    if len(parts) == 1:
+        return parts[0]
+    if verbose:
+        print "Using '.' character as shorthand for current working directory"
+    return os.getcwd().join(parts)
+
+def argerrmsg(attr, type):
+    return textwrap.TextWrapper(initial_indent = "Argument Error: ", \
+                                subsequent_indent = "                ", \
+                                width = 80).wrap('Missing argument {0}, '\
+                                                 'which is required for '\
+                                                 'selected {1}.  Please '\
+                                                 'include a value for '\
+                                                 '{0}.\n'.format(attr,type))
+def formerrmsg(attr, type):
+    return textwrap.TextWrapper(initial_indent = "Argument Error: ", \
+                                subsequent_indent = "                ", \
+                                width = 80).wrap('Invalid input for argument '\
+                                                 '{0}.  Argument should be '\
+                                                 '{1}.  Please include a valid'\
+                                                 ' value for {0}.\n'\
+                                                 .format(attr,type))
+
+def parse_grid_parms(gridDef, space):
+    '''
+    Cast the attributes for gridDef found in space to the correct types.
+    Returns the parameter dictionary and a list of error messages for any
+    missing or invalid attributes
+    '''
+    gridDict = dict()
+    unitParms = []
+    parms = dict(gridDef.requiredParms())
+    # optional parameters are only cast if the user supplied them
+    for (attr, val) in gridDef.optionalParms().items():
+        if hasattr(space, attr):
+            parms[attr] = val
+    for attr in parms:
+        # Need to cast input to correct types, then add to dictionary
+        try:
+            if parms[attr][1] == 'int':
+                try:
+                    gridDict[attr] = int(getattr(space, attr))
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, "an integer")
+            elif parms[attr][1] == 'decimal':
+                try:
+                    gridDict[attr] = float(getattr(space, attr))
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, "a decimal")
+            elif parms[attr][1] == 'posint':
+                try:
+                    gridDict[attr] = int(getattr(space, attr))
+                    if gridDict[attr] <= 0:
+                        raise ValueError
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, "a positive integer")
+            elif parms[attr][1] == 'posdecimal':
+                try:
+                    gridDict[attr] = float(getattr(space, attr))
+                    if gridDict[attr] <= 0:
+                        raise ValueError
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, "a positive decimal")
+            elif parms[attr][1] == 'list':
+                gridDict[attr] = getattr(space, \
+                                         attr).split(',')
+            elif parms[attr][1] == 'bool':
+                if getattr(space, attr) == 'True':
+                    gridDict[attr] = True
+                elif getattr(space,attr) == 'False':
+                    gridDict[attr] = False
+                else:
+                    unitParms = unitParms + formerrmsg(attr,
+                                                      "either 'True' or 'False'")
+            else:
+                gridDict[attr] = getattr(space, attr)
+        except AttributeError:
+            unitParms = unitParms + argerrmsg(attr, 'projection (' \
+                                              + space.gridProj + ')')
+    return (gridDict, unitParms)
+
+def parse_out_parms(outFunc, space):
+    '''
+    Cast the attributes for outFunc found in space to the correct types.
+    Returns the parameter dictionary and a list of error messages for any
+    missing or invalid attributes
+    '''
+    outParms = dict()
+    unitParms = []
+    parms = dict(outFunc.required_parms())
+    # optional parameters are only cast if the user supplied them
+    for (attr, val) in outFunc.optional_parms().items():
+        if hasattr(space, attr):
+            parms[attr] = val
+    try:
+        # add coindexed list indexer to dictionary first
+        outParms[outFunc.__userKeys__] = getattr(space,
+                                         outFunc.__userKeys__).split(',')
+
+        for attr in parms:
+            # Again, need to cast input to correct type, then add to dictionary
+            try:
+                if parms[attr][1] == 'int':
+                    try:
+                        outParms[attr] = int(getattr(space, attr))
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr,"\bn integer")
+                elif parms[attr][1] == 'decimal':
+                    try:
+                        outParms[attr] = float(getattr(space, attr))
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr,"decimal")
+                elif parms[attr][1] == 'posint':
+                    try:
+                        outParms[attr] = int(getattr(space, attr))
+                        if outParms[attr] <= 0:
+                            raise ValueError
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr, \
+                                                           "a positive integer")
+                elif parms[attr][1] == 'posdecimal':
+                    try:
+                        outParms[attr] = float(getattr(space, attr))
+                        if outParms[attr] <= 0:
+                            raise ValueError
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr, \
+                                                           "a positive decimal")
+                elif parms[attr][1] == 'intlist':
+                    try:
+                        outParms[attr] = [int(el) for el in
+                                          str(getattr(space, attr)).split(',')]
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr, \
+                                    "a comma-delimited list of integers")
+                elif parms[attr][1] == 'decimallist':
+                    try:
+                        outParms[attr] = [float(el) for el in
+                                          str(getattr(space, attr)).split(',')]
+                    except ValueError:
+                        unitParms = unitParms + formerrmsg(attr, \
+                                    "a comma-delimited list of decimals")
+                elif parms[attr][1] == 'list':
+                    try:
+                        outParms[attr] = getattr(space, attr).split(',')
+                    except AttributeError:
+                        outParms[attr] = [getattr(space, attr)[el] for \
+                                          el in outParms[outFunc.__userKeys__]]
+                        print "   {0}".format(outParms[attr])
+                elif parms[attr][1] == 'listoflists':
+                    try:
+                        lists = getattr(space, attr).split('/')
+                        outParms[attr] = []
+                        for list in lists:
+                            if list == '':
+                                outParms[attr].append([])
+                            else:
+                                outParms[attr].append(list.split(','))
+                    except AttributeError:
+                        outParms[attr] = [getattr(space, attr)[el] for \
+                                          el in outParms[outFunc.__userKeys__]]
+                elif parms[attr][1] == 'bool':
+                    if getattr(space, attr) == 'True':
+                        outParms[attr] = True
+                    elif getattr(space,attr) == 'False':
+                        outParms[attr] = False
+                    else:
+                        unitParms = unitParms + formerrmsg(attr,
+                                    "either 'True' or 'False'")
+                elif parms[attr][1] == 'time':
+                    epoch = '00:00:00_01-01-1993'
+                    format = '%H:%M:%S_%m-%d-%Y'
+                    try:
+                        outParms[attr] = utils.timestr_to_nsecs(getattr
+                                        (space, attr), epoch, format)
+                    except:
+                        unitParms = unitParms + formerrmsg(attr,
+                                    "in the format " + format)
+
+                else:
+                    outParms[attr] = getattr(space, attr)
+            except AttributeError:
+                unitParms = unitParms + argerrmsg(attr, 'output function (' + \
+                                                      space.outFunc + ')')
+    except AttributeError:
+        unitParms = unitParms + argerrmsg(outFunc.__userKeys__, 'output function ('\
+                                              + space.outFunc + ')')
+    return (outParms, unitParms)
+
+def parse_parser_parms(space):
+    '''
+    Cast the parser-specific attributes found in space (those listed in
+    space.parserParms) to the correct types.  Returns the parameter
+    dictionary and a list of error messages for any missing or invalid
+    attributes
+    '''
+    parserParms = {}
+    unitParms = []
+    parms = getattr(space, 'parserParms', {})
+    for attr in parms:
+        # Again, need to cast input to correct type, then add to dictionary
+        try:
+            if parms[attr][1] == 'int':
+                try:
+                    parserParms[attr] = int(getattr(space, attr))
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr,"\bn integer")
+            elif parms[attr][1] == 'decimal':
+                try:
+                    parserParms[attr] = float(getattr(space, attr))
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr,"decimal")
+            elif parms[attr][1] == 'posint':
+                try:
+                    parserParms[attr] = int(getattr(space, attr))
+                    if parserParms[attr] <= 0:
+                        raise ValueError
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, \
+                                                       "a positive integer")
+            elif parms[attr][1] == 'posdecimal':
+                try:
+                    parserParms[attr] = float(getattr(space, attr))
+                    if parserParms[attr] <= 0:
+                        raise ValueError
+                except ValueError:
+                    unitParms = unitParms + formerrmsg(attr, \
+                                                       "a positive decimal")
+            elif parms[attr][1] == 'list':
+                parserParms[attr] = getattr(space, attr).split(',')
+            elif parms[attr][1] == 'listoflists':
+                try:
+                    lists = getattr(space, attr).split('/')
+                    parserParms[attr] = []
+                    for list in lists:
+                        if list == '':
+                            parserParms[attr].append([])
+                        else:
+                            parserParms[attr].append(list.split(','))
+                except AttributeError:
+                    unitParms = unitParms + formerrmsg(attr, \
+                                "a correctly formatted list of lists.  The list "\
+                                "should be delimited by forward slashes, and each "\
+                                "sublist should be delimited by commas")
+            elif parms[attr][1] == 'bool':
+                if getattr(space, attr) == 'True':
+                    parserParms[attr] = True
+                elif getattr(space,attr) == 'False':
+                    parserParms[attr] = False
+                else:
+                    unitParms = unitParms + formerrmsg(attr,
+                                "either 'True' or 'False'")
+            elif parms[attr][1] == 'time':
+                epoch = '00:00:00_01-01-1993'
+                format = '%H:%M:%S_%m-%d-%Y'
+                try:
+                    parserParms[attr] = utils.timestr_to_nsecs(getattr
+                                    (space, attr), epoch, format)
+                except:
+                    unitParms = unitParms + formerrmsg(attr,
+                                "in the format " + format)
+            elif parms[attr][1] == "dirPath":
+                if getattr(space,attr) == 'none':
+                    parserParms[attr] = None
+                    continue
+                if not os.path.isdir(getattr(space,attr)):
+                    print "WARNING: {0} is not a valid directory for corner file "\
+                          "input.  If you are using regional intersect mapping, "\
+                          "this run may terminate unexpectedly".format(getattr(space, attr))
+                    parserParms[attr] = None
+                else:
+                    parserParms[attr] = getattr(space, attr)
+            else:
+                parserParms[attr] = getattr(space, attr)
+        except AttributeError:
+            unitParms = unitParms + argerrmsg(attr, 'filetype (' + \
+                                                  space.filetype + ')')
+    return (parserParms, unitParms)
+
+class Job(object):
+    '''
+    A checked configuration, ready to run.  Built by prepare.
+
+    Attributes:
+        space - the namespace of settings, with the filetype expanded
+        verbose - whether to print status messages
+        filetype - the name of the parser for the input files
+        directory - the directory holding the input files
+        outDirectory - the directory the outputs are written to
+        grids - list of (GridDef class, parameter dict), one per grid
+        outputs - list of (output function class, parameter dict,
+            output filename), one per output
+        parserParms - the parameters passed to the parsers
+        mapFunc - the mapping function
+    '''
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+    def output_files(self):
+        '''The names of the files the outputs are written to'''
+        return [grid_file_name(fname, i) for i in range(len(self.grids))
+                for (func, parms, fname) in self.outputs]
+
+def prepare(config):
+    '''
+    Check config and cast its attributes to the types the grids,
+    outputs and parsers expect.  Returns a Job.  Raises ConfigError,
+    listing every problem found, if config cannot be run.  Nothing
+    is read or written, and the parsers, grids and outputs are not
+    instantiated
+    '''
+    space = make_namespace(config)
+    for name in ['filetype', 'gridProj', 'mapFunc', 'outDirectory']:
+        if getattr(space, name, None) is None:
+            raise ConfigError('Missing setting {0}, which is '
+                              'required.'.format(name))
+
+    # Parse filetype
+    if not hasattr(parse_geo, space.filetype + '_File'):
+        if space.filetype not in parse_geo.SupportedFileTypes():
+            raise ConfigError('{0} is not a valid filetype'.format(
+                    space.filetype))
+        space = utils.parse_filetype(space)
+    if space.outFunc is None:
+        raise ConfigError('Missing setting outFunc, which is required for '
+                          'filetype {0}.'.format(space.filetype))
+
+    # Parse verbose flag
+    verbose = space.verbose != 'False'
+
+    directory = _expand_dir(space.directory or os.getcwd(), verbose)
+    outDirectory = _expand_dir(space.outDirectory, True)
+
+    # Make sure the directories are valid
+    if not os.path.isdir(directory):
+        raise ConfigError("Error: {0} is not a valid directory".format(
+                directory))
+    if not os.path.isdir(outDirectory):
+        raise ConfigError("Error: {0} is not a valid directory".format(
+                outDirectory))
+
+    # parse output filename
+    outFileName = (space.outFileName and \
+                        os.path.join(outDirectory, space.outFileName)) \
+                   or os.path.join(outDirectory, 'output1')
+
+    # Make sure that both the output directory and the given output file
+    # can be accessed and written to
+    if not os.access(outDirectory, os.W_OK) or (os.path.isfile(outFileName)\
+              and not os.access(outFileName, os.W_OK)):
+        raise ConfigError(textwrap.wrap("Error: Unable to write output to "\
+                            "file {1} in directory {0}.  You may not have "\
+                            "write permissions to that directory, or that "\
+                            "directory may already contain an existing file "\
+                            "of that name, for which you do not have write "\
+                            "permissions.  Check the output directory and "\
+                            "try again.".format(outDirectory,
+                                                space.outFileName), 75))
+
+    # parse output filenames for any additional output blocks
+    blockFileNames = []
+    for (i, block) in enumerate(space.outBlocks or [], 1):
+        blockFileName = (block.get('outFileName') and \
+                             os.path.join(outDirectory, block['outFileName']))\
+                        or '{0}-{1}'.format(outFileName, i)
+        if os.path.isfile(blockFileName) and \
+                not os.access(blockFileName, os.W_OK):
+            raise ConfigError(textwrap.wrap("Error: Unable to write output "\
+                                "to file {0}.  You may not have write "\
+                                "permissions for an existing file of that "\
+                                "name.  Check the output directory and try "\
+                                "again.".format(blockFileName), 75))
+        blockFileNames.append(blockFileName)
+
+    for (name, valid) in [('gridProj', grid_geo.ValidProjections()),
+                          ('outFunc', out_geo.ValidOutfuncs()),
+                          ('mapFunc', map_geo.ValidMaps())]:
+        if getattr(space, name) not in valid:
+            raise ConfigError('{0} is not a valid choice for {1}.  Choose '
+                              'from {2}'.format(getattr(space, name), name,
+                                                ', '.join(valid)))
+
+    # retrieve grid definition function from grid_geo
+    gridDef = getattr(grid_geo, space.gridProj + '_GridDef')
+    # retrieve output function function from out_geo
+    outFunc = getattr(out_geo, space.outFunc + '_out_func')
+    if verbose: print('Using outfunc ' + space.outFunc)
+
+    # parse input to initialize gridDict and outParms
+    if verbose: print('Parsing inputs... '+str(datetime.datetime.now()) + \
+                      '\nChecking for required parameters...')
+    (gridDict, unitParms) = parse_grid_parms(gridDef, space)
+
+    # Build the parameters for any additional grids
+    grids = [(gridDef, gridDict)]
+    for block in space.gridBlocks or []:
+        blockDef = getattr(grid_geo, block['gridProj'] + '_GridDef')
+        if verbose: print('Using additional grid projection ' +
+                          block['gridProj'])
+        (blockDict, errs) = parse_grid_parms(blockDef,
+                                             BlockNamespace(block, space))
+        unitParms = unitParms + errs
+        grids.append((blockDef, blockDict))
+
+    (outParms, errs) = parse_out_parms(outFunc, space)
+    unitParms = unitParms + errs
+
+    # Build the parameters for any additional output blocks
+    outputs = [(outFunc, outParms, outFileName)]
+    for (block, blockFileName) in izip(space.outBlocks or [], blockFileNames):
+        blockFunc = getattr(out_geo, block['outFunc'] + '_out_func')
+        if verbose: print('Using outfunc ' + block['outFunc'] + ' for ' +
+                          blockFileName)
+        (blockParms, errs) = parse_out_parms(blockFunc,
+                                             BlockNamespace(block, space))
+        unitParms = unitParms + errs
+        outputs.append((blockFunc, blockParms, blockFileName))
+
+    # Pyramid levels are coarsened from the whole grid, which a tile
+    # worker never holds
+    if space.tileShape:
+        for (func, parms, fname) in outputs:
+            if parms.get('pyramidFactors'):
+                unitParms = unitParms + textwrap.wrap(
+                    'Argument Error: pyramidFactors cannot be used with '
+                    '--tileShape (output {0}).  Run without tiling, or '
+                    'write the coarser grids in runs of their '
+                    'own.'.format(fname), 80)
+    (parserParms, errs) = parse_parser_parms(space)
+    unitParms = unitParms + errs
+
+    # Unless everything checked out, report those messages
+    if unitParms != []:
+        raise ConfigError(unitParms)
+    if verbose: print('                                    Done.')
+    return Job(space=space, verbose=verbose, filetype=space.filetype,
+               directory=directory, outDirectory=outDirectory, grids=grids,
+               outputs=outputs, parserParms=parserParms,
+               mapFunc=getattr(map_geo, space.mapFunc + '_map_geo'))
+
+class Pipeline(object):
+    '''
+    Runs configurations one after another, keeping the grid
+    definitions and a pool of parsers between runs.
+
+    Parsers are kept for up to maxParsers files, the least recently
+    used being dropped first, and are replaced when their file
+    changes.  If keepOpen is True the pooled files are also held
+    open, so that their geolocation is only read once however many
+    runs use them.  Close the pipeline (or use it as a context
+    manager) to release them.
+    '''
+    def __init__(self, maxParsers=DEFAULT_MAX_PARSERS, keepOpen=False):
+        self.maxParsers = maxParsers
+        self.keepOpen = keepOpen
+        self._griddefs = dict()
+        self._parsers = OrderedDict()
+    def griddef(self, gridClass, gridDict):
+        '''The instance of gridClass for parameters gridDict'''
+        key = (gridClass.__name__, repr(sorted(gridDict.items())))
+        if key not in self._griddefs:
+            self._griddefs[key] = gridClass(dict(gridDict))
+        return self._griddefs[key]
+    def parser(self, filename, filetype, parserParms):
+        '''
+        The parser of filetype for filename, from the pool if the file
+        has not changed since it was made.  Raises whatever get_parser
+        raises for files that cannot be read
+        '''
+        key = (os.path.abspath(filename), filetype,
+               repr(sorted(parserParms.items())))
+        mtime = os.path.getmtime(filename)
+        entry = self._parsers.pop(key, None)
+        if entry is not None and entry[0] != mtime:
+            self._release(entry[1])
+            entry = None
+        if entry is None:
+            parser = parse_geo.get_parser(filename, filetype, parserParms)
+            if self.keepOpen:
+                parser.__enter__()
+            entry = (mtime, parser)
+        self._parsers[key] = entry
+        while len(self._parsers) > self.maxParsers:
+            (unused_key, (unused_mtime, old)) = self._parsers.popitem(
+                last=False)
+            self._release(old)
+        return entry[1]
+    def _release(self, parser):
+        if self.keepOpen:
+            parser.__exit__(None, None, None)
+    def close(self):
+        '''Drop the pooled parsers (closing their files) and grids'''
+        while self._parsers:
+            (unused_key, (unused_mtime, parser)) = self._parsers.popitem()
+            self._release(parser)
+        self._griddefs.clear()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+    def run(self, config):
+        '''
+        Process config (see prepare).  Returns the list of output files
+        written
+        '''
+        job = prepare(config)
+        (space, verbose) = (job.space, job.verbose)
+
+        if verbose: print('building filelist '+str(datetime.datetime.now()))
+        # if a filelist was provided, use those files, otherwise find
+        # every file in the directory that the parser could read
+        if space.fileList:
+            files = [os.path.join(job.directory, f) for f in space.fileList]
+        else:
+            files = discovery.discover_files(job.directory, space.include,
+                                             space.exclude,
+                                             space.recursive == 'True',
+                                             discovery.expected_format(
+                                                 job.filetype))
+
+        # Construct the grid definitions
+        if verbose: print('constructing grid '+str(datetime.datetime.now()))
+        griddefs = [self.griddef(gDef, gDict) for (gDef, gDict) in job.grids]
+        outputs = job.outputs
+
+        # the time window covering every output (None if any is
+        # unrestricted)
+        window = utils.time_window([parms for (func, parms, fname)
+                                    in outputs])
+
+        # use the catalog to skip files outside the requested times and
+        # grids
+        if space.catalog is not None:
+            catalogPath = space.catalog or os.path.join(job.directory,
+                                                        catalog.DEFAULT_NAME)
+            files = [f for f in files if os.path.abspath(f) !=
+                     os.path.abspath(catalogPath)]
+            # the time range of a file can also be read with the outputs'
+            # time field
+            timeFields = set([parms.get('time') for (func, parms, fname)
+                              in outputs])
+            timeField = timeFields.pop() if len(timeFields) == 1 else None
+            if verbose: print('updating catalog '+str(datetime.datetime.now()))
+            with catalog.GranuleCatalog(catalogPath) as cat:
+                cat.update(files, job.filetype,
+                           lambda f: self.parser(f, job.filetype,
+                                                 job.parserParms),
+                           timeField, verbose)
+                nFiles = len(files)
+                files = cat.select(files, job.filetype, window,
+                                   [catalog.grid_extent(griddef)
+                                    for griddef in griddefs])
+            if verbose: print('catalog selected {0} of {1} files'.format(
+                    len(files), nFiles))
+
+        parsers = []
+        if verbose: print('getting parsers '+str(datetime.datetime.now()))
+        badfile = space.interactive == 'True' and bad_file or bad_file_default
+        for f in files:
+            if verbose: print "Instantiating parser for file {0}".format(f)
+            try:
+                parser = self.parser(f, job.filetype, job.parserParms)
+            except (IOError, OSError) as inst:
+                if verbose: print "there was an IOError when instantiating parser"
+                answer = badfile(f) # badfile() depends on interactive
+                if answer is 1:
+                    continue
+                elif answer is 2:
+                    break
+                elif answer is 3:
+                    raise SystemExit
+            except Exception as inst:
+                if verbose: print inst.args[0]
+                continue
+            if verbose: print "parser appended successfully."
+            parsers.append(parser)
+
+        # when every output is restricted in time by the 'Time' field, only
+        # map the scanlines that may fall inside the time window
+        if window is not None and all([parms.get('time') == 'Time'
+                                       for (func, parms, fname) in outputs]):
+            if verbose: print('restricting to scanlines in time window '+
+                              str(datetime.datetime.now()))
+            nParsers = len(parsers)
+            parsers = [scanlines.restrict_to_window(p, window)
+                       for p in parsers]
+            parsers = [p for p in parsers if p is not None]
+            if verbose: print('{0} of {1} files have scanlines in the time '
+                              'window'.format(len(parsers), nParsers))
+
+        # only map the pixels that pass the filters of at least one output
+        outFuncs = [func(dict(parms)) for (func, parms, fname) in outputs]
+
+        gridFileName = space.includeGrid
+        if gridFileName:
+            if not os.access(os.path.dirname(gridFileName), os.W_OK):
+                print textwrap.wrap("Warning: Unable to write output to file "\
+                                    "{0}.  No gridcell file will be written "\
+                                    "for this run.".format(gridFileName), 75)
+            else:
+                if verbose: print('writing grid to file '+
+                                  str(datetime.datetime.now()))
+                for (i, griddef) in enumerate(griddefs):
+                    utils.write_grid_to_netcdf(griddef,
+                                               grid_file_name(gridFileName, i),
+                                               space.gridCache)
+
+        written = job.output_files()
+        if space.tileShape:
+            # Map and write outputs one tile at a time.  The files are left
+            # closed, since the tiles may be processed in worker processes.
+            if verbose: print('filtering pixels before mapping '+
+                              str(datetime.datetime.now()))
+            parsers = [prefilter.prefilter_parser(p, outFuncs) 
+                       for p in parsers]
+            for (i, griddef) in enumerate(griddefs):
+                tiling.run_tiled(parsers, griddef, job.mapFunc,
+                                 [(func, parms, grid_file_name(fname, i))
+                                  for (func, parms, fname) in outputs],
+                                 space.tileShape, space.nWorkers,
+                                 verbose, __version__)
+            return written
+        # Filter and map data to grids.  Each file is opened once for the
+        # filters and all the grids, so its geolocation is read once, and
+        # closed before the next.  Files are mapped in chunks of
+        # scanlines (as pixel tables)
+        if verbose: print('filtering and calculating maps '+
+                          str(datetime.datetime.now()))
+        gridMaps = [[] for griddef in griddefs]
+        filtered = []
+        for p in parsers:
+            with p:
+                fp = prefilter.prefilter_parser(p, outFuncs)
+                for (maps, griddef) in izip(gridMaps, griddefs):
+                    maps.append(map_geo.map_pixel_tables(job.mapFunc, fp,
+                                                         griddef, verbose,
+                                                         MAP_CHUNK_ROWS))
+            filtered.append(fp)
+        parsers = filtered
+
+        # Construct output.  The outputs are built a file at a time (see
+        # out_geo.out_func.steps), each file being opened once for all
+        # the grids and outputs, so that fields needed by more than one
+        # output are only read once.  Only one file is open at a time.
+        if verbose: print('creating outfiles '+str(datetime.datetime.now()))
+        steps = [func(dict(parms)).steps(maps, griddef,
+                                         grid_file_name(fname, i),
+                                         verbose, __version__)
+                 for (i, (maps, griddef)) in enumerate(izip(gridMaps,
+                                                            griddefs))
+                 for (func, parms, fname) in outputs]
+        for p in parsers:
+            with p:
+                for step in steps:
+                    step.next()
+        for step in steps:
+            # eventually, we may want to do stuff to outputs, but for now...
+            result = step.next()
+            del(result)
+        return written
+
+def run(config):
+    '''
+    Process config (see prepare) in a pipeline of its own.  Returns the
+    list of output files written
+    '''
+    with Pipeline() as pipeline:
+        return pipeline.run(config)
@@ -0,0 +1,288 @@
+'''
+Columnar tables of pixels.
+
+Parsers hand out geolocation as record arrays, maps hold lists
+of pixel index tuples, and output functions have traditionally
+read fields one pixel at a time.  A PixelTable holds a set of
+pixels as a struct of arrays instead: one column per quantity
+(the pixel centers, corners, indices and any requested fields),
+each with one row per pixel.  Operations on a table are whole
+array operations, so every stage working from tables vectorizes.
+
+Standard columns are
+    ind - the pixel indices, one row per pixel (as in the ind
+        field of the geolocation)
+    lat, lon - the pixel centers
+    latCorners, lonCorners - the 4 pixel corners
+    cell - the (row, col) of the gridcell, for tables built from
+        a map (see map_table)
+    weight - the weight the map gave the pixel in that gridcell
+        (None if the map computes none), for tables built from a
+        map
+Any other column is a parser field of the same name.
+
+Tables are produced in chunks of scanlines from any parser (see
+iter_pixel_tables and the get_pixel_tables method of the parsers)
+and stand in for their parser in the mapping functions, so that
+granules are mapped a chunk at a time (see map_geo.map_pixel_tables).
+They are built from a map (see map_table) so that outputs can
+aggregate over its pixels with grouped reductions (see group_sum),
+and the cache parser builds its geolocation from one (see
+parse_geo.WHCcache_File).
+'''
+import numpy
+
+# columns that are not parser fields
+GEO_COLUMNS = ('ind', 'lat', 'lon', 'latCorners', 'lonCorners', 'cell', 
+               'weight')
+
+class PixelTable(object):
+    '''
+    A set of pixels stored as a dictionary of columns.  Every column
+    has one row per pixel.  parser is the parser the pixels came
+    from.  Any attribute the table lacks is taken from the parser, so
+    a table may be handed to a mapping function in place of its parser
+    (as tiling.TileParser is).  rows, if given, selects the pixels of
+    the table from the flattened geolocation of the parser, so that
+    geolocation without columns in the table is read from the parser.
+    '''
+    def __init__(self, columns, parser=None, rows=None):
+        self.columns = dict(columns)
+        self.parser = parser
+        self.rows = rows
+        lengths = set([len(col) for col in self.columns.itervalues()])
+        if len(lengths) > 1:
+            raise ValueError('All columns of a PixelTable must have the same '
+                             'number of rows')
+    def __len__(self):
+        return len(self.columns['ind'])
+    def __getitem__(self, name):
+        return self.columns[name]
+    def __setitem__(self, name, column):
+        if len(column) != len(self):
+            raise ValueError('Column {0} does not have {1} rows'.format(
+                    name, len(self)))
+        self.columns[name] = column
+    def __contains__(self, name):
+        return name in self.columns
+    def __getattr__(self, name):
+        # only reached for attributes the table doesn't have
+        parser = self.__dict__.get('parser')
+        if parser is None:
+            raise AttributeError(name)
+        return getattr(parser, name)
+    def __enter__(self):
+        self.parser.__enter__()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self.parser.__exit__(exc_type, exc_value, traceback)
+    def _geo_struct(self, latName, lonName, nPoints):
+        if latName not in self.columns or lonName not in self.columns:
+            if self.rows is None or self.parser is None:
+                raise NotImplementedError
+            kind = 'corners' if nPoints > 1 else 'centers'
+            geo = getattr(self.parser, 'get_geo_' + kind)()
+            return geo.reshape(-1)[self.rows]
+        (lat, lon, ind) = (self[latName], self[lonName], self['ind'])
+        shape = (nPoints,) if nPoints > 1 else ()
+        protoDtype = [('lat', lat.dtype, shape), ('lon', lon.dtype, shape),
+                      ('ind', ind.dtype, ind.shape[1:])]
+        struct = numpy.zeros(len(self), dtype=protoDtype)
+        (struct['lat'], struct['lon'], struct['ind']) = (lat, lon, ind)
+        return struct
+    def get_geo_corners(self):
+        '''The corners of the pixels, as a parser's get_geo_corners'''
+        return self._geo_struct('latCorners', 'lonCorners', 4)
+    def get_geo_centers(self):
+        '''The centers of the pixels, as a parser's get_geo_centers'''
+        return self._geo_struct('lat', 'lon', 1)
+
+class _KeyRecorder(object):
+    '''Stands in for a field, so an index map returns the key it uses'''
+    def __getitem__(self, key):
+        return key
+
+def _index_map_axis(indFunc, pxInd, ndim):
+    '''
+    The axis on which the index map indFunc puts the pixels indexed by
+    pxInd in a field read with ndim dimensions, or None if it does not
+    index the field by pixel
+    '''
+    key = indFunc(_KeyRecorder(), pxInd)
+    if not isinstance(key, tuple):
+        key = (key,)
+    pixPos = [pos for (pos, entry) in enumerate(key)
+              if any(entry is i for i in pxInd)]
+    if not pixPos:
+        return None
+    if pixPos != range(pixPos[0], pixPos[-1] + 1):
+        # separated index arrays put the pixels first
+        return 0
+    # integers remove an axis, while slices keep theirs
+    keeps = lambda entries: len([e for e in entries if isinstance(e, slice)
+                                 or e is None])
+    if any(e is Ellipsis for e in key[:pixPos[0]]):
+        return ndim - 1 - keeps(key[pixPos[-1]+1:])
+    return keeps(key[:pixPos[0]])
+
+def read_column(parser, field, ind):
+    '''
+    Read field for many pixels at once through parser.get_cm (so the
+    parser must be in a context manager).  ind is an array with one
+    row of indices per pixel.  Returns (values, perPixel).  If the
+    field varies by pixel, perPixel is True and values has the pixels
+    along its first axis, whatever axis the parser's index map puts
+    them on.  Otherwise perPixel is False and values is the whole
+    field, as returned for any single pixel.
+
+    The field is read once.  The pixel axis is found from the index
+    map (_indexMap) of parsers that have one.  Other parsers are
+    handed index arrays with a trailing axis of length 1, which
+    marks the pixel axis in the shape of the values returned.
+    '''
+    ind = numpy.asarray(ind)
+    nPix = ind.shape[0]
+    pxInd = tuple(ind.reshape(nPix, int(numpy.prod(ind.shape[1:]))).T)
+    indexMap = getattr(parser, '_indexMap', None)
+    if indexMap is not None:
+        vals = numpy.asarray(parser.get_cm(field, pxInd))
+        axis = _index_map_axis(indexMap.get(field, indexMap['default']),
+                               pxInd, vals.ndim)
+        if axis is None:
+            return (vals, False)
+        return (numpy.rollaxis(vals, axis, 0), True)
+    vals = numpy.asarray(parser.get_cm(field, tuple(i[:, numpy.newaxis]
+                                                    for i in pxInd)))
+    marked = [axis for axis in range(vals.ndim - 1)
+              if vals.shape[axis:axis+2] == (nPix, 1)]
+    if not marked:
+        return (vals, False)
+    vals = vals.reshape(vals.shape[:marked[0]+1] + vals.shape[marked[0]+2:])
+    return (numpy.rollaxis(vals, marked[0], 0), True)
+
+def read_field(parser, field, ind):
+    '''
+    Read field for many pixels at once, as read_column.  Returns an
+    array with the pixels along its first axis.  Fields that do not
+    vary by pixel are repeated for every pixel.
+    '''
+    (vals, perPixel) = read_column(parser, field, ind)
+    if not perPixel:
+        return numpy.tile(vals, (len(ind),) + (1,)*vals.ndim)
+    return vals
+
+def iter_pixel_tables(parser, fields=(), chunkRows=None):
+    '''
+    Generate PixelTables covering every pixel of parser, chunkRows
+    scanlines (indices along the first axis of the geolocation) at a
+    time, or all at once if chunkRows is None.  Every table has the
+    ind column, the lat and lon columns (or latCorners and lonCorners
+    if the parser only provides corners) and a column for each of
+    fields.  The other kind of geolocation is read from the parser
+    when the table is asked for it.  The parser is held open while
+    tables are being generated.
+    '''
+    with parser:
+        try:
+            (geo, names) = (parser.get_geo_centers(), ('lat', 'lon'))
+        except NotImplementedError:
+            (geo, names) = (parser.get_geo_corners(), 
+                            ('latCorners', 'lonCorners'))
+        if not geo.ndim:
+            geo = geo.reshape(1)
+        nRows = geo.shape[0]
+        rowSize = geo.size/nRows if nRows else 0
+        step = chunkRows or max(nRows, 1)
+        for first in range(0, nRows, step):
+            chunk = geo[first:first+step].reshape(-1)
+            ind = chunk['ind'].reshape(chunk.size, -1)
+            columns = {'ind' : ind, names[0] : chunk['lat'], 
+                       names[1] : chunk['lon']}
+            if chunk.size:
+                for field in fields:
+                    columns[field] = read_field(parser, field, ind)
+            yield PixelTable(columns, parser, 
+                             slice(first*rowSize, first*rowSize + chunk.size))
+
+def map_table(map, fields=(), parser=None):
+    '''
+    A PixelTable with one row for every (cell, pixel) pair in map, in
+    the order of iteration over the map.  Rows have the cell, ind and
+    weight columns and a column for each of fields, read through the
+    parser of the map (or parser, if given), which must be in a
+    context manager if there are fields to read.
+    '''
+    if parser is None:
+        parser = map.get('parser')
+    cells = []
+    inds = []
+    weights = []
+    for (cell, pixTups) in map.iteritems():
+        if cell == 'parser':
+            continue
+        for (ind, weight) in pixTups:
+            cells.append(cell)
+            inds.append(ind)
+            weights.append(weight)
+    if not inds:
+        columns = {'cell' : numpy.zeros((0, 2), dtype=int),
+                   'ind' : numpy.zeros((0, 0), dtype=int),
+                   'weight' : numpy.zeros((0,), dtype=object)}
+        for field in fields:
+            columns[field] = numpy.zeros((0,))
+        return PixelTable(columns, parser)
+    ind = numpy.array(inds)
+    ind = ind.reshape(ind.shape[0], -1)
+    columns = {'cell' : numpy.array(cells, dtype=int), 'ind' : ind,
+               'weight' : numpy.array(weights, dtype=object)}
+    for field in fields:
+        columns[field] = read_field(parser, field, ind)
+    return PixelTable(columns, parser)
+
+def unique_rows(ind):
+    '''
+    The distinct rows of ind, an array with one row of indices per
+    pixel, in sorted order.  Returns (rows, first, inverse), where
+    first gives the first row of ind equal to each distinct row and
+    inverse the distinct row of each row of ind.
+    '''
+    ind = numpy.asarray(ind)
+    ind = ind.reshape(len(ind), int(numpy.prod(ind.shape[1:])))
+    if not ind.size:
+        empty = numpy.zeros((0,), dtype=numpy.intp)
+        return (ind[:0], empty, numpy.zeros((len(ind),), dtype=numpy.intp))
+    # lexsort is stable, so the first of equal rows comes first
+    order = numpy.lexsort(ind.T[::-1])
+    ind = ind[order]
+    new = numpy.ones(len(ind), dtype=bool)
+    new[1:] = (ind[1:] != ind[:-1]).any(axis=1)
+    inverse = numpy.empty(len(ind), dtype=numpy.intp)
+    inverse[order] = numpy.cumsum(new) - 1
+    return (ind[new], order[new], inverse)
+
+def group_sum(groups, values, nGroups, out=None):
+    '''
+    Sum values (one row per element) into nGroups groups.  groups
+    gives the group of each row.  Each column is summed with
+    numpy.bincount, which adds the rows of a group in order, so the
+    sums are identical to adding them one at a time.  Returns an
+    array of shape (nGroups,) + values.shape[1:], or adds the sums
+    to out (an array of that shape or a view of one) and returns it.
+    Only the rows of out for groups present are touched.
+    '''
+    values = numpy.asarray(values)
+    groups = numpy.asarray(groups, dtype=numpy.intp)
+    if out is not None:
+        # sum over the groups present only
+        (present, groups) = numpy.unique(groups, return_inverse=True)
+        nGroups = present.size
+    nCols = int(numpy.prod(values.shape[1:]))
+    columns = values.reshape(len(values), nCols)
+    sums = numpy.empty((nGroups, nCols))
+    for col in range(nCols):
+        sums[:, col] = numpy.bincount(groups, columns[:, col], nGroups)
+    sums = sums.reshape((nGroups,) + values.shape[1:])
+    if out is None:
+        return sums
+    out[present] += sums
+    return out
@@ -0,0 +1,54 @@
+'''
+Rejection of pixels before mapping.
+
+Output functions reject pixels by quality flags, cutoffs and
+time only after they have been mapped, so the geometry of
+every rejected pixel is computed for nothing.  Output functions
+that can tell ahead of time which pixels they will reject
+implement pixel_filter (see out_geo.out_func).  The filters of
+all the outputs of a run are evaluated over whole granules at
+once, and only the pixels that some output could use are
+handed to the mapping function.
+
+If any output cannot tell which pixels it will use, every
+pixel is mapped.  Since pixels are mapped independently of one
+another, dropping pixels that every output rejects leaves the
+outputs unchanged.
+'''
+import numpy
+
+import tiling
+
+def pixel_mask(parser, outFuncs):
+    '''
+    Boolean vector over the flattened geolocation of parser, True
+    for the pixels that any of outFuncs (instantiated output
+    functions) could use.  Returns None if every pixel must be kept.
+    The parser is held open while the filters are evaluated, so that
+    fields used by several of them are read once.
+    '''
+    if not outFuncs:
+        return None
+    with parser:
+        centers = parser.get_geo_centers().reshape(-1)
+        ind = centers['ind'].reshape(centers.size, -1)
+        keep = numpy.zeros(centers.size, dtype=bool)
+        for func in outFuncs:
+            mask = func.pixel_filter(parser, ind)
+            if mask is None:
+                return None
+            keep |= numpy.asarray(mask, dtype=bool).reshape(-1)
+    return keep
+
+def prefilter_parser(parser, outFuncs):
+    '''
+    Restrict parser to the pixels that any of outFuncs could use.
+    Returns parser itself if every pixel is kept, and otherwise a
+    stand in (see tiling.TileParser) that only hands out the
+    geolocation of the pixels kept.
+    '''
+    keep = pixel_mask(parser, outFuncs)
+    if keep is None or keep.all():
+        return parser
+    return tiling.TileParser(parser, 'centers', parser.get_geo_centers(),
+                             numpy.flatnonzero(keep))
@@ -0,0 +1,94 @@
+#! /Library/Frameworks/Python.framework/Versions/Current/bin/python
+'''
+Command-line regridding of finished output files onto another grid
+
+Re-expresses output files written by whips on a new grid without
+reprocessing the level 2 data (see regridding.py), IE
+
+    regrid.py --gridProj lcc2par
+              --projAttrs stdPar1:33 stdPar2:45 refLat:40 refLon:-97
+                          xOrig:-2556000 yOrig:-1728000 xCell:12000
+                          yCell:12000 nRows:299 nCols:459
+                          earthRadius:6370000
+              --cacheDir /data/grid_cache
+              --outDirectory /data/no2_cmaq /data/no2_latlon/*.nc
+
+The grid of each input file is read from its global attributes.
+Every gridded variable is regridded (as an area weighted average,
+summed for pixel and histogram counts, and merged for the cell
+statistics) unless --variables is given.  The weight matrix between
+two grids is computed once and, with --cacheDir, kept for later
+runs.
+'''
+import os
+import sys
+import argparse
+
+from process_sat import grid_geo
+from process_sat import regridding
+
+def parse_grid_attrs(pairs):
+    '''Parse a list of "name:value" strings into a dictionary'''
+    attrs = dict()
+    for pair in pairs or []:
+        (name, unused_sep, value) = pair.partition(':')
+        attrs[name] = value
+    return attrs
+
+def main(argv=None):
+    argParser = argparse.ArgumentParser("Regrid output files onto another "
+                                        "grid")
+    argParser.add_argument('inFiles', nargs='+', metavar='FileName',
+                           help='The output files to regrid')
+    argParser.add_argument('--gridProj', required=True,
+                           choices=grid_geo.ValidProjections(),
+                           help='The projection of the new grid')
+    argParser.add_argument('--projAttrs', nargs='*', metavar='name:value',
+                           help='The attributes of the new grid, as for '
+                           'whips.py')
+    argParser.add_argument('--outDirectory', required=True,
+                           metavar='DirectoryPath', help='The directory to '
+                           'write the regridded files to, under the names '
+                           'of the input files')
+    argParser.add_argument('--variables', nargs='+', metavar='VariableName',
+                           help='The variables to regrid (default: every '
+                           'gridded variable).  Others are left out')
+    argParser.add_argument('--cacheDir', metavar='DirectoryPath',
+                           help='Directory in which to cache the geometry '
+                           'of the grids and the weight matrix')
+    argParser.add_argument('--minCoverage', type=float, default=0.,
+                           help='The fraction of each new gridcell that '
+                           'valid data must cover for it to be filled '
+                           '(default: 0, any overlap)')
+    argParser.add_argument('--verbose', default='True',
+                           choices={'True', 'False'}, help='Supply False to '
+                           'disable status messages')
+    args = argParser.parse_args(argv)
+    verbose = args.verbose != 'False'
+
+    gridClass = getattr(grid_geo, args.gridProj + '_GridDef')
+    gridAttrs = parse_grid_attrs(args.projAttrs)
+    missing = [attr for attr in gridClass.requiredParms()
+               if attr not in gridAttrs]
+    if missing:
+        argParser.error('Missing grid attributes {0}'.format(
+                ', '.join(sorted(missing))))
+    dstDef = gridClass(gridAttrs)
+    if not os.path.isdir(args.outDirectory):
+        os.makedirs(args.outDirectory)
+    for inFname in args.inFiles:
+        outFname = os.path.join(args.outDirectory, os.path.basename(inFname))
+        if os.path.abspath(outFname) == os.path.abspath(inFname):
+            print('Skipping {0}: would overwrite itself'.format(inFname))
+            continue
+        if verbose:
+            print('Regridding {0} to {1}'.format(inFname, outFname))
+        try:
+            regridding.regrid_file(inFname, outFname, dstDef, args.variables,
+                                   args.cacheDir, args.minCoverage)
+        except (IOError, ValueError) as err:
+            print('Unable to regrid {0}: {1}'.format(inFname, err))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,565 @@
+'''
+Regridding of finished output files from one grid to another.
+
+Re-expressing a finished product on another grid (IE a latlon
+product on an LCC CMAQ domain, or on a coarser latlon grid) does
+not require reprocessing the level 2 data.  Every cell of the new
+grid is the area weighted average of the cells of the old grid
+that overlap it, while counts (of pixels, or of values in histogram
+bins) are shared out by the fraction of each old cell overlapping
+it and summed.  The statistics written by the output functions (see
+cell_stats) are regridded so that they stay what they claim to be:
+minima and maxima are taken over the overlapping old cells, and the
+moment state is merged exactly as separate runs would be (the
+weights, like counts, shared out by area), with the variance and
+std rebuilt from it.  The overlaps are held in a sparse weight matrix
+with one row per target cell and one column per source cell.  The
+matrix only depends on the two grids, so it is computed once and,
+if a cache directory is given, stored there (see load_weight_matrix)
+for every later regridding between the same grids.
+
+Overlaps are computed with the same cell geometry the map
+functions use: the corners of each source cell are projected into
+the gridded (row, col) coordinates of the target grid and joined
+by straight lines, and the resulting polygon is intersected with
+the unit squares of the target cells.  The overlap area is that
+fraction of the area of the source cell (see grid_cache).  When
+both grids are latlon the polygons are rectangles and the overlaps
+are computed directly, a row and a column at a time.
+
+As for the map functions, source cells with any corner that cannot
+be projected are skipped, and no source cell may straddle the
+point where the longitude of the target grid wraps.
+
+The matrix is stored in compressed sparse row form (indptr,
+indices and data, as in scipy.sparse.csr_matrix) and applied with
+a sparse matrix-vector product built from numpy operations.
+'''
+import os
+import hashlib
+
+import numpy
+
+import lazy
+import grid_geo
+import grid_cache
+import cell_stats
+import map_helpers
+import tiling
+
+netCDF4 = lazy.LazyModule('netCDF4')
+geom = lazy.LazyModule('shapely.geometry')
+
+# weight matrices most recently loaded in this process, keyed by 
+# matrix_key
+_loaded = grid_cache.LRUCache(4)
+
+# names of the arrays stored for each weight matrix
+MATRIX_ARRAYS = ('indptr', 'indices', 'data', 'dstArea', 'shapes')
+
+class WeightMatrix(object):
+    '''
+    Sparse matrix of the areas of overlap (in square kilometers) of
+    the cells of a source grid, of shape srcShape, with the cells of a
+    target grid, of shape dstShape.  Cells are numbered in row major
+    order.  The overlaps of target cell i are data[indptr[i]:indptr[i+1]],
+    with the source cells given by indices.  dstArea is the area of
+    every target cell.
+    '''
+    def __init__(self, indptr, indices, data, dstArea, srcShape, dstShape):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.dstArea = dstArea
+        self.srcShape = tuple(srcShape)
+        self.dstShape = tuple(dstShape)
+    @staticmethod
+    def from_overlaps(srcCells, dstCells, overlaps, dstArea, srcShape,
+                      dstShape):
+        '''
+        Build the matrix from the flat indices of the source and target
+        cell of every overlap and its area
+        '''
+        order = numpy.lexsort((srcCells, dstCells))
+        dstCells = numpy.asarray(dstCells)[order]
+        indptr = numpy.searchsorted(dstCells, numpy.arange(
+                numpy.prod(dstShape) + 1)).astype(numpy.int64)
+        return WeightMatrix(indptr,
+                            numpy.asarray(srcCells, dtype=numpy.int64)[order],
+                            numpy.asarray(overlaps, dtype=numpy.float64)[order],
+                            numpy.asarray(dstArea, dtype=numpy.float64).ravel(),
+                            srcShape, dstShape)
+    def arrays(self):
+        '''The arrays to store for this matrix, keyed to name'''
+        return {'indptr' : self.indptr, 'indices' : self.indices,
+                'data' : self.data, 'dstArea' : self.dstArea,
+                'shapes' : numpy.array(self.srcShape + self.dstShape)}
+    def matvec(self, vals, data=None):
+        '''
+        The product of the matrix with vals, an array with one row per
+        source cell (and any number of columns).  Returns an array with
+        one row per target cell.  data replaces the overlap areas, if
+        given.
+        '''
+        vals = numpy.asarray(vals)
+        if data is None:
+            data = self.data
+        return self.reduce_rows(data.reshape((-1,) + (1,)*(vals.ndim - 1)) *
+                                vals[self.indices])
+    def reduce_rows(self, entries, ufunc=numpy.add, empty=0.):
+        '''
+        Reduce entries, an array with one row per element of the matrix
+        (in the order of data), with ufunc over each target cell.
+        Returns an array with one row per target cell, with empty for
+        cells that overlap no source cell.
+        '''
+        out = numpy.empty((self.indptr.size - 1,) + entries.shape[1:])
+        out.fill(empty)
+        rows = numpy.flatnonzero(numpy.diff(self.indptr))
+        if rows.size:
+            # starts of the non-empty rows bound each reduction, since the
+            # rows between them are empty
+            out[rows] = ufunc.reduceat(entries, self.indptr[rows], axis=0)
+        return out
+    def fractions(self, srcArea):
+        '''
+        The fraction of the source cell in each overlap, from srcArea,
+        the area of every source cell
+        '''
+        return self.data/numpy.asarray(srcArea).ravel()[self.indices]
+    def apply(self, vals, fillVal=None, minCoverage=0.):
+        '''
+        Regrid vals, an array of shape srcShape + any extra dimensions.
+        Elements that are NaN or equal to fillVal are ignored.  Each
+        element of the result is the area weighted average of the valid
+        source elements overlapping it, or fillVal (NaN if None) where
+        they cover no more than minCoverage (a fraction) of the target
+        cell, or nothing at all.  Returns an array of shape dstShape
+        + the extra dimensions.
+        '''
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+        extraShape = vals.shape[2:]
+        vals = vals.reshape(numpy.prod(self.srcShape), -1)
+        valid = numpy.logical_not(numpy.isnan(vals))
+        if fillVal is not None:
+            valid &= vals != fillVal
+        validArea = self.matvec(valid.astype(numpy.float64))
+        sums = self.matvec(numpy.where(valid, vals, 0))
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            covered = (validArea > 0) & \
+                (validArea >= minCoverage*self.dstArea[:, numpy.newaxis])
+            out = numpy.where(covered, sums/validArea,
+                              numpy.NaN if fillVal is None else fillVal)
+        return out.reshape(self.dstShape + extraShape)
+    def apply_sum(self, vals, srcArea, fillVal=None):
+        '''
+        Regrid vals, an array of shape srcShape + any extra dimensions
+        holding counts (IE of pixels), by summing them.  srcArea is
+        the area of every source cell.  Each source element adds its
+        value times the fraction of its cell that overlaps the target
+        cell, so the counts of a source cell are shared out by area.
+        Elements that are NaN or equal to fillVal are ignored.  Elements
+        of the result that no valid source element overlaps are fillVal
+        (NaN if None).  Returns an array of shape dstShape + the extra
+        dimensions.
+        '''
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+        extraShape = vals.shape[2:]
+        vals = vals.reshape(numpy.prod(self.srcShape), -1)
+        valid = numpy.logical_not(numpy.isnan(vals))
+        if fillVal is not None:
+            valid &= vals != fillVal
+        sums = self.matvec(numpy.where(valid, vals, 0), 
+                           self.fractions(srcArea))
+        out = numpy.where(self.matvec(valid.astype(numpy.float64)) > 0, sums,
+                          numpy.NaN if fillVal is None else fillVal)
+        return out.reshape(self.dstShape + extraShape)
+    def apply_extreme(self, vals, stat, fillVal=None):
+        '''
+        Regrid vals, an array of shape srcShape + any extra dimensions
+        holding minima (stat 'min') or maxima (stat 'max'), by taking
+        the smallest or largest valid source element overlapping each
+        target cell.  Elements that are NaN or equal to fillVal are
+        ignored, and elements of the result that no valid source 
+        element overlaps are fillVal (NaN if None).  Returns an array
+        of shape dstShape + the extra dimensions.
+        '''
+        (ufunc, empty) = {'min' : (numpy.minimum, numpy.inf),
+                          'max' : (numpy.maximum, -numpy.inf)}[stat]
+        vals = numpy.asarray(vals, dtype=numpy.float64)
+        extraShape = vals.shape[2:]
+        vals = vals.reshape(numpy.prod(self.srcShape), -1)
+        valid = numpy.logical_not(numpy.isnan(vals))
+        if fillVal is not None:
+            valid &= vals != fillVal
+        out = self.reduce_rows(numpy.where(valid, vals, empty)[self.indices],
+                               ufunc, empty)
+        out = numpy.where(numpy.isinf(out), 
+                          numpy.NaN if fillVal is None else fillVal, out)
+        return out.reshape(self.dstShape + extraShape)
+    def apply_moments(self, sumWght, mean, sqDev, srcArea, fillVal=None):
+        '''
+        Regrid the moment state of cell statistics (see cell_stats),
+        arrays of shape srcShape + any extra dimensions, by merging the
+        moments of the source cells overlapping each target cell.  Each
+        source cell adds the fraction of it that overlaps the target
+        cell (from srcArea, the area of every source cell) of its sum
+        of weights and squared deviations, as if its values were spread
+        evenly over it.  Source elements without weight are ignored.
+        Returns the regridded (sumWght, mean, sqDev), each of shape
+        dstShape + the extra dimensions, with fillVal (NaN if None)
+        for the mean and squared deviations of target cells without
+        weight.  As in the output files, sums of weights are never
+        filled.
+        '''
+        extraShape = numpy.shape(sumWght)[2:]
+        (sumWght, mean, sqDev) = [
+            numpy.asarray(arr, dtype=numpy.float64).reshape(
+                numpy.prod(self.srcShape), -1)
+            for arr in (sumWght, mean, sqDev)]
+        with numpy.errstate(invalid='ignore'):
+            valid = (sumWght > 0) & numpy.isfinite(mean) & \
+                numpy.isfinite(sqDev)
+            if fillVal is not None:
+                valid &= (mean != fillVal) & (sqDev != fillVal)
+        (sumWght, mean, sqDev) = [numpy.where(valid, arr, 0)
+                                  for arr in (sumWght, mean, sqDev)]
+        fracs = self.fractions(srcArea)
+        total = self.matvec(sumWght, fracs)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            newMean = self.matvec(sumWght*mean, fracs)/total
+        # the squared deviations within each source cell, plus those of
+        # the source means from the new mean
+        dstCells = numpy.repeat(numpy.arange(self.indptr.size - 1),
+                                numpy.diff(self.indptr))
+        weights = fracs[:, numpy.newaxis]*sumWght[self.indices]
+        deviations = numpy.where(weights > 0, mean[self.indices] -
+                                 newMean[dstCells], 0)
+        newSqDev = self.reduce_rows(fracs[:, numpy.newaxis]*sqDev[self.indices]
+                                    + weights*deviations**2)
+        fill = numpy.NaN if fillVal is None else fillVal
+        return tuple(arr.reshape(self.dstShape + extraShape) for arr in
+                     (total, numpy.where(total > 0, newMean, fill),
+                      numpy.where(total > 0, newSqDev, fill)))
+
+def is_count_variable(name, var):
+    '''
+    Whether the variable name of an output file (var) holds counts:
+    the pixel counts (ValidPixelCount) and histograms (in units of
+    count) written by the output functions
+    '''
+    return (name.startswith('ValidPixelCount') or 
+            getattr(var, 'Units', None) == 'count')
+
+def stat_variable(name, names):
+    '''
+    The statistic or moment state (see cell_stats) held by the variable
+    name of an output file with variables names, or None.  Statistics
+    are written as "<variable>_<statistic>" next to the variable
+    '''
+    for stat in cell_stats.STATISTICS + cell_stats.MOMENT_STATE:
+        if name.endswith('_' + stat) and name[:-len(stat) - 1] in names:
+            return stat
+    return None
+
+def _regrid_moments(inFid, base, matrix, srcShape, srcArea):
+    '''
+    The moment state and the variance and std rebuilt from it of the
+    variable base of an output file open as inFid, regridded with
+    matrix (see WeightMatrix.apply_moments), keyed to statistic.
+    Raises ValueError if the file does not hold the moment state
+    '''
+    names = [base + '_' + stat for stat in cell_stats.MOMENT_STATE]
+    missing = [name for name in names if name not in inFid.variables]
+    if missing:
+        raise ValueError('Cannot regrid the statistics of {0} without its '
+                         'moment state (missing {1})'.format(
+                base, ', '.join(missing)))
+    arrays = [numpy.ma.filled(tiling.gridded_values(inFid, name, srcShape),
+                              numpy.NaN) for name in names]
+    fillVal = getattr(inFid.variables[names[1]], '_FillValue', None)
+    (sumWght, mean, sqDev) = matrix.apply_moments(*(arrays + [srcArea, 
+                                                              fillVal]))
+    fill = numpy.NaN if fillVal is None else fillVal
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        variance = numpy.where(sumWght > 0, sqDev/sumWght, fill)
+    std = numpy.where(sumWght > 0, numpy.sqrt(numpy.abs(variance)), fill)
+    return {'sumWght' : sumWght, 'mean' : mean, 'sqDev' : sqDev,
+            'variance' : variance, 'std' : std}
+
+def matrix_key(srcDef, dstDef):
+    '''A string uniquely identifying the weight matrix between two grids'''
+    return hashlib.sha1(grid_cache.grid_key(srcDef) +
+                        grid_cache.grid_key(dstDef)).hexdigest()
+
+def _grid_shape(griddef):
+    (minRow, maxRow, minCol, maxCol) = griddef.indLims()
+    return (maxRow - minRow + 1, maxCol - minCol + 1)
+
+def _edge_overlaps(srcEdges, (dstMin, dstMax)):
+    '''
+    The overlaps of the intervals between srcEdges (in the gridded
+    coordinates of the target, along one axis) with the target rows (or
+    columns) dstMin to dstMax.  Returns (srcInd, dstInd, fraction of the
+    source interval)
+    '''
+    (srcInd, dstInd, fracs) = ([], [], [])
+    for (i, (lo, hi)) in enumerate(zip(srcEdges[:-1], srcEdges[1:])):
+        (lo, hi) = (min(lo, hi), max(lo, hi))
+        if not hi > lo:
+            continue
+        first = max(int(numpy.floor(lo)), dstMin)
+        last = min(int(numpy.ceil(hi)) - 1, dstMax)
+        for k in range(first, last + 1):
+            overlap = min(hi, k + 1) - max(lo, k)
+            if overlap > 0:
+                srcInd.append(i)
+                dstInd.append(k - dstMin)
+                fracs.append(overlap/(hi - lo))
+    return (numpy.array(srcInd, dtype=numpy.int64),
+            numpy.array(dstInd, dtype=numpy.int64), numpy.array(fracs))
+
+def _latlon_overlaps(srcDef, dstDef):
+    '''
+    The overlaps (see _polygon_overlaps) of two latlon grids, from the
+    overlaps of their rows and of their columns
+    '''
+    (minRow, maxRow, minCol, maxCol) = srcDef.indLims()
+    (dstMinRow, dstMaxRow, dstMinCol, dstMaxCol) = dstDef.indLims()
+    (latEdges, unused_lon) = srcDef.griddedToGeo(
+        numpy.arange(minRow, maxRow + 2, dtype=float), 0.)
+    (unused_lat, lonEdges) = srcDef.griddedToGeo(
+        0., numpy.arange(minCol, maxCol + 2, dtype=float))
+    (rowEdges, unused_col) = dstDef.geoToGridded(latEdges, 0.)
+    (unused_row, colEdges) = dstDef.geoToGridded(0., lonEdges)
+    (srcRow, dstRow, rowFrac) = _edge_overlaps(rowEdges, (dstMinRow, dstMaxRow))
+    (srcCol, dstCol, colFrac) = _edge_overlaps(colEdges, (dstMinCol, dstMaxCol))
+    (srcNCols, dstNCols) = (maxCol - minCol + 1, dstMaxCol - dstMinCol + 1)
+    srcCells = (srcRow[:, numpy.newaxis]*srcNCols + srcCol).ravel()
+    dstCells = (dstRow[:, numpy.newaxis]*dstNCols + dstCol).ravel()
+    fracs = (rowFrac[:, numpy.newaxis]*colFrac).ravel()
+    return (srcCells, dstCells, fracs)
+
+def _polygon_overlaps(srcDef, dstDef, srcGeom):
+    '''
+    The overlaps of the cells of srcDef with the cells of dstDef, as
+    (srcCells, dstCells, fractions of the source cell), from the
+    polygons of the source cells in the gridded coordinates of dstDef.
+    srcGeom is the geometry of srcDef (see grid_cache)
+    '''
+    dstLims = dstDef.indLims()
+    (dstMinRow, dstMaxRow, dstMinCol, dstMaxCol) = dstLims
+    dstNCols = dstMaxCol - dstMinCol + 1
+    (rows, cols) = ([], [])
+    for lbl in ('ll', 'ul', 'ur', 'lr'):
+        (row, col) = dstDef.geoToGridded(numpy.asarray(srcGeom[lbl + '_lat']),
+                                         numpy.asarray(srcGeom[lbl + '_lon']))
+        rows.append(numpy.asarray(row, dtype=numpy.float64).ravel())
+        cols.append(numpy.asarray(col, dtype=numpy.float64).ravel())
+    (rows, cols) = (numpy.column_stack(rows), numpy.column_stack(cols))
+    # only source cells with every corner projected that may reach the
+    # target domain are intersected
+    with numpy.errstate(invalid='ignore'):
+        near = (numpy.isfinite(rows).all(axis=1) &
+                numpy.isfinite(cols).all(axis=1) &
+                (rows.max(axis=1) > dstMinRow) &
+                (rows.min(axis=1) < dstMaxRow + 1) &
+                (cols.max(axis=1) > dstMinCol) &
+                (cols.min(axis=1) < dstMaxCol + 1))
+    gridPolys = map_helpers.rect_grid_polys(dstLims)
+    (srcCells, dstCells, fracs) = ([], [], [])
+    for cell in numpy.flatnonzero(near):
+        poly = geom.MultiPoint(zip(rows[cell], cols[cell])).convex_hull
+        if not poly.area > 0:
+            continue
+        for key in map_helpers.get_possible_cells(dstLims, poly):
+            overlap = gridPolys[key].intersection(poly).area
+            if overlap > 0:
+                srcCells.append(cell)
+                dstCells.append((key[0] - dstMinRow)*dstNCols +
+                                key[1] - dstMinCol)
+                fracs.append(overlap/poly.area)
+    return (numpy.array(srcCells, dtype=numpy.int64),
+            numpy.array(dstCells, dtype=numpy.int64), numpy.array(fracs))
+
+def compute_weight_matrix(srcDef, dstDef, cacheDir=None):
+    '''
+    Compute the WeightMatrix from srcDef to dstDef.  The geometry of
+    the grids is loaded through grid_cache, with cacheDir
+    '''
+    srcGeom = grid_cache.load_grid_geometry(srcDef, cacheDir)
+    dstGeom = grid_cache.load_grid_geometry(dstDef, cacheDir)
+    if isinstance(srcDef, grid_geo.latlon_GridDef) and \
+       isinstance(dstDef, grid_geo.latlon_GridDef):
+        (srcCells, dstCells, fracs) = _latlon_overlaps(srcDef, dstDef)
+    else:
+        (srcCells, dstCells, fracs) = _polygon_overlaps(srcDef, dstDef,
+                                                        srcGeom)
+    srcArea = numpy.asarray(srcGeom['area']).ravel()
+    return WeightMatrix.from_overlaps(srcCells, dstCells,
+                                      fracs*srcArea[srcCells],
+                                      dstGeom['area'], _grid_shape(srcDef),
+                                      _grid_shape(dstDef))
+
+def _read_matrix(path):
+    '''Load the matrix stored in path.  Returns None if any array is missing'''
+    try:
+        arrays = dict([(name, numpy.load(os.path.join(path, name + '.npy'),
+                                         mmap_mode='r'))
+                       for name in MATRIX_ARRAYS])
+    except (IOError, ValueError):
+        return None
+    shapes = tuple(arrays.pop('shapes'))
+    return WeightMatrix(srcShape=shapes[:2], dstShape=shapes[2:], **arrays)
+
+def load_weight_matrix(srcDef, dstDef, cacheDir=None):
+    '''
+    Return the WeightMatrix from srcDef to dstDef.
+
+    The last few matrices are kept in memory.  If cacheDir is
+    given, they are read from (or, the first time, written to) that
+    directory as well, next to the grid geometry (see grid_cache)
+    '''
+    key = matrix_key(srcDef, dstDef)
+    if key in _loaded:
+        return _loaded.get(key)
+    matrix = None
+    if cacheDir is not None:
+        path = os.path.join(cacheDir, 'regrid_{0}_{1}_{2}'.format(
+                srcDef.__class__.__name__, dstDef.__class__.__name__, key))
+        matrix = _read_matrix(path)
+        if matrix is None:
+            matrix = compute_weight_matrix(srcDef, dstDef, cacheDir)
+            try:
+                grid_cache.write_arrays(path, matrix.arrays())
+            except (IOError, OSError):
+                # fine if another process wrote the same matrix first
+                if not os.path.isdir(path):
+                    print('Warning: unable to write weight matrix to '
+                          '{0}'.format(path))
+    if matrix is None:
+        matrix = compute_weight_matrix(srcDef, dstDef, cacheDir)
+    _loaded[key] = matrix
+    return matrix
+
+def griddef_from_file(fid):
+    '''
+    The GridDef of an output file open as fid, from the Projection
+    and grid parameter global attributes written by the output
+    functions.  Raises ValueError if they are missing
+    '''
+    try:
+        gridClass = getattr(grid_geo, str(fid.Projection) + '_GridDef')
+    except AttributeError:
+        raise ValueError('{0} does not name a valid projection'.format(
+                getattr(fid, 'Projection', 'The file')))
+    attrs = fid.ncattrs()
+    parms = dict([(k, getattr(fid, k)) for k in gridClass.parm_list()
+                  if k in attrs])
+    missing = [k for k in gridClass.parm_list() if k not in parms]
+    if missing:
+        raise ValueError('Missing grid attributes {0}'.format(
+                ', '.join(missing)))
+    return gridClass(parms)
+
+def regrid_file(inFname, outFname, dstDef, variables=None, cacheDir=None,
+                minCoverage=0.):
+    '''
+    Regrid the output file inFname onto dstDef, writing outFname.
+
+    variables are the names of the gridded variables to regrid (every
+    gridded variable if None).  Gridded variables have "row" and "col"
+    as their first dimensions, or are gathered along "cell" (see
+    out_geo).  They are regridded as area weighted averages (see
+    WeightMatrix.apply), except that counts (see is_count_variable)
+    are summed (see WeightMatrix.apply_sum), minima and maxima are
+    taken over the overlapping cells (see WeightMatrix.apply_extreme)
+    and the variance, std and moment state of cell statistics (see
+    stat_variable) are rebuilt from the merged moments (see
+    WeightMatrix.apply_moments).  The variance and std can only be
+    regridded from a file holding the moment state.  minCoverage only
+    applies to the averages.  Regridded variables are written as
+    doubles with the same fill value and attributes.  Variables that
+    are not gridded are copied.
+    Global attributes are copied, except that the grid attributes
+    describe dstDef.  Returns the regridded arrays, keyed to name.
+    '''
+    inFid = netCDF4.Dataset(inFname, 'r')
+    try:
+        srcDef = griddef_from_file(inFid)
+        srcShape = _grid_shape(srcDef)
+        gridded = [name for (name, var) in inFid.variables.iteritems()
+                   if var.dimensions[:2] == ('row', 'col') or
+                   (var.dimensions[:1] == ('cell',) and name != 'cell')]
+        if variables is None:
+            variables = gridded
+        notGridded = [name for name in variables if name not in gridded]
+        if notGridded:
+            raise ValueError('Not gridded variables of {0}: {1}'.format(
+                    inFname, ', '.join(notGridded)))
+        if 'row' in inFid.dimensions and \
+           (len(inFid.dimensions['row']), len(inFid.dimensions['col'])) != \
+           srcShape:
+            raise ValueError('The grid of {0} does not match its grid '
+                             'attributes'.format(inFname))
+        matrix = load_weight_matrix(srcDef, dstDef, cacheDir)
+
+        outFid = netCDF4.Dataset(outFname, 'w', format=inFid.file_format)
+        for attr in inFid.ncattrs():
+            if attr not in srcDef.parm_list():
+                setattr(outFid, attr, getattr(inFid, attr))
+        setattr(outFid, 'Projection', dstDef.__class__.__name__[:-8])
+        for k in dstDef.parm_list():
+            setattr(outFid, k, dstDef.parms[k])
+        setattr(outFid, 'Regridded_from', '{0} ({1} grid)'.format(
+                os.path.basename(inFname), str(inFid.Projection)))
+        outFid.createDimension('row', matrix.dstShape[0])
+        outFid.createDimension('col', matrix.dstShape[1])
+        for (name, dim) in inFid.dimensions.iteritems():
+            if name not in ('row', 'col', 'cell'):
+                outFid.createDimension(name, len(dim))
+        srcArea = grid_cache.load_grid_geometry(srcDef, cacheDir)['area']
+        # the regridded moments of each variable with statistics
+        moments = dict()
+        regridded = dict()
+        for (name, var) in inFid.variables.iteritems():
+            if name == 'cell' or (name in gridded and name not in variables):
+                continue
+            fillVal = getattr(var, '_FillValue', None)
+            if name in variables:
+                dims = ('row', 'col') + tuple(d for d in var.dimensions
+                                              if d not in ('row', 'col',
+                                                           'cell'))
+                outVar = outFid.createVariable(name, 'd', dims,
+                                               fill_value=fillVal)
+            else:
+                outVar = outFid.createVariable(name, var.dtype,
+                                               var.dimensions,
+                                               fill_value=fillVal)
+            for attr in var.ncattrs():
+                if attr != '_FillValue':
+                    setattr(outVar, attr, getattr(var, attr))
+            if name in variables:
+                vals = numpy.ma.filled(
+                    tiling.gridded_values(inFid, name, srcShape),
+                    numpy.NaN if fillVal is None else fillVal)
+                stat = stat_variable(name, inFid.variables)
+                if is_count_variable(name, var):
+                    regridded[name] = matrix.apply_sum(vals, srcArea, fillVal)
+                elif stat in ('min', 'max'):
+                    regridded[name] = matrix.apply_extreme(vals, stat, fillVal)
+                elif stat is not None:
+                    base = name[:-len(stat) - 1]
+                    if base not in moments:
+                        moments[base] = _regrid_moments(inFid, base, matrix,
+                                                        srcShape, srcArea)
+                    regridded[name] = moments[base][stat]
+                else:
+                    regridded[name] = matrix.apply(vals, fillVal, minCoverage)
+                outVar[:] = regridded[name]
+            else:
+                outVar[:] = var[:]
+        outFid.close()
+    finally:
+        inFid.close()
+    return regridded
@@ -0,0 +1,95 @@
+'''
+Restriction of granules to the scanlines inside a time window.
+
+Output functions compare the time of each pixel against their
+time window only after the whole swath has been mapped, so a
+narrow window still maps (and reads) every pixel of a granule.
+Within a granule, the time of each scanline does not decrease,
+so the scanlines inside a window can instead be found with a
+binary search over the scanline times (see get_scanline_times
+in parse_geo) before mapping.
+
+Scanlines with a NaN time are kept, since the output functions
+consider pixels with a NaN timestamp to be inside their window
+(see utils.time_window_mask).  The window should already allow
+for local time comparisons (see utils.time_window).
+'''
+import numpy
+
+def scanline_range(times, window):
+    '''
+    The range [first, stop) of the scanlines whose times lie within
+    window, a tuple (timeStart, timeStop).  NaN times are ignored.
+    If the finite times decrease anywhere, the whole range is
+    returned, since a binary search would be unreliable.
+    '''
+    times = numpy.asarray(times, dtype=numpy.float64)
+    valid = numpy.flatnonzero(numpy.isfinite(times))
+    if valid.size == 0:
+        return (0, 0)
+    validTimes = times[valid]
+    if numpy.any(numpy.diff(validTimes) < 0):
+        return (0, times.size)
+    lo = numpy.searchsorted(validTimes, window[0], side='left')
+    hi = numpy.searchsorted(validTimes, window[1], side='right')
+    if lo >= hi:
+        return (0, 0)
+    return (int(valid[lo]), int(valid[hi-1])+1)
+
+def window_scanlines(times, window):
+    '''
+    The indices of the scanlines that must be kept for window: those
+    within scanline_range, and every scanline with a NaN time.
+    '''
+    times = numpy.asarray(times, dtype=numpy.float64)
+    (first, stop) = scanline_range(times, window)
+    keep = numpy.isnan(times)
+    keep[first:stop] = True
+    return numpy.flatnonzero(keep)
+
+class ScanlineParser(object):
+    '''
+    Stand in for a parser, restricted to a subset of its scanlines.
+
+    get_geo_corners, get_geo_centers and get_scanline_times only
+    return the selected scanlines.  Everything else is passed
+    through to the underlying parser, and the ind field of the
+    geolocation is unchanged, so pixel indices still refer to the
+    whole granule.
+    '''
+    def __init__(self, parser, sel):
+        self._parser = parser
+        self._sel = sel
+    def __getattr__(self, name):
+        return getattr(self._parser, name)
+    def get_geo_corners(self):
+        return self._parser.get_geo_corners()[self._sel]
+    def get_geo_centers(self):
+        return self._parser.get_geo_centers()[self._sel]
+    def get_scanline_times(self):
+        return self._parser.get_scanline_times()[self._sel]
+    def __enter__(self):
+        self._parser.__enter__()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._parser.__exit__(exc_type, exc_value, traceback)
+
+def restrict_to_window(parser, window):
+    '''
+    Restrict parser to the scanlines that may fall within window,
+    a tuple (timeStart, timeStop) in TAI93 seconds.
+
+    Returns parser itself if it does not provide scanline times or
+    every scanline is needed, a ScanlineParser if only some are,
+    and None if the granule lies entirely outside the window.
+    '''
+    try:
+        times = parser.get_scanline_times()
+    except NotImplementedError:
+        return parser
+    sel = window_scanlines(times, window)
+    if sel.size == 0:
+        return None
+    if sel.size == times.size:
+        return parser
+    return ScanlineParser(parser, sel)
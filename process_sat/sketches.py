@@ -0,0 +1,157 @@
+'''
+Mergeable quantile sketches, kept for many cells at once.
+
+Medians and percentiles cannot be accumulated like sums: computing
+them exactly means keeping every value.  A sketch keeps at most
+sketchSize centroids instead, each a (mean, count) pair, in order
+of their means.  Values (or the centroids of another sketch) are
+merged in by sorting them together with the centroids already kept
+and, where there are then more than sketchSize entries, pooling
+runs of neighbouring entries into sketchSize bins holding equal
+counts.  Each pooling moves values by at most about 1/sketchSize of
+the values in the sketch in rank, however many values are added.
+Since merging only depends on the values and counts, sketches
+built in separate passes (IE over separate sets of granules) can
+be merged into one, including sketches written out by earlier runs
+(see QuantileSketches.load).
+
+Quantiles are interpolated between the midpoints of the ranks of
+the centroids.  A sketch holding no more values than sketchSize
+gives exact quantiles by that definition (the median of an even
+number of values is the mean of the middle two).
+
+A set of sketches is updated for many keys (IE gridcells) at once
+with whole array operations, and its arrays are allocated through
+an accumulator backend (see accumulators.py).
+'''
+import numpy
+
+# the default number of centroids per sketch
+DEFAULT_SIZE = 100
+
+class QuantileSketches(object):
+    '''
+    One quantile sketch for each of nKeys keys.  The centroids are
+    held in the arrays means and counts, of shape (nKeys, sketchSize)
+    and allocated through backend.  Unused slots have a count of 0.
+    '''
+    def __init__(self, backend, nKeys, sketchSize=DEFAULT_SIZE):
+        if sketchSize < 1:
+            raise ValueError('sketchSize must be positive')
+        self.sketchSize = sketchSize
+        self.means = backend.zeros((nKeys, sketchSize))
+        self.counts = backend.zeros((nKeys, sketchSize))
+    @staticmethod
+    def load(backend, means, counts):
+        '''
+        The sketches with the centroids means and counts, arrays with
+        the slots of each sketch along their last axis (IE as written
+        to an output file), so that they can be merged with others
+        '''
+        counts = numpy.asarray(counts, dtype=numpy.float64)
+        sketchSize = counts.shape[-1]
+        counts = counts.reshape(-1, sketchSize)
+        sk = QuantileSketches(backend, counts.shape[0], sketchSize)
+        sk.means[:] = numpy.asarray(means, 
+                                    dtype=numpy.float64).reshape(counts.shape)
+        sk.counts[:] = counts
+        return sk
+    def add(self, keys, values, counts=None):
+        '''
+        Merge values into the sketches of keys (one key per value).
+        counts is the number of values each of values stands for
+        (default 1).  NaN values are ignored.
+        '''
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        keys = numpy.asarray(keys, dtype=numpy.int64).ravel()
+        if counts is None:
+            counts = numpy.ones(values.shape)
+        counts = numpy.asarray(counts, dtype=numpy.float64).ravel()
+        use = numpy.logical_not(numpy.isnan(values)) & (counts > 0)
+        (keys, values, counts) = (keys[use], values[use], counts[use])
+        touched = numpy.unique(keys)
+        if not touched.size:
+            return
+        size = self.sketchSize
+        # sort the centroids already kept for the keys touched together
+        # with the new values, by key and then value
+        oldCounts = numpy.asarray(self.counts[touched])
+        oldMeans = numpy.asarray(self.means[touched])
+        (oldRow, oldSlot) = numpy.nonzero(oldCounts)
+        allKeys = numpy.concatenate((touched[oldRow], keys))
+        allVals = numpy.concatenate((oldMeans[oldRow, oldSlot], values))
+        allCounts = numpy.concatenate((oldCounts[oldRow, oldSlot], counts))
+        order = numpy.lexsort((allVals, allKeys))
+        (allKeys, allVals, allCounts) = (allKeys[order], allVals[order],
+                                         allCounts[order])
+        # the group (position in touched) of every entry, and its rank and
+        # the midpoint of its counts within the group
+        group = numpy.searchsorted(touched, allKeys)
+        start = numpy.searchsorted(allKeys, touched)
+        nEntries = numpy.diff(numpy.append(start, allKeys.size))
+        rank = numpy.arange(allKeys.size) - start[group]
+        before = numpy.cumsum(allCounts) - allCounts
+        total = numpy.zeros(touched.size)
+        numpy.add.at(total, group, allCounts)
+        mid = before - before[start][group] + allCounts/2.
+        # entries of groups with room for all of them keep their own
+        # slot.  Others are pooled into bins of equal count
+        pooled = numpy.minimum(numpy.floor(mid/total[group]*size), size - 1)
+        slot = numpy.where(nEntries[group] <= size, rank, pooled)
+        flat = group*size + slot.astype(numpy.int64)
+        newCounts = numpy.zeros(touched.size*size)
+        newSums = numpy.zeros(touched.size*size)
+        numpy.add.at(newCounts, flat, allCounts)
+        numpy.add.at(newSums, flat, allCounts*allVals)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            newMeans = numpy.where(newCounts > 0, newSums/newCounts, 0)
+        self.counts[touched] = newCounts.reshape(touched.size, size)
+        self.means[touched] = newMeans.reshape(touched.size, size)
+    def merge(self, other):
+        '''Merge the sketches of other, which has the same keys, into these'''
+        (rows, slots) = numpy.nonzero(numpy.asarray(other.counts))
+        self.add(rows, numpy.asarray(other.means)[rows, slots],
+                 numpy.asarray(other.counts)[rows, slots])
+    def total(self, rows):
+        '''The number of values in the sketches of rows (a slice)'''
+        return numpy.asarray(self.counts[rows]).sum(axis=1)
+    def quantiles(self, rows, qs, fillVal=numpy.NaN):
+        '''
+        The quantiles qs (fractions from 0 to 1) of the sketches of
+        rows (a slice), as an array of shape (number of rows, len(qs)).
+        Sketches holding no values give fillVal.
+        '''
+        counts = numpy.asarray(self.counts[rows])
+        means = numpy.asarray(self.means[rows])
+        nRows = counts.shape[0]
+        out = numpy.empty((nRows, len(qs)))
+        out.fill(fillVal)
+        (row, slot) = numpy.nonzero(counts)
+        if not row.size:
+            return out
+        (c, m) = (counts[row, slot], means[row, slot])
+        # the midpoint of the counts of each centroid, as a fraction of
+        # the values in its sketch, offset by the row so that the
+        # positions increase through every sketch in turn
+        total = counts.sum(axis=1)
+        start = numpy.searchsorted(row, numpy.arange(nRows))
+        before = numpy.cumsum(c) - c
+        pos = row + (before - before[numpy.minimum(start, row.size - 1)][row]
+                     + c/2.)/total[row]
+        filled = total > 0
+        target = numpy.arange(nRows)[filled]
+        for (j, q) in enumerate(qs):
+            want = target + q
+            hi = numpy.searchsorted(pos, want)
+            lo = hi - 1
+            # clamp to the first and last centroids of each sketch
+            hiOut = (hi >= row.size) | \
+                (row[numpy.minimum(hi, row.size - 1)] != target)
+            loOut = (lo < 0) | (row[numpy.maximum(lo, 0)] != target)
+            hi = numpy.where(hiOut, lo, hi)
+            lo = numpy.where(loOut, hi, lo)
+            span = pos[hi] - pos[lo]
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                frac = numpy.where(span > 0, (want - pos[lo])/span, 0)
+            out[filled, j] = m[lo] + (m[hi] - m[lo])*frac
+        return out
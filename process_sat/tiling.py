@@ -0,0 +1,253 @@
+'''
+Tile-decomposed mapping and output for very large grids.
+
+For very large grids the map and the output accumulators
+for the whole grid may not fit in memory.  The functions here
+split the grid into rectangular tiles and run the mapping
+and output functions one tile at a time, optionally in
+several worker processes.  Each tile is written to its own
+file and the tile files are then stitched into the final
+output.  Memory use in each worker is bounded by the tile
+size rather than the size of the grid.
+
+Pixels are routed to tiles by the bounding box of their
+gridded coordinates, so a pixel straddling tile edges is
+given to every tile it may touch.  Every gridcell belongs
+to exactly one tile, so the stitched output matches what
+an untiled run would produce.
+
+Stitching assumes the output functions write netCDF files
+in which every gridded variable has 'row' and 'col' as its
+first two dimensions, or is gathered along a 'cell' dimension
+(see out_geo).  Gathered tiles are scattered back onto the
+grid, so the stitched output is never gathered.  Variables
+without those dimensions are copied from the first tile.
+'''
+import os
+import shutil
+import tempfile
+import datetime
+import multiprocessing
+
+import numpy
+
+import lazy
+
+netCDF4 = lazy.LazyModule('netCDF4')
+
+def split_tiles((minRow, maxRow, minCol, maxCol), tileRows, tileCols):
+    '''
+    Split the index limits of a grid into tiles of at most
+    tileRows x tileCols cells.  Returns a list of index limits
+    in the format of indLims, in row-major order
+    '''
+    tiles = []
+    for r0 in range(minRow, maxRow+1, tileRows):
+        for c0 in range(minCol, maxCol+1, tileCols):
+            tiles.append((r0, min(r0+tileRows-1, maxRow),
+                          c0, min(c0+tileCols-1, maxCol)))
+    return tiles
+
+def route_pixels(geoStruct, griddef, tiles):
+    '''
+    Decide which pixels may touch each tile.
+
+    geoStruct is the output of a parser's get_geo_corners or
+    get_geo_centers.  Returns a list, co-indexed to tiles, of arrays
+    of the positions in the flattened geoStruct of the pixels whose
+    gridded bounding box overlaps the tile.  Pixels with NaN
+    coordinates are not routed anywhere.
+    '''
+    flat = geoStruct.reshape(-1)
+    lat = flat['lat'].reshape(flat.size, -1)
+    lon = flat['lon'].reshape(flat.size, -1)
+    (row, col) = griddef.geoToGridded(lat, lon)
+    row = numpy.asarray(row, dtype=numpy.float64).reshape(lat.shape)
+    col = numpy.asarray(col, dtype=numpy.float64).reshape(lat.shape)
+    with numpy.errstate(invalid='ignore'):
+        minRow = numpy.floor(row.min(axis=1))
+        maxRow = numpy.floor(row.max(axis=1))
+        minCol = numpy.floor(col.min(axis=1))
+        maxCol = numpy.floor(col.max(axis=1))
+        return [numpy.nonzero((maxRow >= r0) & (minRow <= r1) &
+                              (maxCol >= c0) & (minCol <= c1))[0]
+                for (r0, r1, c0, c1) in tiles]
+
+class TileParser(object):
+    '''
+    Stand in for a parser, restricted to the pixels routed to
+    one tile.
+
+    The geolocation of those pixels is handed out by get_geo_corners
+    or get_geo_centers (whichever was used for routing).  Everything
+    else is passed through to the underlying parser, so pixel indices
+    are unchanged.
+    '''
+    def __init__(self, parser, geoKind, geoStruct, sel):
+        self._parser = parser
+        self._geoKind = geoKind
+        self._geoStruct = geoStruct
+        self._sel = sel
+    def __getattr__(self, name):
+        return getattr(self._parser, name)
+    def _subset(self, kind):
+        if kind == self._geoKind:
+            return self._geoStruct.reshape(-1)[self._sel]
+        # the pixels were routed by the other kind of geolocation
+        return getattr(self._parser, 'get_geo_' + kind)().reshape(-1)[self._sel]
+    def get_geo_corners(self):
+        return self._subset('corners')
+    def get_geo_centers(self):
+        return self._subset('centers')
+    def __enter__(self):
+        self._parser.__enter__()
+        return self
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._parser.__exit__(exc_type, exc_value, traceback)
+
+def stitch_netcdf(tileFiles, tiles, fullLims, outFname):
+    '''
+    Combine the netCDF files written for each tile into a single file
+    for the whole grid.  Cells not covered by any tile are left at the
+    fill value of each variable
+    '''
+    (minRow, maxRow, minCol, maxCol) = fullLims
+    first = netCDF4.Dataset(tileFiles[0], 'r')
+    outFid = netCDF4.Dataset(outFname, 'w', format=first.file_format)
+    for (name, dim) in first.dimensions.iteritems():
+        if name == 'row':
+            outFid.createDimension(name, maxRow-minRow+1)
+        elif name == 'col':
+            outFid.createDimension(name, maxCol-minCol+1)
+        elif name != 'cell':
+            outFid.createDimension(name, len(dim))
+    for attr in first.ncattrs():
+        setattr(outFid, attr, getattr(first, attr))
+    gridded = []
+    for (name, var) in first.variables.iteritems():
+        if name == 'cell':
+            continue
+        dims = var.dimensions
+        if dims[:1] == ('cell',):
+            dims = ('row', 'col') + dims[1:]
+        fillVal = getattr(var, '_FillValue', None)
+        outVar = outFid.createVariable(name, var.dtype, dims,
+                                       fill_value=fillVal)
+        for attr in var.ncattrs():
+            if attr != '_FillValue':
+                setattr(outVar, attr, getattr(var, attr))
+        if dims[:2] == ('row', 'col'):
+            gridded.append(name)
+        else:
+            outVar[:] = var[:]
+    first.close()
+    for (fname, (r0, r1, c0, c1)) in zip(tileFiles, tiles):
+        tileFid = netCDF4.Dataset(fname, 'r')
+        for name in gridded:
+            outFid.variables[name][r0-minRow:r1-minRow+1,
+                                   c0-minCol:c1-minCol+1] = \
+                gridded_values(tileFid, name, (r1-r0+1, c1-c0+1))
+        tileFid.close()
+    outFid.close()
+
+def gridded_values(fid, name, (nRows, nCols)):
+    '''
+    The values of gridded variable name of an output file open as
+    fid, on its nRows x nCols grid (IE the grid of a tile).  Gathered
+    variables are scattered onto the grid, with the fill value in the
+    cells absent.
+    '''
+    var = fid.variables[name]
+    if var.dimensions[:1] != ('cell',):
+        return var[:]
+    vals = numpy.asarray(var[:])
+    gridVals = numpy.empty((nRows*nCols,) + vals.shape[1:], dtype=vals.dtype)
+    gridVals.fill(getattr(var, '_FillValue', 0))
+    gridVals[numpy.asarray(fid.variables['cell'][:])] = vals
+    return gridVals.reshape((nRows, nCols) + vals.shape[1:])
+
+# the job shared with the worker processes.  Workers are forked
+# after this is set, so they inherit it rather than having the
+# parsers and grid pickled
+_job = None
+
+def _run_tile(tileNum):
+    '''Map and write all outputs for one tile.  Returns the filenames'''
+    (griddef, tiles, routed, mapFunc, outputs, tmpDir, verbose,
+     version) = _job
+    tileDef = griddef.tile(tiles[tileNum])
+    if verbose:
+        print('Processing tile {0} of {1} {2} at {3}'.format(
+                tileNum+1, len(tiles), tiles[tileNum],
+                str(datetime.datetime.now())))
+    maps = [mapFunc(TileParser(parser, geoKind, geoStruct, sels[tileNum]),
+                    tileDef, verbose)
+            for (parser, geoKind, geoStruct, sels) in routed]
+    fnames = []
+    for (i, (func, parms, unused_fname)) in enumerate(outputs):
+        fname = os.path.join(tmpDir, 'tile{0}_out{1}.nc'.format(tileNum, i))
+        result = func(dict(parms))(maps, tileDef, fname, verbose, version)
+        del(result)
+        fnames.append(fname)
+    return fnames
+
+def run_tiled(parsers, griddef, mapFunc, outputs, tileShape, nWorkers=1,
+              verbose=True, version=None):
+    '''
+    Map parsers onto griddef and write every output, one tile at a time.
+
+    Inputs:
+        parsers - the parsers for the input files
+        griddef - an instantiated GridDef for the whole grid
+        mapFunc - the mapping function
+        outputs - list of (output function class, parameter dict,
+            output filename) tuples
+        tileShape - (rows, cols), the largest tile size
+        nWorkers - the number of worker processes.  If 1, the tiles
+            are processed one after another in this process
+        verbose - passed to the map and output functions
+        version - passed to the output functions
+    '''
+    global _job
+    fullLims = griddef.indLims()
+    tiles = split_tiles(fullLims, tileShape[0], tileShape[1])
+    if verbose:
+        print('Routing pixels to {0} tiles at {1}'.format(
+                len(tiles), str(datetime.datetime.now())))
+    routed = []
+    for parser in parsers:
+        # route by corners where the parser has them, otherwise centers
+        try:
+            (geoKind, geoStruct) = ('corners', parser.get_geo_corners())
+        except NotImplementedError:
+            (geoKind, geoStruct) = ('centers', parser.get_geo_centers())
+        routed.append((parser, geoKind, geoStruct,
+                       route_pixels(geoStruct, griddef, tiles)))
+    # keep the tile files next to the output
+    tmpDir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(
+                outputs[0][2])))
+    try:
+        _job = (griddef, tiles, routed, mapFunc, outputs, tmpDir,
+                verbose, version)
+        if nWorkers > 1:
+            # one tile per worker process keeps memory use bounded
+            pool = multiprocessing.Pool(nWorkers, maxtasksperchild=1)
+            try:
+                tileFiles = pool.map(_run_tile, range(len(tiles)), chunksize=1)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            tileFiles = [_run_tile(i) for i in range(len(tiles))]
+        _job = None
+        if verbose:
+            print('Stitching tiles at {0}'.format(str(datetime.datetime.now())))
+        for (i, (unused_func, unused_parms, fname)) in enumerate(outputs):
+            stitch_netcdf([files[i] for files in tileFiles], tiles,
+                          fullLims, fname)
+    finally:
+        _job = None
+        shutil.rmtree(tmpDir, ignore_errors=True)
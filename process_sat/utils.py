@@ -10,25 +10,34 @@ import calendar
 from itertools import izip
 
 import numpy
-import netCDF4
 
+import lazy
 import filetypes
+import grid_cache
+
+netCDF4 = lazy.LazyModule('netCDF4')
 
 def wrap_lon_0_360(lon):
-    '''Wrap a single longitude to the interval [0, 360)'''
-    while lon < 0:
-        lon += 360
-    while lon >= 360:
-        lon -= 360
-    return lon
+    '''
+    Wrap longitudes to the interval [0, 360).  Accepts either a single
+    longitude or a numpy array of longitudes.
+    '''
+    wrapped = numpy.mod(lon, 360)
+    # mod of a tiny negative longitude can round up to 360
+    wrapped = numpy.where(wrapped >= 360, wrapped-360, wrapped)
+    # return a scalar when given a scalar
+    return wrapped[()]
 
 def wrap_lon_neg180_180(lon):
-    '''Wrap a single longitude to the interval (-180, 180]'''
-    while lon <= -180:
-        lon += 360
-    while lon > 180:
-        lon -= 360
-    return lon
+    '''
+    Wrap longitudes to the interval (-180, 180].  Accepts either a single
+    longitude or a numpy array of longitudes.
+    '''
+    wrapped = 180 - numpy.mod(180 - numpy.asarray(lon), 360)
+    # mod can round up to 360 for values just short of the boundary
+    wrapped = numpy.where(wrapped <= -180, wrapped+360, wrapped)
+    # return a scalar when given a scalar
+    return wrapped[()]
 
 def timestr_to_nsecs(timestr, 
                      epoch='00:00:00 01-01-1970', 
@@ -76,6 +85,34 @@ def nsecs_to_timestr(nSecsSinceEpoch,
     tStructUnix = time.gmtime(nSecsUnix)
     return time.strftime(format, tStructUnix)
     
+# padding added to the time window of a run, in seconds, since some
+# time estimates (IE from file metadata) do not include leap seconds
+TIME_PAD = 60
+# local times differ from UTC by up to 12 hours (see UTCoffset_from_lon)
+LOCAL_TIME_PAD = 12*60*60
+
+def time_window(outputs):
+    '''
+    The UTC time window (timeStart, timeStop) in TAI93 seconds covering
+    every output, given as a list of output parameter dictionaries.
+    Outputs comparing local times widen the window by the largest
+    offset from UTC.  Returns None if any output is not restricted 
+    in time.
+    '''
+    starts = []
+    stops = []
+    for parms in outputs:
+        if 'timeStart' not in parms or 'timeStop' not in parms:
+            return None
+        pad = TIME_PAD
+        if str(parms.get('timeComparison', 'UTC')).lower() == 'local':
+            pad += LOCAL_TIME_PAD
+        starts.append(parms['timeStart'] - pad)
+        stops.append(parms['timeStop'] + pad)
+    if not starts:
+        return None
+    return (min(starts), max(stops))
+
 def UTCoffset_from_lon(lon):
     '''
     Calculate the approximate offset from UTC based on longitude.
@@ -86,10 +123,47 @@ def UTCoffset_from_lon(lon):
     algorithm based on simply the longitude, and therefore
     does not account for actual political timezones.
     
-    Longitude assumed to be in degrees.
+    Longitude assumed to be in degrees.  Accepts either a single 
+    longitude or a numpy array of longitudes.  Half hours are rounded
+    away from zero.
     '''
     hours2secs = 60*60
-    return hours2secs*round(wrap_lon_neg180_180(lon)/15.0)
+    hours = numpy.asarray(wrap_lon_neg180_180(lon))/15.0
+    offset = hours2secs*numpy.sign(hours)*numpy.floor(numpy.abs(hours)+0.5)
+    # return a scalar when given a scalar
+    return offset[()]
+
+def time_window_mask(times, lons, timeStart, timeStop, local=False):
+    '''
+    Compute, for a whole granule at once, which pixels fall within
+    the window [timeStart, timeStop].
+
+    Inputs:
+        times - array of timestamps.  May have fewer dimensions than 
+            lons (IE one timestamp per scanline), in which case the 
+            leading dimensions must match those of lons.
+        lons - array of longitudes at pixel centers, in degrees.  The
+            mask is returned in the shape of this array.
+        timeStart, timeStop - limits of the window, in the same 
+            format as times
+        local - if True, the timestamps are converted to approximate
+            local time using UTCoffset_from_lon before comparison
+
+    Outputs:
+        boolean array - True for pixels inside the window.  Pixels 
+            with a NaN timestamp are considered inside the window.
+    '''
+    times = numpy.asarray(times, dtype=numpy.float64)
+    lons = numpy.asarray(lons)
+    # broadcast the times against any trailing dimensions of lons
+    times = times.reshape(times.shape + (1,)*(lons.ndim-times.ndim))
+    times = times + numpy.zeros(lons.shape)
+    if local:
+        times = times + UTCoffset_from_lon(lons)
+    # NaN comparisons are False, so NaN timestamps stay in the window
+    with numpy.errstate(invalid='ignore'):
+        outside = numpy.logical_or(times < timeStart, times > timeStop)
+    return numpy.logical_not(outside)
 
 def find_occurences(superArray, subArray):
     '''
@@ -100,7 +174,7 @@ def find_occurences(superArray, subArray):
     '''
     return numpy.apply_along_axis(numpy.array_equal, -1, superArray, subArray)
 
-def write_grid_to_netcdf(griddef, outFname):
+def write_grid_to_netcdf(griddef, outFname, cacheDir=None):
     '''
     Function to create netCDF files that contain
     the lat/lon data needed to plot for a given grid 
@@ -109,30 +183,28 @@ def write_grid_to_netcdf(griddef, outFname):
     Inputs:
         griddef - an instantiated griddef object
         outFname - a path to the outfile (will be clobbered)
+        cacheDir - optionally, a directory in which to cache
+            the grid geometry (see grid_cache)
     '''
-    (minRow, maxRow, minCol, maxCol) = griddef.indLims()
-    nRows = maxRow-minRow+1
-    nCols = maxCol-minCol+1
-    # create the index vectors we need to make grids
-    (cols, rows) = numpy.meshgrid(numpy.arange(minCol, maxCol+1), 
-                                  numpy.arange(minRow, maxRow+1))
-    cols = cols.astype(numpy.float32) # cast as precaution
-    rows = rows.astype(numpy.float32)
+    geom = grid_cache.load_grid_geometry(griddef, cacheDir)
+    (nRows, nCols) = geom['cent_lat'].shape
     # write out netcdf
     fid = netCDF4.Dataset(outFname, 'w', format='NETCDF3_CLASSIC')
     # create dimensions and variables
     fid.createDimension('row', nRows)
     fid.createDimension('col', nCols)
     dims = ('row', 'col')
-    # create the 5 grid definitions
-    offsets = [(0,0), (1,0), (1,1), (0,1), (.5,.5)] # row,col
-    labels = ['ll', 'ul', 'ur', 'lr', 'cent']
-    for (lbl, (rowOff, colOff)) in izip(labels,offsets):
+    # write out the 5 grid definitions
+    for (lbl, unused_off) in grid_cache.CELL_POINTS:
         lon = fid.createVariable(lbl+'_lon', 'f', dims)
         setattr(lon, 'Units', 'degrees_east')
         lat = fid.createVariable(lbl+'_lat', 'f', dims)
         setattr(lat, 'Units', 'degrees_north')
-        (lat[:], lon[:]) = griddef.griddedToGeo(rows+rowOff, cols+colOff)
+        lat[:] = geom[lbl+'_lat']
+        lon[:] = geom[lbl+'_lon']
+    area = fid.createVariable('cell_area', 'f', dims)
+    setattr(area, 'Units', 'km^2')
+    area[:] = geom['area']
     # write grid parameters to file as global attributes
     setattr(fid, 'Projection', griddef.__class__.__name__[:-8])
     for (k,v) in griddef.parms.iteritems():
@@ -146,9 +218,21 @@ def parse_fromFile_input_file(inFileName, dryRun):
     Generate and return a command line call
     that can be used to call whips
     with those parameter values.
+
+    Every OUTFUNC line after the first starts an additional output
+    block, and every GRIDPROJ line after the first starts an additional
+    grid block.  Attribute lines belong to the most recently started
+    block and OUTFILENAME lines to the most recently started output
+    block.  They are passed after the repeated --outFunc or --gridProj
+    flag.
     '''
     call = []
     attrs = []
+    # each block is (flags, attribute flag, attributes)
+    blocks = []
+    outBlocks = []
+    haveOutFunc = False
+    haveGridProj = False
     f = open(inFileName, 'r')
     s = f.readline()
     try:
@@ -157,7 +241,10 @@ def parse_fromFile_input_file(inFileName, dryRun):
                 while(s != ""):
                     s = f.readline()
                     if(s == "END\n"):
-                        return call + ["--projAttrs"] + attrs
+                        call = call + ["--projAttrs"] + attrs
+                        for (blockCall, attrFlag, blockAttrs) in blocks:
+                            call += blockCall + [attrFlag] + blockAttrs
+                        return call
                     if(s[0] == '.'):
                         continue
                     s = s.split('"')
@@ -175,39 +262,80 @@ def parse_fromFile_input_file(inFileName, dryRun):
                                  "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "FILELIST"):
                         call += ["--fileList"] + words[2:]
+                    elif(words[0] == "INCLUDE"):
+                        call += ["--include"] + words[2:]
+                    elif(words[0] == "EXCLUDE"):
+                        call += ["--exclude"] + words[2:]
+                    elif(words[0] == "RECURSIVE"):
+                        call += ["--recursive", 
+                                 "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "FILETYPE"):
                         call += ["--filetype", 
                                  "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "GRIDPROJ" and haveGridProj):
+                        # start an additional grid block
+                        blocks.append((["--gridProj", 
+                                        "{0}".format(' '.join(words[2:]))],
+                                       "--projAttrs", []))
                     elif(words[0] == "GRIDPROJ"):
+                        haveGridProj = True
                         call += ["--gridProj", 
                                  "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "MAPFUNC"):
                         call += ["--mapFunc", 
                                  "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "OUTFUNC" and haveOutFunc):
+                        # start an additional output block
+                        blocks.append((["--outFunc", 
+                                        "{0}".format(' '.join(words[2:]))],
+                                       "--outFuncAttrs", []))
+                        outBlocks.append(blocks[-1])
                     elif(words[0] == "OUTFUNC"):
+                        haveOutFunc = True
                         call += ["--outFunc",
                                  "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "OUTDIRECTORY"):
                         call += ["--outDirectory", 
                                  "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "OUTFILENAME" and outBlocks):
+                        outBlocks[-1][0].extend(["--outFileName", 
+                                              "{0}".format(' '.join(words[2:]))])
                     elif(words[0] == "OUTFILENAME"):
                         call += ["--outFileName", 
                                  "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "INCLUDEGRID"):
                         call += ["--includeGrid",
                                  "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "GRIDCACHE"):
+                        call += ["--gridCache",
+                                 "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "TILESHAPE"):
+                        call += ["--tileShape",
+                                 "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "NWORKERS"):
+                        call += ["--nWorkers",
+                                 "{0}".format(' '.join(words[2:]))]
+                    elif(words[0] == "CATALOG"):
+                        call += ["--catalog"] + (
+                            ["{0}".format(' '.join(words[2:]))]
+                            if words[2:] else [])
                     elif(words[0] == "VERBOSE"):
                         call += ["--verbose", 
                                  "{0}".format(' '.join(words[2:]))]
                     elif(words[0] == "INTERACTIVE"):
                         call += ["--interactive", 
                                  "{0}".format(' '.join(words[2:]))]
-                    elif(dryRun):
-                        attrs += ['"{0}:{1}"'.format(words[0], \
-                                                         ' '.join(words[2:]))]
                     else:
-                        attrs += ['{0}:{1}'.format(words[0], \
-                                                         ' '.join(words[2:]))]
+                        if(dryRun):
+                            attr = '"{0}:{1}"'.format(words[0], \
+                                                      ' '.join(words[2:]))
+                        else:
+                            attr = '{0}:{1}'.format(words[0], \
+                                                    ' '.join(words[2:]))
+                        if(blocks):
+                            blocks[-1][2].append(attr)
+                        else:
+                            attrs.append(attr)
                 break
             s = f.readline()
     except:
@@ -232,7 +360,9 @@ def parse_filetype(namespace):
         if attr == "parser":
             setattr(namespace, "filetype", getattr(filetype, attr))
         elif attr == "doutf":
-            setattr(namespace, "outFunc", getattr(filetype, attr))
+            # the default output function can be overridden with --outFunc
+            if getattr(namespace, "outFunc", None) is None:
+                setattr(namespace, "outFunc", getattr(filetype, attr))
         elif attr[0] == "_":
             pass
         else:
@@ -11,7 +11,8 @@ setup(name='WHIPS',
       author='Jacob Oberman, Keith Maki',
       author_email='taholloway@wisc.edu',
       packages=['process_sat'],
-      scripts=['process_sat/whips.py'],
+      scripts=['process_sat/whips.py', 'process_sat/ingest.py',
+               'process_sat/regrid.py'],
       url = 'http://www.sage.wisc.edu/download/WHIPS/WHIPS.html',
       download_url='http://github.com/Joberman/process_sat/downloads',
       classifiers=[